@@ -31,10 +31,12 @@ import file_io
 # This is the default cassandra connection port
 CASS_DEFAULT_PORT = 9160
 
-# Data consistency models available with cassandra
-CONSISTENCY_ONE = pycassa.cassandra.ttypes.ConsistencyLevel.ONE
-CONSISTENCY_QUORUM = pycassa.cassandra.ttypes.ConsistencyLevel.QUORUM
-CONSISTENCY_ALL = pycassa.cassandra.ttypes.ConsistencyLevel.ALL
+# The cassandra consistency level for each datastore consistency level
+CASSANDRA_CONSISTENCY = {
+  CONSISTENCY_ONE: pycassa.cassandra.ttypes.ConsistencyLevel.ONE,
+  CONSISTENCY_QUORUM: pycassa.cassandra.ttypes.ConsistencyLevel.QUORUM,
+  CONSISTENCY_ALL: pycassa.cassandra.ttypes.ConsistencyLevel.ALL
+}
 
 # The keyspace used for all tables
 KEYSPACE = "Keyspace1"
@@ -72,7 +74,8 @@ class DatastoreProxy(AppDBInterface):
     self.pool = pycassa.ConnectionPool(keyspace=KEYSPACE,
       timeout=CONNECTION_TIMEOUT, server_list=server_list, prefill=False)
 
-  def batch_get_entity(self, table_name, row_keys, column_names):
+  def batch_get_entity(self, table_name, row_keys, column_names,
+                       consistency=None):
     """
     Takes in batches of keys and retrieves their corresponding rows.
     
@@ -80,6 +83,8 @@ class DatastoreProxy(AppDBInterface):
       table_name: The table to access
       row_keys: A list of keys to access
       column_names: A list of columns to access
+      consistency: The consistency level to read at, or None for the
+        default of the table
     Returns:
       A dictionary of rows and columns/values of those rows. The format 
       looks like such: {key:{column_name:value,...}}
@@ -91,6 +96,7 @@ class DatastoreProxy(AppDBInterface):
     if not isinstance(table_name, str): raise TypeError("Expected a str")
     if not isinstance(column_names, list): raise TypeError("Expected a list")
     if not isinstance(row_keys, list): raise TypeError("Expected a list")
+    consistency = self.get_consistency(table_name, READ_OPERATION, consistency)
 
     try:
       ret_val = {}
@@ -100,7 +106,7 @@ class DatastoreProxy(AppDBInterface):
       results = client.multiget_slice(row_keys,
                                      path,
                                      slice_predicate,
-                                     CONSISTENCY_QUORUM)
+                                     CASSANDRA_CONSISTENCY[consistency])
 
       for row in row_keys:
         col_dic = {}
@@ -115,7 +121,8 @@ class DatastoreProxy(AppDBInterface):
       logging.exception(ex)
       raise AppScaleDBConnectionError("Exception on batch_get: %s" % str(ex))
 
-  def batch_put_entity(self, table_name, row_keys, column_names, cell_values):
+  def batch_put_entity(self, table_name, row_keys, column_names, cell_values,
+                       consistency=None):
     """
     Allows callers to store multiple rows with a single call. A row can 
     have multiple columns and values with them. We refer to each row as 
@@ -126,6 +133,8 @@ class DatastoreProxy(AppDBInterface):
       row_keys: A list of keys to store on
       column_names: A list of columns to mutate
       cell_values: A dict of key/value pairs
+      consistency: The consistency level to write at, or None for the
+        default of the table
     Raises:
       TypeError: If an argument passed in was not of the expected type.
       AppScaleDBConnectionError: If the batch_put could not be performed due to
@@ -135,6 +144,8 @@ class DatastoreProxy(AppDBInterface):
     if not isinstance(column_names, list): raise TypeError("Expected a list")
     if not isinstance(row_keys, list): raise TypeError("Expected a list")
     if not isinstance(cell_values, dict): raise TypeError("Expected a dic")
+    consistency = self.get_consistency(table_name, WRITE_OPERATION,
+                                       consistency)
 
     try:
       cf = pycassa.ColumnFamily(self.pool,table_name)
@@ -144,12 +155,14 @@ class DatastoreProxy(AppDBInterface):
         for cname in column_names:
           cols[cname] = cell_values[key][cname]
         multi_map[key] = cols
-      cf.batch_insert(multi_map, write_consistency_level=CONSISTENCY_QUORUM)
+      cf.batch_insert(multi_map,
+        write_consistency_level=CASSANDRA_CONSISTENCY[consistency])
     except Exception, ex:
       logging.exception(ex)
       raise AppScaleDBConnectionError("Exception on batch_insert: %s" % str(ex))
       
-  def batch_delete(self, table_name, row_keys, column_names=[]):
+  def batch_delete(self, table_name, row_keys, column_names=[],
+                   consistency=None):
     """
     Remove a set of rows cooresponding to a set of keys.
      
@@ -157,6 +170,8 @@ class DatastoreProxy(AppDBInterface):
       table_name: Table to delete rows from
       row_keys: A list of keys to remove
       column_names: Not used
+      consistency: The consistency level to write at, or None for the
+        default of the table
     Raises:
       TypeError: If an argument passed in was not of the expected type.
       AppScaleDBConnectionError: If the batch_delete could not be performed due
@@ -164,11 +179,13 @@ class DatastoreProxy(AppDBInterface):
     """ 
     if not isinstance(table_name, str): raise TypeError("Expected a str")
     if not isinstance(row_keys, list): raise TypeError("Expected a list")
+    consistency = self.get_consistency(table_name, WRITE_OPERATION,
+                                       consistency)
 
     path = ColumnPath(table_name)
     try:
       cf = pycassa.ColumnFamily(self.pool,table_name)
-      b = cf.batch()
+      b = cf.batch(write_consistency_level=CASSANDRA_CONSISTENCY[consistency])
       for key in row_keys:
         b.remove(key)
       b.send()
@@ -233,7 +250,8 @@ class DatastoreProxy(AppDBInterface):
                   offset=0, 
                   start_inclusive=True, 
                   end_inclusive=True,
-                  keys_only=False):
+                  keys_only=False,
+                  consistency=None):
     """ 
     Gets a dense range ordered by keys. Returns an ordered list of 
     a dictionary of [key:{column1:value1, column2:value2},...]
@@ -249,12 +267,14 @@ class DatastoreProxy(AppDBInterface):
       start_inclusive: Boolean if results should include the start_key
       end_inclusive: Boolean if results should include the end_key
       keys_only: Boolean if to only keys and not values
+      consistency: The consistency level to read at, or None for the
+        default of the table
     Raises:
       TypeError: If an argument passed in was not of the expected type.
       AppScaleDBConnectionError: If the range_query could not be performed due
         to an error with Cassandra.
     Returns:
-      An ordered list of dictionaries of key=>columns/values
+      An ordered list of Rows, or of keys if keys only
     """
 
     if not isinstance(table_name, str): raise TypeError("Expected a str")
@@ -265,6 +285,7 @@ class DatastoreProxy(AppDBInterface):
       raise TypeError("Expected an int or long")
     if not isinstance(offset, int) and not isinstance(offset, long): 
       raise TypeError("Expected an int or long")
+    consistency = self.get_consistency(table_name, READ_OPERATION, consistency)
     
     # We add extra rows in case we exclude the start/end keys
     # This makes sure the limit is upheld correctly
@@ -288,35 +309,21 @@ class DatastoreProxy(AppDBInterface):
                                start=start_key,
                                finish=end_key,
                                row_count=row_count,
-                               read_consistency_level=CONSISTENCY_QUORUM)
+                               read_consistency_level=
+                                 CASSANDRA_CONSISTENCY[consistency])
     except Exception, ex:
       logging.exception(ex)
       raise AppScaleDBConnectionError("Exception on range_query: %s" % str(ex))
 
-    for key in keyslices:
+    for key, columns in keyslices:
+      if (not start_inclusive and key == start_key) or \
+         (not end_inclusive and key == end_key):
+        continue
       if keys_only:
-        results.append(key[0]) 
+        results.append(key)
       else:
-        columns = key[1]
-        col_mapping = {}
-        for column in columns.items():
-          col_name = str(column[0]) 
-          col_val = column[1]
-          col_mapping[col_name] = col_val
-
-        k = key[0]
-        v = col_mapping
-        item = {k:v}
-        results.append(item)
-
-   
-    if not start_inclusive and len(results) > 0:
-      if start_key in results[0]:
-        results = results[1:] 
-
-    if not end_inclusive and len(results) > 0:
-      if end_key in results[-1]:
-        results = results[:-1]
+        results.append(Row(key, {str(name): value
+                                 for name, value in columns.iteritems()}))
 
     if len(results) > limit:
       results = results[:limit]
@@ -324,4 +331,91 @@ class DatastoreProxy(AppDBInterface):
     if offset != 0 and offset <= len(results):
       results = results[offset:]
     
-    return results 
+    return results
+
+  def range_scan(self,
+                 table_name,
+                 column_names,
+                 start_key,
+                 end_key,
+                 limit=None,
+                 offset=0,
+                 start_inclusive=True,
+                 end_inclusive=True,
+                 keys_only=False,
+                 buffer_size=DEFAULT_SCAN_BUFFER_SIZE,
+                 consistency=None):
+    """
+    Streams a dense range ordered by keys. pycassa reads the range from
+    Cassandra in pages of buffer_size rows, so only one page is held in
+    memory however long the range is. The rows before the offset are
+    skipped as they stream past instead of being kept.
+
+    Args:
+      table_name: Name of table to access
+      column_names: Columns which get returned within the key range
+      start_key: String for which the query starts at
+      end_key: String for which the query ends at
+      limit: Maximum number of rows to yield, None for no limit
+      offset: The number of rows skipped before the first one yielded
+      start_inclusive: Boolean if results should include the start_key
+      end_inclusive: Boolean if results should include the end_key
+      keys_only: Boolean if to only keys and not values
+      buffer_size: The number of rows read in each page
+      consistency: The consistency level to read at, or None for the
+        default of the table
+    Raises:
+      TypeError: If an argument passed in was not of the expected type.
+      AppScaleDBConnectionError: If the range could not be read due to an
+        error with Cassandra.
+    Yields:
+      Rows in key order, whose columns are None if keys only
+    """
+    if not isinstance(table_name, str): raise TypeError("Expected a str")
+    if not isinstance(column_names, list): raise TypeError("Expected a list")
+    if not isinstance(start_key, str): raise TypeError("Expected a str")
+    if not isinstance(end_key, str): raise TypeError("Expected a str")
+    if limit is not None and not isinstance(limit, (int, long)):
+      raise TypeError("Expected an int or long")
+    if not isinstance(offset, int) and not isinstance(offset, long): 
+      raise TypeError("Expected an int or long")
+    consistency = self.get_consistency(table_name, READ_OPERATION, consistency)
+    if limit == 0:
+      return
+
+    # Rows for the excluded start and end keys are read on top of the rows
+    # that are skipped and returned.
+    row_count = None
+    if limit is not None:
+      row_count = limit + offset + 2
+
+    skipped = 0
+    yielded = 0
+    try:
+      cf = pycassa.ColumnFamily(self.pool, table_name)
+      keyslices = cf.get_range(columns=column_names,
+                               start=start_key,
+                               finish=end_key,
+                               row_count=row_count,
+                               buffer_size=buffer_size,
+                               read_consistency_level=
+                                 CASSANDRA_CONSISTENCY[consistency])
+      for key, columns in keyslices:
+        if (not start_inclusive and key == start_key) or \
+           (not end_inclusive and key == end_key):
+          continue
+        if skipped < offset:
+          skipped += 1
+          continue
+
+        if keys_only:
+          yield Row(key, None)
+        else:
+          yield Row(key, {str(name): value
+                          for name, value in columns.iteritems()})
+        yielded += 1
+        if limit is not None and yielded >= limit:
+          return
+    except Exception, ex:
+      logging.exception(ex)
+      raise AppScaleDBConnectionError("Exception on range_scan: %s" % str(ex))
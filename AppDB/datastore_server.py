@@ -8,13 +8,16 @@ requests from AppServers and responds according to the type of request its
 given (Put, Get, Delete, Query, etc).
 """
 import __builtin__
+import array
 import getopt
 import itertools
 import logging
 import md5
+import multiprocessing.pool
 import os
 import random
 import sys
+import threading
 import time
 
 import tornado.httpserver
@@ -25,7 +28,9 @@ import appscale_datastore_batch
 import dbconstants
 import groomer
 import helper_functions
+import index_builder
 
+from dbinterface_batch import Row
 from zkappscale import zktransaction as zk
 from zkappscale.zktransaction import ZKInternalException
 from zkappscale.zktransaction import ZKTransactionException
@@ -60,11 +65,27 @@ datastore_access = None
 # ZooKeeper global variable for locking
 zookeeper = None
 
+# Pool of worker threads which run datastore operations off of the IOLoop.
+# None if requests are to be handled inline on the IOLoop thread.
+worker_pool = None
+
+# Pool of threads which apply the independent table mutations of a write at
+# the same time. None if they are to be applied one after another.
+mutation_pool = None
+
+# Pool of threads which run the index scans of a query at the same time.
+# None if they are to be run one after another.
+scan_pool = None
+
+# The thread which builds and deletes composite indexes in the background.
+# None if no index jobs are run by this server.
+composite_index_builder = None
+
 entity_pb.Reference.__hash__ = lambda self: hash(self.Encode())
 datastore_pb.Query.__hash__ = lambda self: hash(self.Encode())
 
 # The datastores supported for this version of the AppScale datastore
-VALID_DATASTORES = ['cassandra']
+VALID_DATASTORES = ['cassandra', 'sqlite']
 
 # Port this service binds to if using SSL
 DEFAULT_SSL_PORT = 8443
@@ -84,6 +105,26 @@ TOMBSTONE = "APPSCALE_SOFT_DELETE"
 # Local datastore location through nginx.
 LOCAL_DATASTORE = "localhost:8888"
 
+# The default number of worker threads used to process requests concurrently.
+# A value of zero processes each request inline on the IOLoop thread.
+DEFAULT_NUM_WORKERS = 10
+
+# The number of table mutations a single write can have in flight at once.
+# The mutation pool has this many threads for each worker thread.
+MUTATIONS_PER_WRITE = 5
+
+# The number of index scans a single query can have in flight at once.
+# The scan pool has this many threads for each worker thread.
+SCANS_PER_QUERY = 4
+
+# The most rows read from the datastore in each page of a streamed range.
+SCAN_PAGE_SIZE = 500
+
+def notify_index_builder():
+  """ Has the index builder check for new jobs, if this server runs one. """
+  if composite_index_builder is not None:
+    composite_index_builder.notify()
+
 def clean_app_id(app_id):
   """ Google App Engine uses a special prepended string to signal that it
       is an HRD application. AppScale does not use this string so we remove
@@ -116,6 +157,30 @@ def reference_property_to_reference(refprop):
   return ref
 
 
+class TransactionCache():
+  """ What a transaction has read from the entity groups it holds locks on.
+
+  No other transaction can write to an entity group while its lock is held,
+  so the rows read from a locked group stay as they were read until the
+  transaction writes them itself.
+  """
+  def __init__(self):
+    """ Constructor. """
+    # When the cache was started, as seconds since the epoch.
+    self.start_time = time.time()
+
+    # The root keys of the entity groups the transaction holds locks on.
+    self.locks = set()
+
+    # Validated entity table rows by row key, with None for rows that do not
+    # hold an entity.
+    self.rows = {}
+
+    # The entities read from ranges of the entity table, by the bounds of
+    # the ranges.
+    self.ranges = {}
+
+
 class DatastoreDistributed():
   """ AppScale persistent layer for the datastore API. It is the 
       replacement for the AppServers to persist their data into 
@@ -124,9 +189,10 @@ class DatastoreDistributed():
   # Max number of results for a query
   _MAXIMUM_RESULTS = 10000
 
-  # The number of entries looked at when doing a composite query
-  # It will keep looking at this size window when getting the result
-  _MAX_COMPOSITE_WINDOW = 10000
+  # The bounds on how many index rows a zigzag merge join reads for each
+  # property when it seeks to a candidate entity.
+  _MIN_ZIGZAG_SEEK = 20
+  _MAX_ZIGZAG_SEEK = 500
 
   # Maximum amount of filter and orderings allowed within a query
   _MAX_QUERY_COMPONENTS = 63
@@ -163,6 +229,17 @@ class DatastoreDistributed():
   # register.
   _MAX_NUM_INDEXES = 1000
 
+  # The most index jobs that are read at once.
+  _MAX_INDEX_JOBS = 1000
+
+  # Index jobs are stored in the metadata table under this name in place of
+  # an application identifier, so that they can be found for every
+  # application at once. It is not a valid application identifier.
+  _INDEX_JOBS = "__index_jobs__"
+
+  # How far each index job has got is stored under this name.
+  _INDEX_JOB_PROGRESS = "__index_job_progress__"
+
   def __init__(self, datastore_batch, zookeeper=None):
     """
        Constructor.
@@ -181,6 +258,15 @@ class DatastoreDistributed():
     # zookeeper instance for accesing ZK functionality.
     self.zookeeper = zookeeper
 
+    # Per-application tuples of the version of the composite index
+    # definitions and a dict mapping each kind to its indexes.
+    self.composite_index_cache = {}
+    self.composite_index_cache_lock = threading.Lock()
+
+    # TransactionCaches by application ID and transaction ID.
+    self.transaction_cache = {}
+    self.transaction_cache_lock = threading.Lock()
+
   @staticmethod
   def get_entity_kind(key_path):
     """ Returns the Kind of the Entity. A Kind is like a type or a 
@@ -253,18 +339,35 @@ class DatastoreDistributed():
     path = []
     path.append(key_path.element_list()[-1].type())
     for e in key_path.element_list():
-      if e.has_name():
-        key_id = e.name()
-      elif e.has_id():
-        # make sure ids are ordered lexigraphically by making sure they 
-        # are of set size i.e. 2 > 0003 but 0002 < 0003
-        key_id = str(e.id()).zfill(ID_KEY_LENGTH)
-      path.append("{0}:{1}".format(e.type(), key_id))
+      path.append("{0}:{1}".format(e.type(), self.__encode_key_id(e)))
     encoded_path = dbconstants.KIND_SEPARATOR.join(path)
     encoded_path += dbconstants.KIND_SEPARATOR
     
     return prefix + self._NAMESPACE_SEPARATOR + encoded_path
     
+  @staticmethod
+  def __encode_key_id(element):
+    """ Returns the part of an encoded path element that names or numbers it.
+
+    IDs are padded so that they sort numerically. Names that could be read
+    as a padded ID, or that start with the marker, get the marker in front
+    so that every encoded path can be decoded.
+
+    Args:
+      element: An entity_pb.Path_Element.
+    Returns:
+      A str, the encoded ID or name.
+    """
+    if element.has_name():
+      name = element.name()
+      if name.startswith(dbconstants.NAME_MARKER) or \
+          (len(name) >= ID_KEY_LENGTH and name.isdigit()):
+        return dbconstants.NAME_MARKER + name
+      return name
+    # make sure ids are ordered lexigraphically by making sure they 
+    # are of set size i.e. 2 > 0003 but 0002 < 0003
+    return str(element.id()).zfill(ID_KEY_LENGTH)
+
   @staticmethod
   def __encode_index_pb(pb):
     """ Returns an encoded protocol buffer.
@@ -278,11 +381,8 @@ class DatastoreDistributed():
       """ Takes a protocol buffer and returns the encoded path. """
       path = []
       for e in pb.element_list():
-        if e.has_name():
-          key_id = e.name()
-        elif e.has_id():
-          key_id = str(e.id()).zfill(ID_KEY_LENGTH)
-        path.append("{0}:{1}".format(e.type(), key_id))
+        path.append("{0}:{1}".format(e.type(),
+          DatastoreDistributed.__encode_key_id(e)))
       val = dbconstants.KIND_SEPARATOR.join(path)
       val += dbconstants.KIND_SEPARATOR
       return val
@@ -302,6 +402,25 @@ class DatastoreDistributed():
     elif isinstance(pb, entity_pb.Path):
       return buffer(_encode_path(pb))
 
+  @staticmethod
+  def __decode_index_path(encoded_path, path):
+    """ Fills in a path from the form __encode_index_pb gives it.
+
+    Args:
+      encoded_path: A str, the encoded path.
+      path: An entity_pb.Path to add the elements to.
+    """
+    for encoded_element in encoded_path.split(dbconstants.KIND_SEPARATOR)[:-1]:
+      kind, key_id = encoded_element.split(':', 1)
+      element = path.add_element()
+      element.set_type(kind)
+      if key_id.startswith(dbconstants.NAME_MARKER):
+        element.set_name(key_id[len(dbconstants.NAME_MARKER):])
+      elif len(key_id) >= ID_KEY_LENGTH and key_id.isdigit():
+        element.set_id(int(key_id))
+      else:
+        element.set_name(key_id)
+
   def validate_app_id(self, app_id):
     """ Verify that this is the stub for app_id.
 
@@ -427,8 +546,22 @@ class DatastoreDistributed():
          deleted.
        compsite_indexes: A list of datastore_pb.CompositeIndex.
     """
+    self.run_mutations('delete composite indexes',
+      self.composite_index_deletions(entities, composite_indexes))
+
+  def composite_index_deletions(self, entities, composite_indexes):
+    """ Builds the mutations which delete the composite indexes of the given
+    entities.
+
+    Args:
+       entities: A list of EntityProto for which their indexes are to be 
+         deleted.
+       compsite_indexes: A list of datastore_pb.CompositeIndex.
+    Returns:
+      A list of mutations, as taken by run_mutations.
+    """
     if len(entities) == 0: 
-      return
+      return []
 
     row_keys = []
     for ent in entities:
@@ -439,9 +572,8 @@ class DatastoreDistributed():
         composite_index_key = self.get_composite_index_key(index_def, ent)  
         row_keys.append(composite_index_key)
 
-    self.datastore_batch.batch_delete(dbconstants.COMPOSITE_TABLE, 
-                                      row_keys, 
-                                      column_names=dbconstants.COMPOSITE_SCHEMA)
+    return [(self.datastore_batch.batch_delete, dbconstants.COMPOSITE_TABLE,
+             row_keys, dbconstants.COMPOSITE_SCHEMA)]
  
   def delete_index_entries(self, entities):
     """ Deletes the entities in the DB.
@@ -450,8 +582,20 @@ class DatastoreDistributed():
        entities: A list of entities for which their 
                  indexes are to be deleted
     """
+    self.run_mutations('delete indexes', self.index_entry_deletions(entities))
+
+  def index_entry_deletions(self, entities):
+    """ Builds the mutations which delete the single property indexes of the
+    given entities.
+
+    Args:
+       entities: A list of entities for which their 
+                 indexes are to be deleted
+    Returns:
+      A list of mutations, as taken by run_mutations.
+    """
     if len(entities) == 0: 
-      return
+      return []
 
     entities_tuple = sorted((self.get_table_prefix(x), x) for x in entities)
     asc_index_keys = self.get_index_kv_from_tuple(entities_tuple, 
@@ -461,21 +605,39 @@ class DatastoreDistributed():
     # Remove the value, just get keys
     asc_index_keys = [x[0] for x in asc_index_keys] 
     desc_index_keys = [x[0] for x in desc_index_keys] 
-    # TODO Consider doing these in parallel with threads
-    self.datastore_batch.batch_delete(dbconstants.ASC_PROPERTY_TABLE, 
-                                      asc_index_keys, 
-                                      column_names=dbconstants.PROPERTY_SCHEMA)
-    self.datastore_batch.batch_delete(dbconstants.DSC_PROPERTY_TABLE, 
-                                      desc_index_keys,
-                                      column_names=dbconstants.PROPERTY_SCHEMA)
+    return [(self.datastore_batch.batch_delete,
+             dbconstants.ASC_PROPERTY_TABLE, asc_index_keys,
+             dbconstants.PROPERTY_SCHEMA),
+            (self.datastore_batch.batch_delete,
+             dbconstants.DSC_PROPERTY_TABLE, desc_index_keys,
+             dbconstants.PROPERTY_SCHEMA)]
     
   def insert_entities(self, entities, txn_hash):
     """Inserts or updates entities in the DB.
 
+    The journal is written before the entities become visible in the
+    entity table.
+
     Args:      
       entities: A list of entities to store.
       txn_hash: A mapping of root keys to transaction IDs.
     """
+    journal, mutations = self.entity_mutations(entities, txn_hash)
+    self.run_mutations('write journal', journal)
+    self.run_mutations('write entities', mutations)
+
+  def entity_mutations(self, entities, txn_hash, kinds=True):
+    """ Builds the mutations which write entities to the entity and kind
+    tables, and their new versions to the journal.
+
+    Args:      
+      entities: A list of entities to store.
+      txn_hash: A mapping of root keys to transaction IDs.
+      kinds: Whether to write the kind table rows of the entities too.
+    Returns:
+      A tuple of two lists of mutations, as taken by run_mutations. The
+      first writes the journal and must be applied before the second.
+    """
     def row_generator(entities):
       """ Generates keys and encoded entities for a list of entities. 
 
@@ -540,19 +702,88 @@ class DatastoreDistributed():
         kind_row_values[str(ii[0])] = \
           {dbconstants.APP_KIND_SCHEMA[0]:str(ii[1])}
 
+    journal = [self.journal_mutation(row_keys, row_values, txn_hash)]
+    mutations = [(self.datastore_batch.batch_put_entity,
+                  dbconstants.APP_ENTITY_TABLE, row_keys,
+                  dbconstants.APP_ENTITY_SCHEMA, row_values)]
+    if kinds:
+      mutations.append((self.datastore_batch.batch_put_entity,
+                        dbconstants.APP_KIND_TABLE, kind_row_keys,
+                        dbconstants.APP_KIND_SCHEMA, kind_row_values))
+    return journal, mutations
 
-    # TODO do these in ||                        
-    self.datastore_batch.batch_put_entity(dbconstants.APP_ENTITY_TABLE, 
-                                          row_keys, 
-                                          dbconstants.APP_ENTITY_SCHEMA, 
-                                          row_values)    
+  def get_index_rows(self, entity, composite_indexes):
+    """ Lists the kind and index table rows that refer to an entity.
+
+    Args:
+      entity: An entity_pb.EntityProto, or None.
+      composite_indexes: A list of datastore_pb.CompositeIndex.
+    Returns:
+      A dict mapping tuples of table name and row key to the row's values.
+    """
+    if entity is None:
+      return {}
 
-    self.update_journal(row_keys, row_values, txn_hash)
+    prefix = self.get_table_prefix(entity)
+    reference = str(self.get_entity_key(prefix, entity.key().path()))
+    rows = {}
+    rows[(dbconstants.APP_KIND_TABLE,
+          str(self.get_kind_key(prefix, entity.key().path())))] = \
+      {dbconstants.APP_KIND_SCHEMA[0]: reference}
+    for table, reverse in [(dbconstants.ASC_PROPERTY_TABLE, False),
+                           (dbconstants.DSC_PROPERTY_TABLE, True)]:
+      for row_key, _ in self.get_index_kv_from_tuple([(prefix, entity)],
+                                                     reverse):
+        rows[(table, str(row_key))] = \
+          {dbconstants.PROPERTY_SCHEMA[0]: reference}
+
+    kind = self.get_entity_kind(entity.key())
+    for index_def in composite_indexes or []:
+      if index_def.definition().entity_type() != kind:
+        continue
+      rows[(dbconstants.COMPOSITE_TABLE,
+            self.get_composite_index_key(index_def, entity))] = \
+        {dbconstants.COMPOSITE_SCHEMA[0]: reference}
+    return rows
 
-    self.datastore_batch.batch_put_entity(dbconstants.APP_KIND_TABLE,
-                                          kind_row_keys,
-                                          dbconstants.APP_KIND_SCHEMA, 
-                                          kind_row_values) 
+  def index_diff(self, changes, composite_indexes):
+    """ Builds the mutations which bring the kind and index rows of entities
+    up to date, touching only the rows which differ between versions.
+
+    Args:
+      changes: A list of tuples of the current and the new version of an
+        entity. Either may be None when the entity does not exist.
+      composite_indexes: A list of datastore_pb.CompositeIndex.
+    Returns:
+      A tuple of two lists of mutations, as taken by run_mutations. The
+      first deletes stale rows and the second writes new ones.
+    """
+    stale = {}
+    added = {}
+    for old_entity, new_entity in changes:
+      old_rows = self.get_index_rows(old_entity, composite_indexes)
+      new_rows = self.get_index_rows(new_entity, composite_indexes)
+      for table, row_key in old_rows:
+        if (table, row_key) not in new_rows:
+          stale.setdefault(table, []).append(row_key)
+      for (table, row_key), values in new_rows.iteritems():
+        if (table, row_key) not in old_rows:
+          added.setdefault(table, {})[row_key] = values
+
+    deletions = []
+    insertions = []
+    for table, schema in [
+      (dbconstants.APP_KIND_TABLE, dbconstants.APP_KIND_SCHEMA),
+      (dbconstants.ASC_PROPERTY_TABLE, dbconstants.PROPERTY_SCHEMA),
+      (dbconstants.DSC_PROPERTY_TABLE, dbconstants.PROPERTY_SCHEMA),
+      (dbconstants.COMPOSITE_TABLE, dbconstants.COMPOSITE_SCHEMA)]:
+      if table in stale:
+        deletions.append((self.datastore_batch.batch_delete, table,
+                          stale[table], schema))
+      if table in added:
+        insertions.append((self.datastore_batch.batch_put_entity, table,
+                           added[table].keys(), schema, added[table]))
+    return deletions, insertions
 
   def get_composite_index_key(self, index, entity, position_list=None, 
     filters=None):
@@ -631,8 +862,21 @@ class DatastoreDistributed():
       entities: A list entities.
       composite_indexes: A list of datastore_pb.CompositeIndex.
     """
+    self.run_mutations('insert composite indexes',
+      self.composite_index_insertions(entities, composite_indexes))
+
+  def composite_index_insertions(self, entities, composite_indexes):
+    """ Builds the mutations which create composite indexes for a set of
+    entities.
+
+    Args:
+      entities: A list entities.
+      composite_indexes: A list of datastore_pb.CompositeIndex.
+    Returns:
+      A list of mutations, as taken by run_mutations.
+    """
     if not composite_indexes:
-      return
+      return []
     row_keys = []
     row_values = {}
     # Create default composite index for all entities. Here we take each
@@ -657,10 +901,9 @@ class DatastoreDistributed():
         # See exploding indexes: 
         # https://developers.google.com/appengine/docs/python/datastore/indexes
 
-    self.datastore_batch.batch_put_entity(dbconstants.COMPOSITE_TABLE, 
-                                          row_keys, 
-                                          dbconstants.COMPOSITE_SCHEMA,
-                                          row_values)
+    return [(self.datastore_batch.batch_put_entity,
+             dbconstants.COMPOSITE_TABLE, row_keys,
+             dbconstants.COMPOSITE_SCHEMA, row_values)]
      
   def insert_index_entries(self, entities):
     """ Inserts index entries for the supplied entities.
@@ -669,6 +912,17 @@ class DatastoreDistributed():
       entities: A list of tuples of prefix and entities 
                 to create index entries for.
     """
+    self.run_mutations('insert indexes', self.index_entry_insertions(entities))
+
+  def index_entry_insertions(self, entities):
+    """ Builds the mutations which insert the single property index entries
+    of the supplied entities.
+
+    Args:
+      entities: A list of entities to create index entries for.
+    Returns:
+      A list of mutations, as taken by run_mutations.
+    """
     entities = sorted((self.get_table_prefix(x), x) for x in entities)
 
     row_keys = []
@@ -688,16 +942,60 @@ class DatastoreDistributed():
       for ii in rev_group_rows:
         rev_row_values[str(ii[0])] = {'reference': str(ii[1])}
     
-    # TODO update all indexes in parallel
-    self.datastore_batch.batch_put_entity(dbconstants.ASC_PROPERTY_TABLE, 
-                          row_keys, 
-                          dbconstants.PROPERTY_SCHEMA, 
-                          row_values)
+    return [(self.datastore_batch.batch_put_entity,
+             dbconstants.ASC_PROPERTY_TABLE, row_keys,
+             dbconstants.PROPERTY_SCHEMA, row_values),
+            (self.datastore_batch.batch_put_entity,
+             dbconstants.DSC_PROPERTY_TABLE, rev_row_keys,
+             dbconstants.PROPERTY_SCHEMA, rev_row_values)]
+
+  def run_mutations(self, stage, mutations):
+    """ Applies a set of table mutations which do not depend on each other.
 
-    self.datastore_batch.batch_put_entity(dbconstants.DSC_PROPERTY_TABLE, 
-                          rev_row_keys,  
-                          dbconstants.PROPERTY_SCHEMA,
-                          rev_row_values)
+    The mutations run on the mutation pool when there is one, so that they
+    cost a single round trip to the datastore instead of one each. The
+    latency of the stage and of each mutation is logged.
+
+    Args:
+      stage: A str naming the step of the write, used when logging.
+      mutations: A list of tuples, each holding a datastore batch method and
+        its table name, row keys and further arguments.
+    Raises:
+      The exception of the first mutation that failed, once every mutation
+        has finished.
+    """
+    # Empty mutations do not need to go to the datastore at all.
+    mutations = [mutation for mutation in mutations if mutation[2]]
+    if not mutations:
+      return
+
+    def apply_mutation(mutation):
+      """ Applies a mutation and returns how long it took, in seconds. """
+      start = time.time()
+      mutation[0](*mutation[1:])
+      return time.time() - start
+
+    start = time.time()
+    if mutation_pool is None or len(mutations) == 1:
+      latencies = [apply_mutation(mutation) for mutation in mutations]
+    else:
+      pending = [mutation_pool.apply_async(apply_mutation, (mutation,))
+                 for mutation in mutations]
+      latencies = []
+      error = None
+      for result in pending:
+        try:
+          latencies.append(result.get())
+        except Exception, exception:
+          if error is None:
+            error = exception
+      if error is not None:
+        raise error
+
+    logging.debug("Applied {0} in {1:.1f}ms ({2})".format(stage,
+      (time.time() - start) * 1000, ', '.join(
+      "{0}: {1:.1f}ms".format(mutation[1], latency * 1000)
+      for mutation, latency in zip(mutations, latencies))))
 
   def get_indices(self, app_id):
     """ Gets the indices of the given application.
@@ -717,14 +1015,51 @@ class DatastoreDistributed():
                                                 offset=0,
                                                 start_inclusive=True,
                                                 end_inclusive=True)
-    list_result = []
-    for list_item in result:
-      for key, value in list_item.iteritems():
-        list_result.append(value['data']) 
-    return list_result
+    return [row.columns['data'] for row in result]
+
+  def get_composite_indexes(self, app_id, kinds):
+    """ Gets the composite indexes of the given kinds of an application.
+
+    The definitions of each application are cached until the version kept
+    for them in ZooKeeper changes, which happens whenever one is created or
+    deleted.
+
+    Args:
+      app_id: A str, the application identifier.
+      kinds: A list of kind names.
+    Returns:
+      A list of entity_pb.CompositeIndex.
+    """
+    try:
+      version = self.zookeeper.get_index_version(app_id)
+    except ZKInternalException, zkie:
+      logging.warning("Unable to get the index version of {0}: {1}".format(
+        app_id, zkie))
+      version = None
+
+    with self.composite_index_cache_lock:
+      cached = self.composite_index_cache.get(app_id)
+    if version is None or cached is None or cached[0] != version:
+      indexes_by_kind = {}
+      for encoded_index in self.get_indices(app_id):
+        index = entity_pb.CompositeIndex(encoded_index)
+        indexes_by_kind.setdefault(index.definition().entity_type(), []).\
+          append(index)
+      cached = (version, indexes_by_kind)
+      if version is not None:
+        with self.composite_index_cache_lock:
+          self.composite_index_cache[app_id] = cached
+
+    composite_indexes = []
+    for kind in set(kinds):
+      composite_indexes.extend(cached[1].get(kind, []))
+    return composite_indexes
 
   def delete_composite_index_metadata(self, app_id, index):
     """ Deletes a index for the given application identifier.
+
+    The index rows are left for the index builder to remove in the
+    background, so a job for it is stored along with the deletion.
   
     Args:
       app_id: A string representing the application identifier.
@@ -737,8 +1072,18 @@ class DatastoreDistributed():
                                       index_keys, 
                                       column_names=dbconstants.METADATA_TABLE)
 
+    job = entity_pb.CompositeIndex()
+    job.CopyFrom(index)
+    job.set_app_id(app_id)
+    job.set_state(entity_pb.CompositeIndex.DELETED)
+    self.put_index_job(job)
+    self.zookeeper.update_index_version(app_id)
+
   def create_composite_index(self, app_id, index):
     """ Stores a new index for the given application identifier.
+
+    The index starts out write-only, and a job is stored for the index
+    builder to fill it in from the existing entities.
   
     Args:
       app_id: A string representing the application identifier.
@@ -749,17 +1094,259 @@ class DatastoreDistributed():
     # Generate a random number based on time of creation.
     rand = int(str(int(time.time())) + str(random.randint(0, 999999)))
     index.set_id(rand)
+    index.set_app_id(app_id)
+    index.set_state(entity_pb.CompositeIndex.WRITE_ONLY)
     encoded_entity = index.Encode()
     row_key = self.get_meta_data_key(app_id, "index", rand)
-    row_keys = [row_key]
+    job_key = self.get_meta_data_key(self._INDEX_JOBS, app_id, rand)
+    row_keys = [row_key, job_key]
     row_values = {}
     row_values[row_key] = {dbconstants.METADATA_SCHEMA[0]: encoded_entity}
+    row_values[job_key] = {dbconstants.METADATA_SCHEMA[0]: encoded_entity}
     self.datastore_batch.batch_put_entity(dbconstants.METADATA_TABLE, 
                                           row_keys, 
                                           dbconstants.METADATA_SCHEMA, 
                                           row_values)    
+    self.zookeeper.update_index_version(app_id)
     return rand 
 
+  def put_index_job(self, index):
+    """ Stores a job for the index builder, replacing any earlier job for the
+    same index.
+
+    Args:
+      index: A entity_pb.CompositeIndex. It is built if its state is
+        WRITE_ONLY, and its rows are deleted if its state is DELETED.
+    """
+    job_key = self.get_meta_data_key(self._INDEX_JOBS, index.app_id(),
+      index.id())
+    self.datastore_batch.batch_put_entity(dbconstants.METADATA_TABLE,
+      [job_key], dbconstants.METADATA_SCHEMA,
+      {job_key: {dbconstants.METADATA_SCHEMA[0]: index.Encode()}})
+
+  def get_index_jobs(self):
+    """ Gets the pending index jobs of every application.
+
+    Returns:
+      A list of entity_pb.CompositeIndex, one for each job.
+    """
+    start_key = self._INDEX_JOBS + self._SEPARATOR
+    end_key = start_key + self._TERM_STRING
+    result = self.datastore_batch.range_query(dbconstants.METADATA_TABLE,
+                                              dbconstants.METADATA_SCHEMA,
+                                              start_key,
+                                              end_key,
+                                              self._MAX_INDEX_JOBS,
+                                              offset=0,
+                                              start_inclusive=True,
+                                              end_inclusive=True)
+    return [entity_pb.CompositeIndex(row.columns['data']) for row in result]
+
+  def get_index_job(self, app_id, index_id):
+    """ Gets the pending job for an index.
+
+    Args:
+      app_id: A str, the application identifier.
+      index_id: An int, the composite index ID.
+    Returns:
+      A entity_pb.CompositeIndex, or None if the index has no job.
+    """
+    job_key = self.get_meta_data_key(self._INDEX_JOBS, app_id, index_id)
+    result = self.datastore_batch.batch_get_entity(dbconstants.METADATA_TABLE,
+      [job_key], dbconstants.METADATA_SCHEMA)
+    if not result.get(job_key):
+      return None
+    return entity_pb.CompositeIndex(result[job_key]['data'])
+
+  def get_index_job_progress_key(self, index):
+    """ Gets the metadata key of how far the job for an index has got. Build
+    and delete jobs have their own keys, so that a deletion never resumes
+    from where a build got to.
+
+    Args:
+      index: A entity_pb.CompositeIndex.
+    Returns:
+      A str, the metadata key.
+    """
+    return self.get_meta_data_key(self._INDEX_JOB_PROGRESS, index.app_id(),
+      "{0}{1}{2}".format(index.id(), self._SEPARATOR, index.state()))
+
+  def get_index_job_progress(self, index):
+    """ Gets how far the job for an index has got.
+
+    Args:
+      index: A entity_pb.CompositeIndex.
+    Returns:
+      The key the job is to continue from, or None if it has not started.
+    """
+    progress_key = self.get_index_job_progress_key(index)
+    result = self.datastore_batch.batch_get_entity(dbconstants.METADATA_TABLE,
+      [progress_key], dbconstants.METADATA_SCHEMA)
+    if not result.get(progress_key):
+      return None
+    return result[progress_key]['data']
+
+  def set_index_job_progress(self, index, key):
+    """ Records how far the job for an index has got, so that it can be
+    resumed after a restart.
+
+    Args:
+      index: A entity_pb.CompositeIndex.
+      key: A str, the key the job is to continue from.
+    """
+    progress_key = self.get_index_job_progress_key(index)
+    self.datastore_batch.batch_put_entity(dbconstants.METADATA_TABLE,
+      [progress_key], dbconstants.METADATA_SCHEMA,
+      {progress_key: {dbconstants.METADATA_SCHEMA[0]: key}})
+
+  def finish_index_job(self, index):
+    """ Removes the job for an index once it is done. A built index is marked
+    as serving, unless it has been deleted in the meantime.
+
+    Args:
+      index: A entity_pb.CompositeIndex.
+    """
+    app_id = index.app_id()
+    if index.state() == entity_pb.CompositeIndex.WRITE_ONLY:
+      row_key = self.get_meta_data_key(app_id, "index", index.id())
+      result = self.datastore_batch.batch_get_entity(
+        dbconstants.METADATA_TABLE, [row_key], dbconstants.METADATA_SCHEMA)
+      if result.get(row_key):
+        serving = entity_pb.CompositeIndex(result[row_key]['data'])
+        serving.set_state(entity_pb.CompositeIndex.READ_WRITE)
+        self.datastore_batch.batch_put_entity(dbconstants.METADATA_TABLE,
+          [row_key], dbconstants.METADATA_SCHEMA,
+          {row_key: {dbconstants.METADATA_SCHEMA[0]: serving.Encode()}})
+        # Other servers start using it for queries once they reload.
+        self.zookeeper.update_index_version(app_id)
+
+    job_keys = [self.get_meta_data_key(self._INDEX_JOBS, app_id, index.id()),
+                self.get_index_job_progress_key(index)]
+    self.datastore_batch.batch_delete(dbconstants.METADATA_TABLE, job_keys,
+      column_names=dbconstants.METADATA_SCHEMA)
+
+  def build_composite_index_batch(self, index, start_key, batch_size):
+    """ Writes the rows of a composite index for a batch of the existing
+    entities of its application.
+
+    The entity groups of the batch are locked while their entities are read
+    and indexed, so that a concurrent put cannot leave a row of an older
+    version of an entity behind.
+
+    Args:
+      index: A entity_pb.CompositeIndex.
+      start_key: A str, the entity table key to continue after, or None to
+        start at the first entity of the application.
+      batch_size: An int, the number of entities to read.
+    Returns:
+      A tuple of the entity table key to continue after, or None once every
+      entity has been read, and the number of entities indexed.
+    Raises:
+      ZKTransactionException: If the entity groups could not be locked.
+    """
+    app_id = index.app_id()
+    kind = index.definition().entity_type()
+    first_key = app_id + self._NAMESPACE_SEPARATOR
+    result = self.datastore_batch.range_query(dbconstants.APP_ENTITY_TABLE,
+                                              dbconstants.APP_ENTITY_SCHEMA,
+                                              start_key or first_key,
+                                              first_key + self._TERM_STRING,
+                                              batch_size,
+                                              offset=0,
+                                              start_inclusive=start_key is None,
+                                              end_inclusive=True)
+    if not result:
+      return None, 0
+
+    # The kind of an entity is the type of the last element of its path. The
+    # check on the row key can match other kinds whose names contain the
+    # separator, which are skipped once the entities are read.
+    row_keys = []
+    for row_key, value in result:
+      path = row_key.split(self._NAMESPACE_SEPARATOR, 2)[-1]
+      last_element = path.rstrip(dbconstants.KIND_SEPARATOR).split(
+        dbconstants.KIND_SEPARATOR)[-1]
+      if last_element.startswith(kind + ":") and \
+          value[dbconstants.APP_ENTITY_SCHEMA[0]] != TOMBSTONE:
+        row_keys.append(row_key)
+    last_key = result[-1].key
+    if len(result) < batch_size:
+      last_key = None
+    if not row_keys:
+      return last_key, 0
+
+    root_keys = list(set(self.get_root_key_from_entity_key(row_key)
+                         for row_key in row_keys))
+    txn_hash = self.acquire_locks_for_root_keys(app_id, root_keys,
+      retries=self.NON_TRANS_LOCK_RETRY_COUNT)
+    try:
+      current = self.datastore_batch.batch_get_entity(
+        dbconstants.APP_ENTITY_TABLE, row_keys, dbconstants.APP_ENTITY_SCHEMA)
+      entities = []
+      for row_key in row_keys:
+        encoded = current.get(row_key, {}).get(dbconstants.APP_ENTITY_SCHEMA[0])
+        if not encoded or encoded == TOMBSTONE:
+          continue
+        entity = entity_pb.EntityProto(encoded)
+        if self.get_entity_kind(entity) == kind:
+          entities.append(entity)
+      self.run_mutations('build composite index',
+        self.composite_index_insertions(entities, [index]))
+    finally:
+      self.zookeeper.release_group_locks(app_id, txn_hash, {})
+    return last_key, len(entities)
+
+  def delete_composite_index_batch(self, index, start_key, batch_size):
+    """ Deletes a batch of the rows of a composite index.
+
+    The rows of all the composite indexes of an application are ordered by
+    namespace before index ID, so each namespace is sought through for the
+    rows of the index instead of scanning every row of the application.
+
+    Args:
+      index: A entity_pb.CompositeIndex.
+      start_key: A str, the composite table key to continue from, or None to
+        start at the first row of the application.
+      batch_size: An int, the number of rows to read.
+    Returns:
+      A tuple of the composite table key to continue from, or None once every
+      row has been deleted, and the number of rows deleted.
+    """
+    first_key = index.app_id() + self._NAMESPACE_SEPARATOR
+    index_id = str(index.id())
+    result = self.datastore_batch.range_query(dbconstants.COMPOSITE_TABLE,
+                                              dbconstants.COMPOSITE_SCHEMA,
+                                              start_key or first_key,
+                                              first_key + self._TERM_STRING,
+                                              batch_size,
+                                              offset=0,
+                                              start_inclusive=True,
+                                              end_inclusive=True,
+                                              keys_only=True)
+    deletions = []
+    for row_key in result:
+      if row_key[len(first_key):].split(self._SEPARATOR, 2)[1] == index_id:
+        deletions.append(row_key)
+    self.run_mutations('delete composite index',
+      [(self.datastore_batch.batch_delete, dbconstants.COMPOSITE_TABLE,
+        deletions, dbconstants.COMPOSITE_SCHEMA)])
+
+    if len(result) < batch_size:
+      return None, len(deletions)
+
+    # IDs compare as strings, which is how they are ordered within a
+    # namespace since the separator sorts before any digit.
+    name_space, last_id, _ = result[-1][len(first_key):].split(
+      self._SEPARATOR, 2)
+    if last_id < index_id:
+      next_key = first_key + name_space + self._SEPARATOR + index_id + \
+        self._SEPARATOR
+    elif last_id > index_id:
+      next_key = first_key + name_space + chr(ord(self._SEPARATOR) + 1)
+    else:
+      next_key = result[-1] + chr(0)
+    return next_key, len(deletions)
+
   def allocate_ids(self, app_id, size, max_id=None, num_retries=0):
     """ Allocates IDs from either a local cache or the datastore. 
 
@@ -804,23 +1391,35 @@ class DatastoreDistributed():
     """ Updates indexes of existing entities, inserts new entities and 
         indexes for them.
 
+    Only the index rows that differ between the current and the new version
+    of each entity are deleted or written.
+
     Args:
       app_id: The application ID.
       entities: List of entities.
       txn_hash: A mapping of root keys to transaction IDs.
       composite_indexes: A list of entity_pb.CompositeIndex.
     """
-    sorted_entities = sorted((self.get_table_prefix(x), x) for x in entities)
-    for prefix, group in itertools.groupby(sorted_entities, lambda x: x[0]):
-      keys = [e.key() for e in entities]
-      # Delete the old entities and indexes.
-      self.delete_entities(app_id, keys, txn_hash, soft_delete=False, 
-        composite_indexes=composite_indexes)
-
-      # Insert the new entities and indexes.
-      self.insert_entities(entities, txn_hash)
-      self.insert_index_entries(entities)
-      self.insert_composite_indexes(entities, composite_indexes)
+    # When a key is put more than once, the last version is the one stored.
+    latest = {}
+    for entity in entities:
+      row_key = str(self.get_entity_key(self.get_table_prefix(entity),
+        entity.key().path()))
+      latest[row_key] = entity
+
+    current = self.get_current_entities(app_id,
+      [entity.key() for entity in latest.values()], txn_hash)
+    stale, added = self.index_diff(
+      [(current.get(row_key), entity) for row_key, entity in latest.items()],
+      composite_indexes)
+    journal, entity_rows = self.entity_mutations(latest.values(), txn_hash,
+      kinds=False)
+
+    # Stale rows are removed while the journal is written, and the new
+    # entities and rows only go in once both are done.
+    self.run_mutations('put journal and delete stale indexes',
+      journal + stale)
+    self.run_mutations('put entities and new indexes', entity_rows + added)
 
   def delete_entities(self, app_id, keys, txn_hash, soft_delete=False, 
     composite_indexes=[]):
@@ -835,61 +1434,50 @@ class DatastoreDistributed():
                    entity table (neither soft or hard). 
       composite_indexes: A list of CompositeIndex objects. 
     """
-    def row_generator(key_list):
-      """ Generates a ruple of keys and encoded entities. """
-      for prefix, k in key_list:
-        yield (self.get_entity_key(prefix, k.path()),
-               buffer(k.Encode()))
-
-    def kind_row_generator(key_list):
-      """ Generates key/values for the kind table. """
-      for prefix, k in key_list:
-        # Yield a tuple of kind key and a reference to entity table.
-        yield (self.get_kind_key(prefix, k.path()),
-               self.get_entity_key(prefix, k.path()))
- 
-    row_keys = []
-    kind_keys = []
-
-    entities = sorted((self.get_table_prefix(x), x) for x in keys)
-
-    for prefix, group in itertools.groupby(entities, lambda x: x[0]):
-      group_rows = tuple(row_generator(group))
-      new_row_keys = [str(ii[0]) for ii in group_rows]
-      row_keys += new_row_keys
+    current = self.get_current_entities(app_id, keys, txn_hash)
+    mutations, _ = self.index_diff(
+      [(entity, None) for entity in current.values()], composite_indexes)
+    if not soft_delete:
+      self.run_mutations('delete indexes', mutations)
+      return
 
-    for prefix, group in itertools.groupby(entities, lambda x: x[0]):
-      group_rows = tuple(kind_row_generator(group))
-      new_row_keys = [str(ii[0]) for ii in group_rows]
-      kind_keys += new_row_keys
+    row_keys = [str(self.get_entity_key(self.get_table_prefix(key),
+                key.path())) for key in keys]
+    row_values = {}
+    for rk in row_keys:
+      root_key = self.get_root_key_from_entity_key(rk)
+      row_values[rk] = {dbconstants.APP_ENTITY_SCHEMA[0]:
+                              TOMBSTONE, 
+                        dbconstants.APP_ENTITY_SCHEMA[1]:
+                              str(txn_hash[root_key])
+                       }
+    # The tombstones are journaled before they replace the entities.
+    self.run_mutations('put journal and delete indexes', mutations +
+      [self.journal_mutation(row_keys, row_values, txn_hash)])
+    self.run_mutations('put tombstones',
+      [(self.datastore_batch.batch_put_entity, dbconstants.APP_ENTITY_TABLE,
+        row_keys, dbconstants.APP_ENTITY_SCHEMA, row_values)])
+
+  def get_current_entities(self, app_id, keys, txn_hash):
+    """ Reads the current versions of the given entities and registers them
+    for rollback.
 
-    # Must fetch the entities to get the keys of indexes before deleting.
+    Args:
+      app_id: The application ID.
+      keys: A list of entity_pb.Reference.
+      txn_hash: A mapping of root keys to transaction IDs.
+    Returns:
+      A dict mapping entity table row keys to the entity_pb.EntityProto
+      stored there, for the entities which exist.
+    """
+    row_keys = [str(self.get_entity_key(self.get_table_prefix(key),
+                key.path())) for key in keys]
     ret = self.datastore_batch.batch_get_entity(dbconstants.APP_ENTITY_TABLE, 
       row_keys, dbconstants.APP_ENTITY_SCHEMA)
 
     self.register_old_entities(ret, txn_hash, app_id)
 
-    if soft_delete:
-      row_values = {}
-      for rk in row_keys:
-        root_key = self.get_root_key_from_entity_key(rk)
-        row_values[rk] = {dbconstants.APP_ENTITY_SCHEMA[0]:
-                                TOMBSTONE, 
-                          dbconstants.APP_ENTITY_SCHEMA[1]:
-                                str(txn_hash[root_key])
-                         }
-      #TODO do these in ||
-      self.datastore_batch.batch_put_entity(dbconstants.APP_ENTITY_TABLE, 
-                                          row_keys, 
-                                          dbconstants.APP_ENTITY_SCHEMA, 
-                                          row_values)    
-      self.update_journal(row_keys, row_values, txn_hash)
-
-    self.datastore_batch.batch_delete(dbconstants.APP_KIND_TABLE,
-                                      kind_keys, 
-                                      column_names=dbconstants.APP_KIND_SCHEMA)
-
-    entities = []
+    entities = {}
     for row_key in ret:
       # Entities may not exist if this is the first put.
       if dbconstants.APP_ENTITY_SCHEMA[0] in ret[row_key] and \
@@ -897,14 +1485,11 @@ class DatastoreDistributed():
            startswith(TOMBSTONE):
         ent = entity_pb.EntityProto()
         ent.ParseFromString(ret[row_key][dbconstants.APP_ENTITY_SCHEMA[0]])
-        entities.append(ent)
+        entities[row_key] = ent
+    return entities
 
-    # Delete associated indexes.
-    self.delete_index_entries(entities)
-    if composite_indexes:
-      self.delete_composite_indexes(entities, composite_indexes)
-
-  def get_journal_key(self, row_key, version):
+  @staticmethod
+  def get_journal_key(row_key, version):
     """ Creates a string for a journal key.
   
     Args:
@@ -913,7 +1498,7 @@ class DatastoreDistributed():
     Returns:
       A string representing a journal key.
     """
-    row_key += self._SEPARATOR
+    row_key += DatastoreDistributed._SEPARATOR
     zero_padded_version = ("0" * (ID_KEY_LENGTH - len(str(version)))) + \
                            str(version)
     row_key += zero_padded_version
@@ -928,6 +1513,20 @@ class DatastoreDistributed():
       txn_hash: A hash mapping root keys to transaction IDs.
     Raises:
       
+    """
+    self.run_mutations('write journal',
+      [self.journal_mutation(row_keys, row_values, txn_hash)])
+
+  def journal_mutation(self, row_keys, row_values, txn_hash):
+    """ Builds the mutation which saves new versions of entities to the
+    journal.
+    
+    Args: 
+      row_keys: A list of keys we will be updating.
+      row_values: Dictionary of values we are storing into the journal.
+      txn_hash: A hash mapping root keys to transaction IDs.
+    Returns:
+      A mutation, as taken by run_mutations.
     """
     journal_keys = []
     journal_values = {}
@@ -940,10 +1539,8 @@ class DatastoreDistributed():
               [dbconstants.APP_ENTITY_SCHEMA[0]] # encoded entity
       journal_values[journal_key] = {column: value}
 
-    self.datastore_batch.batch_put_entity(dbconstants.JOURNAL_TABLE,
-                          journal_keys,
-                          dbconstants.JOURNAL_SCHEMA,
-                          journal_values)
+    return (self.datastore_batch.batch_put_entity, dbconstants.JOURNAL_TABLE,
+            journal_keys, dbconstants.JOURNAL_SCHEMA, journal_values)
 
   def register_old_entities(self, old_entities, txn_hash, app_id):
     """ Tell ZooKeeper about the old versions to enable rollback
@@ -956,24 +1553,24 @@ class DatastoreDistributed():
     Raises:
       ZKTransactionException: If we are unable to register a key/entity.
     """
-    for row_key in old_entities:
-      if dbconstants.APP_ENTITY_SCHEMA[1] in old_entities[row_key]:
-        prev_version = long(old_entities[row_key] \
-            [dbconstants.APP_ENTITY_SCHEMA[1]])
-        # Validate and get the correct version for each key.
-        root_key = self.get_root_key_from_entity_key(row_key)
-        valid_prev_version = self.zookeeper.get_valid_transaction_id(
-          app_id, prev_version, row_key)
-        # Guard against re-registering the rollback version if 
-        # we're updating the same key repeatedly in a transaction.
-        if txn_hash[root_key] != valid_prev_version:
-          try:
-            self.zookeeper.register_updated_key(app_id, txn_hash[root_key], 
-              valid_prev_version, row_key) 
-          except ZKInternalException:
-            raise ZKTransactionException("Unable to register key for " \
-              "old entities {0}, txn_hash {1}, and app id {2}".format(
-              old_entities, txn_hash, app_id))
+    versions = self.get_row_versions(old_entities.iteritems())
+    if not versions:
+      return
+    # Validate and get the correct version for each key.
+    valid_versions = self.zookeeper.get_valid_transaction_ids(app_id, versions)
+    for row_key in versions:
+      root_key = self.get_root_key_from_entity_key(row_key)
+      valid_prev_version = valid_versions[row_key]
+      # Guard against re-registering the rollback version if 
+      # we're updating the same key repeatedly in a transaction.
+      if txn_hash[root_key] != valid_prev_version:
+        try:
+          self.zookeeper.register_updated_key(app_id, txn_hash[root_key], 
+            valid_prev_version, row_key) 
+        except ZKInternalException:
+          raise ZKTransactionException("Unable to register key for " \
+            "old entities {0}, txn_hash {1}, and app id {2}".format(
+            old_entities, txn_hash, app_id))
 
   def dynamic_put(self, app_id, put_request, put_response):
     """ Stores and entity and its indexes in the datastore.
@@ -1026,9 +1623,14 @@ class DatastoreDistributed():
       else:
         txn_hash = self.acquire_locks_for_nontrans(app_id, entities, 
           retries=self.NON_TRANS_LOCK_RETRY_COUNT) 
+      composite_indexes = self.get_composite_indexes(app_id,
+        [self.get_entity_kind(entity) for entity in entities])
       self.put_entities(app_id, entities, txn_hash, 
-        composite_indexes=put_request.composite_index_list())
-      if not put_request.has_transaction():
+        composite_indexes=composite_indexes)
+      if put_request.has_transaction():
+        self.forget_transaction_writes(app_id,
+          put_request.transaction().handle(), [e.key() for e in entities])
+      else:
         self.release_locks_for_nontrans(app_id, entities, txn_hash)
       put_response.key_list().extend([e.key() for e in entities])
     except ZKTransactionException, zkte:
@@ -1036,12 +1638,16 @@ class DatastoreDistributed():
         "info {1}".format(app_id, str(zkte)))
       for root_key in txn_hash:
         self.zookeeper.notify_failed_transaction(app_id, txn_hash[root_key])
+      if put_request.has_transaction():
+        self.drop_transaction_cache(app_id, put_request.transaction().handle())
       raise zkte
     except dbconstants.AppScaleDBConnectionError, dbce:
       logging.exception("Connection issue with datastore for app id {0}, " \
         "info {1}".format(app_id, str(dbce)))
       for root_key in txn_hash:
         self.zookeeper.notify_failed_transaction(app_id, txn_hash[root_key])
+      if put_request.has_transaction():
+        self.drop_transaction_cache(app_id, put_request.transaction().handle())
       raise dbce
 
   def get_root_key_from_entity_key(self, entity_key):
@@ -1084,9 +1690,9 @@ class DatastoreDistributed():
       A hash of root keys mapping to transaction IDs.
     Raises:
      TypeError: If args are the wrong type.
+     ZKTransactionException: If a lock is still in use after all retries.
     """
     root_keys = []
-    txn_hash = {} 
     if not isinstance(entities, list):
       raise TypeError("Expected a list and got {0}".format(entities.__class__))
     for ent in entities:
@@ -1099,24 +1705,47 @@ class DatastoreDistributed():
           "got {0}".format(ent.__class__))
 
     # Remove all duplicate root keys.
-    root_keys = list(set(root_keys))
+    return self.acquire_locks_for_root_keys(app_id, list(set(root_keys)),
+      retries=retries)
+
+  def acquire_locks_for_root_keys(self, app_id, root_keys, retries=0):
+    """ Acquires locks and transaction handlers for a set of entity groups.
+
+    Args:
+      app_id: The application ID.
+      root_keys: A list of distinct root keys of the entity groups to lock.
+      retries: The number of times to try again for groups that are held by
+        other transactions.
+    Returns:
+      A hash of root keys mapping to transaction IDs.
+    Raises:
+     ZKTransactionException: If a lock is still in use after all retries.
+    """
+    txn_hash = {}
+    contended = {}
     try:
-      for root_key in root_keys:
-        txnid = self.setup_transaction(app_id, is_xg=False)
-        txn_hash[root_key] = txnid
-        self.zookeeper.acquire_lock(app_id, txnid, root_key)
-    except ZKTransactionException, zkte:
-      logging.warning("Concurrent transaction exception for app id {0} with " \
-        "info {1}".format(app_id, str(zkte)))
-      if retries > 0:
-        logging.warning("Trying again to acquire lock" \
-          "info {1} with retry #{2}".format(app_id, str(zkte), retries))
+      # The locks for every group are requested at once, and only the groups
+      # held by other transactions are tried again.
+      while True:
+        locked, contended = self.zookeeper.acquire_group_locks(app_id,
+          contended.keys() or root_keys, contended)
+        txn_hash.update(locked)
+        if not contended or retries <= 0:
+          break
+        logging.warning("Trying again to acquire locks for app id {0}, " \
+          "entity keys {1} with retry #{2}".format(app_id, contended.keys(),
+          retries))
+        retries -= 1
         time.sleep(self.LOCK_RETRY_TIME)
-        return self.acquire_locks_for_nontrans(app_id, entities, retries-1)
-      for key in txn_hash:
-        self.zookeeper.notify_failed_transaction(app_id, txn_hash[key])
+    except ZKTransactionException, zkte:
+      self.zookeeper.release_group_locks(app_id, txn_hash, contended)
       raise zkte
 
+    if contended:
+      self.zookeeper.release_group_locks(app_id, txn_hash, contended)
+      raise ZKTransactionException("Concurrent transaction exception for " \
+        "app id {0}, entity keys {1}".format(app_id, contended.keys()))
+
     return txn_hash
       
   def get_root_key(self, app_id, ns, ancestor_list):
@@ -1131,14 +1760,9 @@ class DatastoreDistributed():
     """
     prefix = self.get_table_prefix((app_id, ns))
     first_ent = ancestor_list[0]
-    if first_ent.has_name():
-      key_id = first_ent.name()
-    elif first_ent.has_id():
-      # Make sure ids are ordered lexigraphically by making sure they 
-      # are of set size i.e. 2 > 0003 but 0002 < 0003.
-      key_id = str(first_ent.id()).zfill(ID_KEY_LENGTH)
     return "{0}{1}{2}:{3}{4}".format(prefix, self._NAMESPACE_SEPARATOR, 
-      first_ent.type(), key_id, dbconstants.KIND_SEPARATOR)
+      first_ent.type(), self.__encode_key_id(first_ent),
+      dbconstants.KIND_SEPARATOR)
 
   def is_instance_wrapper(self, obj, expected_type):
     """ A wrapper for isinstance for mocking purposes. 
@@ -1194,7 +1818,7 @@ class DatastoreDistributed():
     try:
       for root_key in root_keys:
         txn_hash[root_key] = txnid
-        self.zookeeper.acquire_lock(app_id, txnid, root_key)
+        self.acquire_transaction_lock(app_id, txnid, root_key)
     except ZKTransactionException, zkte:
       logging.warning("Concurrent transaction exception for app id {0} with " \
         "info {1}".format(app_id, str(zkte)))
@@ -1204,6 +1828,77 @@ class DatastoreDistributed():
 
     return txn_hash
 
+  def get_transaction_cache(self, app_id, txid):
+    """ Gets the cache of a transaction, starting one if there is none.
+
+    Caches are dropped once their transactions could have timed out, so
+    that ZooKeeper is asked about the locks of such transactions again.
+
+    Args:
+      app_id: The application ID.
+      txid: The transaction ID.
+    Returns:
+      A TransactionCache.
+    """
+    expired = time.time() - zk.TX_TIMEOUT
+    with self.transaction_cache_lock:
+      cache = self.transaction_cache.get((app_id, txid))
+      if cache is None or cache.start_time < expired:
+        # Transactions that are never committed or rolled back would
+        # otherwise keep their caches.
+        for key, old_cache in self.transaction_cache.items():
+          if old_cache.start_time < expired:
+            del self.transaction_cache[key]
+        cache = TransactionCache()
+        self.transaction_cache[(app_id, txid)] = cache
+      return cache
+
+  def drop_transaction_cache(self, app_id, txid):
+    """ Drops the cache of a transaction that has finished.
+
+    Args:
+      app_id: The application ID.
+      txid: The transaction ID.
+    """
+    with self.transaction_cache_lock:
+      self.transaction_cache.pop((app_id, txid), None)
+
+  def acquire_transaction_lock(self, app_id, txid, root_key):
+    """ Acquires the lock of an entity group for a transaction, unless the
+    transaction already holds it.
+
+    Args:
+      app_id: The application ID.
+      txid: The transaction ID.
+      root_key: The root key of the entity group.
+    Raises:
+      ZKTransactionException: If the lock could not be acquired.
+    """
+    cache = self.get_transaction_cache(app_id, txid)
+    if root_key in cache.locks:
+      return
+
+    try:
+      self.zookeeper.acquire_lock(app_id, txid, root_key)
+    except ZKTransactionException:
+      self.drop_transaction_cache(app_id, txid)
+      raise
+    cache.locks.add(root_key)
+
+  def forget_transaction_writes(self, app_id, txid, keys):
+    """ Drops what a transaction has read of the entities it writes.
+
+    Args:
+      app_id: The application ID.
+      txid: The transaction ID.
+      keys: A list of entity_pb.References of the entities written.
+    """
+    cache = self.get_transaction_cache(app_id, txid)
+    for key in keys:
+      cache.rows.pop(str(self.get_entity_key(self.get_table_prefix(key),
+        key.path())), None)
+    cache.ranges.clear()
+
   def release_locks_for_nontrans(self, app_id, entities, txn_hash):
     """  Releases locks for non-transactional puts.
   
@@ -1242,10 +1937,10 @@ class DatastoreDistributed():
     """
     if isinstance(db_results, dict): 
       return self.validated_dict_result(app_id, db_results, 
-        current_ongoing_txn=0)
+        current_ongoing_txn=current_ongoing_txn)
     elif isinstance(db_results, list):
       return self.validated_list_result(app_id, db_results, 
-        current_ongoing_txn=0)
+        current_ongoing_txn=current_ongoing_txn)
     else:
       raise TypeError("db_results should be either a list or dict")
 
@@ -1262,48 +1957,42 @@ class DatastoreDistributed():
       A modified copy of db_results whose values have been validated.
 
     """
+    versions = self.get_row_versions(db_results, current_ongoing_txn)
+    if not versions:
+      return db_results
+    valid_versions = self.zookeeper.get_valid_transaction_ids(app_id, versions)
+
     journal_result_map = {}
     journal_keys = []
     # Get all the valid versions of journal entries if needed.
-    for index, dict_entry in enumerate(db_results):
-      row_key = dict_entry.keys()[0]
-      current_version = \
-          long(dict_entry[row_key][dbconstants.APP_ENTITY_SCHEMA[1]])
-      trans_id = self.zookeeper.get_valid_transaction_id(\
-        app_id, current_version, row_key)
-      if current_ongoing_txn != 0 and \
-           current_version == current_ongoing_txn:
-        # This value has been updated from within an ongoing transaction and
-        # hence can be seen from within this scope for serializability.
+    for index, (row_key, _) in enumerate(db_results):
+      if row_key not in versions:
         continue
-      if current_version != trans_id:
+      trans_id = valid_versions[row_key]
+      if versions[row_key] != trans_id:
         journal_key = self.get_journal_key(row_key, trans_id)
         journal_keys.append(journal_key)
         # Index is used here for lookup when replacing back into db_results.
         journal_result_map[journal_key] = (index, row_key, trans_id)
 
-    journal_entities = self.datastore_batch.batch_get_entity(
-                            dbconstants.JOURNAL_TABLE,
-                            journal_keys,
-                            dbconstants.JOURNAL_SCHEMA)
-
     if not journal_result_map: 
       return db_results
 
+    journal_entities = self.__get_journal_entries(journal_keys)
 
     for journal_key in journal_result_map:
       index, row_key, trans_id = journal_result_map[journal_key]
       if dbconstants.JOURNAL_SCHEMA[0] in journal_entities[journal_key]:
-        db_results[index][row_key] = {
+        db_results[index] = Row(row_key, {
           dbconstants.APP_ENTITY_SCHEMA[0]: 
             journal_entities[journal_key][dbconstants.JOURNAL_SCHEMA[0]], 
           dbconstants.APP_ENTITY_SCHEMA[1]: str(trans_id)
-        }
+        })
       else:
         # There was no previous journal because the first put on this 
         # row was apart of a bad transaction, hence we set this key to 
         # be empty.
-        db_results[index][row_key] = {}
+        db_results[index] = Row(row_key, {})
     return db_results
 
 
@@ -1320,22 +2009,18 @@ class DatastoreDistributed():
     Returns:
       A modified copy of db_results whose values have been validated.
     """
+    versions = self.get_row_versions(db_results.iteritems(),
+      current_ongoing_txn)
+    if not versions:
+      return db_results
+    valid_versions = self.zookeeper.get_valid_transaction_ids(app_id, versions)
+
     journal_result_map = {}
     journal_keys = []
     delete_keys = []
-    for row_key in db_results:
-      if dbconstants.APP_ENTITY_SCHEMA[1] not in db_results[row_key]:
-        continue
-      current_version = long(db_results[row_key] \
-        [dbconstants.APP_ENTITY_SCHEMA[1]])
-      trans_id = self.zookeeper.get_valid_transaction_id( \
-        app_id, current_version, row_key)
-      if current_ongoing_txn != 0 and \
-           current_version == current_ongoing_txn:
-        # This value has been updated from within an ongoing transaction and
-        # hence can be seen from within this scope for serializability.
-        continue
-      elif current_version != trans_id:
+    for row_key in versions:
+      trans_id = valid_versions[row_key]
+      if versions[row_key] != trans_id:
         journal_key = self.get_journal_key(row_key, trans_id)
         journal_keys.append(journal_key)
         journal_result_map[journal_key] = (row_key, trans_id)
@@ -1345,8 +2030,7 @@ class DatastoreDistributed():
     if not journal_result_map: 
       return db_results
 
-    journal_entities = self.datastore_batch.batch_get_entity(
-      dbconstants.JOURNAL_TABLE, journal_keys, dbconstants.JOURNAL_SCHEMA)
+    journal_entities = self.__get_journal_entries(journal_keys)
     for journal_key in journal_result_map:
       row_key, trans_id = journal_result_map[journal_key]
       if trans_id == 0:
@@ -1360,6 +2044,53 @@ class DatastoreDistributed():
         }
     return db_results
 
+  @staticmethod
+  def get_row_versions(rows, current_ongoing_txn=0):
+    """ Gets the versions of entity table rows that need validating.
+
+    Args:
+      rows: An iterable of row keys and their columns.
+      current_ongoing_txn: Current transaction ID, 0 if not in a transaction.
+    Returns:
+      A dictionary mapping row keys to the transaction IDs of their versions.
+    """
+    versions = {}
+    for row_key, columns in rows:
+      if dbconstants.APP_ENTITY_SCHEMA[1] not in columns:
+        continue
+      current_version = long(columns[dbconstants.APP_ENTITY_SCHEMA[1]])
+      if current_ongoing_txn != 0 and \
+           current_version == current_ongoing_txn:
+        # This value has been updated from within an ongoing transaction and
+        # hence can be seen from within this scope for serializability.
+        continue
+      versions[row_key] = current_version
+    return versions
+
+  def __get_journal_entries(self, journal_keys):
+    """ Reads entries from the journal table.
+
+    An entry is never changed once it has been written, so whatever a single
+    replica holds for it is current. Each entry is read at ONE, and only the
+    ones that replica does not have yet are read again at the level
+    configured for the table.
+
+    Args:
+      journal_keys: A list of keys to the journal table.
+    Returns:
+      A dictionary of journal keys to their columns.
+    """
+    entries = self.datastore_batch.batch_get_entity(dbconstants.JOURNAL_TABLE,
+      journal_keys, dbconstants.JOURNAL_SCHEMA,
+      consistency=dbconstants.CONSISTENCY_ONE)
+    missing = [journal_key for journal_key in journal_keys
+               if dbconstants.JOURNAL_SCHEMA[0] not in
+                 entries.get(journal_key, {})]
+    if missing:
+      entries.update(self.datastore_batch.batch_get_entity(
+        dbconstants.JOURNAL_TABLE, missing, dbconstants.JOURNAL_SCHEMA))
+    return entries
+
   def remove_tombstoned_entities(self, result):
     """ Removed any keys which have tombstoned entities.
     
@@ -1379,14 +2110,13 @@ class DatastoreDistributed():
       return final_result
     elif isinstance(result, list):
       final_result = []
-      for item in result:
-        key = item.keys()[0]
-        if dbconstants.APP_ENTITY_SCHEMA[0] not in item[key]:
+      for row in result:
+        _, columns = row
+        if dbconstants.APP_ENTITY_SCHEMA[0] not in columns:
           continue
         # Skip over any tombstoned items.
-        if not item[key][dbconstants.APP_ENTITY_SCHEMA[0]].\
-          startswith(TOMBSTONE):
-          final_result.append(item)
+        if not columns[dbconstants.APP_ENTITY_SCHEMA[0]].startswith(TOMBSTONE):
+          final_result.append(row)
       return final_result
     else: 
       raise TypeError("Expected a dict or list for result")
@@ -1406,14 +2136,33 @@ class DatastoreDistributed():
       index_key = str(self.__encode_index_pb(key.path()))
       prefix = self.get_table_prefix(key)
       row_keys.append("{0}{2}{1}".format(prefix, index_key, self._SEPARATOR))
-    result = self.datastore_batch.batch_get_entity(
-                       dbconstants.APP_ENTITY_TABLE, 
-                       row_keys, 
-                       dbconstants.APP_ENTITY_SCHEMA) 
-    if len(key_list) != 0:
+
+    # A transaction reads the rows of the groups it has locked only once.
+    cache = None
+    unread_keys = row_keys
+    if current_txnid and len(key_list) != 0:
+      cache = self.get_transaction_cache(clean_app_id(key_list[0].app()),
+        current_txnid)
+      unread_keys = [row_key for row_key in row_keys
+                     if row_key not in cache.rows]
+
+    result = {}
+    if unread_keys:
+      result = self.datastore_batch.batch_get_entity(
+                         dbconstants.APP_ENTITY_TABLE, 
+                         unread_keys, 
+                         dbconstants.APP_ENTITY_SCHEMA) 
       result = self.validated_result(clean_app_id(key_list[0].app()), 
                   result, current_ongoing_txn=current_txnid)
-    result = self.remove_tombstoned_entities(result)
+      result = self.remove_tombstoned_entities(result)
+
+    if cache is not None:
+      for row_key in unread_keys:
+        if self.get_root_key_from_entity_key(row_key) in cache.locks:
+          cache.rows[row_key] = result.get(row_key)
+      for row_key in row_keys:
+        if row_key not in result and cache.rows.get(row_key) is not None:
+          result[row_key] = cache.rows[row_key]
     return (result, row_keys)
 
   def dynamic_get(self, app_id, get_request, get_response):
@@ -1433,7 +2182,7 @@ class DatastoreDistributed():
       root_key = self.get_root_key_from_entity_key(keys[0])
       txnid = get_request.transaction().handle()
       try:
-        self.zookeeper.acquire_lock(app_id, txnid, root_key)
+        self.acquire_transaction_lock(app_id, txnid, root_key)
       except ZKTransactionException, zkte:
         logging.warning("Concurrent transaction exception for app id {0} " \
           "with transaction id {1}, and info {2}".format(app_id, txnid, 
@@ -1460,39 +2209,25 @@ class DatastoreDistributed():
     if not keys:
       return
 
-    ent_kinds = []
-    for key in delete_request.key_list():
-      last_path = key.path().element_list()[-1]
-      if last_path.type() not in ent_kinds:
-        ent_kinds.append(last_path.type())
-
+    txid = 0
     if delete_request.has_transaction():
-      txn_hash = self.acquire_locks_for_trans(keys, 
-        delete_request.transaction().handle())
+      txid = delete_request.transaction().handle()
+      txn_hash = self.acquire_locks_for_trans(keys, txid)
     else:
       txn_hash = self.acquire_locks_for_nontrans(app_id, keys, 
         retries=self.NON_TRANS_LOCK_RETRY_COUNT) 
 
-    # We use the marked changes field to signify if we should 
-    # look up composite indexes because delete request do not
-    # include that information.
-    composite_indexes = []
-    filtered_indexes = []
-    if delete_request.has_mark_changes():
-      all_composite_indexes = self.get_indices(app_id)
-      for index in all_composite_indexes:
-        new_index = entity_pb.CompositeIndex()
-        new_index.ParseFromString(index)
-        composite_indexes.append(new_index)
-      # Only get composites of the correct kinds.
-      for index in composite_indexes:
-        if index.definition().entity_type() in ent_kinds:
-          filtered_indexes.append(index)
+    # Delete requests do not include the composite indexes of their kinds,
+    # so they are looked up from the cached definitions.
+    composite_indexes = self.get_composite_indexes(app_id,
+      [key.path().element_list()[-1].type() for key in keys])
  
     self.delete_entities(app_id, delete_request.key_list(), txn_hash, 
-      composite_indexes=filtered_indexes, soft_delete=True)
+      composite_indexes=composite_indexes, soft_delete=True)
 
-    if not delete_request.has_transaction():
+    if delete_request.has_transaction():
+      self.forget_transaction_writes(app_id, txid, keys)
+    else:
       self.release_locks_for_nontrans(app_id, keys, txn_hash)
  
   def generate_filter_info(self, filters):
@@ -1633,43 +2368,132 @@ class DatastoreDistributed():
         entities.append(result[key][dbconstants.APP_ENTITY_SCHEMA[0]])
     return entities 
 
-  def __fetch_entities(self, refs, app_id):
-    """ Given the results from a table scan, get the references.
-    
-    Args: 
-      refs: key/value pairs where the values contain a reference to 
-            the entitiy table.
-      app_id: A string, the application identifier.
+  @staticmethod
+  def __get_references(refs):
+    """ Gets the entity table keys from the results of an index scan.
+
+    Args:
+      refs: Rows whose columns contain a reference to the entitiy table.
     Returns:
-      Entities retrieved from entity table.
+      A list of strings which are keys to the entity table.
     """
-    if len(refs) == 0:
-      return []
-    keys = [item.keys()[0] for item in refs]
-    rowkeys = []    
-    for index, ent in enumerate(refs):
-      key = keys[index]
-      ent = ent[key]['reference']
-      rowkeys.append(ent)
-    return self.__fetch_entities_from_row_list(rowkeys, app_id)
+    return [columns['reference'] for _, columns in refs]
+
+  def __get_result_key(self, reference, query):
+    """ Decodes the key of the entity that an index reference points to.
+
+    Args:
+      reference: A str, a key to the entity table.
+      query: The datastore_pb.Query the result is for.
+    Returns:
+      An entity_pb.Reference.
+    """
+    prefix = self.get_table_prefix(query)
+    key = entity_pb.Reference()
+    key.set_app(query.app())
+    if query.name_space():
+      key.set_name_space(query.name_space())
+    self.__decode_index_path(str(reference)[len(prefix) + 1:],
+                             key.mutable_path())
+    return key
+
+  @staticmethod
+  def __new_result_entity(key):
+    """ Builds a result that carries only the key of an entity.
+
+    Args:
+      key: The entity_pb.Reference of the entity.
+    Returns:
+      An entity_pb.EntityProto.
+    """
+    entity = entity_pb.EntityProto()
+    entity.mutable_key().CopyFrom(key)
+    entity.mutable_entity_group()
+    return entity
+
+  def __get_key_only_results(self, references, query):
+    """ Builds keys-only results from their references without reading the
+    entity table.
+
+    None of the keys are checked against the journal, tombstones or the
+    transaction blacklist, so a key is returned for every index entry the
+    scan found, as it is for the counts and offsets built from them.
+
+    Args:
+      references: A list of strings which are keys to the entity table.
+      query: The datastore_pb.Query the results are for.
+    Returns:
+      A list of encoded entities that only have their keys set.
+    """
+    return [self.__new_result_entity(
+              self.__get_result_key(reference, query)).Encode()
+            for reference in references]
+
+  def __get_projected_results(self, refs, query, property_name, direction):
+    """ Builds projection results from the values stored in the keys of a
+    single property index.
+
+    Args:
+      refs: Rows from a scan of a single property table.
+      query: The datastore_pb.Query the results are for.
+      property_name: A string, the property the index is on.
+      direction: The datastore_pb.Query_Order direction of the table.
+    Returns:
+      A list of encoded entities with their key and the projected property.
+    """
+    prefix = self.get_table_prefix(query)
+    value_start = len(self.get_index_key_from_params(
+      [prefix, query.kind(), property_name, None]))
+    results = []
+    for index_key, columns in refs:
+      reference = str(columns['reference'])
+      encoded_path = reference[len(prefix) + 1:]
+      value = str(index_key)[value_start:-(len(encoded_path) + 1)]
+      if direction == datastore_pb.Query_Order.DESCENDING:
+        value = helper_functions.reverse_lex(value)
+
+      entity = self.__new_result_entity(
+        self.__get_result_key(reference, query))
+      prop = entity.add_property()
+      prop.set_name(property_name)
+      prop.set_meaning(entity_pb.Property.INDEX_VALUE)
+      prop.set_multiple(False)
+      decoder = sortable_pb_encoder.Decoder(array.array('B', value), 0,
+                                            len(value))
+      prop.mutable_value().Merge(decoder)
+      results.append(entity.Encode())
+    return results
+
+  def __fetch_query_results(self, references, query):
+    """ Gets the results of a query from the references its index scan found.
+
+    Keys-only queries are answered from the references alone. Otherwise
+    only the results past the offset are read from the entity table, since
+    the skipped ones are never returned.
+
+    Args:
+      references: A list of strings which are keys to the entity table.
+      query: The datastore_pb.Query the results are for.
+    Returns:
+      A list of encoded entities.
+    """
+    if query.keys_only():
+      return self.__get_key_only_results(references, query)
+    offset = min(query.offset(), len(references))
+    return self.__get_key_only_results(references[:offset], query) + \
+      self.__fetch_entities_from_row_list(references[offset:],
+                                          clean_app_id(query.app()))
 
   def __extract_entities(self, kv):
     """ Given a result from a range query on the Entity table return a 
         list of encoded entities.
 
     Args:
-      kv: Key and values from a range query on the entity table.
+      kv: Rows from a range query on the entity table.
     Returns:
       The extracted entities.
     """
-    keys = [item.keys()[0] for item in kv]
-    results = []    
-    for index, entity in enumerate(kv):
-      key = keys[index]
-      entity = entity[key][dbconstants.APP_ENTITY_SCHEMA[0]]
-      results.append(entity)
-
-    return results
+    return [columns[dbconstants.APP_ENTITY_SCHEMA[0]] for _, columns in kv]
 
   def ordered_ancestor_query(self, query, filter_info, order_info):
     """ Performs an ordered ancestor query. It grabs all entities of a 
@@ -1694,7 +2518,8 @@ class DatastoreDistributed():
       root_key = self.get_root_key_from_entity_key(ancestor)
       try:
         prefix = self.get_table_prefix(query)
-        self.zookeeper.acquire_lock(clean_app_id(query.app()), txn_id, root_key)
+        self.acquire_transaction_lock(clean_app_id(query.app()), txn_id,
+          root_key)
       except ZKTransactionException, zkte:
         logging.warning("Concurrent transaction exception for app id {0}, " \
           "transaction id {1}, info {2}".format(query.app(), txn_id, str(zkte)))
@@ -1753,7 +2578,8 @@ class DatastoreDistributed():
       txn_id = query.transaction().handle()   
       root_key = self.get_root_key_from_entity_key(ancestor)
       try:
-        self.zookeeper.acquire_lock(clean_app_id(query.app()), txn_id, root_key)
+        self.acquire_transaction_lock(clean_app_id(query.app()), txn_id,
+          root_key)
       except ZKTransactionException, zkte:
         logging.warning("Concurrent transaction exception for app id {0}, " \
           "transaction id {1}, info {2}".format(query.app(), txn_id, str(zkte)))
@@ -1834,39 +2660,46 @@ class DatastoreDistributed():
     Returns:
        A validated database result.
     """
+    # A transaction reads each range of a group it has locked only once.
+    cache = None
+    bounds = (str(startrow), str(endrow), limit, start_inclusive,
+              end_inclusive)
+    if txn_id and query.has_ancestor():
+      cache = self.get_transaction_cache(clean_app_id(query.app()), txn_id)
+      if self.get_root_key_from_entity_key(query.ancestor()) not in \
+          cache.locks:
+        cache = None
+      elif bounds in cache.ranges:
+        return list(cache.ranges[bounds])
+
+    # The range is streamed a page at a time, and each page is validated as
+    # it arrives, until enough of its entities have turned out to be valid.
+    page_size = max(min(limit, SCAN_PAGE_SIZE), 1)
+    rows = self.datastore_batch.range_scan(dbconstants.APP_ENTITY_TABLE,
+                                           dbconstants.APP_ENTITY_SCHEMA,
+                                           startrow,
+                                           endrow,
+                                           start_inclusive=start_inclusive,
+                                           end_inclusive=end_inclusive,
+                                           buffer_size=page_size)
     final_result = []
-    while 1: 
-      result = self.datastore_batch.range_query(dbconstants.APP_ENTITY_TABLE, 
-                                               dbconstants.APP_ENTITY_SCHEMA,
-                                               startrow, 
-                                               endrow, 
-                                               limit, 
-                                               offset=0, 
-                                               start_inclusive=start_inclusive,
-                                               end_inclusive=end_inclusive)
-      prev_len = len(result)
-      last_result = None
-      if result:
-        last_result = result[-1].keys()[0]
-      else: 
+    while len(final_result) < limit:
+      page = list(itertools.islice(rows, page_size))
+      if not page:
         break
 
-      result = self.validated_result(clean_app_id(query.app()), result, 
+      result = self.validated_result(clean_app_id(query.app()), page, 
                                      current_ongoing_txn=txn_id)
 
-      result = self.remove_tombstoned_entities(result)
-
-      final_result += result
+      final_result += self.remove_tombstoned_entities(result)
 
-      if len(result) != prev_len:
-        startrow = last_result
-        start_inclusive = self._DISABLE_INCLUSIVITY
-        limit = limit - len(result)
-        continue 
-      else:
+      if len(page) < page_size:
         break
 
-    return self.__extract_entities(final_result)
+    entities = self.__extract_entities(final_result[:limit])
+    if cache is not None:
+      cache.ranges[bounds] = entities
+    return list(entities)
 
 
   def kindless_query(self, query, filter_info, order_info):
@@ -2005,14 +2838,16 @@ class DatastoreDistributed():
           dbconstants.KIND_SEPARATOR + __key__ 
     return startrow, endrow, start_inclusive, end_inclusive
 
-  def default_namespace(self):
+  def default_namespace(self, app_id):
     """ Returns the default namespace entry because the groomer does not
     generate it for each application.
  
+    Args:
+      app_id: A str, the application identifier the entry belongs to.
     Returns:
       A entity proto of the default metadata.Namespace.
     """
-    default_namespace = Namespace(id=1)
+    default_namespace = Namespace(id=1, _app=app_id)
     protobuf = db.model_to_protobuf(default_namespace)
     last_path = protobuf.key().path().element_list()[-1]
     last_path.set_id(1)
@@ -2075,14 +2910,16 @@ class DatastoreDistributed():
                                               start_inclusive=start_inclusive, 
                                               end_inclusive=end_inclusive)
 
-    fetched_entities = self.__fetch_entities(result, clean_app_id(query.app()))
+    fetched_entities = self.__fetch_query_results(
+      self.__get_references(result), query)
     if query.kind() == "__namespace__":
-      fetched_entities = [self.default_namespace()] + fetched_entities
+      fetched_entities = [self.default_namespace(clean_app_id(query.app()))] \
+        + fetched_entities
     return fetched_entities
 
   def remove_exists_filters(self, filter_info):
-    """ We don't have native support for projection queries, so remove
-    any filters that have EXISTS filters.
+    """ Remove any filters that have EXISTS filters. Projection queries add
+    them, but only entities with the property are in its index anyway.
   
     Args:
       filter_info: dict of property names mapping to tuples of filter 
@@ -2118,6 +2955,12 @@ class DatastoreDistributed():
     property_names = set(filter_info.keys())
     property_names.update(x[0] for x in order_info)
     property_names.discard('__key__')
+    # A projection on its own is answered by a scan of the property's index.
+    if not filter_info and not order_info and \
+      not query.has_ancestor() and query.property_name_size() == 1:
+      property_names.add(query.property_name(0))
+      order_info = [(query.property_name(0),
+                     datastore_pb.Query_Order.ASCENDING)]
     if len(property_names) != 1:
       return None
 
@@ -2177,7 +3020,12 @@ class DatastoreDistributed():
                                query=query,
                                end_compiled_cursor=end_compiled_cursor)
 
-    return self.__fetch_entities(references, clean_app_id(query.app()))
+    # A projection on the indexed property is answered from the index.
+    if list(query.property_name_list()) == [property_name]:
+      return self.__get_projected_results(references, query, property_name,
+                                          direction)
+    return self.__fetch_query_results(self.__get_references(references),
+                                      query)
  
   def __apply_filters(self, 
                      filter_ops, 
@@ -2498,6 +3346,14 @@ class DatastoreDistributed():
     See http://www.youtube.com/watch?v=AgaL6NGpkB8 for Google's 
     implementation.
 
+    The index rows of each property are ordered by entity key. Every round
+    reads a small batch from each index, starting at the current candidate
+    key, with the scans running at the same time. The scan that reaches
+    furthest comes from the sparsest index, and its keys are the possible
+    matches. Keys past the end of another scan are checked by seeking
+    straight to their rows in that index, and the next round starts after
+    the furthest key.
+
     Args:
       query: A datastore_pb.Query.
       filter_info: dict of property names mapping to tuples of filter 
@@ -2508,143 +3364,158 @@ class DatastoreDistributed():
     """ 
     if not self.is_zigzag_merge_join(query, filter_info, order_info):
       return None
-    kind = query.kind()  
+    filter_info = self.remove_exists_filters(filter_info)
+    property_names = filter_info.keys()
     prefix = self.get_table_prefix(query)
     limit = self.get_limit(query)
 
-    count = self._MAX_COMPOSITE_WINDOW
-    start_key = ""
-    result_list = []
-    force_exclusive = False
-    more_results = True
-    ancestor = None
+    path_start = ''
     if query.has_ancestor():
-      ancestor = query.ancestor()
+      path_start = str(self.__encode_index_pb(query.ancestor().path()))
+    path_end = path_start + self._TERM_STRING
 
-    while more_results:
-      reference_counter_hash = {}
-      temp_res = {}
-      # We use what we learned from the previous scans to skip over any keys 
-      # that we know will not be a match.
-      startrow = "" 
-      # TODO Do these in parallel and measure speedup.
-      # I've tried a thread wrapper before but due to the function having
-      # self attributes it's nontrivial.
-      for prop_name in filter_info.keys():
-        filter_ops = filter_info.get(prop_name, [])
-        if start_key:
-          # Grab the reference key which is after the last delimiter. 
-          value = str(filter_ops[0][1])
-          reference_key = start_key.split(self._SEPARATOR)[-1]
-          params = [prefix, kind, prop_name, value, reference_key]
-          startrow = self.get_index_key_from_params(params)
-        elif query.has_compiled_cursor() and \
-          query.compiled_cursor().position_size():
-          cursor = appscale_stub_util.ListCursor(query)
-          last_result = cursor._GetLastResult()
-          value = str(filter_ops[0][1])
-          reference_key = str(self.__encode_index_pb(last_result.key().path()))
-          params = [prefix, kind, prop_name, value, reference_key]
-          startrow = self.get_index_key_from_params(params)
+    candidate = path_start
+    if query.has_compiled_cursor() and query.compiled_cursor().position_size():
+      last_result = appscale_stub_util.ListCursor(query)._GetLastResult()
+      candidate = max(candidate, self.__next_path(
+        str(self.__encode_index_pb(last_result.key().path()))))
+
+    paths = []
+    while len(paths) < limit:
+      batch_size = min(max(limit - len(paths), self._MIN_ZIGZAG_SEEK),
+                       self._MAX_ZIGZAG_SEEK)
+      scans = self.__run_index_reads([
+        (self.__scan_equality_index, (query, filter_info, name, candidate,
+                                      path_end, batch_size))
+        for name in property_names])
+      if not all(scans):
+        break
 
-        # We use equality filters only so order ops should always be ASC. 
-        order_ops = []
-        for i in order_info:
-          if i[0] == prop_name:
-            order_ops = [i]
-            break
+      lead = max(scans, key=lambda scan: scan[-1])
+      found = [set(scan) for scan in scans]
+      seeks = []
+      for name, scan, found_paths in zip(property_names, scans, found):
+        # A scan which came back short has no rows past its end to seek to.
+        if scan is lead or len(scan) < batch_size:
+          continue
+        targets = [path for path in lead if path > scan[-1]]
+        if targets:
+          seeks.append((found_paths, (self.__seek_equality_index,
+            (query, filter_info, name, targets))))
+      for (found_paths, _), seek_result in zip(seeks,
+          self.__run_index_reads([read for _, read in seeks])):
+        found_paths.update(seek_result)
+
+      paths.extend(path for path in lead
+                   if all(path in found_paths for found_paths in found))
+
+      # Once an index runs out of rows, no later entity can match.
+      if any(len(scan) < batch_size for scan in scans):
+        break
+      candidate = self.__next_path(lead[-1])
 
-        temp_res[prop_name] = self.__apply_filters(filter_ops, 
-          order_ops, 
-          prop_name, 
-          kind, 
-          prefix, 
-          count, 
-          0, 
-          startrow,
-          force_start_key_exclusive=force_exclusive,
-          ancestor=ancestor)
-      # We do reference counting and consider any reference which matches the 
-      # number of properties to be a match. Any others are discarded but it 
-      # possible they show up on subsequent scans. 
-      last_keys_of_scans = {}
-      for prop_name in temp_res:
-        for indexes in temp_res[prop_name]:
-          for reference in indexes: 
-            reference_key = indexes[reference]['reference']
-            if reference_key in reference_counter_hash:
-              reference_counter_hash[reference_key] += 1
-            else:
-              reference_counter_hash[reference_key] = 1
-          # Of the set of entity scans we use the earliest of the set as the
-          # starting point of scans to follow. This makes sure we do not miss 
-          # overlapping results because different properties had different 
-          # distributions of keys. The index value gives us the key to 
-          # the entity table (what the index points to).
-          index_key = indexes.keys()[0]
-          index_value = indexes[index_key]['reference']
-          last_keys_of_scans[prop_name] = index_value
-
-      # We are looking for the earliest (alphabetically) of the set of last 
-      # keys. This tells us where to start our next scans. And from where 
-      # we can remove potential results.
-      start_key = ""
-      starting_prop_name = ""
-      for prop_name in last_keys_of_scans:
-        last_key = last_keys_of_scans[prop_name]
-        if not start_key or last_key < start_key: 
-          start_key = last_key
-          starting_prop_name = prop_name
-      # Purge keys which did not intersect from all equality filters and those
-      # which are past the earliest reference shared by all property names 
-      # (start_key variable). 
-      keys_to_delete = []
-      for key in reference_counter_hash:
-        if reference_counter_hash[key] != len(filter_info.keys()):
-          keys_to_delete.append(key)
-      # You cannot loop on a dictionary and delete from it at the same time.
-      # Hence why the deletes happen here.
-      for key in keys_to_delete:
-        del reference_counter_hash[key]
-
-      result_list.extend(reference_counter_hash.keys())
-      # If the property we are setting the start key did not get the requested 
-      # amount of entities then we can stop scanning, as there are no more 
-      # entities to scan from that property.
-      for prop_name in temp_res:
-        if len(temp_res[prop_name]) < count and prop_name == starting_prop_name:
-          more_results = False
-
-        # If any property no longer has any more items, this query is done.
-        if len(temp_res[prop_name]) == 0:
-          more_results = False 
-
-      # If we reached our limit of result entities, then we are done.
-      if len(result_list) >= limit:
-        more_results = False
-
-      # Do not include the first key in subsequent scans because we have 
-      # already accounted for the given entity.
-      if start_key in result_list:
-        force_exclusive = True
-
-    # Sort and apply the limit.
-    result_list.sort()
-    result_list = result_list[:limit]
-    result_set = self.__fetch_entities_from_row_list(result_list, 
-      clean_app_id(query.app()))
-    return result_set
+    references = [prefix + self._SEPARATOR + path for path in paths[:limit]]
+    return self.__fetch_query_results(references, query)
+
+  def __next_path(self, path):
+    """ Gives the smallest encoded path that sorts after the given one.
+
+    Args:
+      path: A str, an encoded entity path.
+    Returns:
+      A str which sorts after the path and before any other path.
+    """
+    return path + self._SEPARATOR
+
+  def __get_equality_index_head(self, query, filter_info, property_name):
+    """ Builds the start of the index keys of entities matching an equality
+    filter. The encoded entity path follows it.
+
+    Args:
+      query: A datastore_pb.Query.
+      filter_info: dict of property names mapping to tuples of filter 
+        operators and values.
+      property_name: A str, the name of the filtered property.
+    Returns:
+      A str, the shared start of the index keys.
+    """
+    value = str(filter_info[property_name][0][1])
+    return self.get_index_key_from_params(
+      [self.get_table_prefix(query), query.kind(), property_name, value, None])
+
+  def __scan_equality_index(self, query, filter_info, property_name,
+    start_path, end_path, batch_size):
+    """ Reads the index rows of entities matching an equality filter.
+
+    Args:
+      query: A datastore_pb.Query.
+      filter_info: dict of property names mapping to tuples of filter 
+        operators and values.
+      property_name: A str, the name of the filtered property.
+      start_path: A str, the encoded entity path to start the scan at.
+      end_path: A str, the encoded entity path to end the scan at.
+      batch_size: An int, the number of rows to read.
+    Returns:
+      A list of the encoded entity paths found, in order.
+    """
+    head = self.__get_equality_index_head(query, filter_info, property_name)
+    rows = self.datastore_batch.range_scan(dbconstants.ASC_PROPERTY_TABLE,
+      dbconstants.PROPERTY_SCHEMA, head + start_path, head + end_path,
+      limit=batch_size, keys_only=True, buffer_size=batch_size)
+    return [key[len(head):] for key, _ in rows]
+
+  def __seek_equality_index(self, query, filter_info, property_name, paths):
+    """ Checks which entities have an index row for an equality filter.
+
+    Args:
+      query: A datastore_pb.Query.
+      filter_info: dict of property names mapping to tuples of filter 
+        operators and values.
+      property_name: A str, the name of the filtered property.
+      paths: A list of encoded entity paths to look for.
+    Returns:
+      A list of the encoded entity paths which have a row.
+    """
+    head = self.__get_equality_index_head(query, filter_info, property_name)
+    result = self.datastore_batch.batch_get_entity(
+      dbconstants.ASC_PROPERTY_TABLE, [head + path for path in paths],
+      dbconstants.PROPERTY_SCHEMA)
+    return [path for path in paths if result.get(head + path)]
+
+  def __run_index_reads(self, reads):
+    """ Runs index reads, at the same time when there is a scan pool.
+
+    Args:
+      reads: A list of tuples of a function and its arguments.
+    Returns:
+      A list of the results of the reads, in order.
+    """
+    if scan_pool is None or len(reads) < 2:
+      return [function(*args) for function, args in reads]
+    return scan_pool.map(lambda read: read[0](*read[1]), reads)
 
   def does_composite_index_exist(self, query):
     """ Checks to see if the query has a composite index that can implement
     the given query. 
 
+    AppServers cache index definitions, so the state of the index is looked
+    up here. An index only serves queries once the index builder has filled
+    it in and marked it READ_WRITE.
+
     Args:
       query: A datastore_pb.Query.
     Returns:
-      True if the composite exists, False otherwise.
+      True if the composite exists and is serving, False otherwise.
     """
-    return query.composite_index_size() > 0
+    if query.composite_index_size() == 0:
+      return False
+
+    index_id = query.composite_index(0).id()
+    for index in self.get_composite_indexes(clean_app_id(query.app()),
+                                            [query.kind()]):
+      if index.id() == index_id:
+        return index.state() == entity_pb.CompositeIndex.READ_WRITE
+    return False
 
   def get_range_composite_query(self, query, filter_info):
     """ Gets the start and end key of a composite query. 
@@ -2872,16 +3743,16 @@ class DatastoreDistributed():
     table_name = dbconstants.COMPOSITE_TABLE
     column_names = dbconstants.COMPOSITE_SCHEMA
     limit = self.get_limit(query)
-    offset = query.offset()
     index_result = self.datastore_batch.range_query(table_name, 
                                              column_names, 
                                              startrow, 
                                              endrow, 
                                              limit, 
-                                             offset=offset, 
+                                             offset=0, 
                                              start_inclusive=start_inclusive,
                                              end_inclusive=True)
-    return self.__fetch_entities(index_result, clean_app_id(query.app()))
+    return self.__fetch_query_results(self.__get_references(index_result),
+                                      query)
 
   def __composite_query(self, query, filter_info, _):  
     """Performs Composite queries which is a combination of 
@@ -2897,6 +3768,13 @@ class DatastoreDistributed():
     if self.does_composite_index_exist(query):
       return self.composite_v2(query, filter_info)
 
+    if query.composite_index_size() > 0:
+      logging.info("Composite index {0} is not serving yet.".format(
+        query.composite_index(0).id()))
+      raise apiproxy_errors.ApplicationError(
+        datastore_pb.Error.NEED_INDEX,
+        'The composite index is still being built')
+
     logging.error("No composite ID was found for query {0}.".format(query))
     raise apiproxy_errors.ApplicationError(
       datastore_pb.Error.NEED_INDEX,
@@ -3021,17 +3899,17 @@ class DatastoreDistributed():
       query_result: The response given to the application server.
     """
     result = self.__get_query_results(query)
-    count = 0
-    offset = query.offset()
-    if result:
-      query_result.set_skipped_results(len(result) - offset)
-      count = len(result)
-      result = result[offset:]
-      for index, ii in enumerate(result):
-        result[index] = entity_pb.EntityProto(ii) 
-
+    for index, ii in enumerate(result):
+      result[index] = entity_pb.EntityProto(ii)
+      # Queries on the entity table read whole entities.
+      if query.keys_only():
+        result[index].clear_property()
+        result[index].clear_raw_property()
+
+    # Fetches stop at the limit, so a full batch may have more behind it.
+    more_results = len(result) >= self.get_limit(query)
     cur = appscale_stub_util.QueryCursor(query, result)
-    cur.PopulateQueryResult(count, query.offset(), query_result) 
+    cur.PopulateQueryResult(query.offset(), more_results, query_result)
 
   def setup_transaction(self, app_id, is_xg):
     """ Gets a transaction ID for a new transaction.
@@ -3057,6 +3935,7 @@ class DatastoreDistributed():
     commitres_pb = datastore_pb.CommitResponse()
     transaction_pb = datastore_pb.Transaction(http_request_data)
     txn_id = transaction_pb.handle()
+    self.drop_transaction_cache(app_id, txn_id)
     try:
       self.zookeeper.release_lock(app_id, txn_id)
       return (commitres_pb.Encode(), 0, "")
@@ -3086,6 +3965,7 @@ class DatastoreDistributed():
     txn = datastore_pb.Transaction(http_request_data)
     logging.error("Doing a rollback on transaction id {0} for app id {1}"
       .format(txn.handle(), app_id))
+    self.drop_transaction_cache(app_id, txn.handle())
     try:
       self.zookeeper.notify_failed_transaction(app_id, txn.handle())
       return (api_base_pb.VoidProto().Encode(), 0, "")
@@ -3119,6 +3999,10 @@ class MainHandler(tornado.web.RequestHandler):
     """ Function which handles POST requests. Data of the request is 
         the request from the AppServer in an encoded protocol buffer 
         format.
+
+    The datastore operation is handed to the worker pool when there is one,
+    so that a slow Cassandra or ZooKeeper call does not stall every other
+    request to this server. The response is written back on the IOLoop.
     """
     request = self.request
     http_request_data = request.body
@@ -3126,26 +4010,42 @@ class MainHandler(tornado.web.RequestHandler):
     app_data = request.headers['appdata']
     app_data  = app_data.split(':')
 
+    # Per-request information is kept local to the request rather than in 
+    # os.environ, since requests run concurrently.
     if len(app_data) == 4:
-      app_id, user_email, nick_name, auth_domain = app_data
-      os.environ['AUTH_DOMAIN'] = auth_domain
-      os.environ['USER_EMAIL'] = user_email
-      os.environ['USER_NICKNAME'] = nick_name
-      os.environ['APPLICATION_ID'] = app_id
+      app_id, _, _, _ = app_data
     elif len(app_data) == 1:
       app_id = app_data[0]
-      os.environ['APPLICATION_ID'] = app_id
     else:
+      self.finish()
       return
 
     # If the application identifier has the HRD string prepened, remove it.
     app_id = clean_app_id(app_id)
 
-    if pb_type == "Request":
-      self.remote_request(app_id, http_request_data)
-    else:
+    if pb_type != "Request":
       self.unknown_request(app_id, http_request_data, pb_type)
-    self.finish()
+      self.finish()
+      return
+
+    if worker_pool is None:
+      self.finish(self.remote_request(app_id, http_request_data))
+      return
+
+    io_loop = tornado.ioloop.IOLoop.instance()
+    def run_in_worker():
+      """ Runs the request on a worker thread and hands the encoded response
+      back to the IOLoop thread, which is the only one allowed to write it.
+      """
+      try:
+        response = self.remote_request(app_id, http_request_data)
+      except Exception, exception:
+        logging.exception(exception)
+        io_loop.add_callback(lambda: self.send_error(500))
+        return
+      io_loop.add_callback(lambda: self.finish(response))
+
+    worker_pool.apply_async(run_in_worker)
   
   @tornado.web.asynchronous
   def get(self):
@@ -3163,6 +4063,8 @@ class MainHandler(tornado.web.RequestHandler):
     Args:
       app_id: The application ID that is sending this request.
       http_request_data: Encoded protocol buffer.
+    Returns:
+      A str, the encoded remote_api_pb.Response for the request.
     """
     apirequest = remote_api_pb.Request()
     apirequest.ParseFromString(http_request_data)
@@ -3215,6 +4117,9 @@ class MainHandler(tornado.web.RequestHandler):
     elif method == "GetIndices":
       response, errcode, errdetail = self.get_indices_request(app_id)
     elif method == "UpdateIndex":
+      # Index states are set by the index builder once it has built them, so
+      # an update only has it check for work.
+      notify_index_builder()
       response = api_base_pb.VoidProto().Encode()
       errcode = 0
       errdetail = ""
@@ -3231,7 +4136,7 @@ class MainHandler(tornado.web.RequestHandler):
       apperror_pb.set_code(errcode)
       apperror_pb.set_detail(errdetail)
 
-    self.write(apiresponse.Encode())
+    return apiresponse.Encode()
 
   def begin_transaction_request(self, app_id, http_request_data):
     """ Handles the intial request to start a transaction. Replies with 
@@ -3336,6 +4241,12 @@ class MainHandler(tornado.web.RequestHandler):
       return (clone_qr_pb.Encode(),
              datastore_pb.Error.INTERNAL_ERROR,
              "Datastore connection error on run_query request.")
+    except apiproxy_errors.ApplicationError, application_error:
+      logging.info("Query for app id {0} failed: {1}".format(query.app(),
+        application_error.error_detail))
+      clone_qr_pb.set_more_results(False)
+      return (clone_qr_pb.Encode(), application_error.application_error,
+              application_error.error_detail)
     return (clone_qr_pb.Encode(), 0, "")
 
   def create_index_request(self, app_id, http_request_data):
@@ -3354,6 +4265,7 @@ class MainHandler(tornado.web.RequestHandler):
     try:
       index_id = datastore_access.create_composite_index(app_id, request)
       response.set_value(index_id)
+      notify_index_builder()
     except dbconstants.AppScaleDBConnectionError, dbce:
       logging.error("Connection issue with datastore for app id {0}, " \
         "info {1}".format(app_id, str(dbce)))
@@ -3378,6 +4290,7 @@ class MainHandler(tornado.web.RequestHandler):
     response = api_base_pb.VoidProto()
     try: 
       datastore_access.delete_composite_index_metadata(app_id, request)
+      notify_index_builder()
     except dbconstants.AppScaleDBConnectionError, dbce:
       logging.error("Connection issue with datastore for app id {0}, " \
         "info {1}".format(app_id, str(dbce)))
@@ -3572,6 +4485,8 @@ def usage():
   print "\t--no_encryption"
   print "\t--port"
   print "\t--zoo_keeper <zk nodes>"
+  print "\t--workers <number of worker threads, 0 to run inline>"
+  print "\t--index_build_rate <entities indexed per second, 0 for no limit>"
 
 pb_application = tornado.web.Application([
     (r"/*", MainHandler),
@@ -3580,7 +4495,13 @@ pb_application = tornado.web.Application([
 def main(argv):
   """ Starts a web service for handing datastore requests. """
   global datastore_access
+  global worker_pool
+  global mutation_pool
+  global scan_pool
+  global composite_index_builder
   zookeeper_locations = ""
+  num_workers = DEFAULT_NUM_WORKERS
+  index_build_rate = index_builder.IndexBuilder.DEFAULT_MAX_RATE
 
   db_info = appscale_info.get_db_info()
   db_type = db_info[':table']
@@ -3588,11 +4509,13 @@ def main(argv):
   is_encrypted = True
 
   try:
-    opts, args = getopt.getopt( argv, "t:p:n:z:",
+    opts, args = getopt.getopt( argv, "t:p:n:z:w:r:",
                                ["type=",
                                 "port",
                                 "no_encryption",
-                                "zoo_keeper"] )
+                                "zoo_keeper",
+                                "workers=",
+                                "index_build_rate="] )
   except getopt.GetoptError:
     usage()
     sys.exit(1)
@@ -3607,6 +4530,10 @@ def main(argv):
       is_encrypted = False
     elif opt in ("-z", "--zoo_keeper"):
       zookeeper_locations = arg
+    elif opt in ("-w", "--workers"):
+      num_workers = int(arg)
+    elif opt in ("-r", "--index_build_rate"):
+      index_build_rate = int(arg)
 
   if db_type not in VALID_DATASTORES:
     print "This datastore is not supported for this version of the AppScale\
@@ -3621,12 +4548,25 @@ def main(argv):
   if port == DEFAULT_SSL_PORT and not is_encrypted:
     port = DEFAULT_PORT
 
-  server = tornado.httpserver.HTTPServer(pb_application)
+  if num_workers > 0:
+    worker_pool = multiprocessing.pool.ThreadPool(processes=num_workers)
+  mutation_pool = multiprocessing.pool.ThreadPool(
+    processes=max(num_workers, 1) * MUTATIONS_PER_WRITE)
+  scan_pool = multiprocessing.pool.ThreadPool(
+    processes=max(num_workers, 1) * SCANS_PER_QUERY)
+
+  # AppServers reuse connections across requests, so keep HTTP/1.1
+  # connections open after each response.
+  server = tornado.httpserver.HTTPServer(pb_application, no_keep_alive=False)
   server.listen(port)
 
   ds_groomer = groomer.DatastoreGroomer(zookeeper, db_type, LOCAL_DATASTORE)
   ds_groomer.start()
 
+  composite_index_builder = index_builder.IndexBuilder(zookeeper,
+    datastore_access, max_rate=index_build_rate)
+  composite_index_builder.start()
+
   while 1:
     try:
       # Start Server #
@@ -4,11 +4,17 @@
 """
 SECRET_LOCATION = "/etc/appscale/secret.key"
 
+# The file with the default consistency levels of reads and writes.
+CONSISTENCY_CONFIG_LOCATION = "/etc/appscale/datastore_consistency.json"
+
 ERROR_DEFAULT = "DB_ERROR:"
 NONEXISTANT_TRANSACTION = "0"
 KEY_DELIMITER = '\x00'
 KIND_SEPARATOR = '\x01'
 
+# Starts the names in encoded key paths that could otherwise be read as IDs.
+NAME_MARKER = '\x02'
+
 # Table names
 USERS_TABLE = "USERS__"
 APPS_TABLE = "APPS__"
@@ -23,6 +29,21 @@ APP_KIND_TABLE = "KINDS__"
 JOURNAL_TABLE = "JOURNAL__"
 METADATA_TABLE = "METADATA__"
 
+# Consistency levels a read or write can be made at. A read at ONE is
+# answered by a single replica, and may miss the latest writes unless they
+# were made at ALL.
+CONSISTENCY_ONE = "ONE"
+CONSISTENCY_QUORUM = "QUORUM"
+CONSISTENCY_ALL = "ALL"
+CONSISTENCY_LEVELS = [CONSISTENCY_ONE, CONSISTENCY_QUORUM, CONSISTENCY_ALL]
+
+# The level used when neither the caller nor the configuration chooses one.
+DEFAULT_CONSISTENCY = CONSISTENCY_QUORUM
+
+# The kinds of operations that have their own consistency levels.
+READ_OPERATION = "read"
+WRITE_OPERATION = "write"
+
 INITIAL_TABLES = [ASC_PROPERTY_TABLE,
                   DSC_PROPERTY_TABLE,
                   APP_ID_TABLE,
@@ -3,10 +3,23 @@
 """ 
  AppScale Datastore Interface 
 """
+import collections
+import json
+import logging
 import os
 
+import dbconstants
+
+# A row read from a range of a table, holding its key and a dictionary of its
+# columns/values.
+Row = collections.namedtuple('Row', ['key', 'columns'])
+
+# The default number of rows read in each page of a range scan.
+DEFAULT_SCAN_BUFFER_SIZE = 500
+
 class AppDBInterface:
-  def batch_get_entity(self, table_name, row_key, column_names):
+  def batch_get_entity(self, table_name, row_key, column_names,
+                       consistency=None):
     """
     Takes in batches of keys and retrieves their cooresponding rows.
     
@@ -14,13 +27,16 @@ class AppDBInterface:
       table_name: The table to access
       row_keys: A list of keys to access
       column_names: A list of columns to access
+      consistency: The consistency level to read at, or None for the
+        default of the table
     Returns:
       A dictionary of rows and columns/values of those rows. The format 
       looks like such: {key:{column_name:value,...}}
     """
 
     raise NotImplementedError("get_entity is not implemented in %s." % self.__class__)
-  def batch_put_entity(self, table_name, row_key, column_names, cell_values):
+  def batch_put_entity(self, table_name, row_key, column_names, cell_values,
+                       consistency=None):
     """
     Allows callers to store multiple rows with a single call. A row can 
     have multiple columns and values with them. We refer to each row as 
@@ -31,13 +47,16 @@ class AppDBInterface:
       row_keys: A list of keys to store on
       column_names: A list of columns to mutate
       cell_values: A dict of key/value pairs
+      consistency: The consistency level to write at, or None for the
+        default of the table
     Raises:
       TypeError: when bad arguments are given
     """
 
     raise NotImplementedError("put_entity is not implemented in %s." % self.__class__)
 
-  def batch_delete(self, table_name, row_keys, column_names=[]):
+  def batch_delete(self, table_name, row_keys, column_names=[],
+                   consistency=None):
     """
     Remove a set of rows cooresponding to a set of keys.
      
@@ -45,6 +64,8 @@ class AppDBInterface:
       table_name: Table to delete rows from
       row_keys: A list of keys to remove
       column_names: Not used
+      consistency: The consistency level to write at, or None for the
+        default of the table
     Raises:
       AppScaleDBConnectionError: when unable to execute deletes
       TypeError: when given bad argument types 
@@ -71,10 +92,11 @@ class AppDBInterface:
                   offset=0,
                   start_inclusive=True,
                   end_inclusive=True,
-                  keys_only=False):
+                  keys_only=False,
+                  consistency=None):
     """ 
     Gets a dense range ordered by keys. Returns an ordered list of 
-    a dictionary of [key:{column1:value1, column2:value2},...]
+    Rows such as [Row(key, {column1:value1, column2:value2}),...]
     or a list of keys if keys only.
      
     Args:
@@ -87,13 +109,78 @@ class AppDBInterface:
       start_inclusive: Boolean if results should include the start_key
       end_inclusive: Boolean if results should include the end_key
       keys_only: Boolean if to only keys and not values
+      consistency: The consistency level to read at, or None for the
+        default of the table
     Raises:
       TypeError: when bad arguments are given
     Returns:
-      An ordered list of dictionaries of key=>columns/values
+      An ordered list of Rows, or of keys if keys only
     """
     raise NotImplementedError("range_query is not implemented in %s." % self.__class__)
 
+  def range_scan(self,
+                 table_name,
+                 column_names,
+                 start_key,
+                 end_key,
+                 limit=None,
+                 offset=0,
+                 start_inclusive=True,
+                 end_inclusive=True,
+                 keys_only=False,
+                 buffer_size=DEFAULT_SCAN_BUFFER_SIZE,
+                 consistency=None):
+    """
+    Streams a dense range ordered by keys. Rows are read a page at a time,
+    so only one page is held in memory however long the range is. This
+    implementation pages through range_query, and datastores which can
+    stream a range themselves override it.
+
+    Args:
+      table_name: Name of table to access
+      column_names: Columns which get returned within the key range
+      start_key: String for which the query starts at
+      end_key: String for which the query ends at
+      limit: Maximum number of rows to yield, None for no limit
+      offset: The number of rows skipped before the first one yielded
+      start_inclusive: Boolean if results should include the start_key
+      end_inclusive: Boolean if results should include the end_key
+      keys_only: Boolean if to only keys and not values
+      buffer_size: The number of rows read in each page
+      consistency: The consistency level to read at, or None for the
+        default of the table
+    Raises:
+      TypeError: when bad arguments are given
+    Yields:
+      Rows in key order, whose columns are None if keys only
+    """
+    if limit == 0:
+      return
+    skipped = 0
+    yielded = 0
+    while True:
+      page = self.range_query(table_name, column_names, start_key, end_key,
+        buffer_size, offset=0, start_inclusive=start_inclusive,
+        end_inclusive=end_inclusive, keys_only=keys_only,
+        consistency=consistency)
+      for item in page:
+        if keys_only:
+          row = Row(item, None)
+        else:
+          row = item
+        if skipped < offset:
+          skipped += 1
+          continue
+        yield row
+        yielded += 1
+        if limit is not None and yielded >= limit:
+          return
+
+      if len(page) < buffer_size:
+        return
+      start_key = row.key
+      start_inclusive = False
+
   def create_table(self,table_name, column_names):
     """ 
     Creates a table given a schema (column_names).
@@ -106,6 +193,70 @@ class AppDBInterface:
     """
     raise NotImplementedError("create_table is not implemented in %s." % self.__class__)
 
+  def get_consistency(self, table_name, operation, consistency=None):
+    """ Gets the consistency level to make a read or write on a table at.
+
+    A level given by the caller is used as is. Otherwise the level the
+    configuration file sets for the table is used, then the level it sets
+    for every table, and then DEFAULT_CONSISTENCY.
+
+    Args:
+      table_name: The table the operation is on
+      operation: READ_OPERATION or WRITE_OPERATION
+      consistency: The level the caller asked for, or None
+    Returns:
+      One of CONSISTENCY_LEVELS
+    Raises:
+      TypeError: when the level asked for is not known
+    """
+    if consistency is None:
+      levels = self.get_consistency_config().get(operation, {})
+      consistency = levels.get(table_name, levels.get("default",
+        dbconstants.DEFAULT_CONSISTENCY))
+
+    if consistency not in dbconstants.CONSISTENCY_LEVELS:
+      raise TypeError("Unknown consistency level %s" % consistency)
+    return consistency
+
+  def get_consistency_config(self):
+    """ Gets the default consistency levels from the configuration file.
+
+    The file holds a JSON object with "read" and "write" objects, which map
+    table names, or "default" for every table, to consistency levels, e.g.
+    {"read": {"default": "QUORUM", "JOURNAL__": "ONE"}}. It is read once,
+    and levels that are not known are ignored.
+
+    Returns:
+      A dictionary of operations to dictionaries of tables to levels
+    """
+    try:
+      config = self.__consistency_config
+    except AttributeError:
+      config = None
+
+    if config is None:
+      config = {}
+      if os.path.exists(dbconstants.CONSISTENCY_CONFIG_LOCATION):
+        try:
+          with open(dbconstants.CONSISTENCY_CONFIG_LOCATION) as config_file:
+            contents = json.load(config_file)
+          for operation in [dbconstants.READ_OPERATION,
+                            dbconstants.WRITE_OPERATION]:
+            config[operation] = {}
+            for table, level in contents.get(operation, {}).iteritems():
+              if level in dbconstants.CONSISTENCY_LEVELS:
+                config[operation][str(table)] = str(level)
+              else:
+                logging.error("Ignoring unknown {0} consistency level {1} "
+                  "for {2}".format(operation, level, table))
+        except (IOError, ValueError, AttributeError), error:
+          logging.error("Unable to read the consistency levels from {0}: {1}"
+            .format(dbconstants.CONSISTENCY_CONFIG_LOCATION, error))
+          config = {}
+      self.__consistency_config = config
+
+    return self.__consistency_config
+
   def get_local_ip(self):
     """ Gets the local IP of the current node.
      
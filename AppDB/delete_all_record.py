@@ -32,7 +32,7 @@ def delete_all(entities, table, db):
     db: The database accessor
   """
   for ii in entities:
-    db.batch_delete(table, ii.keys())
+    db.batch_delete(table, [ii.key])
 
 def main(argv):
   DB_TYPE="cassandra"
@@ -50,6 +50,10 @@ class DatastoreGroomer(threading.Thread):
   # The amount of time in seconds before we want to clean up task name holders.
   TASK_NAME_TIMEOUT = 24 * 60 * 60
 
+  # The most journal rows that are examined in each run. The next run picks
+  # up where the last one stopped.
+  JOURNAL_ROWS_PER_RUN = 100000
+
   # Do not generate stats for AppScale internal apps.
   APPSCALE_APPLICATIONS = ['apichecker', 'appscaledashboard']
 
@@ -72,6 +76,16 @@ class DatastoreGroomer(threading.Thread):
     self.stats = {}
     self.namespace_info = {}
     self.num_deletes = 0
+    self.num_rollbacks = 0
+    self.scan_start = 0
+    # Per-application sets of the blacklisted versions, and of the keys of
+    # the entities, which the scan could not roll back.
+    self.blacklisted_versions = {}
+    self.blacklisted_keys = {}
+    self.journal_deletes = 0
+    self.journal_bytes_reclaimed = 0
+    # The last journal key examined, which is kept between runs.
+    self.journal_cursor = ""
 
   def stop(self):
     """ Stops the groomer thread. """
@@ -101,23 +115,52 @@ class DatastoreGroomer(threading.Thread):
     """
     return self.zoo_keeper.get_datastore_groomer_lock()
 
-  def get_entity_batch(self, last_key):
-    """ Gets a batch of entites to operate on.
+  def get_entities(self):
+    """ Streams every entity in the datastore, reading them a batch at a
+    time. The scan only gathers statistics and finds tombstones, so it reads
+    from a single replica.
 
-    Args:
-      last_key: The last key from a previous query.
     Returns:
-      A list of entities.
+      An iterator of the Rows of the entity table.
     """ 
-    return self.db_access.range_query(dbconstants.APP_ENTITY_TABLE, 
-      dbconstants.APP_ENTITY_SCHEMA, last_key, "", self.BATCH_SIZE,
-      start_inclusive=False)
+    return self.db_access.range_scan(dbconstants.APP_ENTITY_TABLE,
+      dbconstants.APP_ENTITY_SCHEMA, "", "", buffer_size=self.BATCH_SIZE,
+      consistency=dbconstants.CONSISTENCY_ONE)
+
+  def is_current_tombstone(self, row_key, version):
+    """ Checks that a row still holds the tombstone the scan found. The scan
+    may have read a replica that missed a later write, so the row is read
+    again at quorum.
+
+    Args:
+      row_key: A str representing the row key to check.
+      version: The version of the tombstone the scan found.
+    Returns:
+      True if the row is still the same tombstone, False otherwise.
+    """
+    try:
+      current = self.db_access.batch_get_entity(dbconstants.APP_ENTITY_TABLE,
+        [row_key], dbconstants.APP_ENTITY_SCHEMA,
+        consistency=dbconstants.CONSISTENCY_QUORUM).get(row_key, {})
+    except dbconstants.AppScaleDBConnectionError, db_error:
+      logging.error("Error reading key {0}".format(row_key))
+      return False
+
+    return current.get(dbconstants.APP_ENTITY_SCHEMA[0]) == \
+      datastore_server.TOMBSTONE and \
+      str(current.get(dbconstants.APP_ENTITY_SCHEMA[1])) == str(version)
 
   def reset_statistics(self):
     """ Reinitializes statistics. """
     self.stats = {}
     self.namespace_info = {}
     self.num_deletes = 0
+    self.num_rollbacks = 0
+    self.scan_start = time.time()
+    self.blacklisted_versions = {}
+    self.blacklisted_keys = {}
+    self.journal_deletes = 0
+    self.journal_bytes_reclaimed = 0
 
   def hard_delete_row(self, row_key):
     """ Does a hard delete on a given row key to the entity
@@ -154,6 +197,30 @@ class DatastoreGroomer(threading.Thread):
     tokens = key.split(dbconstants.KIND_SEPARATOR)
     return tokens[0] + dbconstants.KIND_SEPARATOR
 
+  @staticmethod
+  def get_app_id_from_entity_key(entity_key):
+    """ Extracts the application ID from a key to the entity table.
+
+    Args:
+      entity_key: A str representing a row key to the entity table.
+    Returns:
+      A str representing the application ID.
+    """
+    return entity_key.split(dbconstants.KEY_DELIMITER)[0]
+
+  @staticmethod
+  def split_journal_key(journal_key):
+    """ Splits a key to the journal table into the key of the entity and
+    the version.
+
+    Args:
+      journal_key: A str representing a row key to the journal table.
+    Returns:
+      A tuple of the entity key and the version as a long.
+    """
+    entity_key, _, version = journal_key.rpartition(dbconstants.KEY_DELIMITER)
+    return entity_key, long(version)
+
   @staticmethod
   def get_prefix_from_entity_key(entity_key):
     """ Extracts the prefix from a key to the entity table.
@@ -178,15 +245,16 @@ class DatastoreGroomer(threading.Thread):
       True if a hard delete occurred, False otherwise.
     """
     success = False
-    app_prefix = DatastoreGroomer.get_prefix_from_entity_key(key)
-    root_key = DatastoreGroomer.get_root_key_from_entity_key(key)
+    app_prefix = self.get_prefix_from_entity_key(key)
+    root_key = self.get_root_key_from_entity_key(key)
     
     if self.zoo_keeper.is_blacklisted(app_prefix, version):
       return False
  
     txn_id = self.zoo_keeper.get_transaction_id(app_prefix)
     try:
-      if self.zoo_keeper.acquire_lock(app_prefix, txn_id, root_key):
+      if self.zoo_keeper.acquire_lock(app_prefix, txn_id, root_key) and \
+          self.is_current_tombstone(key, version):
         success = self.hard_delete_row(key)
       else:
         success = False
@@ -280,29 +348,348 @@ class DatastoreGroomer(threading.Thread):
     self.stats[app_id][kind]['number'] += 1
     return True
 
+  def roll_back_entity(self, app_id, key, version):
+    """ Replaces an entity written by a failed transaction with its last
+    valid version from the journal, so that the blacklist no longer has to
+    be consulted for it. The journal entry of the failed version is removed.
+
+    Args:
+      app_id: The application ID.
+      key: The key to the entity table.
+      version: The blacklisted version of the entity.
+    Returns:
+      A dict of the columns of the row after the rollback, which is empty if
+      the row was removed, or None if it could not be rolled back.
+    """
+    root_key = self.get_root_key_from_entity_key(key)
+    restored = None
+    wrote = False
+    txn_id = self.zoo_keeper.get_transaction_id(app_id)
+    try:
+      if not self.zoo_keeper.acquire_lock(app_id, txn_id, root_key):
+        return None
+
+      # The row may have been written again since the scan read it.
+      current = self.db_access.batch_get_entity(dbconstants.APP_ENTITY_TABLE,
+        [key], dbconstants.APP_ENTITY_SCHEMA,
+        consistency=dbconstants.CONSISTENCY_QUORUM).get(key, {})
+      if str(current.get(dbconstants.APP_ENTITY_SCHEMA[1])) != str(version):
+        return None
+
+      valid_version = self.zoo_keeper.get_valid_transaction_id(app_id,
+        version, key)
+      if str(valid_version) == str(version):
+        # The version is not blacklisted after all.
+        restored = current
+        return restored
+      if valid_version == 0:
+        # The entity did not exist before the failed transaction.
+        wrote = True
+        self.db_access.batch_delete(dbconstants.APP_ENTITY_TABLE, [key])
+        restored = {}
+      else:
+        journal_key = datastore_server.DatastoreDistributed.get_journal_key(
+          key, valid_version)
+        journal = self.db_access.batch_get_entity(dbconstants.JOURNAL_TABLE,
+          [journal_key], dbconstants.JOURNAL_SCHEMA,
+          consistency=dbconstants.CONSISTENCY_QUORUM).get(journal_key, {})
+        if dbconstants.JOURNAL_SCHEMA[0] not in journal:
+          logging.error("No journal entry for version {0} of key {1}".format(
+            valid_version, key))
+          return None
+        restored = {
+          dbconstants.APP_ENTITY_SCHEMA[0]: journal[
+            dbconstants.JOURNAL_SCHEMA[0]],
+          dbconstants.APP_ENTITY_SCHEMA[1]: str(valid_version)
+        }
+        wrote = True
+        self.db_access.batch_put_entity(dbconstants.APP_ENTITY_TABLE, [key],
+          dbconstants.APP_ENTITY_SCHEMA, {key: restored})
+
+      self.db_access.batch_delete(dbconstants.JOURNAL_TABLE,
+        [datastore_server.DatastoreDistributed.get_journal_key(key, version)])
+    except (zk.ZKTransactionException, zk.ZKInternalException), zk_exception:
+      logging.error("Unable to roll back key {0}: {1}".format(key,
+        zk_exception))
+      restored = None
+    except dbconstants.AppScaleDBConnectionError, db_error:
+      logging.error("Error rolling back key {0}: {1}".format(key, db_error))
+      restored = None
+    finally:
+      # Nothing needs to be undone unless the rollback wrote something.
+      if wrote and restored is None:
+        if not self.zoo_keeper.notify_failed_transaction(app_id, txn_id):
+          logging.error("Unable to invalidate txn for {0} with txnid: {1}"\
+            .format(app_id, txn_id))
+      try:
+        self.zoo_keeper.release_lock(app_id, txn_id)
+      except zk.ZKTransactionException, zk_exception:
+        # The rollback has already happened, if it was going to.
+        pass
+
+    if restored is not None:
+      self.num_rollbacks += 1
+    logging.debug("Rolling back key {0}: {1}".format(key, restored))
+    return restored
+
+  def recheck_blacklisted_keys(self, app_id):
+    """ Reads the entities that have a valid version registered at quorum,
+    and marks those whose versions are still blacklisted as in use. The scan
+    reads a single replica, which may have missed the write of a failed
+    transaction.
+
+    Args:
+      app_id: The application ID.
+    Raises:
+      ZKTransactionException: If the keys could not be listed.
+      ZKInternalException: If a version could not be checked.
+      AppScaleDBConnectionError: If the entities could not be read.
+    """
+    keys = list(self.zoo_keeper.get_valid_transaction_keys(app_id) -
+      self.blacklisted_keys[app_id])
+    for index in range(0, len(keys), self.BATCH_SIZE):
+      current = self.db_access.batch_get_entity(dbconstants.APP_ENTITY_TABLE,
+        keys[index:index + self.BATCH_SIZE], dbconstants.APP_ENTITY_SCHEMA,
+        consistency=dbconstants.CONSISTENCY_QUORUM)
+      for key, columns in current.iteritems():
+        version = columns.get(dbconstants.APP_ENTITY_SCHEMA[1])
+        if version is None:
+          continue
+        if self.zoo_keeper.is_blacklisted(app_id, version):
+          self.blacklisted_versions[app_id].add(str(version))
+          self.blacklisted_keys[app_id].add(key)
+
   def txn_blacklist_cleanup(self):
     """ Clean up old transactions and removed unused references
         to reap storage.
 
+    Once the scan has rolled back the entities of failed transactions, the
+    blacklist entries and valid versions that no entity refers to are
+    removed. Only those older than the start of the scan, less the
+    transaction timeout, are removed, since their transactions are done
+    writing entities and the scan has read all of them. The entities failed
+    transactions wrote to are read again at quorum first.
+
     Returns:
       True on success, False otherwise.
     """
-    #TODO implement
-    return True
+    cutoff = self.scan_start - zk.TX_TIMEOUT
+    success = True
+    for app_id in self.blacklisted_versions:
+      try:
+        self.recheck_blacklisted_keys(app_id)
+        removed_txids, removed_versions = self.zoo_keeper.compact_blacklist(
+          app_id, cutoff, self.blacklisted_versions[app_id],
+          self.blacklisted_keys[app_id])
+      except (zk.ZKTransactionException, zk.ZKInternalException), \
+          zk_exception:
+        logging.error("Unable to compact the blacklist of {0}: {1}".format(
+          app_id, zk_exception))
+        success = False
+        continue
+      except dbconstants.AppScaleDBConnectionError, db_error:
+        logging.error("Error checking the blacklist of {0}: {1}".format(
+          app_id, db_error))
+        success = False
+        continue
+      logging.info("Removed {0} blacklisted transactions and {1} valid " \
+        "versions of {2}, with {3} still in use".format(removed_txids,
+        removed_versions, app_id, len(self.blacklisted_versions[app_id])))
+    logging.info("Number of rollbacks: {0}".format(self.num_rollbacks))
+    return success
+
+  def get_journal_rows(self):
+    """ Streams the journal from where the last run stopped, reading it a
+    batch at a time from a single replica.
+
+    Returns:
+      An iterator of up to JOURNAL_ROWS_PER_RUN Rows of the journal table.
+    """
+    return self.db_access.range_scan(dbconstants.JOURNAL_TABLE,
+      dbconstants.JOURNAL_SCHEMA, self.journal_cursor, "",
+      limit=self.JOURNAL_ROWS_PER_RUN, start_inclusive=False,
+      buffer_size=self.BATCH_SIZE, consistency=dbconstants.CONSISTENCY_ONE)
+
+  def prune_journal(self):
+    """ Deletes the journal entries of entity versions that have been
+    superseded, examining at most JOURNAL_ROWS_PER_RUN rows of the journal.
+
+    Returns:
+      True on success, False otherwise.
+    """
+    success = True
+    batch = {}
+    examined = 0
+    for row in self.get_journal_rows():
+      examined += 1
+      self.journal_cursor = row.key
+      entity_key, version = self.split_journal_key(row.key)
+      if entity_key not in batch and len(batch) >= self.BATCH_SIZE:
+        success = self.prune_journal_batch(batch) and success
+        batch = {}
+      size = len(row.key) + len(row.columns.get(dbconstants.JOURNAL_SCHEMA[0],
+        ""))
+      batch.setdefault(entity_key, {})[version] = (row.key, size)
+    if batch:
+      success = self.prune_journal_batch(batch) and success
+
+    if examined < self.JOURNAL_ROWS_PER_RUN:
+      # The end of the journal was reached, so the next run starts over.
+      self.journal_cursor = ""
+
+    logging.info("Examined {0} journal entries and deleted {1}, reclaiming " \
+      "{2} bytes".format(examined, self.journal_deletes,
+      self.journal_bytes_reclaimed))
+    return success
+
+  def prune_journal_batch(self, batch):
+    """ Prunes the journals of a batch of entities, skipping those whose only
+    journal entries are for their current versions.
+
+    Args:
+      batch: A dict mapping entity keys to dicts, which map versions to
+        tuples of the journal key and its size in bytes.
+    Returns:
+      True on success, False otherwise.
+    """
+    try:
+      current = self.db_access.batch_get_entity(dbconstants.APP_ENTITY_TABLE,
+        batch.keys(), dbconstants.APP_ENTITY_SCHEMA,
+        consistency=dbconstants.CONSISTENCY_ONE)
+    except dbconstants.AppScaleDBConnectionError, db_error:
+      logging.error("Error reading entities for the journal: {0}".format(
+        db_error))
+      return False
+
+    success = True
+    for entity_key, versions in batch.iteritems():
+      columns = current.get(entity_key, {})
+      if versions.keys() == [long(columns.get(dbconstants.APP_ENTITY_SCHEMA[1],
+          0))]:
+        continue
+      success = self.prune_entity_journal(entity_key, versions) and success
+    return success
+
+  def is_running_transaction(self, app_id, txid):
+    """ Checks if a transaction still holds locks, and so has yet to commit
+    or time out.
+
+    Args:
+      app_id: A str representing the application ID.
+      txid: The transaction ID.
+    Returns:
+      True if the transaction is running, False otherwise.
+    Raises:
+      ZKInternalException: If the transaction could not be looked up.
+    """
+    try:
+      return self.zoo_keeper.is_in_transaction(app_id, txid)
+    except zk.ZKTransactionException:
+      # The transaction is blacklisted.
+      return False
+
+  def prune_entity_journal(self, entity_key, versions):
+    """ Deletes the journal entries of an entity, except for the one of its
+    current version. Writes to the entity take its group's lock, so holding
+    it keeps the entry of a version being written from being deleted.
+
+    The entries of the valid version registered for the entity by a failed
+    transaction, and of versions whose transactions are still running and
+    so have not timed out yet, are kept too, since rollbacks and reads can
+    still need them.
+
+    Args:
+      entity_key: A str representing the key of the entity.
+      versions: A dict mapping versions to tuples of the journal key and its
+        size in bytes.
+    Returns:
+      True on success, False otherwise.
+    """
+    app_id = self.get_app_id_from_entity_key(entity_key)
+    root_key = self.get_root_key_from_entity_key(entity_key)
+    success = False
+    txn_id = self.zoo_keeper.get_transaction_id(app_id)
+    try:
+      if not self.zoo_keeper.acquire_lock(app_id, txn_id, root_key):
+        return False
+
+      current = self.db_access.batch_get_entity(dbconstants.APP_ENTITY_TABLE,
+        [entity_key], dbconstants.APP_ENTITY_SCHEMA,
+        consistency=dbconstants.CONSISTENCY_QUORUM).get(entity_key, {})
+      current_version = None
+      if dbconstants.APP_ENTITY_SCHEMA[1] in current:
+        current_version = long(current[dbconstants.APP_ENTITY_SCHEMA[1]])
+        if self.zoo_keeper.is_blacklisted(app_id, current_version):
+          # Reads still go through the journal to find the valid version,
+          # until the entity is rolled back.
+          return True
+
+      keep = set([current_version,
+                  self.zoo_keeper.get_valid_version(app_id, entity_key)])
+      superseded = [version for version in versions if version not in keep
+                    and not self.is_running_transaction(app_id, version)]
+      if superseded:
+        self.db_access.batch_delete(dbconstants.JOURNAL_TABLE,
+          [versions[version][0] for version in superseded])
+      self.journal_deletes += len(superseded)
+      self.journal_bytes_reclaimed += sum(versions[version][1]
+                                          for version in superseded)
+      success = True
+    except (zk.ZKTransactionException, zk.ZKInternalException), zk_exception:
+      logging.error("Unable to prune the journal of key {0}: {1}".format(
+        entity_key, zk_exception))
+    except dbconstants.AppScaleDBConnectionError, db_error:
+      logging.error("Error pruning the journal of key {0}: {1}".format(
+        entity_key, db_error))
+    finally:
+      # Deleting journal entries of superseded versions leaves nothing to
+      # undo, so the transaction is only released.
+      try:
+        self.zoo_keeper.release_lock(app_id, txn_id)
+      except zk.ZKTransactionException, zk_exception:
+        # The entries have already been deleted, if they were going to be.
+        pass
+
+    return success
 
   def process_entity(self, entity):
     """ Processes an entity by updating statistics, indexes, and removes 
-        tombstones.
+        tombstones. Entities written by failed transactions are rolled back
+        first.
 
     Args:
-      entity: The entity to operate on. 
+      entity: The Row of the entity to operate on. 
     Returns:
       True on success, False otherwise.
     """
     logging.debug("Process entity {0}".format(str(entity)))
-    key = entity.keys()[0] 
-    one_entity = entity[key][dbconstants.APP_ENTITY_SCHEMA[0]]
-    version = entity[key][dbconstants.APP_ENTITY_SCHEMA[1]]
+    key = entity.key
+    one_entity = entity.columns[dbconstants.APP_ENTITY_SCHEMA[0]]
+    version = entity.columns[dbconstants.APP_ENTITY_SCHEMA[1]]
+
+    app_id = self.get_app_id_from_entity_key(key)
+    self.blacklisted_versions.setdefault(app_id, set())
+    self.blacklisted_keys.setdefault(app_id, set())
+    restored = {dbconstants.APP_ENTITY_SCHEMA[0]: one_entity,
+                dbconstants.APP_ENTITY_SCHEMA[1]: version}
+    try:
+      if self.zoo_keeper.is_blacklisted(app_id, version):
+        restored = self.roll_back_entity(app_id, key, version)
+    except zk.ZKInternalException, zk_exception:
+      logging.error("Unable to check version {0} of key {1}: {2}".format(
+        version, key, zk_exception))
+      restored = None
+
+    if restored is None:
+      # The version and its valid version are kept until a later run.
+      self.blacklisted_versions[app_id].add(str(version))
+      self.blacklisted_keys[app_id].add(key)
+      return False
+    if not restored:
+      # The entity did not exist before the failed transaction.
+      return True
+    one_entity = restored[dbconstants.APP_ENTITY_SCHEMA[0]]
+    version = restored[dbconstants.APP_ENTITY_SCHEMA[1]]
 
     logging.debug("Entity value: {0}".format(entity))
     if one_entity == datastore_server.TOMBSTONE:
@@ -521,22 +908,19 @@ class DatastoreGroomer(threading.Thread):
     """
     logging.info("Groomer started")
     start = time.time()
-    last_key = ""
     self.reset_statistics()
 
     self.db_access = appscale_datastore_batch.DatastoreFactory.getDatastore(
       self.table_name)
 
-    while True:
-      entities = self.get_entity_batch(last_key)
-
-      if not entities:
-        break
+    for entity in self.get_entities():
+      self.process_entity(entity)
 
-      for entity in entities:
-        self.process_entity(entity)
+    if not self.txn_blacklist_cleanup():
+      logging.error("There was an error compacting the blacklists")
 
-      last_key = entities[-1].keys()[0]
+    if not self.prune_journal():
+      logging.error("There was an error pruning the journal")
 
     timestamp = datetime.datetime.now()
 
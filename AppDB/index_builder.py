@@ -0,0 +1,136 @@
+""" This process builds new composite indexes from the entities that already
+exist, and removes the rows of composite indexes that have been deleted.
+"""
+import logging
+import os
+import sys
+import threading
+import time
+
+sys.path.append(os.path.join(os.path.dirname(__file__), "../AppServer"))
+from google.appengine.datastore import entity_pb
+
+class IndexBuilder(threading.Thread):
+  """ Works through the pending index jobs of every application. """
+
+  # The amount of seconds between checks for new jobs, when not notified of
+  # them.
+  POLL_PERIOD = 5 * 60
+
+  # The number of entities or index rows handled in one batch.
+  DEFAULT_BATCH_SIZE = 100
+
+  # The most entities or index rows handled each second. A value of zero
+  # does not limit the rate.
+  DEFAULT_MAX_RATE = 500
+
+  # The amount of seconds between progress reports for a job.
+  REPORT_PERIOD = 60
+
+  def __init__(self, zoo_keeper, datastore_access,
+               batch_size=DEFAULT_BATCH_SIZE, max_rate=DEFAULT_MAX_RATE):
+    """ Constructor.
+
+    Args:
+      zoo_keeper: ZooKeeper client.
+      datastore_access: A datastore_server.DatastoreDistributed.
+      batch_size: The number of entities or index rows handled in one batch.
+      max_rate: The most entities or index rows handled each second, or zero
+        for no limit.
+    """
+    threading.Thread.__init__(self)
+    self.daemon = True
+    self.zoo_keeper = zoo_keeper
+    self.datastore_access = datastore_access
+    self.batch_size = batch_size
+    self.max_rate = max_rate
+    self.wake_up = threading.Event()
+
+  def notify(self):
+    """ Has the builder check for new jobs without waiting for the next
+    poll. """
+    self.wake_up.set()
+
+  def run(self):
+    """ Runs the pending jobs whenever notified or polled. """
+    while True:
+      self.wake_up.clear()
+      try:
+        self.run_jobs()
+      except Exception, exception:
+        logging.exception(exception)
+      self.wake_up.wait(self.POLL_PERIOD)
+
+  def run_jobs(self):
+    """ Runs every pending job that no other datastore server is running. """
+    for index in self.datastore_access.get_index_jobs():
+      app_id = index.app_id()
+      if not self.zoo_keeper.get_index_build_lock(app_id, index.id()):
+        continue
+      try:
+        self.run_job(index)
+      finally:
+        self.zoo_keeper.release_index_build_lock(app_id, index.id())
+
+  def run_job(self, index):
+    """ Builds an index or deletes its rows, resuming from where the job got
+    to before, and removes the job once it is done.
+
+    Args:
+      index: A entity_pb.CompositeIndex, whose state tells whether it is to
+        be built or deleted.
+    Returns:
+      True if the job is done, False if it was replaced before it finished.
+    """
+    if index.state() == entity_pb.CompositeIndex.DELETED:
+      action = "Deleting"
+      run_batch = self.datastore_access.delete_composite_index_batch
+    else:
+      action = "Building"
+      run_batch = self.datastore_access.build_composite_index_batch
+
+    logging.info("{0} index {1} of {2}".format(action, index.id(),
+      index.app_id()))
+    start_key = self.datastore_access.get_index_job_progress(index)
+    start = time.time()
+    last_report = start
+    handled = 0
+    while True:
+      start_key, count = run_batch(index, start_key, self.batch_size)
+      handled += count
+      if start_key is None:
+        break
+
+      # A deleted index replaces its build job, which is then dropped.
+      job = self.datastore_access.get_index_job(index.app_id(), index.id())
+      if job is None or job.state() != index.state():
+        logging.info("Job for index {0} of {1} was replaced".format(
+          index.id(), index.app_id()))
+        return False
+      self.datastore_access.set_index_job_progress(index, start_key)
+
+      now = time.time()
+      if now - last_report >= self.REPORT_PERIOD:
+        self.report(action, index, handled, now - start)
+        last_report = now
+      if self.max_rate:
+        wait = float(handled) / self.max_rate - (now - start)
+        if wait > 0:
+          time.sleep(wait)
+
+    self.datastore_access.finish_index_job(index)
+    self.report(action, index, handled, time.time() - start)
+    return True
+
+  def report(self, action, index, handled, elapsed):
+    """ Logs the throughput of a job.
+
+    Args:
+      action: A str describing the job.
+      index: The entity_pb.CompositeIndex of the job.
+      handled: The number of entities or index rows handled so far.
+      elapsed: The number of seconds the job has run for.
+    """
+    logging.info("{0} index {1} of {2}: {3} handled in {4:.1f}s, {5:.1f}/s".
+      format(action, index.id(), index.app_id(), handled, elapsed,
+             handled / max(elapsed, 0.001)))
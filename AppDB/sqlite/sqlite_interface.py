@@ -0,0 +1,432 @@
+"""
+ SQLite Interface for AppScale
+"""
+import itertools
+import logging
+import os
+import sqlite3
+import threading
+
+from dbconstants import *
+from dbinterface_batch import *
+
+# The database file used unless the environment names another one.
+DEFAULT_DB_LOCATION = "/opt/appscale/sqlite/datastore.db"
+
+# The environment variable that names the database file.
+DB_LOCATION_ENV = "APPSCALE_SQLITE_DB"
+
+# The seconds a statement waits for the writes of other connections.
+BUSY_TIMEOUT = 30.0
+
+# The most values bound in a single statement. SQLite allows 999.
+MAX_BOUND_VALUES = 900
+
+class DatastoreProxy(AppDBInterface):
+  """
+    SQLite implementation of the AppDBInterface
+
+    Every table is kept in a single embedded database file, so one node can
+    run the datastore without any other service. A table has a row for each
+    column of each key, clustered on the key and column name, so its rows
+    are stored in key order and ranges are read straight off its primary
+    key. There is only one replica, which meets every consistency level.
+  """
+  def __init__(self, db_location=None):
+    """
+    Constructor.
+
+    Args:
+      db_location: The path of the database file, or None to use the one in
+        the environment or DEFAULT_DB_LOCATION
+    """
+    if db_location is None:
+      db_location = os.environ.get(DB_LOCATION_ENV, DEFAULT_DB_LOCATION)
+    directory = os.path.dirname(db_location)
+    if directory and not os.path.exists(directory):
+      os.makedirs(directory)
+
+    self.db_location = db_location
+    self.local = threading.local()
+    for table_name in INITIAL_TABLES:
+      self.create_table(table_name, [])
+
+  def get_connection(self):
+    """ Gets the connection of the current thread, since a SQLite
+    connection can only be used by the thread that opened it.
+
+    Returns:
+      A sqlite3.Connection
+    """
+    connection = getattr(self.local, "connection", None)
+    if connection is None:
+      connection = sqlite3.connect(self.db_location, timeout=BUSY_TIMEOUT,
+                                   isolation_level=None)
+      connection.text_factory = str
+      # Readers do not wait for writers, and writers only wait for each
+      # other, when the log is written ahead.
+      connection.execute("PRAGMA journal_mode=WAL")
+      connection.execute("PRAGMA synchronous=NORMAL")
+      self.local.connection = connection
+    return connection
+
+  @staticmethod
+  def quote(table_name):
+    """ Quotes a table name for use in a statement. """
+    return '"{0}"'.format(table_name.replace('"', '""'))
+
+  def write(self, statement, values):
+    """ Runs a statement for each set of values in a single transaction.
+
+    Args:
+      statement: The SQL statement to run
+      values: A list of tuples of the values bound for each run
+    """
+    connection = self.get_connection()
+    connection.execute("BEGIN IMMEDIATE")
+    try:
+      connection.executemany(statement, values)
+    except Exception:
+      connection.execute("ROLLBACK")
+      raise
+    connection.execute("COMMIT")
+
+  def batch_get_entity(self, table_name, row_keys, column_names,
+                       consistency=None):
+    """
+    Takes in batches of keys and retrieves their corresponding rows.
+
+    Args:
+      table_name: The table to access
+      row_keys: A list of keys to access
+      column_names: A list of columns to access
+      consistency: The consistency level to read at, or None for the
+        default of the table
+    Returns:
+      A dictionary of rows and columns/values of those rows. The format
+      looks like such: {key:{column_name:value,...}}
+    Raises:
+      TypeError: If an argument passed in was not of the expected type.
+      AppScaleDBConnectionError: If the batch_get could not be performed due to
+        an error with SQLite.
+    """
+    if not isinstance(table_name, str): raise TypeError("Expected a str")
+    if not isinstance(column_names, list): raise TypeError("Expected a list")
+    if not isinstance(row_keys, list): raise TypeError("Expected a list")
+    self.get_consistency(table_name, READ_OPERATION, consistency)
+
+    ret_val = dict((row_key, {}) for row_key in row_keys)
+    keys_per_read = max(MAX_BOUND_VALUES - len(column_names), 1)
+    try:
+      connection = self.get_connection()
+      for start in range(0, len(row_keys), keys_per_read):
+        keys = row_keys[start:start + keys_per_read]
+        statement = "SELECT row_key, column_name, value FROM {0} " \
+          "WHERE row_key IN ({1}) AND column_name IN ({2})".format(
+          self.quote(table_name), ",".join("?" * len(keys)),
+          ",".join("?" * len(column_names)))
+        cells = connection.execute(statement,
+          [buffer(key) for key in keys] + column_names)
+        for row_key, column_name, value in cells:
+          ret_val[str(row_key)][column_name] = str(value)
+      return ret_val
+    except Exception, ex:
+      logging.exception(ex)
+      raise AppScaleDBConnectionError("Exception on batch_get: %s" % str(ex))
+
+  def batch_put_entity(self, table_name, row_keys, column_names, cell_values,
+                       consistency=None):
+    """
+    Allows callers to store multiple rows with a single call. A row can
+    have multiple columns and values with them. We refer to each row as
+    an entity.
+
+    Args:
+      table_name: The table to mutate
+      row_keys: A list of keys to store on
+      column_names: A list of columns to mutate
+      cell_values: A dict of key/value pairs
+      consistency: The consistency level to write at, or None for the
+        default of the table
+    Raises:
+      TypeError: If an argument passed in was not of the expected type.
+      AppScaleDBConnectionError: If the batch_put could not be performed due to
+        an error with SQLite.
+    """
+    if not isinstance(table_name, str): raise TypeError("Expected a str")
+    if not isinstance(column_names, list): raise TypeError("Expected a list")
+    if not isinstance(row_keys, list): raise TypeError("Expected a list")
+    if not isinstance(cell_values, dict): raise TypeError("Expected a dic")
+    self.get_consistency(table_name, WRITE_OPERATION, consistency)
+
+    try:
+      self.write("INSERT OR REPLACE INTO {0} (row_key, column_name, value) "
+                 "VALUES (?, ?, ?)".format(self.quote(table_name)),
+                 [(buffer(key), cname, buffer(str(cell_values[key][cname])))
+                  for key in row_keys for cname in column_names])
+    except Exception, ex:
+      logging.exception(ex)
+      raise AppScaleDBConnectionError("Exception on batch_insert: %s" % str(ex))
+
+  def batch_delete(self, table_name, row_keys, column_names=[],
+                   consistency=None):
+    """
+    Remove a set of rows cooresponding to a set of keys.
+
+    Args:
+      table_name: Table to delete rows from
+      row_keys: A list of keys to remove
+      column_names: Not used
+      consistency: The consistency level to write at, or None for the
+        default of the table
+    Raises:
+      TypeError: If an argument passed in was not of the expected type.
+      AppScaleDBConnectionError: If the batch_delete could not be performed due
+        to an error with SQLite.
+    """
+    if not isinstance(table_name, str): raise TypeError("Expected a str")
+    if not isinstance(row_keys, list): raise TypeError("Expected a list")
+    self.get_consistency(table_name, WRITE_OPERATION, consistency)
+
+    try:
+      self.write("DELETE FROM {0} WHERE row_key = ?".format(
+        self.quote(table_name)), [(buffer(key),) for key in row_keys])
+    except Exception, ex:
+      logging.exception(ex)
+      raise AppScaleDBConnectionError("Exception on batch_delete: %s" % str(ex))
+
+  def delete_table(self, table_name):
+    """
+    Drops a given table.
+
+    Args:
+      table_name: A string name of the table to drop
+    Raises:
+      TypeError: If an argument passed in was not of the expected type.
+      AppScaleDBConnectionError: If the delete_table could not be performed due
+        to an error with SQLite.
+    """
+    if not isinstance(table_name, str): raise TypeError("Expected a str")
+
+    try:
+      self.get_connection().execute("DROP TABLE IF EXISTS {0}".format(
+        self.quote(table_name)))
+    except Exception, ex:
+      logging.exception(ex)
+      raise AppScaleDBConnectionError("Exception on delete_table: %s" % str(ex))
+
+  def create_table(self, table_name, column_names):
+    """
+    Creates a table clustered on its keys and column names.
+
+    Args:
+      table_name: The table name
+      column_names: Not used but here to match the interface
+    Raises:
+      TypeError: If an argument passed in was not of the expected type.
+      AppScaleDBConnectionError: If the create_table could not be performed due
+        to an error with SQLite.
+    """
+    if not isinstance(table_name, str): raise TypeError("Expected a str")
+    if not isinstance(column_names, list): raise TypeError("Expected a list")
+
+    try:
+      self.get_connection().execute("CREATE TABLE IF NOT EXISTS {0} ("
+        "row_key BLOB NOT NULL, column_name TEXT NOT NULL, value BLOB, "
+        "PRIMARY KEY (row_key, column_name)) WITHOUT ROWID".format(
+        self.quote(table_name)))
+    except Exception, ex:
+      logging.exception(ex)
+      raise AppScaleDBConnectionError("Exception on create_table: %s" % str(ex))
+
+  def read_page(self, table_name, column_names, start_key, end_key,
+                start_inclusive, end_inclusive, keys_only, page_size, offset):
+    """ Reads the rows of a page of a range.
+
+    The keys of the page are read first, and then their columns, both in a
+    single transaction so the page is read as of one point in time.
+
+    Args:
+      table_name: Name of table to access
+      column_names: Columns which get returned, or all columns if empty
+      start_key: String for which the page starts at
+      end_key: String for which the range ends at, or "" for no end
+      start_inclusive: Boolean if results should include the start_key
+      end_inclusive: Boolean if results should include the end_key
+      keys_only: Boolean if to only keys and not values
+      page_size: The number of rows read
+      offset: The number of rows skipped before the page
+    Returns:
+      A list of Rows, whose columns are None if keys only
+    """
+    table = self.quote(table_name)
+    statement = "SELECT DISTINCT row_key FROM {0} WHERE row_key {1} ?".format(
+      table, ">=" if start_inclusive else ">")
+    values = [buffer(start_key)]
+    if end_key:
+      statement += " AND row_key {0} ?".format("<=" if end_inclusive else "<")
+      values.append(buffer(end_key))
+    statement += " ORDER BY row_key LIMIT ? OFFSET ?"
+    values += [page_size, offset]
+
+    connection = self.get_connection()
+    connection.execute("BEGIN")
+    try:
+      keys = [str(row[0]) for row in connection.execute(statement, values)]
+      if keys_only or not keys:
+        return [Row(key, None) for key in keys]
+
+      statement = "SELECT row_key, column_name, value FROM {0} " \
+        "WHERE row_key >= ? AND row_key <= ?".format(table)
+      values = [buffer(keys[0]), buffer(keys[-1])]
+      if column_names:
+        statement += " AND column_name IN ({0})".format(
+          ",".join("?" * len(column_names)))
+        values += column_names
+      columns = dict((key, {}) for key in keys)
+      for row_key, column_name, value in connection.execute(statement,
+                                                            values):
+        columns[str(row_key)][column_name] = str(value)
+      return [Row(key, columns[key]) for key in keys]
+    finally:
+      connection.execute("COMMIT")
+
+  def scan(self, table_name, column_names, start_key, end_key,
+           start_inclusive, end_inclusive, keys_only, buffer_size, offset):
+    """ Streams a range a page at a time, skipping the offset in the first
+    page's read.
+
+    Yields:
+      Rows in key order, whose columns are None if keys only
+    """
+    while True:
+      page = self.read_page(table_name, column_names, start_key, end_key,
+                            start_inclusive, end_inclusive, keys_only,
+                            buffer_size, offset)
+      for row in page:
+        yield row
+      if len(page) < buffer_size:
+        return
+      start_key = page[-1].key
+      start_inclusive = False
+      offset = 0
+
+  def range_query(self,
+                  table_name,
+                  column_names,
+                  start_key,
+                  end_key,
+                  limit,
+                  offset=0,
+                  start_inclusive=True,
+                  end_inclusive=True,
+                  keys_only=False,
+                  consistency=None):
+    """
+    Gets a dense range ordered by keys. Returns an ordered list of
+    Rows such as [Row(key, {column1:value1, column2:value2}),...]
+    or a list of keys if keys only.
+
+    Args:
+      table_name: Name of table to access
+      column_names: Columns which get returned within the key range
+      start_key: String for which the query starts at
+      end_key: String for which the query ends at
+      limit: Maximum number of results to return
+      offset: Cuts off these many from the results [offset:]
+      start_inclusive: Boolean if results should include the start_key
+      end_inclusive: Boolean if results should include the end_key
+      keys_only: Boolean if to only keys and not values
+      consistency: The consistency level to read at, or None for the
+        default of the table
+    Raises:
+      TypeError: If an argument passed in was not of the expected type.
+      AppScaleDBConnectionError: If the range_query could not be performed due
+        to an error with SQLite.
+    Returns:
+      An ordered list of Rows, or of keys if keys only
+    """
+    if not isinstance(table_name, str): raise TypeError("Expected a str")
+    if not isinstance(column_names, list): raise TypeError("Expected a list")
+    if not isinstance(start_key, str): raise TypeError("Expected a str")
+    if not isinstance(end_key, str): raise TypeError("Expected a str")
+    if not isinstance(limit, int) and not isinstance(limit, long):
+      raise TypeError("Expected an int or long")
+    if not isinstance(offset, int) and not isinstance(offset, long):
+      raise TypeError("Expected an int or long")
+    self.get_consistency(table_name, READ_OPERATION, consistency)
+    if limit <= 0:
+      return []
+
+    try:
+      results = self.read_page(table_name, column_names, start_key, end_key,
+                               start_inclusive, end_inclusive, keys_only,
+                               limit, 0)[offset:]
+    except Exception, ex:
+      logging.exception(ex)
+      raise AppScaleDBConnectionError("Exception on range_query: %s" % str(ex))
+
+    if keys_only:
+      return [row.key for row in results]
+    return results
+
+  def range_scan(self,
+                 table_name,
+                 column_names,
+                 start_key,
+                 end_key,
+                 limit=None,
+                 offset=0,
+                 start_inclusive=True,
+                 end_inclusive=True,
+                 keys_only=False,
+                 buffer_size=DEFAULT_SCAN_BUFFER_SIZE,
+                 consistency=None):
+    """
+    Streams a dense range ordered by keys. The range is read in pages of
+    buffer_size rows, so only one page is held in memory however long the
+    range is, and the rows before the offset are skipped by SQLite.
+
+    Args:
+      table_name: Name of table to access
+      column_names: Columns which get returned within the key range
+      start_key: String for which the query starts at
+      end_key: String for which the query ends at
+      limit: Maximum number of rows to yield, None for no limit
+      offset: The number of rows skipped before the first one yielded
+      start_inclusive: Boolean if results should include the start_key
+      end_inclusive: Boolean if results should include the end_key
+      keys_only: Boolean if to only keys and not values
+      buffer_size: The number of rows read in each page
+      consistency: The consistency level to read at, or None for the
+        default of the table
+    Raises:
+      TypeError: If an argument passed in was not of the expected type.
+      AppScaleDBConnectionError: If the range could not be read due to an
+        error with SQLite.
+    Yields:
+      Rows in key order, whose columns are None if keys only
+    """
+    if not isinstance(table_name, str): raise TypeError("Expected a str")
+    if not isinstance(column_names, list): raise TypeError("Expected a list")
+    if not isinstance(start_key, str): raise TypeError("Expected a str")
+    if not isinstance(end_key, str): raise TypeError("Expected a str")
+    if limit is not None and not isinstance(limit, (int, long)):
+      raise TypeError("Expected an int or long")
+    if not isinstance(offset, int) and not isinstance(offset, long):
+      raise TypeError("Expected an int or long")
+    self.get_consistency(table_name, READ_OPERATION, consistency)
+    if limit == 0:
+      return
+
+    if limit is not None:
+      buffer_size = min(buffer_size, limit)
+    rows = self.scan(table_name, column_names, start_key, end_key,
+                     start_inclusive, end_inclusive, keys_only, buffer_size,
+                     offset)
+    try:
+      for row in itertools.islice(rows, limit):
+        yield row
+    except Exception, ex:
+      logging.exception(ex)
+      raise AppScaleDBConnectionError("Exception on range_scan: %s" % str(ex))
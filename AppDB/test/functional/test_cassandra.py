@@ -3,6 +3,7 @@ import sys
 import unittest
 
 from dbconstants import *
+from dbinterface_batch import Row
 
 sys.path.append(os.path.join(os.path.dirname(__file__), "../../cassandra"))
 import cassandra_interface
@@ -115,12 +116,12 @@ class RangeTestCase(unittest.TestCase):
                    'd':{'c1':'10','c2':'11','c3':'12'},
                    'e':{'c1':'13','c2':'14','c3':'15'},
                    'f':{'c1':'16','c2':'17','c3':'18'}}
-    expected = [{'a':{'c1':'1','c2':'2','c3':'3'}},
-                   {'b':{'c1':'4','c2':'5','c3':'6'}},
-                   {'c':{'c1':'7','c2':'8','c3':'9'}},
-                   {'d':{'c1':'10','c2':'11','c3':'12'}},
-                   {'e':{'c1':'13','c2':'14','c3':'15'}},
-                   {'f':{'c1':'16','c2':'17','c3':'18'}}]
+    expected = [Row('a', {'c1':'1','c2':'2','c3':'3'}),
+                   Row('b', {'c1':'4','c2':'5','c3':'6'}),
+                   Row('c', {'c1':'7','c2':'8','c3':'9'}),
+                   Row('d', {'c1':'10','c2':'11','c3':'12'}),
+                   Row('e', {'c1':'13','c2':'14','c3':'15'}),
+                   Row('f', {'c1':'16','c2':'17','c3':'18'})]
 
     self.cass.batch_put_entity(TEST5_TABLE, row_key, TEST5_TABLE_SCHEMA, 
                                cell_values)
@@ -144,29 +145,29 @@ class RangeTestCase(unittest.TestCase):
 
     keys_only = False
     start_in = False
-    expected = [{'b':{'c1':'4','c2':'5','c3':'6'}},
-                   {'c':{'c1':'7','c2':'8','c3':'9'}},
-                   {'d':{'c1':'10','c2':'11','c3':'12'}},
-                   {'e':{'c1':'13','c2':'14','c3':'15'}},
-                   {'f':{'c1':'16','c2':'17','c3':'18'}}]
+    expected = [Row('b', {'c1':'4','c2':'5','c3':'6'}),
+                   Row('c', {'c1':'7','c2':'8','c3':'9'}),
+                   Row('d', {'c1':'10','c2':'11','c3':'12'}),
+                   Row('e', {'c1':'13','c2':'14','c3':'15'}),
+                   Row('f', {'c1':'16','c2':'17','c3':'18'})]
     assert self.cass.range_query(TEST5_TABLE, column_names,
                                  startrow, endrow, limit, 
                                  offset, start_in, end_in) == expected
 
-    expected = [{'b':{'c1':'4','c2':'5','c3':'6'}},
-                   {'c':{'c1':'7','c2':'8','c3':'9'}},
-                   {'d':{'c1':'10','c2':'11','c3':'12'}},
-                   {'e':{'c1':'13','c2':'14','c3':'15'}}]
+    expected = [Row('b', {'c1':'4','c2':'5','c3':'6'}),
+                   Row('c', {'c1':'7','c2':'8','c3':'9'}),
+                   Row('d', {'c1':'10','c2':'11','c3':'12'}),
+                   Row('e', {'c1':'13','c2':'14','c3':'15'})]
 
     end_in = False
     assert self.cass.range_query(TEST5_TABLE, column_names,
                                  startrow, endrow, limit, 
                                  offset, start_in, end_in) == expected
 
-    expected = [{'b':{'c1':'4','c2':'5','c3':'6'}},
-                   {'c':{'c1':'7','c2':'8','c3':'9'}},
-                   {'d':{'c1':'10','c2':'11','c3':'12'}},
-                   {'e':{'c1':'13','c2':'14','c3':'15'}}]
+    expected = [Row('b', {'c1':'4','c2':'5','c3':'6'}),
+                   Row('c', {'c1':'7','c2':'8','c3':'9'}),
+                   Row('d', {'c1':'10','c2':'11','c3':'12'}),
+                   Row('e', {'c1':'13','c2':'14','c3':'15'})]
     start_in = True
     end_in = True
     startrow = 'b'
@@ -175,14 +176,14 @@ class RangeTestCase(unittest.TestCase):
                                  startrow, endrow, limit, offset, 
                                  start_in, end_in) == expected
 
-    expected = [{'b':{'c1':'4','c2':'5','c3':'6'}},
-                   {'c':{'c1':'7','c2':'8','c3':'9'}}]
+    expected = [Row('b', {'c1':'4','c2':'5','c3':'6'}),
+                   Row('c', {'c1':'7','c2':'8','c3':'9'})]
     limit = 2    
     assert self.cass.range_query(TEST5_TABLE, column_names,
                                  startrow, endrow, limit, 
                                  offset, start_in, end_in) == expected
 
-    expected = [{'c':{'c1':'7','c2':'8','c3':'9'}}]
+    expected = [Row('c', {'c1':'7','c2':'8','c3':'9'})]
     offset = 1
     assert self.cass.range_query(TEST5_TABLE, column_names,
                                  startrow, endrow, limit, 
@@ -0,0 +1,254 @@
+""" Measures what each consistency level costs on a simulated cluster.
+
+The stand-in cluster keeps a copy of every table on each of a few
+in-memory replicas. Each request reaches every replica after a random delay,
+and now and then a replica stalls, as on a garbage collection pause. A
+request at ONE finishes when the fastest replica answers, at QUORUM when
+most of them have and at ALL when every one has. Writes only become visible
+on a replica once they reach it, so a read at ONE can miss a write that
+another replica already acknowledged.
+
+Time is simulated, so the run is quick and repeatable. Three workloads are
+reported for each level:
+- groomer: a scan of the entity table in pages.
+- journal: reads of journal entries right after they were written at
+  QUORUM. When a read at ONE misses an entry, it is read again at QUORUM, as
+  the datastore server does, and the rate of those misses is reported.
+- commit: writes of entities.
+
+Usage: python benchmark_consistency.py [num_rows]
+"""
+import bisect
+import os
+import random
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(__file__), "../../"))
+import dbconstants
+from dbinterface_batch import AppDBInterface
+from dbinterface_batch import Row
+
+# The number of rows in the simulated entity table.
+DEFAULT_NUM_ROWS = 10000
+
+# The number of replicas each row is kept on.
+REPLICAS = 3
+
+# The shortest time in ms a replica takes to answer a request.
+BASE_LATENCY = 0.5
+
+# The mean time in ms a replica takes on top of the base latency.
+MEAN_EXTRA_LATENCY = 1.0
+
+# How often a replica stalls, and for how many ms.
+STALL_CHANCE = 0.03
+STALL_LATENCY = 25.0
+
+# The rows read in each page of the groomer scan.
+PAGE_SIZE = 100
+
+# The number of journal entries written and read back.
+JOURNAL_ENTRIES = 2000
+
+# The number of entities committed.
+COMMITS = 2000
+
+# The replicas that must answer at each level.
+REQUIRED_REPLICAS = {
+  dbconstants.CONSISTENCY_ONE: 1,
+  dbconstants.CONSISTENCY_QUORUM: REPLICAS / 2 + 1,
+  dbconstants.CONSISTENCY_ALL: REPLICAS
+}
+
+
+class LocalCluster(AppDBInterface):
+  """ An in-memory datastore that keeps tables on several simulated
+  replicas. """
+
+  def __init__(self, seed):
+    self.random = random.Random(seed)
+    self.now = 0.0
+    # Each replica maps tables to keys to (time the write arrives, columns).
+    self.replicas = [{} for _ in range(REPLICAS)]
+
+  def get_consistency_config(self):
+    """ Leaves every table at the default levels, whatever this host has
+    configured. """
+    return {}
+
+  def request(self, consistency):
+    """ Sends a request to every replica and waits for enough answers.
+
+    Returns:
+      A list of the times each replica received the request, and the time
+      the request finished.
+    """
+    latencies = []
+    for _ in range(REPLICAS):
+      latency = BASE_LATENCY + self.random.expovariate(1 / MEAN_EXTRA_LATENCY)
+      if self.random.random() < STALL_CHANCE:
+        latency += STALL_LATENCY
+      latencies.append(latency)
+    arrivals = [self.now + latency for latency in latencies]
+    done = sorted(arrivals)[REQUIRED_REPLICAS[consistency] - 1]
+    return arrivals, done
+
+  def read_replicas(self, consistency):
+    """ Gets the replicas that answer a read, and advances the clock. """
+    arrivals, done = self.request(consistency)
+    answered = [(arrival, replica) for arrival, replica
+                in zip(arrivals, self.replicas) if arrival <= done]
+    self.now = done
+    return answered
+
+  def visible(self, answered, table_name, row_key):
+    """ Gets the columns of a row that the answering replicas have. """
+    for arrival, replica in answered:
+      written = replica.get(table_name, {}).get(row_key)
+      if written is not None and written[0] <= arrival:
+        return written[1]
+    return None
+
+  def batch_get_entity(self, table_name, row_keys, column_names,
+                       consistency=None):
+    consistency = self.get_consistency(table_name,
+      dbconstants.READ_OPERATION, consistency)
+    answered = self.read_replicas(consistency)
+    results = {}
+    for row_key in row_keys:
+      results[row_key] = self.visible(answered, table_name, row_key) or {}
+    return results
+
+  def batch_put_entity(self, table_name, row_keys, column_names, cell_values,
+                       consistency=None):
+    consistency = self.get_consistency(table_name,
+      dbconstants.WRITE_OPERATION, consistency)
+    arrivals, done = self.request(consistency)
+    for arrival, replica in zip(arrivals, self.replicas):
+      table = replica.setdefault(table_name, {})
+      for row_key in row_keys:
+        table[row_key] = (arrival, cell_values[row_key])
+    self.now = done
+
+  def range_query(self, table_name, column_names, start_key, end_key, limit,
+                  offset=0, start_inclusive=True, end_inclusive=True,
+                  keys_only=False, consistency=None):
+    consistency = self.get_consistency(table_name,
+      dbconstants.READ_OPERATION, consistency)
+    answered = self.read_replicas(consistency)
+    keys = sorted(self.replicas[0].get(table_name, {}))
+    start = bisect.bisect_left(keys, start_key)
+    end = bisect.bisect_right(keys, end_key)
+    results = []
+    for row_key in keys[start:end]:
+      if (not start_inclusive and row_key == start_key) or \
+         (not end_inclusive and row_key == end_key):
+        continue
+      columns = self.visible(answered, table_name, row_key)
+      if columns is None:
+        continue
+      results.append(row_key if keys_only else Row(row_key, columns))
+      if len(results) == limit:
+        break
+    return results
+
+
+def percentile(latencies, fraction):
+  """ Gets the latency a fraction of the requests finished within. """
+  ordered = sorted(latencies)
+  return ordered[min(int(len(ordered) * fraction), len(ordered) - 1)]
+
+
+def timed(cluster, operation):
+  """ Runs an operation and returns the simulated ms it took. """
+  start = cluster.now
+  operation()
+  return cluster.now - start
+
+
+def run_groomer(num_rows, consistency):
+  """ Scans a filled entity table, returning the latency of each page. """
+  cluster = LocalCluster(1)
+  for number in range(num_rows):
+    row_key = "app\x00\x00kind:{0:010d}\x01".format(number)
+    cluster.batch_put_entity(dbconstants.APP_ENTITY_TABLE, [row_key],
+      dbconstants.APP_ENTITY_SCHEMA, {row_key: {'entity': 'e', 'txnID': '1'}},
+      consistency=dbconstants.CONSISTENCY_ALL)
+  cluster.now += STALL_LATENCY * 10
+
+  latencies = []
+  rows = cluster.range_scan(dbconstants.APP_ENTITY_TABLE,
+    dbconstants.APP_ENTITY_SCHEMA, "", "\xff", buffer_size=PAGE_SIZE,
+    consistency=consistency)
+  while True:
+    start = cluster.now
+    page = [row for _, row in zip(range(PAGE_SIZE), rows)]
+    if not page:
+      break
+    latencies.append(cluster.now - start)
+  return latencies, 0
+
+
+def run_journal(consistency):
+  """ Writes journal entries at QUORUM and reads each back at once.
+
+  Returns:
+    A tuple of the latency of each read and the number of reads at ONE
+    that had to be made again.
+  """
+  cluster = LocalCluster(2)
+  latencies = []
+  rereads = [0]
+  for number in range(JOURNAL_ENTRIES):
+    journal_key = "app\x00\x00kind:{0:010d}\x01\x000000000001".format(number)
+    cluster.batch_put_entity(dbconstants.JOURNAL_TABLE, [journal_key],
+      dbconstants.JOURNAL_SCHEMA, {journal_key: {'Encoded_Entity': 'e'}})
+
+    def read():
+      entries = cluster.batch_get_entity(dbconstants.JOURNAL_TABLE,
+        [journal_key], dbconstants.JOURNAL_SCHEMA, consistency=consistency)
+      if not entries[journal_key] and \
+          consistency == dbconstants.CONSISTENCY_ONE:
+        rereads[0] += 1
+        cluster.batch_get_entity(dbconstants.JOURNAL_TABLE, [journal_key],
+          dbconstants.JOURNAL_SCHEMA)
+    latencies.append(timed(cluster, read))
+  return latencies, rereads[0]
+
+
+def run_commits(consistency):
+  """ Writes entities, returning the latency of each write. """
+  cluster = LocalCluster(3)
+  latencies = []
+  for number in range(COMMITS):
+    row_key = "app\x00\x00kind:{0:010d}\x01".format(number)
+    latencies.append(timed(cluster, lambda: cluster.batch_put_entity(
+      dbconstants.APP_ENTITY_TABLE, [row_key], dbconstants.APP_ENTITY_SCHEMA,
+      {row_key: {'entity': 'e', 'txnID': '1'}}, consistency=consistency)))
+  return latencies, 0
+
+
+def main():
+  num_rows = DEFAULT_NUM_ROWS
+  if len(sys.argv) > 1:
+    num_rows = int(sys.argv[1])
+
+  print 'Replicas: {0}, rows: {1}'.format(REPLICAS, num_rows)
+  print '{0:>8} {1:>7} {2:>8} {3:>10} {4:>10} {5:>10} {6:>8}'.format(
+    'workload', 'level', 'requests', 'mean (ms)', 'p99 (ms)', 'total (ms)',
+    'rereads')
+  workloads = [('groomer', lambda level: run_groomer(num_rows, level)),
+               ('journal', run_journal),
+               ('commit', run_commits)]
+  for name, run in workloads:
+    for level in dbconstants.CONSISTENCY_LEVELS:
+      latencies, rereads = run(level)
+      print ('{0:>8} {1:>7} {2:>8} {3:>10.2f} {4:>10.2f} {5:>10.1f} '
+             '{6:>8}').format(name, level, len(latencies),
+                              sum(latencies) / len(latencies),
+                              percentile(latencies, 0.99), sum(latencies),
+                              rereads)
+
+
+if __name__ == "__main__":
+  main()
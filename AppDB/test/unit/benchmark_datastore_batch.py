@@ -0,0 +1,154 @@
+""" Measures the batch interface of a datastore backend.
+
+The entity table is filled with rows shaped like entities, and then read
+back the ways the datastore server and groomer read it: gets of random
+batches of keys, queries of short ranges, a scan of the whole table in
+pages, and deletes. The rate of rows for each workload is reported.
+
+The SQLite backend needs nothing but this checkout, so it is the default,
+and its database is kept in a temporary directory. Other backends are
+loaded the way DatastoreFactory loads them and need their service running.
+
+Usage: python benchmark_datastore_batch.py [datastore] [num_rows]
+"""
+import imp
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+APPDB_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "../../")
+sys.path.append(APPDB_DIR)
+import dbconstants
+
+# The number of rows in the entity table.
+DEFAULT_NUM_ROWS = 20000
+
+# The rows written, read or deleted by each batch call.
+BATCH_SIZE = 100
+
+# The rows in each range query.
+RANGE_SIZE = 20
+
+# The number of range queries made.
+RANGE_QUERIES = 500
+
+# The rows read in each page of the scan.
+PAGE_SIZE = 500
+
+# The bytes of each encoded entity.
+ENTITY_SIZE = 200
+
+
+def load_datastore(d_type):
+  """ Loads a datastore backend from this checkout.
+
+  Args:
+    d_type: The name of the datastore (ex: sqlite)
+  Returns:
+    A DatastoreProxy of the backend
+  """
+  d_dir = os.path.join(APPDB_DIR, d_type)
+  sys.path.append(d_dir)
+  d_mod = imp.load_source(d_type + "_interface",
+                          os.path.join(d_dir, d_type + "_interface.py"))
+  return d_mod.DatastoreProxy()
+
+
+def row_key(number):
+  """ Gets the key of an entity row. """
+  return "bench\x00\x00Kind:{0:010d}\x01".format(number)
+
+
+def timed(operation):
+  """ Runs an operation and returns the seconds it took. """
+  start = time.time()
+  operation()
+  return time.time() - start
+
+
+def run_puts(db, keys):
+  """ Writes every row in batches. """
+  for start in range(0, len(keys), BATCH_SIZE):
+    batch = keys[start:start + BATCH_SIZE]
+    db.batch_put_entity(dbconstants.APP_ENTITY_TABLE, batch,
+      dbconstants.APP_ENTITY_SCHEMA,
+      dict((key, {'entity': 'e' * ENTITY_SIZE, 'txnID': '1'})
+           for key in batch))
+  return len(keys)
+
+
+def run_gets(db, keys):
+  """ Reads random batches of rows, as when entities are fetched. """
+  shuffled = list(keys)
+  random.Random(1).shuffle(shuffled)
+  for start in range(0, len(shuffled), BATCH_SIZE):
+    db.batch_get_entity(dbconstants.APP_ENTITY_TABLE,
+      shuffled[start:start + BATCH_SIZE], dbconstants.APP_ENTITY_SCHEMA)
+  return len(shuffled)
+
+
+def run_range_queries(db, keys):
+  """ Reads short ranges from random places, as queries with limits do. """
+  chooser = random.Random(2)
+  for _ in range(RANGE_QUERIES):
+    start = chooser.randrange(len(keys))
+    db.range_query(dbconstants.APP_ENTITY_TABLE,
+      dbconstants.APP_ENTITY_SCHEMA, keys[start], row_key(len(keys)),
+      RANGE_SIZE)
+  return RANGE_QUERIES * RANGE_SIZE
+
+
+def run_scan(db, keys):
+  """ Scans the whole table in pages, as the groomer does. """
+  count = 0
+  for _ in db.range_scan(dbconstants.APP_ENTITY_TABLE,
+      dbconstants.APP_ENTITY_SCHEMA, row_key(0), row_key(len(keys)),
+      buffer_size=PAGE_SIZE):
+    count += 1
+  return count
+
+
+def run_deletes(db, keys):
+  """ Deletes every row in batches. """
+  for start in range(0, len(keys), BATCH_SIZE):
+    db.batch_delete(dbconstants.APP_ENTITY_TABLE,
+      keys[start:start + BATCH_SIZE])
+  return len(keys)
+
+
+def main():
+  d_type = "sqlite"
+  num_rows = DEFAULT_NUM_ROWS
+  if len(sys.argv) > 1:
+    d_type = sys.argv[1]
+  if len(sys.argv) > 2:
+    num_rows = int(sys.argv[2])
+
+  directory = tempfile.mkdtemp()
+  os.environ.setdefault("APPSCALE_SQLITE_DB",
+                        os.path.join(directory, "datastore.db"))
+  try:
+    db = load_datastore(d_type)
+    keys = [row_key(number) for number in range(num_rows)]
+
+    print 'Datastore: {0}, rows: {1}'.format(d_type, num_rows)
+    print '{0:>12} {1:>8} {2:>10} {3:>12}'.format('workload', 'rows',
+                                                  'time (s)', 'rows/s')
+    for name, run in [('put', run_puts),
+                      ('get', run_gets),
+                      ('range_query', run_range_queries),
+                      ('range_scan', run_scan),
+                      ('delete', run_deletes)]:
+      result = []
+      elapsed = timed(lambda: result.append(run(db, keys)))
+      print '{0:>12} {1:>8} {2:>10.3f} {3:>12.0f}'.format(name, result[0],
+        elapsed, result[0] / elapsed)
+  finally:
+    shutil.rmtree(directory)
+
+
+if __name__ == "__main__":
+  main()
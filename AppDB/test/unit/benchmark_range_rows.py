@@ -0,0 +1,108 @@
+""" Compares the cost of range query results held as one-element dicts with
+that of results held as Rows.
+
+A range of entity table rows as pycassa returns them is converted to both
+forms the way the Cassandra proxy converts them, and then read the way the
+datastore server reads the results of a query: the key and version of every
+row are checked, as when they are validated, and the entities are
+extracted. The memory taken by the containers that wrap each row and the
+time to build and read the range are reported for both.
+
+Usage: python benchmark_range_rows.py [num_rows]
+"""
+import os
+import sys
+import time
+
+sys.path.append(os.path.join(os.path.dirname(__file__), "../../"))
+from dbinterface_batch import Row
+
+# The number of rows in the simulated range.
+DEFAULT_NUM_ROWS = 10000
+
+# How many times each range is built and read.
+REPEATS = 20
+
+
+def build_dicts(slices):
+  """ Wraps every row in a dictionary of its key, as results used to be. """
+  results = []
+  for key in slices:
+    columns = key[1]
+    col_mapping = {}
+    for column in columns.items():
+      col_mapping[str(column[0])] = column[1]
+    results.append({key[0]: col_mapping})
+  return results
+
+
+def read_dicts(results):
+  """ Reads dictionary results the way they used to be read. """
+  versions = 0
+  for item in results:
+    key = item.keys()[0]
+    versions += long(item[key]['txnID'])
+  keys = [item.keys()[0] for item in results]
+  entities = []
+  for index, item in enumerate(results):
+    entities.append(item[keys[index]]['entity'])
+  return versions, entities
+
+
+def build_rows(slices):
+  """ Wraps every row in a Row. """
+  return [Row(key, {str(name): value for name, value in columns.iteritems()})
+          for key, columns in slices]
+
+
+def read_rows(results):
+  """ Reads Row results the way they are read now. """
+  versions = 0
+  for key, columns in results:
+    versions += long(columns['txnID'])
+  entities = [columns['entity'] for _, columns in results]
+  return versions, entities
+
+
+def wrapper_bytes(results):
+  """ Gets the bytes taken by the containers around each row's columns. """
+  return sys.getsizeof(results) + sum(sys.getsizeof(item) for item in results)
+
+
+def run_case(slices, build, read):
+  """ Builds and reads a range repeatedly.
+
+  Returns:
+    A tuple of the bytes taken by the row containers and the shortest time
+    in seconds to build and read the range.
+  """
+  size = wrapper_bytes(build(slices))
+
+  elapsed = None
+  for _ in range(REPEATS):
+    start = time.time()
+    read(build(slices))
+    if elapsed is None or time.time() - start < elapsed:
+      elapsed = time.time() - start
+  return size, elapsed
+
+
+def main():
+  num_rows = DEFAULT_NUM_ROWS
+  if len(sys.argv) > 1:
+    num_rows = int(sys.argv[1])
+
+  slices = [("app\x00\x00kind:{0:010d}\x01".format(number),
+             {u'entity': 'x' * 100, u'txnID': str(number)})
+            for number in range(num_rows)]
+
+  print 'Rows: {0}'.format(num_rows)
+  print '{0:>8} {1:>12} {2:>10}'.format('format', 'bytes', 'time (ms)')
+  for name, build, read in [('dicts', build_dicts, read_dicts),
+                            ('rows', build_rows, read_rows)]:
+    size, elapsed = run_case(slices, build, read)
+    print '{0:>8} {1:>12} {2:>10.1f}'.format(name, size, elapsed * 1000)
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,157 @@
+""" Measures how many index rows the zigzag merge join reads for each result.
+
+An in-memory property index is filled with entities whose properties match
+with different selectivities, and keys-only queries with two equality
+filters are run against it. For each case the number of index rows scanned
+and looked up is compared with the number of results returned, and with the
+rows that one round of 10,000-row windows per property would have read.
+
+Usage: python benchmark_zigzag_merge_join.py [num_entities]
+"""
+import bisect
+import os
+import sys
+import time
+
+sys.path.append(os.path.join(os.path.dirname(__file__), "../../../AppServer"))
+from google.appengine.datastore import datastore_pb
+
+sys.path.append(os.path.join(os.path.dirname(__file__), "../../"))
+from datastore_server import DatastoreDistributed
+from dbinterface_batch import Row
+
+# The number of entities in the simulated index.
+DEFAULT_NUM_ENTITIES = 100000
+
+# The rows read for each property by one round of a window scan.
+WINDOW_SIZE = 10000
+
+# The (name, every nth entity with property a, every nth with property b,
+# query limit) cases to run.
+CASES = [
+  ('dense', 2, 3, 1000),
+  ('dense, small limit', 2, 3, 20),
+  ('one selective', 1, 1000, 1000),
+  ('both selective', 97, 101, 1000),
+  ('disjoint', 2, 2, 1000),
+]
+
+
+class FakeIndex(object):
+  """ A sorted in-memory property table that counts the rows it returns. """
+
+  def __init__(self):
+    self.keys = []
+    self.references = {}
+    self.rows_scanned = 0
+    self.rows_looked_up = 0
+    self.reads = 0
+
+  def add(self, row_key, reference):
+    self.references[row_key] = reference
+
+  def seal(self):
+    self.keys = sorted(self.references)
+
+  def range_scan(self, table, column_names, start_key, end_key, limit=None,
+                 offset=0, start_inclusive=True, end_inclusive=True,
+                 keys_only=False, buffer_size=100):
+    start = bisect.bisect_left(self.keys, start_key)
+    end = bisect.bisect_right(self.keys, end_key)
+    if limit is not None:
+      end = min(end, start + limit)
+    self.reads += 1
+    for key in self.keys[start:end]:
+      self.rows_scanned += 1
+      if keys_only:
+        yield Row(key, None)
+      else:
+        yield Row(key, {'reference': self.references[key]})
+
+  def batch_get_entity(self, table, row_keys, column_names):
+    self.rows_looked_up += len(row_keys)
+    self.reads += 1
+    rows = {}
+    for key in row_keys:
+      rows[key] = {}
+      if key in self.references:
+        rows[key] = {'reference': self.references[key]}
+    return rows
+
+
+def build_index(num_entities, every_a, every_b):
+  """ Fills an index with entities that have property a or b set.
+
+  Args:
+    num_entities: An int, the number of entities.
+    every_a: An int, every how many entities have property a.
+    every_b: An int, every how many entities have property b. When it equals
+      every_a, the entities with b are shifted by one so none match.
+  Returns:
+    A tuple of the FakeIndex and a dict of the number of rows for each
+    property.
+  """
+  index = FakeIndex()
+  counts = {'a': 0, 'b': 0}
+  shift = 1 if every_a == every_b else 0
+  for number in range(num_entities):
+    path = "kind:{0:010d}\x01".format(number)
+    reference = "app\x00\x00" + path
+    if number % every_a == 0:
+      index.add("app\x00\x00kind\x00a\x00x\x00" + path, reference)
+      counts['a'] += 1
+    if (number + shift) % every_b == 0:
+      index.add("app\x00\x00kind\x00b\x00y\x00" + path, reference)
+      counts['b'] += 1
+  index.seal()
+  return index, counts
+
+
+def run_case(num_entities, every_a, every_b, limit):
+  """ Runs one query and reports what it read.
+
+  Returns:
+    A tuple of results returned, index rows scanned, index rows looked up,
+    reads issued, rows a window scan would read and the elapsed time in
+    seconds.
+  """
+  index, counts = build_index(num_entities, every_a, every_b)
+  datastore = DatastoreDistributed(index, None)
+
+  query = datastore_pb.Query()
+  query.set_app('app')
+  query.set_kind('kind')
+  query.set_keys_only(True)
+  query.set_limit(limit)
+  filter_info = {'a': [(datastore_pb.Query_Filter.EQUAL, 'x')],
+                 'b': [(datastore_pb.Query_Filter.EQUAL, 'y')]}
+
+  start = time.time()
+  results = datastore.zigzag_merge_join(query, filter_info, [])
+  elapsed = time.time() - start
+
+  window_rows = sum(min(count, WINDOW_SIZE) for count in counts.values())
+  return (len(results), index.rows_scanned, index.rows_looked_up, index.reads,
+          window_rows, elapsed)
+
+
+def main():
+  num_entities = DEFAULT_NUM_ENTITIES
+  if len(sys.argv) > 1:
+    num_entities = int(sys.argv[1])
+
+  print 'Entities: {0}'.format(num_entities)
+  print ('{0:>20} {1:>8} {2:>8} {3:>8} {4:>6} {5:>12} {6:>8} '
+         '{7:>10}').format('case', 'results', 'scanned', 'lookups', 'reads',
+                           'rows/result', 'window', 'time (ms)')
+  for name, every_a, every_b, limit in CASES:
+    results, scanned, looked_up, reads, window_rows, elapsed = run_case(
+      num_entities, every_a, every_b, limit)
+    print ('{0:>20} {1:>8} {2:>8} {3:>8} {4:>6} {5:>12.1f} {6:>8} '
+           '{7:>10.1f}').format(name, results, scanned, looked_up, reads,
+                                float(scanned + looked_up) / max(results, 1),
+                                window_rows, elapsed * 1000)
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,95 @@
+""" Measures how long ZooKeeper takes to finish a transaction as it spans
+more entity groups and updates more keys.
+
+For each number of entity groups, up to the most a cross-group transaction
+may lock, transactions lock that many groups and register updated keys in
+each. Then either their locks are released, as on a commit, or they are
+failed, as on a rollback. The mean latency of each is reported.
+
+This needs a ZooKeeper server. Everything it writes is kept under its own
+application and removed at the end.
+
+Usage: python benchmark_zookeeper_commit.py [zookeeper_host] [repeats]
+"""
+import os
+import sys
+import time
+import uuid
+
+sys.path.append(os.path.join(os.path.dirname(__file__), "../../"))
+from zkappscale import zktransaction as zk
+
+# The application the transactions are made for.
+APP_ID = "benchmarkzookeepercommit"
+
+# How many transactions are timed for each case.
+DEFAULT_REPEATS = 20
+
+# The numbers of updated keys registered in each entity group.
+KEYS_PER_GROUP = [0, 10]
+
+
+def start_transaction(zoo, groups, keys_per_group):
+  """ Starts a transaction that locks entity groups and updates keys.
+
+  Args:
+    zoo: A ZKTransaction.
+    groups: The number of entity groups to lock.
+    keys_per_group: The number of updated keys to register in each group.
+  Returns:
+    The transaction ID.
+  """
+  txid = zoo.get_transaction_id(APP_ID, is_xg=groups > 1)
+  run = uuid.uuid4().hex
+  for group in range(groups):
+    root_key = "{0}\x00\x00Group:{1}{2}\x01".format(APP_ID, run, group)
+    zoo.acquire_lock(APP_ID, txid, root_key)
+    for key in range(keys_per_group):
+      zoo.register_updated_key(APP_ID, txid, 1,
+        "{0}Kind:{1}\x01".format(root_key, key))
+  return txid
+
+
+def time_finish(zoo, groups, keys_per_group, repeats, finish):
+  """ Times how long transactions take to finish.
+
+  Returns:
+    The mean latency in ms.
+  """
+  elapsed = 0
+  for _ in range(repeats):
+    txid = start_transaction(zoo, groups, keys_per_group)
+    start = time.time()
+    finish(APP_ID, txid)
+    elapsed += time.time() - start
+  return elapsed / repeats * 1000
+
+
+def main():
+  host = zk.DEFAULT_HOST
+  repeats = DEFAULT_REPEATS
+  if len(sys.argv) > 1:
+    host = sys.argv[1]
+  if len(sys.argv) > 2:
+    repeats = int(sys.argv[2])
+
+  zoo = zk.ZKTransaction(host=host, start_gc=False)
+  try:
+    print 'ZooKeeper: {0}, repeats: {1}'.format(host, repeats)
+    print '{0:>6} {1:>14} {2:>12} {3:>14}'.format('groups', 'keys/group',
+      'commit (ms)', 'rollback (ms)')
+    for keys_per_group in KEYS_PER_GROUP:
+      for groups in range(1, zk.MAX_GROUPS_FOR_XG + 1):
+        commit = time_finish(zoo, groups, keys_per_group, repeats,
+                             zoo.release_lock)
+        rollback = time_finish(zoo, groups, keys_per_group, repeats,
+                               zoo.notify_failed_transaction)
+        print '{0:>6} {1:>14} {2:>12.2f} {3:>14.2f}'.format(groups,
+          keys_per_group, commit, rollback)
+  finally:
+    zoo.handle.delete(zoo.get_app_root_path(APP_ID), recursive=True)
+    zoo.close()
+
+
+if __name__ == "__main__":
+  main()
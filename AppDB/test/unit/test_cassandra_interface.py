@@ -4,10 +4,14 @@
 import pycassa
 import os 
 import sys
+import tempfile
 import unittest
 
 from flexmock import flexmock
 
+sys.path.append(os.path.join(os.path.dirname(__file__), "../../"))
+import dbconstants
+
 sys.path.append(os.path.join(os.path.dirname(__file__), "../../cassandra"))  
 import cassandra_interface
 
@@ -110,5 +114,72 @@ class TestCassandra(unittest.TestCase):
 
     assert [] == db.range_query("table", [], "start", "end", 0)
 
+  def testRangeScan(self):
+    flexmock(file_io) \
+        .should_receive('read') \
+        .and_return('127.0.0.1')
+
+    keys = ["a", "b", "c", "d", "e"]
+    read = []
+    def get_range(start='', finish='', columns='', row_count=None,
+                  buffer_size=None, read_consistency_level=''):
+      assert buffer_size == 2
+      for key in keys:
+        read.append(key)
+        yield key, {u'column': key.upper()}
+
+    column_family = FakeColumnFamily()
+    flexmock(column_family).should_receive("get_range") \
+        .replace_with(get_range)
+    flexmock(pycassa) \
+        .should_receive("ColumnFamily") \
+        .and_return(column_family)
+
+    db = cassandra_interface.DatastoreProxy()
+
+    rows = db.range_scan("table", ["column"], "a", "e", buffer_size=2)
+    self.assertEquals([("a", {"column": "A"}), ("b", {"column": "B"})],
+                      [rows.next(), rows.next()])
+    # Rows are only read as they are needed.
+    self.assertEquals(["a", "b"], read)
+
+    rows = db.range_scan("table", ["column"], "a", "e", limit=2, offset=1,
+                         start_inclusive=False, keys_only=True,
+                         buffer_size=2)
+    self.assertEquals([("c", None), ("d", None)], list(rows))
+
+  def testConsistency(self):
+    flexmock(file_io) \
+        .should_receive('read') \
+        .and_return('127.0.0.1')
+
+    config_file = tempfile.NamedTemporaryFile()
+    config_file.write('{"read": {"default": "ONE", "JOURNAL__": "ALL", '
+                      '"KINDS__": "TWO"}}')
+    config_file.flush()
+    flexmock(dbconstants, CONSISTENCY_CONFIG_LOCATION=config_file.name)
+
+    db = cassandra_interface.DatastoreProxy()
+    self.assertEquals("ALL", db.get_consistency("JOURNAL__", "read"))
+    # Unknown levels in the file are ignored.
+    self.assertEquals("ONE", db.get_consistency("KINDS__", "read"))
+    self.assertEquals("QUORUM", db.get_consistency("KINDS__", "write"))
+    self.assertEquals("QUORUM",
+                      db.get_consistency("JOURNAL__", "read", "QUORUM"))
+    self.assertRaises(TypeError, db.get_consistency, "JOURNAL__", "read",
+                      "TWO")
+
+    # The level is passed on to Cassandra.
+    column_family = FakeColumnFamily()
+    flexmock(column_family).should_receive("get_range") \
+        .with_args(columns=[], start="a", finish="b", row_count=2,
+                   read_consistency_level=
+                     pycassa.cassandra.ttypes.ConsistencyLevel.ALL) \
+        .and_return({}).once()
+    flexmock(pycassa) \
+        .should_receive("ColumnFamily") \
+        .and_return(column_family)
+    self.assertEquals([], db.range_query("JOURNAL__", [], "a", "b", 1))
+
 if __name__ == "__main__":
   unittest.main()    
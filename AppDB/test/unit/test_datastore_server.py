@@ -1,8 +1,14 @@
 #!/usr/bin/env python
 # Programmer: Navraj Chohan <nlake44@gmail.com>
 
+import multiprocessing.pool
 import os
 import sys
+import threading
+import time
+import tornado.httputil
+import tornado.ioloop
+import tornado.web
 import unittest
 from flexmock import flexmock
 
@@ -10,21 +16,29 @@ sys.path.append(os.path.join(os.path.dirname(__file__), "../../../AppServer"))
 from google.appengine.datastore import entity_pb
 from google.appengine.datastore import datastore_index
 from google.appengine.datastore import datastore_pb
+from google.appengine.datastore import sortable_pb_encoder
 from google.appengine.api import api_base_pb
+from google.appengine.runtime import apiproxy_errors
 from google.appengine.api import datastore
 from google.appengine.ext import db
 
 sys.path.append(os.path.join(os.path.dirname(__file__), "../../"))  
+import datastore_server
 from appscale_datastore_batch import DatastoreFactory
 from datastore_server import DatastoreDistributed
 from datastore_server import BLOCK_SIZE
 from datastore_server import TOMBSTONE
 from dbconstants import *
+from dbinterface_batch import Row
 
 sys.path.append(os.path.join(os.path.dirname(__file__), "../../"))  
 from zkappscale import zktransaction as zk
 from zkappscale.zktransaction import ZKTransactionException
 
+def valid_transaction_ids(txid):
+  """ Fakes get_valid_transaction_ids, finding every row valid at txid. """
+  return lambda app_id, versions: dict((row_key, txid) for row_key in versions)
+
 class Item(db.Model):
   name = db.StringProperty(required = True)
 
@@ -38,6 +52,8 @@ class TestDatastoreServer(unittest.TestCase):
     zookeeper.should_receive("release_lock").and_return(True)
     zookeeper.should_receive("get_transaction_id").and_return(1)
     zookeeper.should_receive("increment_and_get_counter").and_return(0,1000)
+    zookeeper.should_receive("get_index_version").and_return(1)
+    zookeeper.should_receive("update_index_version").and_return(True)
     return zookeeper
 
   def test_get_entity_kind(self):
@@ -166,16 +182,67 @@ class TestDatastoreServer(unittest.TestCase):
     
     self.assertEquals(dd.get_indices("appid"), [])
 
+  def test_get_composite_indexes(self):
+    def encoded_index(index_id, kind):
+      index = entity_pb.CompositeIndex()
+      index.set_id(index_id)
+      index.set_app_id("appid")
+      index.set_state(entity_pb.CompositeIndex.READ_WRITE)
+      index.mutable_definition().set_entity_type(kind)
+      index.mutable_definition().set_ancestor(0)
+      return index.Encode()
+
+    db_batch = flexmock()
+    db_batch.should_receive("range_query").and_return(
+      [Row("key1", {"data": encoded_index(1, "kind")}),
+       Row("key2", {"data": encoded_index(2, "other")})]).once()
+    zookeeper = flexmock()
+    zookeeper.should_receive("get_index_version").and_return(1)
+    dd = DatastoreDistributed(db_batch, zookeeper)
+
+    indexes = dd.get_composite_indexes("appid", ["kind", "kind"])
+    self.assertEquals([1], [index.id() for index in indexes])
+    # The definitions are read once for as long as their version holds.
+    indexes = dd.get_composite_indexes("appid", ["kind", "other"])
+    self.assertEquals([1, 2], sorted(index.id() for index in indexes))
+
+    # A new version has them read again.
+    zookeeper.should_receive("get_index_version").and_return(2)
+    db_batch.should_receive("range_query").and_return(
+      [Row("key2", {"data": encoded_index(2, "other")})]).once()
+    self.assertEquals([], dd.get_composite_indexes("appid", ["kind"]))
+
+    # They are not cached when the version is unknown.
+    zookeeper.should_receive("get_index_version").\
+      and_raise(zk.ZKInternalException)
+    db_batch.should_receive("range_query").and_return([]).twice()
+    dd.get_composite_indexes("appid", ["other"])
+    self.assertEquals([], dd.get_composite_indexes("appid", ["other"]))
+
   def test_delete_composite_index_metadata(self):
     db_batch = flexmock()
     db_batch.should_receive("batch_delete").and_return(None)
+    jobs = {}
+    db_batch.should_receive("batch_put_entity").replace_with(
+      lambda table, row_keys, column_names, row_values: jobs.update(
+        row_values))
     dd = DatastoreDistributed(db_batch, self.get_zookeeper())
     dd = flexmock(dd)
     dd.should_receive("get_meta_data_key").and_return("somekey")
     composite_index = entity_pb.CompositeIndex() 
     composite_index.set_id(1)
+    composite_index.set_app_id("appid")
+    composite_index.set_state(entity_pb.CompositeIndex.READ_WRITE)
+    definition = composite_index.mutable_definition()
+    definition.set_entity_type("kind")
+    definition.set_ancestor(0)
     dd.delete_composite_index_metadata("appid", composite_index)
 
+    # The rows of the index are left for the index builder to delete.
+    job = entity_pb.CompositeIndex(jobs["somekey"]["data"])
+    self.assertEquals("appid", job.app_id())
+    self.assertEquals(entity_pb.CompositeIndex.DELETED, job.state())
+
   def test_create_composite_index(self):
     db_batch = flexmock()
     db_batch.should_receive("batch_put_entity").and_return(None)
@@ -197,6 +264,144 @@ class TestDatastoreServer(unittest.TestCase):
 
     dd.create_composite_index("appid", index)
     assert index.id() > 0 
+    # The index is only written to until the index builder has filled it in.
+    self.assertEquals(entity_pb.CompositeIndex.WRITE_ONLY, index.state())
+
+  def test_composite_query_waits_for_index_build(self):
+    index = entity_pb.CompositeIndex()
+    index.set_id(123)
+    index.set_app_id("hello")
+    index.set_state(entity_pb.CompositeIndex.WRITE_ONLY)
+    definition = index.mutable_definition()
+    definition.set_entity_type("Item")
+    definition.set_ancestor(0)
+    for name in ["name", "age"]:
+      prop = definition.add_property()
+      prop.set_name(name)
+      prop.set_direction(1)
+
+    query = datastore_pb.Query()
+    query.set_app("hello")
+    query.set_kind("Item")
+    query.add_composite_index().CopyFrom(index)
+    for name in ["name", "age"]:
+      order = query.add_order()
+      order.set_property(name)
+      order.set_direction(datastore_pb.Query_Order.ASCENDING)
+
+    # The AppServer may send the index before it is built.
+    db_batch = flexmock()
+    db_batch.should_receive("range_query").with_args(METADATA_TABLE,
+      METADATA_SCHEMA, str, str, int, offset=0, start_inclusive=True,
+      end_inclusive=True).and_return([Row("key", {"data": index.Encode()})])
+    dd = flexmock(DatastoreDistributed(db_batch, self.get_zookeeper()))
+    dd.should_receive("composite_v2").never()
+    try:
+      dd._dynamic_run_query(query, datastore_pb.QueryResult())
+      self.fail("The query should need the index")
+    except apiproxy_errors.ApplicationError, error:
+      self.assertEquals(datastore_pb.Error.NEED_INDEX, error.application_error)
+
+    # Queries use it once the index builder has marked it as serving.
+    index.set_state(entity_pb.CompositeIndex.READ_WRITE)
+    db_batch.should_receive("range_query").with_args(METADATA_TABLE,
+      METADATA_SCHEMA, str, str, int, offset=0, start_inclusive=True,
+      end_inclusive=True).and_return([Row("key", {"data": index.Encode()})])
+    dd = flexmock(DatastoreDistributed(db_batch, self.get_zookeeper()))
+    dd.should_receive("composite_v2").and_return([]).once()
+    dd._dynamic_run_query(query, datastore_pb.QueryResult())
+
+  def test_build_composite_index_batch(self):
+    index = entity_pb.CompositeIndex()
+    index.set_id(123)
+    index.set_app_id("hello")
+    index.set_state(entity_pb.CompositeIndex.WRITE_ONLY)
+    definition = index.mutable_definition()
+    definition.set_entity_type("Item")
+    definition.set_ancestor(0)
+    prop = definition.add_property()
+    prop.set_name("name")
+    prop.set_direction(1)
+
+    bob = db.model_to_protobuf(Item(key_name="Bob", name="Bob", _app="hello"))
+    sally = db.model_to_protobuf(Item(key_name="Sally", name="Sally",
+                                      _app="hello"))
+    rows = [
+      Row("hello\x00\x00Item:Bob\x01", {APP_ENTITY_SCHEMA[0]: bob.Encode()}),
+      Row("hello\x00\x00Item:Gone\x01", {APP_ENTITY_SCHEMA[0]: TOMBSTONE}),
+      Row("hello\x00\x00Other:Carl\x01", {APP_ENTITY_SCHEMA[0]: "other"}),
+    ]
+    # Sally is changed before the batch is locked, and is indexed as she is
+    # once it has been.
+    current = {
+      "hello\x00\x00Item:Bob\x01": {APP_ENTITY_SCHEMA[0]: sally.Encode()},
+    }
+    written = []
+    db_batch = flexmock()
+    db_batch.should_receive("range_query").and_return(rows)
+    db_batch.should_receive("batch_get_entity").\
+      with_args(APP_ENTITY_TABLE, ["hello\x00\x00Item:Bob\x01"],
+                APP_ENTITY_SCHEMA).and_return(current)
+    db_batch.should_receive("batch_put_entity").replace_with(
+      lambda table, row_keys, column_names, row_values: written.append(
+        (table, row_keys)))
+    zookeeper = flexmock()
+    zookeeper.should_receive("acquire_group_locks").\
+      with_args("hello", ["hello\x00\x00Item:Bob\x01"], {}).\
+      and_return(({"hello\x00\x00Item:Bob\x01": 1}, {})).once()
+    zookeeper.should_receive("release_group_locks").\
+      with_args("hello", {"hello\x00\x00Item:Bob\x01": 1}, {}).once()
+    dd = DatastoreDistributed(db_batch, zookeeper)
+
+    # A short batch is the last one.
+    self.assertEquals((None, 1), dd.build_composite_index_batch(index, None,
+                                                                 10))
+    self.assertEquals([(COMPOSITE_TABLE,
+                        [dd.get_composite_index_key(index, sally)])],
+                      written)
+
+    # A full batch continues after its last row.
+    db_batch.should_receive("range_query").and_return(rows[1:])
+    self.assertEquals(("hello\x00\x00Other:Carl\x01", 0),
+                      dd.build_composite_index_batch(index, None, 2))
+
+  def test_delete_composite_index_batch(self):
+    index = entity_pb.CompositeIndex()
+    index.set_id(50)
+    index.set_app_id("hello")
+    index.set_state(entity_pb.CompositeIndex.DELETED)
+    rows = ["hello\x00\x004\x00a\x00Item:1\x01",
+            "hello\x00\x0050\x00a\x00Item:1\x01",
+            "hello\x00\x0050\x00b\x00Item:2\x01",
+            "hello\x00ns\x0050\x00a\x00Item:1\x01",
+            "hello\x00ns\x006\x00a\x00Item:1\x01",
+            "hello\x00other\x001\x00a\x00Item:1\x01"]
+    deleted = []
+    db_batch = flexmock()
+    db_batch.should_receive("batch_delete").replace_with(
+      lambda table, row_keys, column_names: deleted.extend(row_keys))
+
+    def range_query(table, column_names, start_key, end_key, limit,
+                    offset=0, start_inclusive=True, end_inclusive=True,
+                    keys_only=False):
+      return [key for key in rows if start_key <= key <= end_key][:limit]
+    db_batch.should_receive("range_query").replace_with(range_query)
+    dd = DatastoreDistributed(db_batch, self.get_zookeeper())
+
+    # Rows of lower IDs are skipped to the start of the index.
+    self.assertEquals(("hello\x00\x0050\x00", 0),
+                      dd.delete_composite_index_batch(index, None, 1))
+    # Rows of the index are deleted, and the rest of the namespace skipped
+    # once a row of a higher ID is found.
+    next_key, count = dd.delete_composite_index_batch(index,
+      "hello\x00\x0050\x00", 2)
+    self.assertEquals(2, count)
+    self.assertEquals(rows[2] + "\x00", next_key)
+    next_key, count = dd.delete_composite_index_batch(index, next_key, 2)
+    self.assertEquals(("hello\x00ns\x01", 1), (next_key, count))
+    self.assertEquals((None, 0),
+                      dd.delete_composite_index_batch(index, next_key, 2))
+    self.assertEquals(rows[1:4], deleted)
 
   def test_insert_composite_indexes(self):
     composite_index = entity_pb.CompositeIndex()
@@ -282,6 +487,62 @@ class TestDatastoreServer(unittest.TestCase):
     dd = DatastoreDistributed(db_batch, zookeeper)
     dd.put_entities("hello", [key1, key2], {}) 
 
+  def test_put_entities_writes_index_diff(self):
+    old_entity = self.get_new_entity_proto("test", "kind", "bob", "a", "1")
+    prop = old_entity.add_property()
+    prop.set_name("b")
+    prop.set_multiple(0)
+    prop.mutable_value().set_stringvalue("2")
+    new_entity = entity_pb.EntityProto(old_entity.Encode())
+    new_entity.property(1).mutable_value().set_stringvalue("3")
+    row_key = "test\x00\x00kind:bob\x01"
+
+    written = []
+    db_batch = flexmock()
+    db_batch.should_receive("batch_get_entity").and_return(
+      {row_key: {APP_ENTITY_SCHEMA[0]: old_entity.Encode()}})
+    db_batch.should_receive("batch_delete").replace_with(
+      lambda table, row_keys, column_names=[]:
+        written.append(("delete", table, len(row_keys))))
+    db_batch.should_receive("batch_put_entity").replace_with(
+      lambda table, row_keys, schema, row_values:
+        written.append(("put", table, len(row_keys))))
+    dd = DatastoreDistributed(db_batch, self.get_zookeeper())
+    dd.put_entities("test", [new_entity], {row_key: 2})
+
+    # Only the rows of the changed property are touched, and the entity
+    # goes in after its journal entry.
+    self.assertEquals([("put", JOURNAL_TABLE, 1),
+                       ("delete", ASC_PROPERTY_TABLE, 1),
+                       ("delete", DSC_PROPERTY_TABLE, 1),
+                       ("put", APP_ENTITY_TABLE, 1),
+                       ("put", ASC_PROPERTY_TABLE, 1),
+                       ("put", DSC_PROPERTY_TABLE, 1)], written)
+
+  def test_run_mutations_overlap(self):
+    state = {'in_flight': 0, 'max_in_flight': 0}
+    state_lock = threading.Lock()
+    def fake_mutation(table, row_keys):
+      with state_lock:
+        state['in_flight'] += 1
+        state['max_in_flight'] = max(state['max_in_flight'],
+                                     state['in_flight'])
+      time.sleep(0.05)
+      with state_lock:
+        state['in_flight'] -= 1
+
+    dd = DatastoreDistributed(None, self.get_zookeeper())
+    mutations = [(fake_mutation, table, ['key'])
+                 for table in ['a', 'b', 'c']]
+    # Mutations without rows are never sent.
+    mutations.append((None, 'd', []))
+    datastore_server.mutation_pool = multiprocessing.pool.ThreadPool(3)
+    try:
+      dd.run_mutations('test', mutations)
+    finally:
+      datastore_server.mutation_pool = None
+    self.assertEquals(3, state['max_in_flight'])
+
   def testFetchKeys(self):
     entity_proto1 = self.get_new_entity_proto("test", "test_kind", "bob", "prop1name", 
                                               "prop1val", ns="blah")
@@ -299,7 +560,8 @@ class TestDatastoreServer(unittest.TestCase):
     zookeeper = flexmock()
     zookeeper.should_receive("acquire_lock").and_return(True)
     zookeeper.should_receive("release_lock").and_return(True)
-    zookeeper.should_receive("get_valid_transaction_id").and_return(2)
+    zookeeper.should_receive("get_valid_transaction_ids").\
+      replace_with(valid_transaction_ids(2))
     dd = DatastoreDistributed(db_batch, zookeeper)
 
     self.assertEquals(({'test\x00blah\x00test_kind:bob\x01': 
@@ -308,6 +570,57 @@ class TestDatastoreServer(unittest.TestCase):
                        ['test\x00blah\x00test_kind:bob\x01']), 
                        dd.fetch_keys([entity_proto1.key()]))
 
+  def test_validated_result_rereads_missing_journal_entries(self):
+    journal_key = 'test\x00blah\x00test_kind:bob\x01\x000000000002'
+    db_batch = flexmock()
+    db_batch.should_receive("batch_get_entity").\
+      with_args(JOURNAL_TABLE, [journal_key], JOURNAL_SCHEMA,
+                consistency=CONSISTENCY_ONE).\
+      and_return({journal_key: {}}).once()
+    db_batch.should_receive("batch_get_entity").\
+      with_args(JOURNAL_TABLE, [journal_key], JOURNAL_SCHEMA).\
+      and_return({journal_key: {JOURNAL_SCHEMA[0]: "entity2"}}).once()
+    zookeeper = flexmock()
+    zookeeper.should_receive("get_valid_transaction_ids").\
+      replace_with(valid_transaction_ids(2))
+    dd = DatastoreDistributed(db_batch, zookeeper)
+
+    # The replica read at ONE has not seen the entry yet.
+    self.assertEquals({'test\x00blah\x00test_kind:bob\x01':
+                        {APP_ENTITY_SCHEMA[0]: "entity2",
+                         APP_ENTITY_SCHEMA[1]: "2"}},
+                      dd.validated_result("test",
+                        {'test\x00blah\x00test_kind:bob\x01':
+                          {APP_ENTITY_SCHEMA[0]: "entity3",
+                           APP_ENTITY_SCHEMA[1]: "3"}}))
+
+  def test_validated_list_result_batches_versions(self):
+    journal_key = 'c\x000000000002'
+    zookeeper = flexmock()
+    zookeeper.should_receive("get_valid_transaction_ids").\
+      with_args("test", {"a": 1, "b": 1, "c": 3}).\
+      and_return({"a": 1, "b": 1, "c": 2}).once()
+    db_batch = flexmock()
+    db_batch.should_receive("batch_get_entity").\
+      with_args(JOURNAL_TABLE, [journal_key], JOURNAL_SCHEMA,
+                consistency=CONSISTENCY_ONE).\
+      and_return({journal_key: {JOURNAL_SCHEMA[0]: "entity2"}}).once()
+    dd = DatastoreDistributed(db_batch, zookeeper)
+
+    rows = [Row("a", {APP_ENTITY_SCHEMA[0]: "entity1",
+                      APP_ENTITY_SCHEMA[1]: "1"}),
+            Row("b", {APP_ENTITY_SCHEMA[0]: "entity1",
+                      APP_ENTITY_SCHEMA[1]: "1"}),
+            Row("c", {APP_ENTITY_SCHEMA[0]: "entity3",
+                      APP_ENTITY_SCHEMA[1]: "3"}),
+            Row("d", {APP_ENTITY_SCHEMA[0]: "entity4",
+                      APP_ENTITY_SCHEMA[1]: "4"})]
+    # The row written by the ongoing transaction is not looked up.
+    results = dd.validated_result("test", rows, current_ongoing_txn=4)
+    self.assertEquals(Row("c", {APP_ENTITY_SCHEMA[0]: "entity2",
+                                APP_ENTITY_SCHEMA[1]: "2"}), results[2])
+    self.assertEquals("entity4", results[3].columns[APP_ENTITY_SCHEMA[0]])
+
   def test_commit_transaction(self):
     db_batch = flexmock()
     zookeeper = flexmock()
@@ -366,9 +679,12 @@ class TestDatastoreServer(unittest.TestCase):
     db_batch.should_receive("batch_delete").and_return(None)
 
     zookeeper = flexmock()
-    zookeeper.should_receive("acquire_lock").and_return(True)
+    zookeeper.should_receive("acquire_group_locks").\
+      and_return(({"test\x00blah\x00test_kind:bob\x01": 1,
+                   "test\x00blah\x00test_kind:nancy\x01": 2}, {}))
     zookeeper.should_receive("release_lock").and_return(True)
-    zookeeper.should_receive("get_transaction_id").and_return(1)
+    zookeeper.should_receive("get_index_version").and_return(1)
+    db_batch.should_receive("range_query").and_return([])
 
     entity_proto1 = self.get_new_entity_proto("test", "test_kind", "bob", "prop1name", 
                                               "prop1val", ns="blah")
@@ -451,9 +767,11 @@ class TestDatastoreServer(unittest.TestCase):
          
   def test_acquire_locks_for_nontrans(self):
     PREFIX = 'x\x01'
+    bob = 'test\x00blah\x00test_kind:bob\x01'
+    nancy = 'test\x00blah\x00test_kind:nancy\x01'
     zookeeper = flexmock()
-    zookeeper.should_receive("acquire_lock").and_return(True)
-    zookeeper.should_receive("get_transaction_id").and_return(1).and_return(2)
+    zookeeper.should_receive("acquire_group_locks").\
+      with_args("test", list, {}).and_return(({bob: 2, nancy: 1}, {})).once()
     db_batch = flexmock()
     db_batch.should_receive("batch_put_entity").and_return(None)
     db_batch.should_receive("batch_get_entity").and_return({PREFIX:{}})
@@ -464,12 +782,34 @@ class TestDatastoreServer(unittest.TestCase):
     entity_proto2 = self.get_new_entity_proto("test", "test_kind", "nancy", "prop1name", 
                                               "prop2val", ns="blah")
     entity_list = [entity_proto1, entity_proto2]
-    self.assertEquals({'test\x00blah\x00test_kind:bob\x01': 2, 'test\x00blah\x00test_kind:nancy\x01': 1}, 
+    self.assertEquals({bob: 2, nancy: 1},
                       dd.acquire_locks_for_nontrans("test", entity_list))
 
+  def test_acquire_locks_for_nontrans_retries_contended_groups(self):
+    bob = 'test\x00blah\x00test_kind:bob\x01'
+    nancy = 'test\x00blah\x00test_kind:nancy\x01'
+    zookeeper = flexmock()
+    zookeeper.should_receive("acquire_group_locks").\
+      with_args("test", list, {}).and_return(({bob: 1}, {nancy: 2})).once()
+    # Only the contended group is tried again, with the same transaction ID.
+    zookeeper.should_receive("acquire_group_locks").\
+      with_args("test", [nancy], {nancy: 2}).and_return(({}, {nancy: 2})).once()
+    zookeeper.should_receive("release_group_locks").\
+      with_args("test", {bob: 1}, {nancy: 2}).once()
+    dd = DatastoreDistributed(None, zookeeper)
+    dd.LOCK_RETRY_TIME = 0
+    entity_list = [
+      self.get_new_entity_proto("test", "test_kind", "bob", "prop1name",
+                                "prop1val", ns="blah"),
+      self.get_new_entity_proto("test", "test_kind", "nancy", "prop1name",
+                                "prop2val", ns="blah")]
+    self.assertRaises(ZKTransactionException, dd.acquire_locks_for_nontrans,
+                      "test", entity_list, retries=1)
+
   def test_register_old_entities(self):
     zookeeper = flexmock()
-    zookeeper.should_receive("get_valid_transaction_id").and_return(1)
+    zookeeper.should_receive("get_valid_transaction_ids").\
+      replace_with(valid_transaction_ids(1))
     zookeeper.should_receive("register_updated_key").and_return(True)
     db_batch = flexmock()
     dd = DatastoreDistributed(db_batch, zookeeper) 
@@ -500,7 +840,8 @@ class TestDatastoreServer(unittest.TestCase):
                          APP_ENTITY_SCHEMA[1]: '1'}}
 
     zookeeper = flexmock()
-    zookeeper.should_receive("get_valid_transaction_id").and_return(1)
+    zookeeper.should_receive("get_valid_transaction_ids").\
+      replace_with(valid_transaction_ids(1))
     zookeeper.should_receive("register_updated_key").and_return(1)
     db_batch = flexmock()
     db_batch.should_receive("batch_put_entity").and_return(None)
@@ -515,7 +856,8 @@ class TestDatastoreServer(unittest.TestCase):
      
   def test_release_put_locks_for_nontrans(self):
     zookeeper = flexmock()
-    zookeeper.should_receive("get_valid_transaction_id").and_return(1)
+    zookeeper.should_receive("get_valid_transaction_ids").\
+      replace_with(valid_transaction_ids(1))
     zookeeper.should_receive("register_updated_key").and_return(1)
     zookeeper.should_receive("release_lock").and_return(True)
     db_batch = flexmock()
@@ -553,12 +895,16 @@ class TestDatastoreServer(unittest.TestCase):
     self.assertEquals({"key2": {APP_ENTITY_SCHEMA[0]:"blah"}}, 
                       dd.remove_tombstoned_entities({'key': {APP_ENTITY_SCHEMA[0]:TOMBSTONE}, 
                                                      'key2': {APP_ENTITY_SCHEMA[0]:"blah"}}))
+    self.assertEquals([Row("key2", {APP_ENTITY_SCHEMA[0]:"blah"})],
+                      dd.remove_tombstoned_entities([Row('key', {APP_ENTITY_SCHEMA[0]:TOMBSTONE}),
+                                                     Row('key2', {APP_ENTITY_SCHEMA[0]:"blah"})]))
 
   def test_dynamic_get(self):
     entity_proto1 = self.get_new_entity_proto("test", "test_kind", "nancy", "prop1name", 
                                               "prop2val", ns="blah")
     zookeeper = flexmock()
-    zookeeper.should_receive("get_valid_transaction_id").and_return(1)
+    zookeeper.should_receive("get_valid_transaction_ids").\
+      replace_with(valid_transaction_ids(1))
     zookeeper.should_receive("register_updated_key").and_return(1)
     zookeeper.should_receive("acquire_lock").and_return(True)
     db_batch = flexmock()
@@ -588,6 +934,41 @@ class TestDatastoreServer(unittest.TestCase):
     dd.dynamic_get("test", get_req, get_resp)     
     self.assertEquals(get_resp.entity_size(), 1)
 
+  def test_dynamic_get_caches_transaction_reads(self):
+    entity_proto1 = self.get_new_entity_proto("test", "test_kind", "nancy", "prop1name",
+                                              "prop2val", ns="blah")
+    row_key = "test\x00blah\x00test_kind:nancy\x01"
+    zookeeper = flexmock()
+    zookeeper.should_receive("get_valid_transaction_ids").\
+      replace_with(valid_transaction_ids(1))
+    zookeeper.should_receive("acquire_lock").with_args("test", 1, row_key).\
+      and_return(True).once()
+    zookeeper.should_receive("release_lock").and_return(True).once()
+    db_batch = flexmock()
+    db_batch.should_receive("batch_get_entity").and_return(
+      {row_key: {APP_ENTITY_SCHEMA[0]: entity_proto1.Encode(),
+                 APP_ENTITY_SCHEMA[1]: 1}}).once()
+    dd = DatastoreDistributed(db_batch, zookeeper)
+
+    get_req = datastore_pb.GetRequest()
+    get_req.add_key().MergeFrom(entity_proto1.key())
+    get_req.mutable_transaction().set_handle(1)
+    for _ in range(2):
+      get_resp = datastore_pb.GetResponse()
+      dd.dynamic_get("test", get_req, get_resp)
+      self.assertEquals(get_resp.entity(0).entity(), entity_proto1)
+
+    # Writes in the transaction are read again.
+    dd.forget_transaction_writes("test", 1, [entity_proto1.key()])
+    self.assertEquals({}, dd.get_transaction_cache("test", 1).rows)
+
+    # The cache is dropped when the transaction commits.
+    commit_request = datastore_pb.Transaction()
+    commit_request.set_handle(1)
+    commit_request.set_app("test")
+    dd.commit_transaction("test", commit_request.Encode())
+    self.assertEquals({}, dd.transaction_cache)
+
   def test_ancestor_query(self):
     query = datastore_pb.Query()
     ancestor = query.mutable_ancestor()
@@ -613,9 +994,12 @@ class TestDatastoreServer(unittest.TestCase):
     db_batch.should_receive("batch_put_entity").and_return(None)
     entity_proto1 = {'test\x00blah\x00test_kind:nancy\x01':{APP_ENTITY_SCHEMA[0]:entity_proto1.Encode(),
                       APP_ENTITY_SCHEMA[1]: 1}}
-    db_batch.should_receive("range_query").and_return([entity_proto1, tombstone1]).and_return([])
+    db_batch.should_receive("range_scan").replace_with(
+      lambda *args, **kwargs: iter([Row(*entity_proto1.items()[0]),
+                                    Row(*tombstone1.items()[0])]))
     zookeeper = flexmock()
-    zookeeper.should_receive("get_valid_transaction_id").and_return(1)
+    zookeeper.should_receive("get_valid_transaction_ids").\
+      replace_with(valid_transaction_ids(1))
     zookeeper.should_receive("acquire_lock").and_return(True)
     dd = DatastoreDistributed(db_batch, zookeeper) 
     dd.ancestor_query(query, filter_info, None)
@@ -649,9 +1033,12 @@ class TestDatastoreServer(unittest.TestCase):
     db_batch.should_receive("batch_put_entity").and_return(None)
     entity_proto1 = {'test\x00blah\x00test_kind:nancy\x01':{APP_ENTITY_SCHEMA[0]:entity_proto1.Encode(),
                       APP_ENTITY_SCHEMA[1]: 1}}
-    db_batch.should_receive("range_query").and_return([entity_proto1, tombstone1]).and_return([])
+    db_batch.should_receive("range_scan").replace_with(
+      lambda *args, **kwargs: iter([Row(*entity_proto1.items()[0]),
+                                    Row(*tombstone1.items()[0])]))
     zookeeper = flexmock()
-    zookeeper.should_receive("get_valid_transaction_id").and_return(1)
+    zookeeper.should_receive("get_valid_transaction_ids").\
+      replace_with(valid_transaction_ids(1))
     zookeeper.should_receive("acquire_lock").and_return(True)
     dd = DatastoreDistributed(db_batch, zookeeper)
     dd.ordered_ancestor_query(query, filter_info, None)
@@ -662,6 +1049,32 @@ class TestDatastoreServer(unittest.TestCase):
     dd.ordered_ancestor_query(query, filter_info, None) 
 
   
+  def test_fetch_from_entity_table_streams_pages(self):
+    read = []
+    def range_scan(table, column_names, start_key, end_key, limit=None,
+                   offset=0, start_inclusive=True, end_inclusive=True,
+                   keys_only=False, buffer_size=100):
+      for number in range(10):
+        read.append(number)
+        value = TOMBSTONE if number % 2 else "entity{0}".format(number)
+        yield Row("key{0}".format(number), {APP_ENTITY_SCHEMA[0]: value,
+                                            APP_ENTITY_SCHEMA[1]: "1"})
+
+    db_batch = flexmock()
+    db_batch.should_receive("range_scan").replace_with(range_scan)
+    dd = DatastoreDistributed(db_batch, self.get_zookeeper())
+    flexmock(dd).should_receive("validated_result").replace_with(
+      lambda app_id, result, current_ongoing_txn: result)
+    query = datastore_pb.Query()
+    query.set_app("app")
+
+    # Half of the rows are tombstones, so a second page is read to make up
+    # the limit, and nothing after it.
+    results = dd.fetch_from_entity_table("start", "end", 3, 0, True, True,
+                                         query, 0)
+    self.assertEquals(["entity0", "entity2", "entity4"], results)
+    self.assertEquals(range(6), read)
+
   def test_kindless_query(self):
     query = datastore_pb.Query()
     ancestor = query.mutable_ancestor()
@@ -685,9 +1098,12 @@ class TestDatastoreServer(unittest.TestCase):
     db_batch.should_receive("batch_put_entity").and_return(None)
     entity_proto1 = {'test\x00blah\x00test_kind:nancy\x01':{APP_ENTITY_SCHEMA[0]:entity_proto1.Encode(),
                       APP_ENTITY_SCHEMA[1]: 1}}
-    db_batch.should_receive("range_query").and_return([entity_proto1, tombstone1]).and_return([])
+    db_batch.should_receive("range_scan").replace_with(
+      lambda *args, **kwargs: iter([Row(*entity_proto1.items()[0]),
+                                    Row(*tombstone1.items()[0])]))
     zookeeper = flexmock()
-    zookeeper.should_receive("get_valid_transaction_id").and_return(1)
+    zookeeper.should_receive("get_valid_transaction_ids").\
+      replace_with(valid_transaction_ids(1))
     zookeeper.should_receive("acquire_lock").and_return(True)
     dd = DatastoreDistributed(db_batch, zookeeper) 
     filter_info = {
@@ -719,8 +1135,12 @@ class TestDatastoreServer(unittest.TestCase):
     del_request.should_receive("has_mark_changes").and_return(False)
     dd = DatastoreDistributed(None, None)
     flexmock(dd).should_receive("acquire_locks_for_trans").and_return({})
+    flexmock(dd).should_receive("get_composite_indexes").\
+      with_args("appid", ["kind"]).and_return([])
     flexmock(dd).should_receive("release_locks_for_nontrans").never()
     flexmock(dd).should_receive("delete_entities").once()
+    flexmock(dd).should_receive("forget_transaction_writes").\
+      with_args("appid", 1, [fake_key]).once()
     flexmock(dd).should_receive("get_entity_kind").and_return("kind")
     dd.dynamic_delete("appid", del_request)
 
@@ -731,6 +1151,7 @@ class TestDatastoreServer(unittest.TestCase):
     dd = DatastoreDistributed(None, None)
     flexmock(dd).should_receive("acquire_locks_for_trans").never()
     flexmock(dd).should_receive("acquire_locks_for_nontrans").once().and_return({})
+    flexmock(dd).should_receive("get_composite_indexes").and_return([])
     flexmock(dd).should_receive("delete_entities").once()
     flexmock(dd).should_receive("release_locks_for_nontrans").once()
     dd.dynamic_delete("appid", del_request)
@@ -738,7 +1159,8 @@ class TestDatastoreServer(unittest.TestCase):
   def test_reverse_path(self):
     zookeeper = flexmock()
     zookeeper.should_receive("get_transaction_id").and_return(1)
-    zookeeper.should_receive("get_valid_transaction_id").and_return(1)
+    zookeeper.should_receive("get_valid_transaction_ids").\
+      replace_with(valid_transaction_ids(1))
     zookeeper.should_receive("register_updated_key").and_return(1)
     zookeeper.should_receive("acquire_lock").and_return(True)
     zookeeper.should_receive("release_lock").and_return(True)
@@ -754,7 +1176,8 @@ class TestDatastoreServer(unittest.TestCase):
   def test_remove_exists_filters(self):
     zookeeper = flexmock()
     zookeeper.should_receive("get_transaction_id").and_return(1)
-    zookeeper.should_receive("get_valid_transaction_id").and_return(1)
+    zookeeper.should_receive("get_valid_transaction_ids").\
+      replace_with(valid_transaction_ids(1))
     zookeeper.should_receive("register_updated_key").and_return(1)
     zookeeper.should_receive("acquire_lock").and_return(True)
     zookeeper.should_receive("release_lock").and_return(True)
@@ -778,7 +1201,8 @@ class TestDatastoreServer(unittest.TestCase):
   def test_is_zigzag_merge_join(self):
     zookeeper = flexmock()
     zookeeper.should_receive("get_transaction_id").and_return(1)
-    zookeeper.should_receive("get_valid_transaction_id").and_return(1)
+    zookeeper.should_receive("get_valid_transaction_ids").\
+      replace_with(valid_transaction_ids(1))
     zookeeper.should_receive("register_updated_key").and_return(1)
     zookeeper.should_receive("acquire_lock").and_return(True)
     zookeeper.should_receive("release_lock").and_return(True)
@@ -804,7 +1228,8 @@ class TestDatastoreServer(unittest.TestCase):
   def test_zigzag_merge_join(self):
     zookeeper = flexmock()
     zookeeper.should_receive("get_transaction_id").and_return(1)
-    zookeeper.should_receive("get_valid_transaction_id").and_return(1)
+    zookeeper.should_receive("get_valid_transaction_ids").\
+      replace_with(valid_transaction_ids(1))
     zookeeper.should_receive("register_updated_key").and_return(1)
     zookeeper.should_receive("acquire_lock").and_return(True)
     zookeeper.should_receive("release_lock").and_return(True)
@@ -826,6 +1251,207 @@ class TestDatastoreServer(unittest.TestCase):
     flexmock(query).should_receive("limit").and_return(1)
     self.assertEquals(dd.zigzag_merge_join(query, filter_info, []), None)
 
+  def test_zigzag_merge_join_seeks_between_matches(self):
+    # Property a is set on even entities and b on multiples of three.
+    index = {}
+    for number in range(1, 61):
+      path = "kind:e{0:02d}\x01".format(number)
+      reference = "app\x00\x00" + path
+      if number % 2 == 0:
+        index["app\x00\x00kind\x00a\x00x\x00" + path] = reference
+      if number % 3 == 0:
+        index["app\x00\x00kind\x00b\x00y\x00" + path] = reference
+
+    scanned = []
+    def range_scan(table, column_names, start_key, end_key, limit=None,
+                   offset=0, start_inclusive=True, end_inclusive=True,
+                   keys_only=False, buffer_size=100):
+      for key in sorted(index):
+        if start_key <= key <= end_key and (limit is None or limit > 0):
+          scanned.append(key)
+          yield Row(key, None)
+          if limit is not None:
+            limit -= 1
+
+    def batch_get_entity(table, row_keys, column_names):
+      scanned.extend(row_keys)
+      return dict((key, {'reference': index[key]} if key in index else {})
+                  for key in row_keys)
+
+    db_batch = flexmock()
+    db_batch.should_receive("range_scan").replace_with(range_scan)
+    db_batch.should_receive("batch_get_entity").replace_with(batch_get_entity)
+    dd = DatastoreDistributed(db_batch, self.get_zookeeper())
+    dd._MIN_ZIGZAG_SEEK = 3
+    query = datastore_pb.Query()
+    query.set_app("app")
+    query.set_kind("kind")
+    query.set_keys_only(True)
+    query.set_limit(4)
+    filter_info = {"a": [(datastore_pb.Query_Filter.EQUAL, "x")],
+                   "b": [(datastore_pb.Query_Filter.EQUAL, "y")]}
+
+    results = dd.zigzag_merge_join(query, filter_info, [])
+    self.assertEquals(["e06", "e12", "e18", "e24"],
+      [entity_pb.EntityProto(result).key().path().element(0).name()
+       for result in results])
+    # Of the 50 index rows, 20 come before the last match, and the scans
+    # stop soon after it.
+    self.assertTrue(len(scanned) < 30)
+
+  def test_dynamic_run_query(self):
+    entity_proto1 = self.get_new_entity_proto("test", "test_kind", "bob",
+      "prop1name", "prop1val", ns="blah")
+    entity_proto2 = self.get_new_entity_proto("test", "test_kind", "nancy",
+      "prop1name", "prop1val", ns="blah")
+    dd = DatastoreDistributed(None, None)
+    flexmock(dd).should_receive("_DatastoreDistributed__get_query_results").\
+      replace_with(lambda query: [entity_proto1.Encode(),
+                                  entity_proto2.Encode()])
+
+    query = datastore_pb.Query()
+    query.set_app("test")
+    query.set_kind("test_kind")
+    query.set_offset(1)
+    query.set_limit(1)
+    query_result = datastore_pb.QueryResult()
+    dd._dynamic_run_query(query, query_result)
+    self.assertEquals(query_result.skipped_results(), 1)
+    self.assertEquals(query_result.result_size(), 1)
+    self.assertTrue(query_result.more_results())
+    self.assertTrue(query_result.has_compiled_cursor())
+
+    # The cursor is kept when every result is skipped.
+    query.set_offset(2)
+    query_result = datastore_pb.QueryResult()
+    dd._dynamic_run_query(query, query_result)
+    self.assertEquals(query_result.skipped_results(), 2)
+    self.assertEquals(query_result.result_size(), 0)
+    self.assertFalse(query_result.more_results())
+    self.assertTrue(query_result.has_compiled_cursor())
+
+  def test_keys_only_query_skips_entity_table(self):
+    db_batch = flexmock()
+    db_batch.should_receive("range_query").and_return([
+      Row("test\x00blah\x00test_kind\x01test_kind:nancy\x01",
+          {"reference": "test\x00blah\x00test_kind:nancy\x01"}),
+      Row("test\x00blah\x00test_kind\x01test_kind:123456789\x01",
+          {"reference": "test\x00blah\x00test_kind:123456789\x01"})])
+    db_batch.should_receive("batch_get_entity").never()
+    dd = DatastoreDistributed(db_batch, None)
+
+    query = datastore_pb.Query()
+    query.set_app("test")
+    query.set_name_space("blah")
+    query.set_kind("test_kind")
+    query.set_keys_only(True)
+    query_result = datastore_pb.QueryResult()
+    dd._dynamic_run_query(query, query_result)
+
+    self.assertEquals(query_result.result_size(), 2)
+    nancy = query_result.result(0).key()
+    self.assertEquals((nancy.app(), nancy.name_space()), ("test", "blah"))
+    self.assertEquals(nancy.path().element(0).name(), "nancy")
+    self.assertEquals(query_result.result(1).key().path().element(0).name(),
+                      "123456789")
+
+  def test_keys_only_query_tells_ids_from_names(self):
+    dd = DatastoreDistributed(None, None)
+    references = []
+    for key_id in [7, "1234567890", "\x02name"]:
+      path = entity_pb.Path()
+      element = path.add_element()
+      element.set_type("test_kind")
+      if isinstance(key_id, int):
+        element.set_id(key_id)
+      else:
+        element.set_name(key_id)
+      references.append(str(dd.get_entity_key("test\x00blah", path)))
+    self.assertEquals(references, [
+      "test\x00blah\x00test_kind:0000000007\x01",
+      "test\x00blah\x00test_kind:\x021234567890\x01",
+      "test\x00blah\x00test_kind:\x02\x02name\x01"])
+
+    db_batch = flexmock()
+    db_batch.should_receive("range_query").and_return([
+      Row("test\x00blah\x00test_kind\x01" + reference[len("test\x00blah\x00"):],
+          {"reference": reference}) for reference in references])
+    db_batch.should_receive("batch_get_entity").never()
+    dd = DatastoreDistributed(db_batch, None)
+
+    query = datastore_pb.Query()
+    query.set_app("test")
+    query.set_name_space("blah")
+    query.set_kind("test_kind")
+    query.set_keys_only(True)
+    query_result = datastore_pb.QueryResult()
+    dd._dynamic_run_query(query, query_result)
+
+    self.assertEquals(query_result.result_size(), 3)
+    self.assertEquals(query_result.result(0).key().path().element(0).id(), 7)
+    self.assertEquals(query_result.result(1).key().path().element(0).name(),
+                      "1234567890")
+    self.assertEquals(query_result.result(2).key().path().element(0).name(),
+                      "\x02name")
+    self.assertEquals(query_result.result(1).property_size(), 0)
+
+  def test_projection_query_uses_index_values(self):
+    value = entity_pb.PropertyValue()
+    value.set_stringvalue("prop1val")
+    encoder = sortable_pb_encoder.Encoder()
+    value.Output(encoder)
+    index_key = "test\x00blah\x00test_kind\x00prop1name\x00{0}\x00" \
+      "test_kind:nancy\x01".format(encoder.buffer().tostring())
+    db_batch = flexmock()
+    db_batch.should_receive("range_query").and_return([
+      Row(index_key, {"reference": "test\x00blah\x00test_kind:nancy\x01"})])
+    db_batch.should_receive("batch_get_entity").never()
+    dd = DatastoreDistributed(db_batch, None)
+
+    query = datastore_pb.Query()
+    query.set_app("test")
+    query.set_name_space("blah")
+    query.set_kind("test_kind")
+    query.add_property_name("prop1name")
+    query_result = datastore_pb.QueryResult()
+    dd._dynamic_run_query(query, query_result)
+
+    self.assertEquals(query_result.result_size(), 1)
+    prop = query_result.result(0).property(0)
+    self.assertEquals(prop.name(), "prop1name")
+    self.assertEquals(prop.value().stringvalue(), "prop1val")
+
+  def test_projection_query_with_key_filter(self):
+    # The key range has to be applied, so the property's index is not used.
+    tables = []
+    db_batch = flexmock()
+    db_batch.should_receive("range_query").replace_with(
+      lambda table, *args, **kwargs: tables.append(table) or [])
+    db_batch.should_receive("batch_get_entity").and_return({})
+    dd = DatastoreDistributed(db_batch, None)
+
+    query = datastore_pb.Query()
+    query.set_app("test")
+    query.set_name_space("blah")
+    query.set_kind("test_kind")
+    query.add_property_name("prop1name")
+    key_filter = query.add_filter()
+    key_filter.set_op(datastore_pb.Query_Filter.GREATER_THAN)
+    prop = key_filter.add_property()
+    prop.set_name("__key__")
+    prop.set_multiple(False)
+    reference = prop.mutable_value().mutable_referencevalue()
+    reference.set_app("test")
+    reference.set_name_space("blah")
+    element = reference.add_pathelement()
+    element.set_type("test_kind")
+    element.set_name("bob")
+    query_result = datastore_pb.QueryResult()
+    dd._dynamic_run_query(query, query_result)
+
+    self.assertEquals([APP_KIND_TABLE], tables)
+    self.assertEquals(query_result.result_size(), 0)
+
   def test_get_meta_data_key(self):
     dd = DatastoreDistributed(None, None)
     item = Item(key_name="Bob", name="Bob", _app="hello")
@@ -833,5 +1459,58 @@ class TestDatastoreServer(unittest.TestCase):
     self.assertEquals(str(dd.get_meta_data_key("howdy", "doody", "what")), 
       "howdy{0}doody{0}what".format(KEY_DELIMITER))
 
+  def get_handler(self):
+    connection = flexmock(set_close_callback=lambda callback: None)
+    request = tornado.httputil.HTTPServerRequest(method='POST', uri='/',
+      body='request', connection=connection, headers=tornado.httputil.\
+      HTTPHeaders({'protocolbuffertype': 'Request', 'appdata': 'app'}))
+    return datastore_server.MainHandler(tornado.web.Application(), request)
+
+  def run_post(self, handler):
+    """ Posts to the handler on a worker pool that runs inline, returning
+    the callbacks it left for the IOLoop. """
+    callbacks = []
+    io_loop = flexmock(add_callback=callbacks.append)
+    flexmock(tornado.ioloop.IOLoop).should_receive('instance').\
+      and_return(io_loop)
+    pool = flexmock(apply_async=lambda function: function())
+    datastore_server.worker_pool = pool
+    try:
+      handler.post()
+    finally:
+      datastore_server.worker_pool = None
+    return callbacks
+
+  def test_post_without_workers(self):
+    handler = self.get_handler()
+    flexmock(handler).should_receive('remote_request').\
+      with_args('app', 'request').and_return('response').once()
+    flexmock(handler).should_receive('finish').with_args('response').once()
+    handler.post()
+
+  def test_post_finishes_on_the_io_loop(self):
+    handler = self.get_handler()
+    flexmock(handler).should_receive('remote_request').\
+      with_args('app', 'request').and_return('response').once()
+    flexmock(handler).should_receive('finish').never()
+    callbacks = self.run_post(handler)
+
+    # Nothing is written from the worker; the IOLoop does it.
+    self.assertEquals(1, len(callbacks))
+    flexmock(handler).should_receive('finish').with_args('response').once()
+    callbacks[0]()
+
+  def test_post_error_in_worker(self):
+    handler = self.get_handler()
+    flexmock(handler).should_receive('remote_request').\
+      and_raise(zk.ZKInternalException('down'))
+    flexmock(handler).should_receive('finish').never()
+    flexmock(handler).should_receive('send_error').never()
+    callbacks = self.run_post(handler)
+
+    self.assertEquals(1, len(callbacks))
+    flexmock(handler).should_receive('send_error').with_args(500).once()
+    callbacks[0]()
+
 if __name__ == "__main__":
   unittest.main()    
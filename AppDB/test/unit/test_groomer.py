@@ -19,6 +19,7 @@ import datastore_server
 import appscale_datastore_batch
 import groomer
 
+from dbinterface_batch import Row
 from zkappscale import zktransaction as zk
 from zkappscale.zktransaction import ZKTransactionException
 
@@ -86,6 +87,25 @@ class TestGroomer(unittest.TestCase):
     dsg.db_access = FakeDatastore()    
     self.assertEquals(False, dsg.hard_delete_row("some_key"))
 
+  def test_is_current_tombstone(self):
+    zookeeper = flexmock()
+    dsg = groomer.DatastoreGroomer(zookeeper, "cassandra", "localhost:8888")
+    dsg.db_access = flexmock()
+    dsg.db_access.should_receive("batch_get_entity").\
+      with_args(dbconstants.APP_ENTITY_TABLE, ["key"],
+                dbconstants.APP_ENTITY_SCHEMA,
+                consistency=dbconstants.CONSISTENCY_QUORUM).\
+      and_return({"key": {
+        dbconstants.APP_ENTITY_SCHEMA[0]: datastore_server.TOMBSTONE,
+        dbconstants.APP_ENTITY_SCHEMA[1]: "2"}})
+    self.assertEquals(True, dsg.is_current_tombstone("key", "2"))
+    self.assertEquals(False, dsg.is_current_tombstone("key", "1"))
+
+    dsg.db_access.should_receive("batch_get_entity").and_return({"key": {
+      dbconstants.APP_ENTITY_SCHEMA[0]: "entity",
+      dbconstants.APP_ENTITY_SCHEMA[1]: "2"}})
+    self.assertEquals(False, dsg.is_current_tombstone("key", "2"))
+
   def test_get_root_key_from_entity_key(self):
     self.assertEquals("hi/bye\x01", groomer.DatastoreGroomer.\
       get_root_key_from_entity_key("hi/bye\x01otherstuff\x01moar"))
@@ -105,8 +125,9 @@ class TestGroomer(unittest.TestCase):
     zookeeper = flexmock()
     dsg = groomer.DatastoreGroomer(zookeeper, "cassandra", "localhost:8888")
     dsg = flexmock(dsg)
-    dsg.should_receive("get_entity_batch").and_return([])
+    dsg.should_receive("get_entities").and_return([])
     dsg.should_receive("process_entity")
+    dsg.should_receive("prune_journal").and_return(True)
     dsg.should_receive("update_statistics").and_raise(Exception)
     ds_factory = flexmock(appscale_datastore_batch.DatastoreFactory)
     ds_factory.should_receive("getDatastore").and_return(FakeDatastore())
@@ -114,13 +135,93 @@ class TestGroomer(unittest.TestCase):
 
   def test_process_entity(self):
     zookeeper = flexmock()
+    zookeeper.should_receive("is_blacklisted").and_return(False)
     flexmock(entity_pb).should_receive('EntityProto').and_return(FakeEntity())
 
     dsg = groomer.DatastoreGroomer(zookeeper, "cassandra", "localhost:8888")
     dsg = flexmock(dsg)
     dsg.should_receive('process_statistics')
-    self.assertEquals(True, dsg.process_entity({'key':{dbconstants.APP_ENTITY_SCHEMA[0]:'ent',
-      dbconstants.APP_ENTITY_SCHEMA[1]:'version'}}))
+    self.assertEquals(True, dsg.process_entity(Row('key', {dbconstants.APP_ENTITY_SCHEMA[0]:'ent',
+      dbconstants.APP_ENTITY_SCHEMA[1]:'version'})))
+
+    # Entities of failed transactions are rolled back before they count.
+    zookeeper.should_receive("is_blacklisted").and_return(True)
+    dsg.should_receive("roll_back_entity").with_args("app",
+      "app\x00\x00key", "5").\
+      and_return({dbconstants.APP_ENTITY_SCHEMA[0]: 'old',
+                  dbconstants.APP_ENTITY_SCHEMA[1]: '4'}).once()
+    dsg.should_receive('process_statistics').with_args("app\x00\x00key",
+      'old', '4').once()
+    self.assertEquals(True, dsg.process_entity(Row("app\x00\x00key", {
+      dbconstants.APP_ENTITY_SCHEMA[0]: 'ent',
+      dbconstants.APP_ENTITY_SCHEMA[1]: '5'})))
+
+    # Those that cannot be rolled back keep their blacklist entries.
+    dsg.should_receive("roll_back_entity").and_return(None)
+    self.assertEquals(False, dsg.process_entity(Row("app\x00\x00key", {
+      dbconstants.APP_ENTITY_SCHEMA[0]: 'ent',
+      dbconstants.APP_ENTITY_SCHEMA[1]: '5'})))
+    self.assertEquals(set(['5']), dsg.blacklisted_versions['app'])
+    self.assertEquals(set(["app\x00\x00key"]), dsg.blacklisted_keys['app'])
+
+  def test_roll_back_entity(self):
+    zookeeper = flexmock()
+    zookeeper.should_receive("get_transaction_id").and_return(1)
+    zookeeper.should_receive("acquire_lock").and_return(True)
+    zookeeper.should_receive("release_lock").and_return(True)
+    zookeeper.should_receive("get_valid_transaction_id").and_return(4)
+    zookeeper.should_receive("notify_failed_transaction").never()
+
+    dsg = groomer.DatastoreGroomer(zookeeper, "cassandra", "localhost:8888")
+    dsg.db_access = flexmock()
+    dsg.db_access.should_receive("batch_get_entity").\
+      with_args(dbconstants.APP_ENTITY_TABLE, ["key"],
+                dbconstants.APP_ENTITY_SCHEMA,
+                consistency=dbconstants.CONSISTENCY_QUORUM).\
+      and_return({"key": {dbconstants.APP_ENTITY_SCHEMA[0]: "bad",
+                          dbconstants.APP_ENTITY_SCHEMA[1]: "5"}})
+    dsg.db_access.should_receive("batch_get_entity").\
+      with_args(dbconstants.JOURNAL_TABLE, ["key\x000000000004"],
+                dbconstants.JOURNAL_SCHEMA,
+                consistency=dbconstants.CONSISTENCY_QUORUM).\
+      and_return({"key\x000000000004": {dbconstants.JOURNAL_SCHEMA[0]: "old"}})
+    restored = {dbconstants.APP_ENTITY_SCHEMA[0]: "old",
+                dbconstants.APP_ENTITY_SCHEMA[1]: "4"}
+    dsg.db_access.should_receive("batch_put_entity").\
+      with_args(dbconstants.APP_ENTITY_TABLE, ["key"],
+                dbconstants.APP_ENTITY_SCHEMA, {"key": restored}).once()
+    # The journal entry of the failed version goes too.
+    dsg.db_access.should_receive("batch_delete").\
+      with_args(dbconstants.JOURNAL_TABLE, ["key\x000000000005"]).once()
+    self.assertEquals(restored, dsg.roll_back_entity("app", "key", "5"))
+    self.assertEquals(1, dsg.num_rollbacks)
+
+    # An entity that did not exist before the failed transaction is removed.
+    zookeeper.should_receive("get_valid_transaction_id").and_return(0)
+    dsg.db_access.should_receive("batch_delete").\
+      with_args(dbconstants.APP_ENTITY_TABLE, ["key"]).once()
+    dsg.db_access.should_receive("batch_delete").\
+      with_args(dbconstants.JOURNAL_TABLE, ["key\x000000000005"]).once()
+    self.assertEquals({}, dsg.roll_back_entity("app", "key", "5"))
+
+    # Nothing is written if the row changed since the scan read it, so the
+    # groomer's transaction is not blacklisted.
+    dsg.db_access.should_receive("batch_put_entity").never()
+    dsg.db_access.should_receive("batch_delete").never()
+    self.assertEquals(None, dsg.roll_back_entity("app", "key", "6"))
+
+    # Nor is it if the lock is taken.
+    zookeeper.should_receive("acquire_lock").and_return(False)
+    self.assertEquals(None, dsg.roll_back_entity("app", "key", "5"))
+
+    # A rollback that fails partway through is undone.
+    zookeeper.should_receive("acquire_lock").and_return(True)
+    zookeeper.should_receive("get_valid_transaction_id").and_return(4)
+    zookeeper.should_receive("notify_failed_transaction").and_return(True).\
+      once()
+    dsg.db_access.should_receive("batch_put_entity").\
+      and_raise(dbconstants.AppScaleDBConnectionError("Bad connection"))
+    self.assertEquals(None, dsg.roll_back_entity("app", "key", "5"))
  
   def test_process_statistics(self):
     zookeeper = flexmock()
@@ -148,8 +249,169 @@ class TestGroomer(unittest.TestCase):
     self.assertEquals(dsg.stats, {'app_id': {'kind': {'size': 0, 'number': 0}}}) 
  
   def test_txn_blacklist_cleanup(self):
-    #TODO 
-    pass
+    zookeeper = flexmock()
+    dsg = groomer.DatastoreGroomer(zookeeper, "cassandra", "localhost:8888")
+    dsg.scan_start = 1000
+    dsg.blacklisted_versions = {'app': set(['5']), 'app1': set()}
+    dsg.blacklisted_keys = {'app': set(['key']), 'app1': set()}
+    dsg.db_access = flexmock()
+
+    # A replica the scan read may have missed the write of a failed
+    # transaction, so those entities are read again at quorum.
+    zookeeper.should_receive("get_valid_transaction_keys").with_args('app').\
+      and_return(set(['key', 'stale', 'fine', 'gone']))
+    zookeeper.should_receive("get_valid_transaction_keys").with_args('app1').\
+      and_return(set())
+    dsg.db_access.should_receive("batch_get_entity").with_args(
+      dbconstants.APP_ENTITY_TABLE, list, dbconstants.APP_ENTITY_SCHEMA,
+      consistency=dbconstants.CONSISTENCY_QUORUM).and_return(
+      {'stale': {dbconstants.APP_ENTITY_SCHEMA[1]: '7'},
+       'fine': {dbconstants.APP_ENTITY_SCHEMA[1]: '3'}})
+    zookeeper.should_receive("is_blacklisted").with_args('app', '7').\
+      and_return(True)
+    zookeeper.should_receive("is_blacklisted").with_args('app', '3').\
+      and_return(False)
+
+    # Entries that entities still refer to are kept.
+    zookeeper.should_receive("compact_blacklist").\
+      with_args('app', 1000 - zk.TX_TIMEOUT, set(['5', '7']),
+                set(['key', 'stale'])).\
+      and_return((1, 2)).once()
+    zookeeper.should_receive("compact_blacklist").\
+      with_args('app1', 1000 - zk.TX_TIMEOUT, set(), set()).\
+      and_return((0, 0)).once()
+    self.assertEquals(True, dsg.txn_blacklist_cleanup())
+
+    zookeeper.should_receive("compact_blacklist").\
+      and_raise(ZKTransactionException('zk'))
+    self.assertEquals(False, dsg.txn_blacklist_cleanup())
+
+  def test_split_journal_key(self):
+    self.assertEquals(("app\x00\x00Kind:a\x01", 5),
+      groomer.DatastoreGroomer.split_journal_key(
+      "app\x00\x00Kind:a\x01\x000000000005"))
+
+  def test_prune_journal(self):
+    zookeeper = flexmock()
+    dsg = groomer.DatastoreGroomer(zookeeper, "cassandra", "localhost:8888")
+    dsg = flexmock(dsg)
+    dsg.JOURNAL_ROWS_PER_RUN = 3
+    dsg.db_access = flexmock()
+    value = {dbconstants.JOURNAL_SCHEMA[0]: 'ent'}
+
+    # A full run leaves the cursor at the last key examined.
+    dsg.should_receive("get_journal_rows").and_return([
+      Row('a\x000000000001', value), Row('a\x000000000002', value),
+      Row('b\x000000000001', value)])
+    dsg.should_receive("prune_journal_batch").with_args(
+      {'a': {1: ('a\x000000000001', 15), 2: ('a\x000000000002', 15)},
+       'b': {1: ('b\x000000000001', 15)}}).and_return(True).once()
+    self.assertEquals(True, dsg.prune_journal())
+    self.assertEquals('b\x000000000001', dsg.journal_cursor)
+
+    # The next run starts over after reaching the end of the journal.
+    dsg.should_receive("get_journal_rows").and_return([
+      Row('c\x000000000001', value)])
+    dsg.should_receive("prune_journal_batch").and_return(False)
+    self.assertEquals(False, dsg.prune_journal())
+    self.assertEquals("", dsg.journal_cursor)
+
+  def test_prune_journal_batch(self):
+    zookeeper = flexmock()
+    dsg = groomer.DatastoreGroomer(zookeeper, "cassandra", "localhost:8888")
+    dsg = flexmock(dsg)
+    dsg.db_access = flexmock()
+    batch = {'a': {1: ('a\x000000000001', 15)},
+             'b': {1: ('b\x000000000001', 15), 2: ('b\x000000000002', 15)}}
+
+    # Entities whose only entry is for their current version are skipped.
+    dsg.db_access.should_receive("batch_get_entity").and_return(
+      {'a': {dbconstants.APP_ENTITY_SCHEMA[1]: '1'},
+       'b': {dbconstants.APP_ENTITY_SCHEMA[1]: '2'}})
+    dsg.should_receive("prune_entity_journal").with_args('b', batch['b']).\
+      and_return(True).once()
+    self.assertEquals(True, dsg.prune_journal_batch(batch))
+
+    dsg.db_access.should_receive("batch_get_entity").\
+      and_raise(dbconstants.AppScaleDBConnectionError("Bad connection"))
+    self.assertEquals(False, dsg.prune_journal_batch(batch))
+
+  def test_prune_entity_journal(self):
+    zookeeper = flexmock()
+    zookeeper.should_receive("get_transaction_id").and_return(1)
+    zookeeper.should_receive("acquire_lock").and_return(True)
+    zookeeper.should_receive("release_lock").and_return(True)
+    zookeeper.should_receive("is_blacklisted").and_return(False)
+    zookeeper.should_receive("get_valid_version").and_return(None)
+    zookeeper.should_receive("is_in_transaction").and_return(False)
+    zookeeper.should_receive("notify_failed_transaction").never()
+    dsg = groomer.DatastoreGroomer(zookeeper, "cassandra", "localhost:8888")
+    dsg = flexmock(dsg)
+    dsg.should_receive("get_root_key_from_entity_key").and_return(
+      "app\x00\x00Kind:a\x01")
+    dsg.db_access = flexmock()
+    key = "app\x00\x00Kind:a\x01"
+    versions = {1: (key + '\x000000000001', 20),
+                2: (key + '\x000000000002', 30)}
+
+    # Only the entry of the current version is kept.
+    dsg.db_access.should_receive("batch_get_entity").and_return(
+      {key: {dbconstants.APP_ENTITY_SCHEMA[1]: '2'}})
+    dsg.db_access.should_receive("batch_delete").with_args(
+      dbconstants.JOURNAL_TABLE, [key + '\x000000000001']).once()
+    self.assertEquals(True, dsg.prune_entity_journal(key, versions))
+    self.assertEquals(1, dsg.journal_deletes)
+    self.assertEquals(20, dsg.journal_bytes_reclaimed)
+
+    # Entries of rows that are gone are all deleted.
+    dsg.db_access.should_receive("batch_get_entity").and_return({})
+    dsg.db_access.should_receive("batch_delete").with_args(
+      dbconstants.JOURNAL_TABLE, [key + '\x000000000001',
+      key + '\x000000000002']).once()
+    self.assertEquals(True, dsg.prune_entity_journal(key, versions))
+
+    # A blacklisted old version is deleted.
+    zookeeper.should_receive("is_in_transaction").\
+      and_raise(ZKTransactionException("zk"))
+    dsg.db_access.should_receive("batch_get_entity").and_return(
+      {key: {dbconstants.APP_ENTITY_SCHEMA[1]: '2'}})
+    dsg.db_access.should_receive("batch_delete").with_args(
+      dbconstants.JOURNAL_TABLE, [key + '\x000000000001']).once()
+    self.assertEquals(True, dsg.prune_entity_journal(key, versions))
+    zookeeper.should_receive("is_in_transaction").and_return(False)
+
+    # The valid version a failed transaction registered is kept.
+    zookeeper.should_receive("get_valid_version").with_args("app", key).\
+      and_return(1)
+    dsg.db_access.should_receive("batch_delete").never()
+    self.assertEquals(True, dsg.prune_entity_journal(key, versions))
+    zookeeper.should_receive("get_valid_version").and_return(None)
+
+    # So is a version whose transaction has not finished or timed out.
+    zookeeper.should_receive("is_in_transaction").with_args("app", 1).\
+      and_return(True)
+    dsg.db_access.should_receive("batch_delete").never()
+    self.assertEquals(True, dsg.prune_entity_journal(key, versions))
+    zookeeper.should_receive("is_in_transaction").and_return(False)
+
+    # The journal is needed until a failed version is rolled back, which
+    # is not an error.
+    dsg.db_access.should_receive("batch_get_entity").and_return(
+      {key: {dbconstants.APP_ENTITY_SCHEMA[1]: '2'}})
+    zookeeper.should_receive("is_blacklisted").and_return(True)
+    dsg.db_access.should_receive("batch_delete").never()
+    self.assertEquals(True, dsg.prune_entity_journal(key, versions))
+
+    # Failed to acquire lock.
+    zookeeper.should_receive("acquire_lock").and_return(False)
+    self.assertEquals(False, dsg.prune_entity_journal(key, versions))
+
+    # A delete that fails is retried by a later run.
+    zookeeper.should_receive("acquire_lock").and_return(True)
+    zookeeper.should_receive("is_blacklisted").and_return(False)
+    dsg.db_access.should_receive("batch_delete").\
+      and_raise(dbconstants.AppScaleDBConnectionError("Bad connection"))
+    self.assertEquals(False, dsg.prune_entity_journal(key, versions))
   
   def test_process_tombstone(self):
     zookeeper = flexmock()
@@ -165,11 +427,10 @@ class TestGroomer(unittest.TestCase):
  
     dsg = groomer.DatastoreGroomer(zookeeper, "cassandra", "localhost:8888")
     dsg = flexmock(dsg)
+    dsg.should_receive("is_current_tombstone").and_return(True)
     dsg.should_receive("hard_delete_row").and_return(True)
-    flexmock(groomer.DatastoreGroomer).should_receive(
-      "get_root_key_from_entity_key").and_return("key")
-    flexmock(groomer.DatastoreGroomer).should_receive(
-      "get_prefix_from_entity_key").and_return("app/ns")
+    dsg.should_receive("get_root_key_from_entity_key").and_return("key")
+    dsg.should_receive("get_prefix_from_entity_key").and_return("app/ns")
     dsg.db_access = FakeDatastore()
 
     # Successful operation.
@@ -179,6 +440,12 @@ class TestGroomer(unittest.TestCase):
     zookeeper.should_receive("release_lock").and_raise(ZKTransactionException('zk'))
     self.assertEquals(True, dsg.process_tombstone("key", "entity", "1"))
 
+    # The row was written again since the scan read it.
+    dsg.should_receive("is_current_tombstone").and_return(False)
+    dsg.should_receive("hard_delete_row").never()
+    self.assertEquals(False, dsg.process_tombstone("key", "entity", "1"))
+    dsg.should_receive("is_current_tombstone").and_return(True)
+
     # Hard delete failed.
     dsg.should_receive("hard_delete_row").and_return(False)
     self.assertEquals(False, dsg.process_tombstone("key", "entity", "1"))
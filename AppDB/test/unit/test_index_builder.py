@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+
+import os
+import sys
+import unittest
+from flexmock import flexmock
+
+sys.path.append(os.path.join(os.path.dirname(__file__), "../../../AppServer"))
+from google.appengine.datastore import entity_pb
+
+sys.path.append(os.path.join(os.path.dirname(__file__), "../../"))
+import index_builder
+
+
+class TestIndexBuilder(unittest.TestCase):
+  """
+  A set of test cases for the composite index builder.
+  """
+  def get_index(self, state):
+    index = entity_pb.CompositeIndex()
+    index.set_id(123)
+    index.set_app_id("appid")
+    index.set_state(state)
+    index.mutable_definition().set_entity_type("kind")
+    return index
+
+  def test_run_jobs_skips_locked_indexes(self):
+    index = self.get_index(entity_pb.CompositeIndex.WRITE_ONLY)
+    zoo_keeper = flexmock()
+    zoo_keeper.should_receive("get_index_build_lock").with_args("appid", 123).\
+      and_return(False)
+    zoo_keeper.should_receive("release_index_build_lock").never()
+    datastore_access = flexmock()
+    datastore_access.should_receive("get_index_jobs").and_return([index])
+
+    builder = index_builder.IndexBuilder(zoo_keeper, datastore_access)
+    flexmock(builder).should_receive("run_job").never()
+    builder.run_jobs()
+
+  def test_run_jobs_releases_lock_on_failure(self):
+    index = self.get_index(entity_pb.CompositeIndex.WRITE_ONLY)
+    zoo_keeper = flexmock()
+    zoo_keeper.should_receive("get_index_build_lock").and_return(True)
+    zoo_keeper.should_receive("release_index_build_lock").\
+      with_args("appid", 123).once()
+    datastore_access = flexmock()
+    datastore_access.should_receive("get_index_jobs").and_return([index])
+
+    builder = index_builder.IndexBuilder(zoo_keeper, datastore_access)
+    flexmock(builder).should_receive("run_job").and_raise(ValueError)
+    self.assertRaises(ValueError, builder.run_jobs)
+
+  def test_build_resumes_and_finishes(self):
+    index = self.get_index(entity_pb.CompositeIndex.WRITE_ONLY)
+    datastore_access = flexmock()
+    datastore_access.should_receive("get_index_job_progress").\
+      and_return("key1")
+    datastore_access.should_receive("build_composite_index_batch").\
+      with_args(index, "key1", 2).and_return(("key2", 2)).once()
+    datastore_access.should_receive("build_composite_index_batch").\
+      with_args(index, "key2", 2).and_return((None, 1)).once()
+    datastore_access.should_receive("get_index_job").and_return(index)
+    datastore_access.should_receive("set_index_job_progress").\
+      with_args(index, "key2").once()
+    datastore_access.should_receive("finish_index_job").with_args(index).\
+      once()
+
+    builder = index_builder.IndexBuilder(flexmock(), datastore_access,
+                                         batch_size=2, max_rate=0)
+    self.assertEquals(True, builder.run_job(index))
+
+  def test_delete_stops_when_replaced(self):
+    index = self.get_index(entity_pb.CompositeIndex.DELETED)
+    datastore_access = flexmock()
+    datastore_access.should_receive("get_index_job_progress").\
+      and_return(None)
+    datastore_access.should_receive("delete_composite_index_batch").\
+      with_args(index, None, 100).and_return(("key", 100)).once()
+    datastore_access.should_receive("get_index_job").and_return(None)
+    datastore_access.should_receive("set_index_job_progress").never()
+    datastore_access.should_receive("finish_index_job").never()
+
+    builder = index_builder.IndexBuilder(flexmock(), datastore_access)
+    self.assertEquals(False, builder.run_job(index))
+
+  def test_rate_is_limited(self):
+    index = self.get_index(entity_pb.CompositeIndex.WRITE_ONLY)
+    datastore_access = flexmock()
+    datastore_access.should_receive("get_index_job_progress").\
+      and_return(None)
+    datastore_access.should_receive("build_composite_index_batch").\
+      and_return(("key", 100)).and_return((None, 0))
+    datastore_access.should_receive("get_index_job").and_return(index)
+    datastore_access.should_receive("set_index_job_progress")
+    datastore_access.should_receive("finish_index_job")
+
+    flexmock(index_builder.time).should_receive("time").and_return(0)
+    flexmock(index_builder.time).should_receive("sleep").with_args(2.0).once()
+    builder = index_builder.IndexBuilder(flexmock(), datastore_access,
+                                         max_rate=50)
+    builder.run_job(index)
+
+if __name__ == "__main__":
+  unittest.main()
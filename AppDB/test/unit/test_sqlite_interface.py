@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.append(os.path.join(os.path.dirname(__file__), "../../"))
+import dbconstants
+from dbinterface_batch import Row
+
+sys.path.append(os.path.join(os.path.dirname(__file__), "../../sqlite"))
+import sqlite_interface
+
+class TestSQLite(unittest.TestCase):
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+    self.db = sqlite_interface.DatastoreProxy(
+      os.path.join(self.directory, "datastore.db"))
+    self.db.create_table("table", ["a", "b"])
+    keys = ["key{0}".format(number) for number in range(5)]
+    self.db.batch_put_entity("table", keys, ["a", "b"],
+      dict((key, {"a": key + "a", "b": key + "b"}) for key in keys))
+
+  def tearDown(self):
+    shutil.rmtree(self.directory)
+
+  def testConstructor(self):
+    self.assertEquals([], self.db.range_query(dbconstants.APP_ENTITY_TABLE,
+      dbconstants.APP_ENTITY_SCHEMA, "", "", 10))
+
+  def testGet(self):
+    self.assertEquals({"key1": {"a": "key1a"}, "missing": {}},
+      self.db.batch_get_entity("table", ["key1", "missing"], ["a"]))
+    self.assertRaises(TypeError, self.db.batch_get_entity, "table", "key1",
+      ["a"])
+
+  def testPut(self):
+    self.db.batch_put_entity("table", ["key1"], ["a"], {"key1": {"a": "new"}})
+    self.assertEquals({"key1": {"a": "new", "b": "key1b"}},
+      self.db.batch_get_entity("table", ["key1"], ["a", "b"]))
+
+  def testDelete(self):
+    self.db.batch_delete("table", ["key1"])
+    self.assertEquals({"key1": {}},
+      self.db.batch_get_entity("table", ["key1"], ["a", "b"]))
+
+  def testRangeQuery(self):
+    self.assertEquals([Row("key1", {"a": "key1a"}), Row("key2", {"a": "key2a"})],
+      self.db.range_query("table", ["a"], "key1", "key2", 10))
+    self.assertEquals(["key2", "key3"], self.db.range_query("table", [],
+      "key1", "key4", 10, start_inclusive=False, end_inclusive=False,
+      keys_only=True))
+    self.assertEquals(["key1"], self.db.range_query("table", [], "", "", 2,
+      offset=1, keys_only=True))
+    self.assertEquals(5, len(self.db.range_query("table", [], "", "", 10)))
+
+  def testRangeScan(self):
+    rows = list(self.db.range_scan("table", ["a", "b"], "key0", "key4",
+      offset=1, end_inclusive=False, buffer_size=2))
+    self.assertEquals(["key1", "key2", "key3"], [row.key for row in rows])
+    self.assertEquals({"a": "key3a", "b": "key3b"}, rows[-1].columns)
+    self.assertEquals([Row("key0", None), Row("key1", None)],
+      list(self.db.range_scan("table", [], "", "", limit=2, keys_only=True,
+      buffer_size=1)))
+
+  def testConsistency(self):
+    self.assertRaises(TypeError,
+      self.db.batch_get_entity, "table", ["key1"], ["a"], consistency="TWO")
+
+  def testDeleteTable(self):
+    self.db.delete_table("table")
+    self.assertRaises(dbconstants.AppScaleDBConnectionError,
+      self.db.range_query, "table", [], "", "", 10)
+
+if __name__ == "__main__":
+  unittest.main()
@@ -20,6 +20,79 @@ from zkappscale import zktransaction as zk
 from zkappscale.zktransaction import ZKTransactionException
 
 
+class FakeRequest():
+  """ The result of an asynchronous call to FakeZookeeper. """
+
+  def __init__(self, function, *args, **kwargs):
+    self.value = None
+    self.error = None
+    try:
+      self.value = function(*args, **kwargs)
+    except kazoo.exceptions.KazooException as kazoo_exception:
+      self.error = kazoo_exception
+
+  def get(self):
+    if self.error is not None:
+      raise self.error
+    return self.value
+
+
+class FakeZookeeper():
+  """ Keeps nodes in a dict, for tests that follow them across calls. """
+
+  def __init__(self):
+    self.nodes = {}
+    self.sequence = 0
+
+  def start(self):
+    pass
+
+  def retry(self, function, *args, **kwargs):
+    return function(*args, **kwargs)
+
+  def exists(self, path):
+    return path in self.nodes
+
+  def get(self, path):
+    if path not in self.nodes:
+      raise kazoo.exceptions.NoNodeError()
+    return self.nodes[path], None
+
+  def get_children(self, path):
+    prefix = path + '/'
+    return [node[len(prefix):] for node in self.nodes
+            if node.startswith(prefix) and '/' not in node[len(prefix):]]
+
+  def set(self, path, value):
+    if path not in self.nodes:
+      raise kazoo.exceptions.NoNodeError()
+    self.nodes[path] = value
+
+  def create(self, path, value='', acl=None, ephemeral=False, sequence=False,
+             makepath=False):
+    if sequence:
+      path += '%010d' % self.sequence
+      self.sequence += 1
+    if path in self.nodes:
+      raise kazoo.exceptions.NodeExistsError()
+    self.nodes[path] = value
+    return path
+
+  def delete(self, path):
+    if path not in self.nodes:
+      raise kazoo.exceptions.NoNodeError()
+    del self.nodes[path]
+
+  def get_async(self, path):
+    return FakeRequest(self.get, path)
+
+  def get_children_async(self, path):
+    return FakeRequest(self.get_children, path)
+
+  def create_async(self, path, **kwargs):
+    return FakeRequest(self.create, path, **kwargs)
+
+
 class TestZookeeperTransaction(unittest.TestCase):
   """
   """
@@ -109,15 +182,106 @@ class TestZookeeperTransaction(unittest.TestCase):
       'now'))
 
 
-  def test_get_transaction_id(self):
-    # mock out getTransactionRootPath
+  def test_lease_transaction_ids(self):
     flexmock(zk.ZKTransaction)
-    zk.ZKTransaction.should_receive('get_transaction_prefix_path').with_args(
-      self.appid).and_return('/rootpath/' + self.appid)
-    path_to_create = "/rootpath/" + self.appid + "/" + zk.APP_TX_PREFIX
-    zk.ZKTransaction.should_receive('get_txn_path_before_getting_id') \
-      .with_args(self.appid).and_return(path_to_create)
-    
+    zk.ZKTransaction.should_receive('get_app_root_path').\
+      and_return('/appscale/apps/' + self.appid)
+    counter_path = '/appscale/apps/' + self.appid + '/' + \
+      zk.APP_TX_COUNTER_PATH
+
+    # mock out initializing a ZK connection
+    fake_zookeeper = flexmock(name='fake_zoo', get='get', set='set',
+      exists='exists', create='create')
+    fake_zookeeper.should_receive('start')
+    flexmock(kazoo.client)
+    kazoo.client.should_receive('KazooClient').and_return(fake_zookeeper)
+
+    # The first lease starts the counter above the IDs that were handed out
+    # as sequence nodes.
+    stat = flexmock(name='stat', version=0, cversion=42)
+    fake_zookeeper.should_receive('retry').with_args('get', counter_path).\
+      and_raise(kazoo.exceptions.NoNodeError).\
+      and_return(('42', stat))
+    fake_zookeeper.should_receive('retry').with_args('exists', str).\
+      and_return(stat)
+    fake_zookeeper.should_receive('retry').with_args('create', counter_path,
+      value='42', acl=None, ephemeral=False, sequence=False, makepath=True).\
+      once()
+    fake_zookeeper.should_receive('retry').with_args('set', counter_path,
+      str(42 + zk.TXID_BLOCK_SIZE), version=0).once()
+
+    transaction = zk.ZKTransaction(host="something", start_gc=False)
+    self.assertEquals((43, 42 + zk.TXID_BLOCK_SIZE),
+      transaction.lease_transaction_ids(self.appid))
+
+    # A block leased by another server at the same time is not reused.
+    taken = flexmock(name='stat', version=1)
+    fake_zookeeper.should_receive('retry').with_args('get', counter_path).\
+      and_return(('1042', stat)).and_return(('2042', taken))
+    fake_zookeeper.should_receive('retry').with_args('set', counter_path,
+      '2042', version=0).and_raise(kazoo.exceptions.BadVersionError)
+    fake_zookeeper.should_receive('retry').with_args('set', counter_path,
+      '3042', version=1).once()
+    self.assertEquals((2043, 3042),
+      transaction.lease_transaction_ids(self.appid))
+
+  def test_allocate_transaction_id(self):
+    # mock out initializing a ZK connection
+    fake_zookeeper = flexmock(name='fake_zoo')
+    fake_zookeeper.should_receive('start')
+    fake_zookeeper.should_receive('retry')
+    flexmock(kazoo.client)
+    kazoo.client.should_receive('KazooClient').and_return(fake_zookeeper)
+
+    # IDs are handed out in order, and a new block is only leased once the
+    # last one runs out.
+    flexmock(zk.ZKTransaction)
+    zk.ZKTransaction.should_receive('lease_transaction_ids').\
+      with_args(self.appid).and_return((1, 2)).and_return((11, 12)).twice()
+    transaction = zk.ZKTransaction(host="something", start_gc=False)
+    self.assertEquals([1, 2, 11],
+      [transaction.allocate_transaction_id(self.appid) for _ in range(3)])
+
+  def test_get_transaction_start_time(self):
+    now = [1000.0]
+    flexmock(time)
+    time.should_receive('time').replace_with(lambda: now[0])
+
+    # mock out initializing a ZK connection
+    fake_zookeeper = flexmock(name='fake_zoo')
+    fake_zookeeper.should_receive('start')
+    fake_zookeeper.should_receive('retry')
+    flexmock(kazoo.client)
+    kazoo.client.should_receive('KazooClient').and_return(fake_zookeeper)
+
+    flexmock(zk.ZKTransaction)
+    zk.ZKTransaction.should_receive('lease_transaction_ids').\
+      with_args(self.appid).and_return((1, 1000))
+    transaction = zk.ZKTransaction(host="something", start_gc=False)
+    self.assertEquals(1, transaction.allocate_transaction_id(self.appid))
+
+    # A transaction that takes its first lock later still times out from
+    # when it began.
+    now[0] = 1020.0
+    self.assertEquals(1000.0,
+      transaction.get_transaction_start_time(self.appid, 1))
+
+    # IDs handed out by another server start their timeout with their lock.
+    self.assertEquals(None,
+      transaction.get_transaction_start_time(self.appid, 5000))
+
+    # Transactions are forgotten once they time out.
+    now[0] = 1000.0 + zk.TX_TIMEOUT + 1
+    self.assertEquals(2, transaction.allocate_transaction_id(self.appid))
+    self.assertEquals(None,
+      transaction.get_transaction_start_time(self.appid, 1))
+    now[0] += 1
+    self.assertEquals(now[0] - 1,
+      transaction.get_transaction_start_time(self.appid, 2, forget=True))
+    self.assertEquals(None,
+      transaction.get_transaction_start_time(self.appid, 2))
+
+  def test_get_transaction_id(self):
     # mock out time.time
     flexmock(time)
     time.should_receive('time').and_return(1000)
@@ -130,17 +294,28 @@ class TestZookeeperTransaction(unittest.TestCase):
     flexmock(kazoo.client)
     kazoo.client.should_receive('KazooClient').and_return(fake_zookeeper)
 
-    # mock out making the txn id
-    zk.ZKTransaction.should_receive('create_sequence_node').with_args(
-      path_to_create, '1000').and_return(1)
+    # mock out getting the txn id from the leased block
+    flexmock(zk.ZKTransaction)
+    zk.ZKTransaction.should_receive('allocate_transaction_id').\
+      with_args(self.appid).and_return(1)
+
+    # A non-XG transaction does not touch ZooKeeper until it takes a lock.
+    zk.ZKTransaction.should_receive('create_node').never()
+    transaction = zk.ZKTransaction(host="something", start_gc=False)
+    self.assertEquals(1, transaction.get_transaction_id(self.appid))
 
     # mock out zookeeper.create for is_xg
-    xg_path = path_to_create + "/1/" + zk.XG_PREFIX
-    zk.ZKTransaction.should_receive('get_xg_path').and_return(xg_path)
-    zk.ZKTransaction.should_receive('create_node').with_args(xg_path, '1000')
+    index_path = transaction.get_expiry_index_path(self.appid, 1, '1000')
+    txn_path = transaction.get_transaction_path(self.appid, 1)
+    xg_path = transaction.get_xg_path(self.appid, 1)
+    zk.ZKTransaction.should_receive('create_node').with_args(index_path,
+      '1000').once()
+    zk.ZKTransaction.should_receive('create_node').with_args(txn_path, '1000')\
+      .once()
+    zk.ZKTransaction.should_receive('create_node').with_args(xg_path, '1000')\
+      .once()
 
     # assert, make sure we got back our id
-    transaction = zk.ZKTransaction(host="something", start_gc=False)
     self.assertEquals(1, transaction.get_transaction_id(self.appid, is_xg=True))
 
   def test_get_txn_path_before_getting_id(self):
@@ -288,7 +463,8 @@ class TestZookeeperTransaction(unittest.TestCase):
        and_return('/rootpath/' + self.appid)
 
     fake_zookeeper = flexmock(name='fake_zoo', create='create',
-      create_async='create_async', get='get', set_async='set_async')
+      create_async='create_async', get='get', set_async='set_async',
+      exists='exists')
     fake_zookeeper.should_receive('start')
     fake_zookeeper.should_receive('retry').with_args('create', str, makepath=bool, sequence=bool,
       ephemeral=bool, value=str, acl=None).and_return("/some/lock/path")
@@ -301,17 +477,38 @@ class TestZookeeperTransaction(unittest.TestCase):
     fake_zookeeper.should_receive('retry').with_args('get', str) \
       .and_return([lock_list_str])
     fake_zookeeper.should_receive('retry').with_args('set_async', str, str)
+    txn_request = flexmock(name='request')
+    txn_request.should_receive('get').and_raise(
+      kazoo.exceptions.NodeExistsError)
+    fake_zookeeper.should_receive('retry').with_args('create_async',
+      str, value=str, acl=None, ephemeral=False, sequence=False,
+      makepath=True).and_return(txn_request)
 
     flexmock(kazoo.client)
     kazoo.client.should_receive('KazooClient').and_return(fake_zookeeper)
 
     transaction = zk.ZKTransaction(host="something", start_gc=False)
     self.assertEquals(True, transaction.acquire_additional_lock(self.appid,
-      "txid", "somekey", False))
+      1, "somekey", False))
+
+    # Test for when we want to create a new ZK node for the lock path. The
+    # transaction and its expiry index entry are stamped with the time the
+    # transaction began.
+    zk.ZKTransaction.should_receive('get_transaction_start_time').\
+      with_args(self.appid, 1).and_return(1000.0)
+    fake_zookeeper.should_receive('retry').with_args('create_async',
+      str, value='1000.0', acl=None, ephemeral=False, sequence=False,
+      makepath=True).and_return(txn_request).times(2)
+    self.assertEquals(True, transaction.acquire_additional_lock(self.appid,
+      1, "somekey", True))
 
-    # Test for when we want to create a new ZK node for the lock path
+    # A XG transaction was indexed when it began, so only its lock is made.
+    zk.ZKTransaction.should_receive('get_transaction_start_time').\
+      with_args(self.appid, 2).and_return(None)
+    fake_zookeeper.should_receive('retry').with_args('exists', '/txn/path').\
+      and_return(True).once()
     self.assertEquals(True, transaction.acquire_additional_lock(self.appid,
-      "txid", "somekey", True))
+      2, "somekey", True))
 
     # Test for existing max groups 
     lock_list = ['path1', 'path2', 'path3', 'path4', 'path5'] 
@@ -321,14 +518,14 @@ class TestZookeeperTransaction(unittest.TestCase):
 
     transaction = zk.ZKTransaction(host="something", start_gc=False)
     self.assertRaises(zk.ZKTransactionException,
-      transaction.acquire_additional_lock, self.appid, "txid", "somekey", False)
+      transaction.acquire_additional_lock, self.appid, 1, "somekey", False)
 
     # Test for when there is a node which already exists.
     fake_zookeeper.should_receive('retry').with_args('create', str, str, None,
       bool, bool, bool).and_raise(kazoo.exceptions.NodeExistsError)
     transaction = zk.ZKTransaction(host="something", start_gc=False)
     self.assertRaises(zk.ZKTransactionException,
-      transaction.acquire_additional_lock, self.appid, "txid", "somekey", False)
+      transaction.acquire_additional_lock, self.appid, 1, "somekey", False)
 
 
   def test_check_transaction(self):
@@ -377,39 +574,61 @@ class TestZookeeperTransaction(unittest.TestCase):
   def test_release_lock(self):
     # mock out getTransactionRootPath
     flexmock(zk.ZKTransaction)
-    zk.ZKTransaction.should_receive('check_transaction')
+    zk.ZKTransaction.should_receive('is_blacklisted').and_return(False)
     zk.ZKTransaction.should_receive('get_transaction_path').\
       and_return('/rootpath')
     zk.ZKTransaction.should_receive('get_transaction_lock_list_path').\
-      and_return('/rootpath')
-    zk.ZKTransaction.should_receive('is_xg').and_return(False)
+      and_return('/rootpath/lockpath')
+
+    def request(result):
+      fake_request = flexmock(name='request')
+      fake_request.should_receive('get').and_return(result)
+      return fake_request
+
+    deleted = []
+    multi_op = flexmock(name='multi_op')
+    multi_op.should_receive('delete').replace_with(deleted.append)
+    multi_op.should_receive('commit').and_return([True] * 6)
 
     # mock out initializing a ZK connection
-    fake_zookeeper = flexmock(name='fake_zoo', exists='exists', get='get',
-      delete='delete', delete_async='delete_async', get_children='get_children')
+    fake_zookeeper = flexmock(name='fake_zoo', exists='exists')
     fake_zookeeper.should_receive('start')
     fake_zookeeper.should_receive('retry').with_args('exists', str) \
       .and_return(True)
-    fake_zookeeper.should_receive('retry').with_args('get', str) \
-      .and_return(['/1/2/3'])
-    fake_zookeeper.should_receive('retry').with_args('delete_async', str)
-    fake_zookeeper.should_receive('retry').with_args('delete', str)
-    fake_zookeeper.should_receive('retry').with_args('get_children', str) \
-      .and_return(['1','2'])
+    lock_list = zk.LOCK_LIST_SEPARATOR.join(['/lock1', '/lock2'])
+    fake_zookeeper.should_receive('get_async').with_args('/rootpath/lockpath').\
+      and_return(request((lock_list, None)))
+    fake_zookeeper.should_receive('get_async').with_args('/rootpath').\
+      and_return(request(('1000', None)))
+    fake_zookeeper.should_receive('get_children_async').\
+      and_return(request(['lockpath', 'xg']))
+    fake_zookeeper.should_receive('transaction').and_return(multi_op)
+    fake_zookeeper.should_receive('add_listener')
+    fake_zookeeper.should_receive('DataWatch')
 
     flexmock(kazoo.client)
     kazoo.client.should_receive('KazooClient').and_return(fake_zookeeper)
 
     transaction = zk.ZKTransaction(host="something", start_gc=False)
     self.assertEquals(True, transaction.release_lock(self.appid, 1))
-
-    zk.ZKTransaction.should_receive('is_xg').and_return(True)
+    # The locks, every node of the transaction and its expiry index entry go
+    # in one request.
+    self.assertEquals(['/lock1', '/lock2', '/rootpath/lockpath',
+      '/rootpath/xg', transaction.get_expiry_index_path(self.appid, 1, '1000'),
+      '/rootpath'], deleted)
+
+    # When a node is already gone, the rest are deleted one by one.
+    multi_op.should_receive('commit').\
+      and_return([kazoo.exceptions.NoNodeError()] * 6)
+    fake_zookeeper.should_receive('delete_async').and_return(request(True)).\
+      times(6)
     self.assertEquals(True, transaction.release_lock(self.appid, 1))
 
     # Check to make sure it raises exception for blacklisted transactions.
-    zk.ZKTransaction.should_receive('is_xg').and_return(False)
-    fake_zookeeper.should_receive('retry').with_args('get', str) \
-      .and_raise(kazoo.exceptions.NoNodeError)
+    missing = flexmock(name='request')
+    missing.should_receive('get').and_raise(kazoo.exceptions.NoNodeError)
+    fake_zookeeper.should_receive('get_async').and_return(missing)
+    zk.ZKTransaction.should_receive('is_blacklisted').and_return(True)
     self.assertRaises(zk.ZKTransactionException, transaction.release_lock,
       self.appid, 1)
 
@@ -421,27 +640,147 @@ class TestZookeeperTransaction(unittest.TestCase):
       and_return("bl_root_path")
 
     # mock out initializing a ZK connection
-    fake_zookeeper = flexmock(name='fake_zoo', create='create', exists='exists',
-      get_children='get_children')
+    fake_zookeeper = flexmock(name='fake_zoo', get_children='get_children')
     fake_zookeeper.should_receive('start')
-    fake_zookeeper.should_receive('retry').with_args('create', str, str, None,
-      bool, bool, bool).and_return()
-    fake_zookeeper.should_receive('retry').with_args('exists', str) \
-      .and_return(True)
     fake_zookeeper.should_receive('retry').with_args('get_children', str) \
       .and_return(['1','2'])
+    fake_zookeeper.should_receive('add_listener')
+    fake_zookeeper.should_receive('DataWatch')
+
+    flexmock(kazoo.client)
+    kazoo.client.should_receive('KazooClient').and_return(fake_zookeeper)
+
+    transaction = zk.ZKTransaction(host="something", start_gc=False)
+    self.assertEquals(True, transaction.is_blacklisted(self.appid, 1))
+
+  def test_is_blacklisted_with_watch(self):
+    flexmock(zk.ZKTransaction)
+    zk.ZKTransaction.should_receive('get_blacklist_root_path').\
+      and_return("bl_root_path")
+
+    # The watches report the current children as soon as they are set, so
+    # ZooKeeper is never read.
+    fake_zookeeper = flexmock(name='fake_zoo', get_children='get_children')
+    fake_zookeeper.should_receive('start')
+    fake_zookeeper.should_receive('retry').with_args('get_children', str) \
+      .never()
+    fake_zookeeper.should_receive('add_listener').once()
+    fake_zookeeper.should_receive('DataWatch').replace_with(
+      lambda path, func: func('', flexmock(version=0))).once()
+    fake_zookeeper.should_receive('ChildrenWatch').replace_with(
+      lambda path, func: func(['1', '2'])).once()
 
     flexmock(kazoo.client)
     kazoo.client.should_receive('KazooClient').and_return(fake_zookeeper)
 
     transaction = zk.ZKTransaction(host="something", start_gc=False)
     self.assertEquals(True, transaction.is_blacklisted(self.appid, 1))
+    self.assertEquals(False, transaction.is_blacklisted(self.appid, 3))
+
+    transaction.add_to_blacklist_cache(self.appid, 3)
+    self.assertEquals(True, transaction.is_blacklisted(self.appid, 3))
+
+    # Only one watch is set for each application.
+    transaction.watch_blacklist(self.appid, "bl_root_path")
+
+    # Losing the connection drops the cache and falls back to ZooKeeper.
+    transaction.handle_connection_change(
+      kazoo.protocol.states.KazooState.SUSPENDED)
+    fake_zookeeper.should_receive('DataWatch')
+    fake_zookeeper.should_receive('retry').with_args('get_children', str) \
+      .and_return(['1']).once()
+    self.assertEquals(False, transaction.is_blacklisted(self.appid, 3))
+
+  def test_is_blacklisted_without_blacklist(self):
+    flexmock(zk.ZKTransaction)
+    zk.ZKTransaction.should_receive('get_blacklist_root_path').\
+      and_return("bl_root_path")
+
+    # An application without a blacklist is cached as having an empty one,
+    # until the root is created.
+    watches = []
+    fake_zookeeper = flexmock(name='fake_zoo', get_children='get_children')
+    fake_zookeeper.should_receive('start')
+    fake_zookeeper.should_receive('retry').with_args('get_children', str) \
+      .never()
+    fake_zookeeper.should_receive('add_listener')
+    fake_zookeeper.should_receive('DataWatch').replace_with(
+      lambda path, func: watches.append(func) or func(None, None)).once()
+    fake_zookeeper.should_receive('ChildrenWatch').replace_with(
+      lambda path, func: func(['4']))
+
+    flexmock(kazoo.client)
+    kazoo.client.should_receive('KazooClient').and_return(fake_zookeeper)
+
+    transaction = zk.ZKTransaction(host="something", start_gc=False)
+    self.assertEquals(False, transaction.is_blacklisted(self.appid, 4))
+    self.assertEquals(False, transaction.is_blacklisted(self.appid, 4))
+
+    watches[0]('', flexmock(version=0))
+    self.assertEquals(True, transaction.is_blacklisted(self.appid, 4))
+
+  def test_get_index_version(self):
+    flexmock(zk.ZKTransaction)
+
+    # The watch reports the version as soon as it is set, so ZooKeeper
+    # should only be read once.
+    fake_zookeeper = flexmock(name='fake_zoo', create='create', exists='exists')
+    fake_zookeeper.should_receive('start')
+    fake_zookeeper.should_receive('retry').with_args('exists',
+      '/appscale/apps/' + self.appid + '/indexversion').and_return(True).once()
+    fake_zookeeper.should_receive('add_listener').once()
+    fake_zookeeper.should_receive('DataWatch').replace_with(
+      lambda path, func: func('value', flexmock(version=3)))
+
+    flexmock(kazoo.client)
+    kazoo.client.should_receive('KazooClient').and_return(fake_zookeeper)
+
+    transaction = zk.ZKTransaction(host="something", start_gc=False)
+    self.assertEquals(3, transaction.get_index_version(self.appid))
+    self.assertEquals(3, transaction.get_index_version(self.appid))
+
+    # Losing the connection drops the cached version.
+    transaction.handle_connection_change(
+      kazoo.protocol.states.KazooState.SUSPENDED)
+    fake_zookeeper.should_receive('retry').with_args('exists', str) \
+      .and_return(flexmock(version=4))
+    fake_zookeeper.should_receive('DataWatch')
+    self.assertEquals(4, transaction.get_index_version(self.appid))
+
+    fake_zookeeper.should_receive('retry').with_args('exists', str) \
+      .and_raise(kazoo.exceptions.ConnectionLoss)
+    fake_zookeeper.should_receive('stop')
+    transaction.handle_connection_change(
+      kazoo.protocol.states.KazooState.SUSPENDED)
+    self.assertRaises(zk.ZKInternalException, transaction.get_index_version,
+      self.appid)
+
+  def test_update_index_version(self):
+    flexmock(zk.ZKTransaction)
+
+    fake_zookeeper = flexmock(name='fake_zoo', create='create', set='set')
+    fake_zookeeper.should_receive('start')
+    fake_zookeeper.should_receive('retry').with_args('set',
+      '/appscale/apps/' + self.appid + '/indexversion', str).once()
+
+    flexmock(kazoo.client)
+    kazoo.client.should_receive('KazooClient').and_return(fake_zookeeper)
+
+    transaction = zk.ZKTransaction(host="something", start_gc=False)
+    self.assertEquals(True, transaction.update_index_version(self.appid))
+
+    # The node is created the first time the indexes change.
+    fake_zookeeper.should_receive('retry').with_args('set', str, str) \
+      .and_raise(kazoo.exceptions.NoNodeError)
+    fake_zookeeper.should_receive('retry').with_args('create', str,
+      value=str, acl=None, makepath=True).once()
+    self.assertEquals(True, transaction.update_index_version(self.appid))
 
   def test_register_updated_key(self):
     # mock out getTransactionRootPath
     flexmock(zk.ZKTransaction)
     zk.ZKTransaction.should_receive('get_valid_transaction_path').\
-      and_return('/txn/path')
+      and_return('/valid/path')
     zk.ZKTransaction.should_receive('get_transaction_path').\
       and_return('/txn/path')
 
@@ -449,25 +788,74 @@ class TestZookeeperTransaction(unittest.TestCase):
       and_return("bl_root_path")
 
     # mock out initializing a ZK connection
-    fake_zookeeper = flexmock(name='fake_zoo', exists='exists',
-      set_async='set_async')
+    fake_zookeeper = flexmock(name='fake_zoo', exists='exists', set='set',
+      create_async='create_async')
     fake_zookeeper.should_receive('start')
-    fake_zookeeper.should_receive('retry').with_args('exists', str) \
-      .and_return(True)
-    fake_zookeeper.should_receive('retry').with_args('set_async', str, str)
+    fake_zookeeper.should_receive('retry').with_args('set', '/valid/path',
+      '2').once()
 
     flexmock(kazoo.client)
     kazoo.client.should_receive('KazooClient').and_return(fake_zookeeper)
 
+    # The valid version left by an earlier failed transaction is updated.
     transaction = zk.ZKTransaction(host="something", start_gc=False)
     self.assertEquals(True, transaction.register_updated_key(self.appid, 
       "1", "2", "somekey"))
 
-    fake_zookeeper.should_receive('retry').with_args('exists', str) \
-      .and_return(False)
+    # Otherwise the key is kept under the transaction.
+    fake_zookeeper.should_receive('retry').with_args('set', '/valid/path',
+      '2').and_raise(kazoo.exceptions.NoNodeError)
+    fake_zookeeper.should_receive('retry').with_args('exists', '/txn/path').\
+      and_return(True)
+    fake_zookeeper.should_receive('create_async').with_args(
+      '/txn/path/' + zk.TX_UPDATEDKEY_PREFIX, value='somekey/2', acl=None,
+      ephemeral=False, sequence=True, makepath=False).once()
+    self.assertEquals(True, transaction.register_updated_key(self.appid, 
+      "1", "2", "somekey"))
+
+    fake_zookeeper.should_receive('retry').with_args('exists', '/txn/path').\
+      and_return(False)
     self.assertRaises(ZKTransactionException, 
       transaction.register_updated_key, self.appid, "1", "2", "somekey")
 
+  def test_failed_write_during_blacklist_compaction(self):
+    fake_zookeeper = FakeZookeeper()
+    flexmock(kazoo.client)
+    kazoo.client.should_receive('KazooClient').and_return(fake_zookeeper)
+    transaction = zk.ZKTransaction(host="something", start_gc=False)
+    flexmock(transaction).should_receive('delete_transaction_nodes')
+
+    txpath = transaction.get_transaction_path(self.appid, 8)
+    vtxpath = transaction.get_valid_transaction_path(self.appid, 'key')
+    fake_zookeeper.nodes[txpath] = '1000'
+    fake_zookeeper.nodes[txpath + '/' + zk.TX_LOCK_PATH] = '/lock'
+    fake_zookeeper.nodes[vtxpath] = '3'
+
+    # Compacting the blacklist removes the valid version of an earlier
+    # failure just before transaction 8 registers the key.
+    set_node = fake_zookeeper.set
+    def compact_then_set(path, value):
+      fake_zookeeper.delete(vtxpath)
+      return set_node(path, value)
+    fake_zookeeper.set = compact_then_set
+    transaction.register_updated_key(self.appid, 8, 5, 'key')
+    fake_zookeeper.set = set_node
+    self.assertFalse(vtxpath in fake_zookeeper.nodes)
+
+    # The failed write still leaves the version to roll back to.
+    self.assertEquals(True,
+      transaction.notify_failed_transaction(self.appid, 8))
+    self.assertEquals('5', fake_zookeeper.nodes[vtxpath])
+    self.assertTrue(zk.PATH_SEPARATOR.join([
+      transaction.get_blacklist_root_path(self.appid), '8'])
+      in fake_zookeeper.nodes)
+
+    # A valid version that is already registered is kept.
+    fake_zookeeper.nodes[vtxpath] = '3'
+    self.assertEquals(True,
+      transaction.notify_failed_transaction(self.appid, 8))
+    self.assertEquals('3', fake_zookeeper.nodes[vtxpath])
+
   def test_try_garbage_collection(self):
     # mock out getTransactionRootPath
     flexmock(zk.ZKTransaction)
@@ -518,25 +906,181 @@ class TestZookeeperTransaction(unittest.TestCase):
     #TODO  
 
   def test_execute_garbage_collection(self):
-    # mock out getTransactionRootPath
     flexmock(zk.ZKTransaction)
-    zk.ZKTransaction.should_receive('notify_failed_transaction')
+    zk.ZKTransaction.should_receive('collect_expired_transactions').\
+      with_args(self.appid, "some/path").twice()
+    zk.ZKTransaction.should_receive('update_node')
 
     # mock out initializing a ZK connection
-    fake_zookeeper = flexmock(name='fake_zoo', exists='exists', get='get',
-      get_children='get_children')
+    fake_zookeeper = flexmock(name='fake_zoo', get='get')
     fake_zookeeper.should_receive('start')
-    fake_zookeeper.should_receive('retry').with_args('exists', str) \
-      .and_return(True)
+    flexmock(kazoo.client)
+    kazoo.client.should_receive('KazooClient').and_return(fake_zookeeper)
+
+    # Only the expiry index is used after a recent full scan.
     fake_zookeeper.should_receive('retry').with_args('get', str) \
-      .and_return([str(time.time() + 10000)])
-    fake_zookeeper.should_receive('retry').with_args('get_children', str) \
-      .and_return(['1','2','3'])
+      .and_return([str(time.time())])
+    transaction = zk.ZKTransaction(host="something", start_gc=False)
+    zk.ZKTransaction.should_receive('collect_all_transactions').never()
+    transaction.execute_garbage_collection(self.appid, "some/path")
+
+    # Every transaction is checked when there has not been a full scan.
+    fake_zookeeper.should_receive('retry').with_args('get', str) \
+      .and_raise(kazoo.exceptions.NoNodeError)
+    zk.ZKTransaction.should_receive('collect_all_transactions').\
+      with_args(self.appid, "some/path").once()
+    transaction.execute_garbage_collection(self.appid, "some/path")
+
+  def test_collect_expired_transactions(self):
+    flexmock(zk.ZKTransaction)
+    failed = []
+    zk.ZKTransaction.should_receive('notify_failed_transaction').\
+      replace_with(lambda app_id, txid: failed.append(txid))
+
+    now = time.time()
+    expired = "%012d" % (now - zk.TX_TIMEOUT - 2 * zk.GC_BUCKET_SECONDS)
+    pending = "%012d" % now
+    expiry_root = "some/path/" + zk.APP_TX_EXPIRY_PATH
+
+    def request(result):
+      fake_request = flexmock(name='request')
+      fake_request.should_receive('get').and_return(result)
+      return fake_request
+
+    def get_async(path):
+      if path.endswith('tx0000000001'):
+        return request([str(now - 2 * zk.TX_TIMEOUT)])
+      if path.endswith('tx0000000003'):
+        # Started again, so it is also in a later bucket.
+        return request([str(now)])
+      missing = flexmock(name='request')
+      missing.should_receive('get').and_raise(kazoo.exceptions.NoNodeError)
+      return missing
+
+    deleted = []
+    def delete_async(path):
+      deleted.append(path)
+      return request(True)
 
+    # mock out initializing a ZK connection
+    fake_zookeeper = flexmock(name='fake_zoo', get_children='get_children',
+      delete='delete')
+    fake_zookeeper.should_receive('start')
+    fake_zookeeper.should_receive('retry').with_args('get_children',
+      expiry_root).and_return([pending, expired])
+    fake_zookeeper.should_receive('retry').with_args('get_children',
+      expiry_root + '/' + pending).never()
+    fake_zookeeper.should_receive('retry').with_args('get_children',
+      expiry_root + '/' + expired).and_return(['tx0000000001',
+      'tx0000000002', 'tx0000000003'])
+    fake_zookeeper.should_receive('retry').with_args('delete',
+      expiry_root + '/' + expired).once()
+    fake_zookeeper.should_receive('get_async').replace_with(get_async)
+    fake_zookeeper.should_receive('delete_async').replace_with(delete_async)
     flexmock(kazoo.client)
     kazoo.client.should_receive('KazooClient').and_return(fake_zookeeper)
+
     transaction = zk.ZKTransaction(host="something", start_gc=False)
-    transaction.execute_garbage_collection(self.appid, "some/path")
+    transaction.collect_expired_transactions(self.appid, "some/path")
+
+    # Only the transaction that is still running past its timeout is failed,
+    # and the expired bucket is emptied.
+    self.assertEquals([1], failed)
+    self.assertEquals(3, len(deleted))
+    stats = transaction.gc_stats[self.appid]
+    self.assertEquals(1, stats['expired_buckets'])
+    self.assertEquals(1, stats['pending_buckets'])
+    self.assertEquals(3, stats['examined'])
+    self.assertEquals(1, stats['collected'])
+    self.assertTrue(stats['lag'] > 0)
+
+  def test_compact_blacklist(self):
+    flexmock(zk.ZKTransaction)
+    zk.ZKTransaction.should_receive('get_app_root_path').\
+      and_return('/appscale/apps/' + self.appid)
+    transaction_root = '/appscale/apps/' + self.appid + '/' + zk.APP_TX_PATH
+    blacklist_root = transaction_root + '/' + zk.TX_BLACKLIST_PATH
+    valid_root = transaction_root + '/' + zk.TX_VALIDLIST_PATH
+
+    # Times are in ms, and one of each kind of entry was written recently.
+    stats = {'old': flexmock(mtime=1000 * 1000, version=0),
+             'new': flexmock(mtime=3000 * 1000, version=0)}
+    def exists_async(path):
+      request = flexmock(name='request')
+      request.should_receive('get').and_return(stats[path.split('_')[-1]])
+      return request
+
+    deleted = []
+    def delete_async(path, version):
+      deleted.append(path)
+      request = flexmock(name='request')
+      if path.endswith('3_old'):
+        # Written again while it was being removed.
+        request.should_receive('get').\
+          and_raise(kazoo.exceptions.BadVersionError)
+      else:
+        request.should_receive('get').and_return(True)
+      return request
+
+    fake_zookeeper = flexmock(name='fake_zoo', get_children='get_children')
+    fake_zookeeper.should_receive('start')
+    fake_zookeeper.should_receive('retry').with_args('get_children',
+      blacklist_root).and_return(['1_old', '2_old', '3_new'])
+    fake_zookeeper.should_receive('retry').with_args('get_children',
+      valid_root).and_return(['key1_old', 'key2_old', 'key3_old'])
+    fake_zookeeper.should_receive('exists_async').replace_with(exists_async)
+    fake_zookeeper.should_receive('delete_async').replace_with(delete_async)
+    flexmock(kazoo.client)
+    kazoo.client.should_receive('KazooClient').and_return(fake_zookeeper)
+
+    transaction = zk.ZKTransaction(host="something", start_gc=False)
+    self.assertEquals((1, 1), transaction.compact_blacklist(self.appid, 2000,
+      set(['2_old']), set(['key2_old'])))
+    self.assertEquals([blacklist_root + '/1_old', valid_root + '/key1_old',
+      valid_root + '/key3_old'], deleted)
+
+  def test_get_valid_transaction_keys(self):
+    flexmock(zk.ZKTransaction)
+    zk.ZKTransaction.should_receive('get_valid_transaction_root_path').\
+      and_return('/valid/root')
+
+    # mock out initializing a ZK connection
+    fake_zookeeper = flexmock(name='fake_zoo', get_children='get_children')
+    fake_zookeeper.should_receive('start')
+    fake_zookeeper.should_receive('retry').with_args('get_children',
+      '/valid/root').and_return(['app%00%00Kind%3Aa%01', 'key2'])
+    flexmock(kazoo.client)
+    kazoo.client.should_receive('KazooClient').and_return(fake_zookeeper)
+
+    transaction = zk.ZKTransaction(host="something", start_gc=False)
+    self.assertEquals(set(['app\x00\x00Kind:a\x01', 'key2']),
+      transaction.get_valid_transaction_keys(self.appid))
+
+    # No failed transaction has registered a valid version yet.
+    fake_zookeeper.should_receive('retry').with_args('get_children',
+      '/valid/root').and_raise(kazoo.exceptions.NoNodeError)
+    self.assertEquals(set(),
+      transaction.get_valid_transaction_keys(self.appid))
+
+  def test_get_valid_version(self):
+    flexmock(zk.ZKTransaction)
+    zk.ZKTransaction.should_receive('get_valid_transaction_path').\
+      with_args(self.appid, 'key').and_return('/valid/key')
+
+    # mock out initializing a ZK connection
+    fake_zookeeper = flexmock(name='fake_zoo', get='get')
+    fake_zookeeper.should_receive('start')
+    fake_zookeeper.should_receive('retry').with_args('get', '/valid/key').\
+      and_return(('5', None))
+    flexmock(kazoo.client)
+    kazoo.client.should_receive('KazooClient').and_return(fake_zookeeper)
+
+    transaction = zk.ZKTransaction(host="something", start_gc=False)
+    self.assertEquals(5, transaction.get_valid_version(self.appid, 'key'))
+
+    fake_zookeeper.should_receive('retry').with_args('get', '/valid/key').\
+      and_raise(kazoo.exceptions.NoNodeError)
+    self.assertEquals(None, transaction.get_valid_version(self.appid, 'key'))
 
   def test_get_datastore_groomer_lock(self):
     flexmock(zk.ZKTransaction)
@@ -575,6 +1119,148 @@ class TestZookeeperTransaction(unittest.TestCase):
       .and_raise(kazoo.exceptions.NoNodeError)
     self.assertRaises(ZKTransactionException,
       transaction.release_datastore_groomer_lock)
+
+  def test_get_index_build_lock(self):
+    flexmock(zk.ZKTransaction)
+
+    # mock out initializing a ZK connection
+    fake_zookeeper = flexmock(name='fake_zoo', create='create')
+    fake_zookeeper.should_receive('start')
+    fake_zookeeper.should_receive('retry').with_args('create',
+      '/appscale_index_builds/' + self.appid + '/123', value=str, acl=None,
+      ephemeral=True, makepath=True).and_return(True)
+
+    flexmock(kazoo.client)
+    kazoo.client.should_receive('KazooClient').and_return(fake_zookeeper)
+
+    transaction = zk.ZKTransaction(host="something", start_gc=False)
+    self.assertEquals(True, transaction.get_index_build_lock(self.appid, 123))
+
+    fake_zookeeper.should_receive('retry').with_args('create', str, value=str,
+      acl=None, ephemeral=True, makepath=True).\
+      and_raise(kazoo.exceptions.NodeExistsError)
+    self.assertEquals(False, transaction.get_index_build_lock(self.appid, 123))
+
+  def test_release_index_build_lock(self):
+    flexmock(zk.ZKTransaction)
+
+    # mock out initializing a ZK connection
+    fake_zookeeper = flexmock(name='fake_zoo', delete='delete')
+    fake_zookeeper.should_receive('start')
+    fake_zookeeper.should_receive('retry').with_args('delete',
+      '/appscale_index_builds/' + self.appid + '/123')
+
+    flexmock(kazoo.client)
+    kazoo.client.should_receive('KazooClient').and_return(fake_zookeeper)
+
+    transaction = zk.ZKTransaction(host="something", start_gc=False)
+    self.assertEquals(True,
+      transaction.release_index_build_lock(self.appid, 123))
+
+    # A lock that is already gone is released.
+    fake_zookeeper.should_receive('retry').with_args('delete', str) \
+      .and_raise(kazoo.exceptions.NoNodeError)
+    self.assertEquals(True,
+      transaction.release_index_build_lock(self.appid, 123))
+
+  def test_acquire_group_locks(self):
+    flexmock(zk.ZKTransaction)
+    zk.ZKTransaction.should_receive('get_app_root_path').\
+      and_return('/appscale/apps/app_' + self.appid)
+
+    created = []
+    def create_async(path, value, acl, ephemeral, sequence, makepath):
+      created.append(path)
+      request = flexmock(name='request')
+      if path.endswith('contended'):
+        request.should_receive('get').\
+          and_raise(kazoo.exceptions.NodeExistsError)
+      else:
+        request.should_receive('get').and_return(path)
+      return request
+
+    fake_zookeeper = flexmock(name='fake_zoo', retry='retry')
+    fake_zookeeper.should_receive('start')
+    fake_zookeeper.should_receive('create_async').replace_with(create_async)
+    flexmock(kazoo.client)
+    kazoo.client.should_receive('KazooClient').and_return(fake_zookeeper)
+
+    transaction = zk.ZKTransaction(host="something", start_gc=False)
+    zk.ZKTransaction.should_receive('allocate_transaction_id').\
+      with_args(self.appid).and_return(7).once()
+    zk.ZKTransaction.should_receive('acquire_additional_lock').\
+      with_args(self.appid, 8, 'contended', create=True).\
+      and_raise(ZKTransactionException).once()
+    locked, contended = transaction.acquire_group_locks(self.appid,
+      ['free', 'contended'], {'contended': 8})
+    self.assertEquals({'free': 7}, locked)
+    self.assertEquals({'contended': 8}, contended)
+    # The new transaction is indexed and created before both locks, and the
+    # lock list of the group that was locked comes last.
+    self.assertEquals(5, len(created))
+    self.assertTrue(created[0].startswith(
+      transaction.get_app_root_path(self.appid) + '/' + zk.APP_TX_EXPIRY_PATH))
+    self.assertEquals(transaction.get_transaction_path(self.appid, 7),
+      created[1])
+
+  def test_release_group_locks(self):
+    flexmock(zk.ZKTransaction)
+    zk.ZKTransaction.should_receive('get_app_root_path').\
+      and_return('/appscale/apps/app_' + self.appid)
+
+    deleted = []
+    def delete_async(path):
+      deleted.append(path)
+      request = flexmock(name='request')
+      request.should_receive('get').and_raise(kazoo.exceptions.NoNodeError)
+      return request
+
+    fake_zookeeper = flexmock(name='fake_zoo', retry='retry')
+    fake_zookeeper.should_receive('start')
+    fake_zookeeper.should_receive('delete_async').replace_with(delete_async)
+    flexmock(kazoo.client)
+    kazoo.client.should_receive('KazooClient').and_return(fake_zookeeper)
+
+    transaction = zk.ZKTransaction(host="something", start_gc=False)
+    transaction.release_group_locks(self.appid, {'free': 7},
+      {'contended': 8})
+    # The lock and lock list go before the transaction nodes.
+    self.assertEquals(4, len(deleted))
+    self.assertEquals(
+      [transaction.get_transaction_path(self.appid, 7),
+       transaction.get_transaction_path(self.appid, 8)], deleted[2:])
+
+  def test_get_valid_transaction_ids(self):
+    flexmock(zk.ZKTransaction)
+    zk.ZKTransaction.should_receive('get_app_root_path').\
+      and_return('/appscale/apps/app_' + self.appid)
+    zk.ZKTransaction.should_receive('is_blacklisted').with_args(self.appid, 1).\
+      and_return(False).once()
+    zk.ZKTransaction.should_receive('is_blacklisted').with_args(self.appid, 3).\
+      and_return(True).once()
+
+    read = []
+    def get_async(path):
+      read.append(path)
+      request = flexmock(name='request')
+      if path.endswith('new'):
+        request.should_receive('get').and_raise(kazoo.exceptions.NoNodeError)
+      else:
+        request.should_receive('get').and_return(('2', None))
+      return request
+
+    fake_zookeeper = flexmock(name='fake_zoo', retry='retry')
+    fake_zookeeper.should_receive('start')
+    fake_zookeeper.should_receive('get_async').replace_with(get_async)
+    flexmock(kazoo.client)
+    kazoo.client.should_receive('KazooClient').and_return(fake_zookeeper)
+
+    transaction = zk.ZKTransaction(host="something", start_gc=False)
+    self.assertEquals({'a': 1, 'b': 1, 'c': 2, 'new': 0},
+      transaction.get_valid_transaction_ids(self.appid,
+        {'a': 1, 'b': 1, 'c': 3, 'new': 3}))
+    # Only the entities of the blacklisted transaction are read.
+    self.assertEquals(2, len(read))
      
 if __name__ == "__main__":
   unittest.main()    
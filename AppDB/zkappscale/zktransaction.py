@@ -3,6 +3,7 @@
 Distributed id and lock service for transaction support.
 Rewritten by Navraj Chohan and Chris Bunch (raj, chris@appscale.com)
 """
+import collections
 import logging
 import re
 import sys
@@ -12,6 +13,7 @@ import urllib
 
 import kazoo.client
 import kazoo.exceptions
+import kazoo.protocol.states
 
 class ZKTimeoutException(Exception):
   """ A special Exception class that should be thrown if a function is 
@@ -45,6 +47,23 @@ APPS_PATH = "/appscale/apps"
 # This path contains different transaction IDs.
 APP_TX_PATH = "txids"
 
+# The node that holds the last transaction ID leased to a datastore server.
+APP_TX_COUNTER_PATH = "txcounter"
+
+# The number of transaction IDs a datastore server leases at a time.
+TXID_BLOCK_SIZE = 1000
+
+# The node whose children are buckets of transactions, named after the time
+# the transactions started.
+APP_TX_EXPIRY_PATH = "txexpiry"
+
+# The number of seconds of transaction start times that share a bucket.
+GC_BUCKET_SECONDS = 10
+
+# The number of seconds between full scans of the transactions of an
+# application, which catch any that are missing from the expiry index.
+GC_FULL_SCAN_INTERVAL = 3600
+
 # This is the node which holds all the locks of an application.
 APP_LOCK_PATH = "locks"
 
@@ -70,11 +89,20 @@ TX_VALIDLIST_PATH = "validlist"
 
 GC_LOCK_PATH = "gclock"
 
+# The node whose version changes whenever the composite indexes of an
+# application are created or deleted.
+APP_INDEX_VERSION_PATH = "indexversion"
+
 GC_TIME_PATH = "gclast_time"
 
+GC_FULL_SCAN_TIME_PATH = "gclast_full_scan"
+
 # Lock path for the datastore groomer.
 DS_GROOM_LOCK_PATH = "/appscale_datastore_groomer"
 
+# The path under which the locks for building composite indexes are held.
+INDEX_BUILD_LOCK_PATH = "/appscale_index_builds"
+
 # A unique prefix for cross group transactions.
 XG_PREFIX = "xg"
 
@@ -125,6 +153,24 @@ class ZKTransaction:
       '%(lineno)s %(message)s ', level=logging.ERROR)
     logging.debug("Started logging")
 
+    # Per-application sets of blacklisted transaction IDs, kept fresh by
+    # ZooKeeper child watches. An application which is missing from the
+    # cache has no live watch and is answered by reading from ZooKeeper.
+    self.__blacklist_cache = {}
+    self.__blacklist_lock = threading.Lock()
+    # Bumped whenever the cache is dropped so stale watches unregister.
+    self.__blacklist_generation = 0
+    # The applications whose blacklists are watched in this generation.
+    self.__blacklist_watches = set()
+    # The client handle we registered a connection listener on.
+    self.__listening_handle = None
+
+    # Per-application versions of the composite index definitions, kept
+    # fresh by ZooKeeper data watches.
+    self.__index_versions = {}
+    # Bumped whenever the versions are dropped so stale watches unregister.
+    self.__index_version_generation = 0
+
     # Connection instance variables.
     self.needs_connection = True
     self.failure_count = 0
@@ -141,6 +187,17 @@ class ZKTransaction:
 
     self.__counter_cache = {}
 
+    # Per-application blocks of leased transaction IDs, as [next ID, last ID]
+    # lists which are handed out without going to ZooKeeper.
+    self.__txid_blocks = {}
+    self.__txid_lock = threading.Lock()
+    # The times at which the transactions this server handed out IDs for
+    # began, in the order they began, until they time out.
+    self.__txid_start_times = collections.OrderedDict()
+
+    # Per-application results of the last garbage collection run.
+    self.gc_stats = {}
+
     # for gc
     self.gc_running = False
     self.gc_cv = threading.Condition()
@@ -331,6 +388,19 @@ class ZKTransaction:
     return PATH_SEPARATOR.join([self.get_transaction_prefix_path(app_id),
       APP_TX_PREFIX])
 
+  def get_transaction_counter_path(self, app_id):
+    """ Returns the location of the ZooKeeper node whose value is the last
+    transaction ID that was leased for the given application.
+
+    Args:
+      app_id: A str that represents the application we wish to get the
+        counter path for.
+    Returns:
+      A str that represents the transaction ID counter.
+    """
+    return PATH_SEPARATOR.join([self.get_app_root_path(app_id),
+      APP_TX_COUNTER_PATH])
+
   def get_transaction_path(self, app_id, txid):
     """ Returns the location of the ZooKeeper node who contains all information
       for a transaction, and is the parent of the transaction lock list and
@@ -346,6 +416,24 @@ class ZKTransaction:
     return PATH_SEPARATOR.join([self.get_app_root_path(app_id), APP_TX_PATH,
       txstr])
 
+  def get_expiry_index_path(self, app_id, txid, timestamp):
+    """ Returns the location of the ZooKeeper node that puts a transaction in
+    the expiry index, under the bucket for the time it started.
+
+    Bucket names are zero-padded start times, so they sort in the order
+    their transactions expire.
+
+    Args:
+      app_id: A str that represents the application of the transaction.
+      txid: An int that represents the transaction ID.
+      timestamp: A str or float, the time the transaction started.
+    Returns:
+      A str that represents the index entry of the transaction.
+    """
+    bucket = int(float(timestamp)) // GC_BUCKET_SECONDS * GC_BUCKET_SECONDS
+    return PATH_SEPARATOR.join([self.get_app_root_path(app_id),
+      APP_TX_EXPIRY_PATH, "%012d" % bucket, APP_TX_PREFIX + "%010d" % txid])
+
   def get_transaction_lock_list_path(self, app_id, txid):
     """ Returns the location of the ZooKeeper node whose value is a
     XG_LIST-separated str, representing all of the locks that have been acquired
@@ -497,12 +585,121 @@ class ZKTransaction:
     raise ZKTransactionException("Unable to create sequence node with path" \
       " {0}, value {1}".format(path, value))
 
+  def lease_transaction_ids(self, app_id):
+    """ Leases a block of TXID_BLOCK_SIZE transaction IDs by bumping the
+    transaction ID counter of the application.
+
+    The counter starts above every ID that was handed out as a sequence node
+    under the transaction path, since those IDs live on as entity versions.
+
+    Args:
+      app_id: A str representing the application to lease IDs for.
+    Returns:
+      A tuple of two longs, the first and last IDs of the block.
+    Raises:
+      ZKTransactionException: If the counter could not be updated.
+    """
+    if self.needs_connection:
+      self.reestablish_connection()
+
+    counter_path = self.get_transaction_counter_path(app_id)
+    try:
+      while True:
+        try:
+          value, stat = self.run_with_retry(self.handle.get, counter_path)
+        except kazoo.exceptions.NoNodeError:
+          # A sequence node always gets a number below the child version of
+          # its parent.
+          prefix_stat = self.run_with_retry(self.handle.exists,
+            self.get_transaction_prefix_path(app_id))
+          first_value = 0
+          if prefix_stat:
+            first_value = prefix_stat.cversion
+          try:
+            self.run_with_retry(self.handle.create, counter_path,
+              value=str(first_value), acl=ZOO_ACL_OPEN, ephemeral=False,
+              sequence=False, makepath=True)
+          except kazoo.exceptions.NodeExistsError:
+            pass
+          continue
+
+        last_id = long(value)
+        try:
+          self.run_with_retry(self.handle.set, counter_path,
+            str(last_id + TXID_BLOCK_SIZE), version=stat.version)
+        except kazoo.exceptions.BadVersionError:
+          # Another server leased a block first.
+          continue
+        logging.debug("Leased transaction IDs {0} to {1} for app {2}".format(
+          last_id + 1, last_id + TXID_BLOCK_SIZE, app_id))
+        return last_id + 1, last_id + TXID_BLOCK_SIZE
+    except kazoo.exceptions.KazooException as kazoo_exception:
+      logging.exception(kazoo_exception)
+      self.reestablish_connection()
+      raise ZKTransactionException("Couldn't lease transaction IDs for app " \
+        "{0}".format(app_id))
+
+  def allocate_transaction_id(self, app_id):
+    """ Hands out the next transaction ID from the block leased by this
+    server, leasing a new block once it runs out.
+
+    Args:
+      app_id: A str representing the application to get an ID for.
+    Returns:
+      A long that represents the new transaction ID.
+    Raises:
+      ZKTransactionException: If a new block could not be leased.
+    """
+    with self.__txid_lock:
+      block = self.__txid_blocks.get(app_id)
+      if block is None or block[0] > block[1]:
+        block = list(self.lease_transaction_ids(app_id))
+        self.__txid_blocks[app_id] = block
+      txid = block[0]
+      block[0] += 1
+
+      # Transactions are forgotten once they time out.
+      now = time.time()
+      while self.__txid_start_times and \
+          self.__txid_start_times.itervalues().next() + TX_TIMEOUT < now:
+        self.__txid_start_times.popitem(last=False)
+      self.__txid_start_times[(app_id, txid)] = now
+      return txid
+
+  def get_transaction_start_time(self, app_id, txid, forget=False):
+    """ Gets the time a transaction began, for the node that is created when
+    it takes its first lock.
+
+    Args:
+      app_id: A str representing the application ID.
+      txid: The transaction ID.
+      forget: A bool that indicates if the time is no longer needed.
+    Returns:
+      A float, the time the transaction began, or None for transactions whose
+      IDs came from another server, that were forgotten after they timed out,
+      or whose nodes were created when they began.
+    """
+    with self.__txid_lock:
+      if forget:
+        return self.__txid_start_times.pop((app_id, txid), None)
+      return self.__txid_start_times.get((app_id, txid))
+
   def get_transaction_id(self, app_id, is_xg=False):
     """Acquires a new id for an upcoming transaction.
 
     Note that the caller must lock particular root entities using acquire_lock,
     and that the transaction ID expires after a constant amount of time.
 
+    IDs come from a block leased by this server, so a transaction only shows
+    up in ZooKeeper once it takes its first lock. The time it began is kept
+    until then and becomes the timestamp of its node, so its timeout still
+    runs from when it began. XG transactions are the exception, because the
+    node that marks them as XG must be seen by every server. IDs are unique
+    and increase on each server, but IDs from different servers do not say
+    which transaction began first. Nothing relies on that: versions are only
+    compared for equality, and the garbage collector goes by the timestamp
+    in the transaction node.
+
     Args:
       app_id: A str representing the application we want to perform a
         transaction on.
@@ -514,22 +711,20 @@ class ZKTransaction:
     logging.debug("Getting new transaction id for app {0}, with is_xg set " \
       "to {1}".format(app_id, is_xg))
 
-    if self.needs_connection:
-      self.reestablish_connection()
-
-    timestamp = str(time.time())
-
-    # First, make the ZK node for the actual transaction id.
-    app_path = self.get_txn_path_before_getting_id(app_id)
-    txn_id = self.create_sequence_node(app_path, timestamp)
+    txn_id = self.allocate_transaction_id(app_id)
 
-    # Next, make the ZK node that indicates if this a XG transaction.
+    # Make the ZK node for the transaction, and the one that indicates that
+    # it is a XG transaction. The transaction is indexed first, so the garbage
+    # collector can always find it.
     if is_xg:
-      xg_path = self.get_xg_path(app_id, txn_id)
-      self.create_node(xg_path, timestamp)
-    logging.debug("Returning transaction ID {0} with timestamp {1} for " \
-      "app_id {2}, with is_xg set to {3}".format(txn_id, timestamp, app_id,
-      is_xg))
+      timestamp = str(self.get_transaction_start_time(app_id, txn_id,
+        forget=True) or time.time())
+      self.create_node(self.get_expiry_index_path(app_id, txn_id, timestamp),
+        timestamp)
+      self.create_node(self.get_transaction_path(app_id, txn_id), timestamp)
+      self.create_node(self.get_xg_path(app_id, txn_id), timestamp)
+    logging.debug("Returning transaction ID {0} for app_id {1}, with is_xg " \
+      "set to {2}".format(txn_id, app_id, is_xg))
     return txn_id
 
   def check_transaction(self, app_id, txid):
@@ -634,7 +829,9 @@ class ZKTransaction:
             the path.
       entity_key: Used to get the root path.
       create: A bool that indicates if we should create a new Zookeeper node
-        to store the lock information in.
+        to store the lock information in. The node of the transaction itself
+        is created and indexed too if it does not exist yet, stamped with the
+        time the transaction began.
     Returns:
       Boolean, of true on success, false if lock can not be acquired.
     Raises:
@@ -652,7 +849,24 @@ class ZKTransaction:
     lockrootpath = self.get_lock_root_path(app_id, entity_key)
     lockpath = None
 
+    txn_requests = []
     try:
+      start_time = None
+      if create:
+        start_time = self.get_transaction_start_time(app_id, txid)
+      # The begin time of a transaction is only unknown here if it began on
+      # another server, or if it is XG and so already has its node and index
+      # entry.
+      if create and (start_time is not None or
+          not self.run_with_retry(self.handle.exists, txpath)):
+        # Requests are handled in order, so the transaction is indexed and
+        # exists before its lock can be seen by others.
+        timestamp = str(start_time or time.time())
+        for path in [self.get_expiry_index_path(app_id, txid, timestamp),
+                     txpath]:
+          txn_requests.append(self.run_with_retry(self.handle.create_async,
+            path, value=timestamp, acl=ZOO_ACL_OPEN, ephemeral=False,
+            sequence=False, makepath=True))
       logging.debug("Trying to create path {0} with value {1}".format(
         lockrootpath, txpath))
       lockpath = self.run_with_retry(self.handle.create, lockrootpath,
@@ -683,6 +897,14 @@ class ZKTransaction:
       self.reestablish_connection()
       raise ZKTransactionException("Couldn't get a lock at path {0}" \
         .format(lockrootpath))
+    finally:
+      for request in txn_requests:
+        try:
+          request.get()
+        except kazoo.exceptions.NodeExistsError:
+          pass
+        except kazoo.exceptions.KazooException as kazoo_exception:
+          logging.exception(kazoo_exception)
 
     logging.debug("Created new lock root path {0} with value {1}".format(
       lockrootpath, txpath))
@@ -807,6 +1029,140 @@ class ZKTransaction:
 
     return self.acquire_additional_lock(app_id, txid, entity_key, create=True)
 
+  def acquire_group_locks(self, app_id, entity_keys, txids=None):
+    """ Acquires a transaction ID and a lock for each of a set of entity
+    groups, sending the ZooKeeper requests for all of the groups at once.
+
+    Each group gets its own non-XG transaction, with an ID from the block
+    leased by this server. Locks held by other transactions are tried once
+    more on their own, which also releases orphan locks, and are otherwise
+    left for the caller to retry.
+
+    Args:
+      app_id: A str representing the application ID.
+      entity_keys: A list of strs, the root keys of the entity groups.
+      txids: A dict mapping root keys to transaction IDs from an earlier call
+        that did not get their locks, which are reused.
+    Returns:
+      A tuple of two dicts mapping root keys to transaction IDs. The first
+      holds the groups that are now locked, and the second holds the groups
+      whose locks are in use by other transactions.
+    Raises:
+      ZKTransactionException: If the requests could not be completed.
+    """
+    if self.needs_connection:
+      self.reestablish_connection()
+
+    txids = dict(txids or {})
+    locked = {}
+    contended = {}
+    try:
+      # IDs reused from an earlier call already have their nodes.
+      txn_requests = []
+      for key in entity_keys:
+        if key in txids:
+          continue
+        txids[key] = self.allocate_transaction_id(app_id)
+        timestamp = str(self.get_transaction_start_time(app_id, txids[key])
+          or time.time())
+        for path in [self.get_expiry_index_path(app_id, txids[key], timestamp),
+                     self.get_transaction_path(app_id, txids[key])]:
+          txn_requests.append(self.handle.create_async(path, value=timestamp,
+            acl=ZOO_ACL_OPEN, ephemeral=False, sequence=False, makepath=True))
+
+      # Requests are handled in order, so each transaction is indexed and
+      # exists before its lock can be seen by others.
+      lock_requests = []
+      for key in entity_keys:
+        txpath = self.get_transaction_path(app_id, txids[key])
+        lockrootpath = self.get_lock_root_path(app_id, key)
+        lock_requests.append((key, self.handle.create_async(lockrootpath,
+          value=str(txpath), acl=ZOO_ACL_OPEN, ephemeral=False,
+          sequence=False, makepath=True)))
+
+      for request in txn_requests:
+        request.get()
+
+      list_requests = []
+      for key, request in lock_requests:
+        try:
+          lockpath = request.get()
+        except kazoo.exceptions.NodeExistsError:
+          contended[key] = txids[key]
+          continue
+        locked[key] = txids[key]
+        transaction_lock_path = self.get_transaction_lock_list_path(app_id,
+          txids[key])
+        list_requests.append(self.handle.create_async(transaction_lock_path,
+          value=str(lockpath), acl=ZOO_ACL_OPEN, ephemeral=False,
+          makepath=False, sequence=False))
+      for request in list_requests:
+        request.get()
+    except kazoo.exceptions.KazooException as kazoo_exception:
+      logging.exception(kazoo_exception)
+      self.reestablish_connection()
+      raise ZKTransactionException("Couldn't acquire locks for app id {0}, " \
+        "entity keys {1}".format(app_id, entity_keys))
+
+    for key in contended.keys():
+      try:
+        self.acquire_additional_lock(app_id, txids[key], key, create=True)
+        locked[key] = contended.pop(key)
+      except ZKTransactionException as zk_exception:
+        logging.debug("Lock for {0} is in use: {1}".format(key, zk_exception))
+
+    return locked, contended
+
+  def release_group_locks(self, app_id, locked, unlocked):
+    """ Releases the locks and transaction IDs of groups that were set up for
+    a write that never happened, sending all of the deletes at once.
+
+    Nothing was written under these transactions, so they are removed
+    instead of being blacklisted.
+
+    Args:
+      app_id: A str representing the application ID.
+      locked: A dict mapping root keys to the transaction IDs that hold
+        their locks.
+      unlocked: A dict mapping root keys to transaction IDs that never got
+        their locks.
+    """
+    if self.needs_connection:
+      self.reestablish_connection()
+
+    try:
+      requests = []
+      for key, txid in locked.iteritems():
+        requests.append(self.handle.delete_async(
+          self.get_lock_root_path(app_id, key)))
+        requests.append(self.handle.delete_async(
+          self.get_transaction_lock_list_path(app_id, txid)))
+      self.__wait_for_deletes(requests)
+
+      # Transaction nodes can only go once their lock lists are gone.
+      requests = [self.handle.delete_async(self.get_transaction_path(app_id,
+        txid)) for txid in locked.values() + unlocked.values()]
+      self.__wait_for_deletes(requests)
+    except kazoo.exceptions.KazooException as kazoo_exception:
+      # Whatever is left over times out and is cleaned up by the garbage
+      # collector.
+      logging.exception(kazoo_exception)
+      self.reestablish_connection()
+
+  def __wait_for_deletes(self, requests):
+    """ Waits for asynchronous deletes, ignoring nodes that are already gone.
+
+    Args:
+      requests: A list of kazoo IAsyncResults from delete_async calls.
+    Raises:
+      KazooException: If a delete failed for another reason.
+    """
+    for request in requests:
+      try:
+        request.get()
+      except kazoo.exceptions.NoNodeError:
+        pass
+
   def get_updated_key_list(self, app_id, txid):
     """ Gets a list of keys updated in this transaction.
 
@@ -844,7 +1200,9 @@ class ZKTransaction:
     """ Releases all locks acquired during this transaction.
 
     Callers must call acquire_lock before calling release_lock. Upon calling
-    release_lock, the given transaction ID is no longer valid.
+    release_lock, the given transaction ID is no longer valid. A transaction
+    that never took a lock has nothing in ZooKeeper, so there is nothing to
+    release.
 
     Args:
       app_id: The application ID we are releasing a lock for.
@@ -861,18 +1219,28 @@ class ZKTransaction:
     if self.needs_connection:
       self.reestablish_connection()
 
-    self.check_transaction(app_id, txid)
+    try:
+      if self.is_blacklisted(app_id, txid):
+        raise ZKTransactionException("Transaction {0} timed out.".format(txid))
+    except ZKInternalException as zk_exception:
+      logging.exception(zk_exception)
+      self.reestablish_connection()
+      raise ZKTransactionException("Couldn't see if transaction {0} is valid" \
+        .format(txid))
+
     txpath = self.get_transaction_path(app_id, txid)
      
     transaction_lock_path = self.get_transaction_lock_list_path(app_id, txid)
     try:
-      lock_list_str = self.run_with_retry(self.handle.get,
-        transaction_lock_path)[0]
-      lock_list = lock_list_str.split(LOCK_LIST_SEPARATOR)
-      for lock_path in lock_list:
-        logging.debug("Lock released: {0}".format(lock_path))
-        self.run_with_retry(self.handle.delete, lock_path)
-      self.run_with_retry(self.handle.delete, transaction_lock_path)
+      # The lock list, the start time and the nodes of the transaction are
+      # read together.
+      lock_request = self.handle.get_async(transaction_lock_path)
+      txn_request = self.handle.get_async(txpath)
+      children_request = self.handle.get_children_async(txpath)
+      lock_list = lock_request.get()[0].split(LOCK_LIST_SEPARATOR)
+      index_path = self.get_expiry_index_path(app_id, txid,
+        txn_request.get()[0])
+      children = children_request.get()
     except kazoo.exceptions.NoNodeError:
       try:
         if self.is_blacklisted(app_id, txid):
@@ -894,38 +1262,265 @@ class ZKTransaction:
         .format(transaction_lock_path, app_id))
 
     try:
-      if self.is_xg(app_id, txid):
-        xg_path = self.get_xg_path(app_id, txid)
-        self.run_with_retry(self.handle.delete, xg_path)
+      logging.debug("Locks released: {0}".format(lock_list))
+      self.delete_transaction_nodes(txpath, lock_list, children, index_path)
+    except kazoo.exceptions.KazooException as kazoo_exception:
+      logging.exception(kazoo_exception)
+      self.reestablish_connection()
+      raise ZKTransactionException("Couldn't release lock {0} for appid {1}" \
+        .format(transaction_lock_path, app_id))
 
-      for child in self.run_with_retry(self.handle.get_children, txpath):
-        logging.debug("Removing lock: {0}".format(PATH_SEPARATOR.join(
-          [txpath, child])))
-        self.run_with_retry(self.handle.delete, PATH_SEPARATOR.join(
-          [txpath, child]))
+    return True
 
-      # This deletes the transaction root path.
-      self.run_with_retry(self.handle.delete, txpath)
+  def delete_transaction_nodes(self, txpath, lock_list, children,
+                               index_path=None):
+    """ Deletes the locks of a transaction, the nodes under it and its entry
+    in the expiry index in a single multi-op transaction, instead of one
+    request for each.
 
-    except ZKInternalException as zk_exception:
-      # Although there was a failure doing the async deletes, since we've
-      # already released the locks above, we can safely return True here.
-      logging.exception(kazoo_exception)
+    A multi-op transaction fails as a whole if any of its nodes is already
+    gone, in which case the nodes are deleted with concurrent requests that
+    skip the missing ones. Whatever is left of the transaction node then is
+    cleaned up by the garbage collector.
+
+    Args:
+      txpath: A str, the path of the transaction node.
+      lock_list: A list of strs, the paths of the locks the transaction holds.
+      children: A list of strs, the names of the nodes under the transaction
+        node.
+      index_path: A str, the path of the entry of the transaction in the
+        expiry index, or None if it is not known.
+    Raises:
+      KazooException: If the locks could not be deleted.
+    """
+    child_paths = [PATH_SEPARATOR.join([txpath, child]) for child in children]
+    other_paths = lock_list + child_paths
+    if index_path is not None:
+      other_paths.append(index_path)
+    multi_op = self.handle.transaction()
+    for path in other_paths + [txpath]:
+      multi_op.delete(path)
+    results = multi_op.commit()
+    if not [result for result in results if isinstance(result, Exception)]:
+      return
+
+    logging.debug("Multi-op delete of {0} failed: {1}".format(txpath, results))
+    self.__wait_for_deletes([self.handle.delete_async(path)
+                             for path in other_paths])
+    try:
+      self.__wait_for_deletes([self.handle.delete_async(txpath)])
+    except kazoo.exceptions.KazooException as kazoo_exception:
+      # The locks are already released.
+      logging.warning("Couldn't delete {0}: {1}".format(txpath,
+        kazoo_exception))
+
+  def drop_blacklist_cache(self):
+    """ Forgets all cached blacklists and index versions and invalidates their
+    watches, so that they are read from ZooKeeper until new watches are in
+    place.
+    """
+    with self.__blacklist_lock:
+      self.__blacklist_generation += 1
+      self.__blacklist_cache = {}
+      self.__blacklist_watches = set()
+      self.__index_version_generation += 1
+      self.__index_versions = {}
+
+  def handle_connection_change(self, state):
+    """ Listener for ZooKeeper connection state changes. While we are not
+    connected watches may miss updates, so the blacklist cache is dropped.
+
+    Args:
+      state: A kazoo.protocol.states.KazooState.
+    """
+    if state != kazoo.protocol.states.KazooState.CONNECTED:
+      logging.warning("ZooKeeper connection state is {0}, dropping the " \
+        "blacklist and index version caches.".format(state))
+      self.drop_blacklist_cache()
+
+  def watch_blacklist(self, app_id, blacklist_root):
+    """ Sets watches on an application's blacklist which keep the in-memory
+    copy of it up to date. Only one is set for each application.
+
+    The blacklist root is watched for being created or deleted, so that an
+    application without one is cached as having an empty blacklist. Its
+    children are watched while it exists.
+
+    Args:
+      app_id: The application ID whose blacklist we want to watch.
+      blacklist_root: A str, the ZooKeeper node holding the blacklist.
+    """
+    handle = self.handle
+    with self.__blacklist_lock:
+      if app_id in self.__blacklist_watches:
+        return
+      self.__blacklist_watches.add(app_id)
+      generation = self.__blacklist_generation
+      if self.__listening_handle is not handle:
+        handle.add_listener(self.handle_connection_change)
+        self.__listening_handle = handle
+
+    def is_stale():
+      """ Tells whether the cache has been dropped since the watches were
+      set. The caller must hold self.__blacklist_lock.
+      """
+      return generation != self.__blacklist_generation or \
+        handle is not self.handle
+
+    def update_root(data, stat):
+      """ Caches an empty blacklist while the root does not exist, and
+      watches its children once it does.
+
+      Returns:
+        False if the watch is stale and should be removed, None otherwise.
+      """
+      with self.__blacklist_lock:
+        if is_stale():
+          return False
+        if stat is None:
+          self.__blacklist_cache[app_id] = set()
+          return None
+      # The children watch stops by itself if the root is deleted.
+      handle.ChildrenWatch(blacklist_root, update_blacklist)
+
+    def update_blacklist(children):
+      """ Replaces the cached blacklist with the current set of children.
+
+      Returns:
+        False if the watch is stale and should be removed, None otherwise.
+      """
+      with self.__blacklist_lock:
+        if is_stale():
+          return False
+        self.__blacklist_cache[app_id] = set(children)
+
+    try:
+      handle.DataWatch(blacklist_root, update_root)
+    except kazoo.exceptions.KazooException:
+      with self.__blacklist_lock:
+        if not is_stale():
+          self.__blacklist_watches.discard(app_id)
+      raise
+
+  def get_index_version_path(self, app_id):
+    """ Gets the path of the node whose version tells when the composite
+    indexes of an application last changed.
+
+    Args:
+      app_id: The application ID.
+    Returns:
+      A str, the ZooKeeper path of the node.
+    """
+    return PATH_SEPARATOR.join([self.get_app_root_path(app_id),
+      APP_INDEX_VERSION_PATH])
+
+  def get_index_version(self, app_id):
+    """ Gets the version of the composite index definitions of an
+    application, which changes whenever one is created or deleted.
+
+    The version is answered from a watched in-memory copy when one is
+    available, and read from ZooKeeper otherwise.
+
+    Args:
+      app_id: The application ID.
+    Returns:
+      An int, the version of the index definitions.
+    Raises:
+      ZKInternalException: If the version could not be read.
+    """
+    if self.needs_connection:
       self.reestablish_connection()
-      return True
+
+    with self.__blacklist_lock:
+      version = self.__index_versions.get(app_id)
+    if version is not None:
+      return version
+
+    version_path = self.get_index_version_path(app_id)
+    handle = self.handle
+    if self.__listening_handle is not handle:
+      handle.add_listener(self.handle_connection_change)
+      self.__listening_handle = handle
+    with self.__blacklist_lock:
+      generation = self.__index_version_generation
+
+    def update_version(data, stat):
+      """ Records the current version of the node.
+
+      Returns:
+        False if the watch is stale and should be removed, None otherwise.
+      """
+      with self.__blacklist_lock:
+        if generation != self.__index_version_generation or \
+          handle is not self.handle:
+          return False
+        self.__index_versions[app_id] = stat.version if stat else -1
+
+    try:
+      if not self.run_with_retry(handle.exists, version_path):
+        handle.create(version_path, value=DEFAULT_VAL, acl=ZOO_ACL_OPEN,
+          ephemeral=False, sequence=False, makepath=True)
+      handle.DataWatch(version_path, update_version)
+
+      # The watch reports the version as soon as it is set, unless it is
+      # already stale.
+      with self.__blacklist_lock:
+        version = self.__index_versions.get(app_id)
+      if version is not None:
+        return version
+      stat = self.run_with_retry(handle.exists, version_path)
+      return stat.version if stat else -1
+    except kazoo.exceptions.NodeExistsError:
+      return self.get_index_version(app_id)
     except kazoo.exceptions.KazooException as kazoo_exception:
-      # Although there was a failure doing the async deletes, since we've
-      # already released the locks above, we can safely return True here.
       logging.exception(kazoo_exception)
       self.reestablish_connection()
-      return True
+      raise ZKInternalException("Couldn't get the index version of app " \
+        "{0}.".format(app_id))
+
+  def update_index_version(self, app_id):
+    """ Changes the version of the composite index definitions of an
+    application, so that every datastore server reloads them.
 
+    Args:
+      app_id: The application ID.
+    Returns:
+      True on success, False on system failures.
+    """
+    version_path = self.get_index_version_path(app_id)
+    try:
+      try:
+        self.run_with_retry(self.handle.set, version_path, str(time.time()))
+      except kazoo.exceptions.NoNodeError:
+        self.run_with_retry(self.handle.create, version_path,
+          value=str(time.time()), acl=ZOO_ACL_OPEN, makepath=True)
+    except kazoo.exceptions.NodeExistsError:
+      return self.update_index_version(app_id)
+    except kazoo.exceptions.KazooException as kazoo_exception:
+      logging.exception(kazoo_exception)
+      self.reestablish_connection()
+      return False
     return True
 
+  def add_to_blacklist_cache(self, app_id, txid):
+    """ Adds a transaction ID to the cached blacklist of an application, if
+    it is being cached, ahead of the watch reporting the new child.
+
+    Args:
+      app_id: The application ID whose transaction was blacklisted.
+      txid: The transaction ID that was blacklisted.
+    """
+    with self.__blacklist_lock:
+      if app_id in self.__blacklist_cache:
+        self.__blacklist_cache[app_id].add(str(txid))
+
   def is_blacklisted(self, app_id, txid):
     """ Checks to see if the given transaction ID has been blacklisted (that is,
     if it is no longer considered to be a valid transaction).
 
+    Membership is answered from the watched in-memory blacklist when one is
+    available, and read from ZooKeeper otherwise.
+
     Args:
       app_id: The application ID whose transaction ID we want to validate.
       txid: The transaction ID that we want to validate.
@@ -938,16 +1533,23 @@ class ZKTransaction:
     if self.needs_connection:
       self.reestablish_connection()
 
+    with self.__blacklist_lock:
+      blacklist = self.__blacklist_cache.get(app_id)
+    if blacklist is not None:
+      return str(txid) in blacklist
+
     blacklist_root = self.get_blacklist_root_path(app_id)
     try:
-      if not self.run_with_retry(self.handle.exists, blacklist_root):
-        self.handle.create(blacklist_root, value=DEFAULT_VAL,
-          acl=ZOO_ACL_OPEN, ephemeral=False, sequence=False, makepath=True)
+      self.watch_blacklist(app_id, blacklist_root)
     except kazoo.exceptions.KazooException as kazoo_exception:
-      logging.exception(kazoo_exception)
-      self.reestablish_connection()
-      raise ZKInternalException("Couldn't see if appid {0}'s transaction, " \
-        "{1}, is blacklisted.".format(app_id, txid))
+      # We can still answer with a read from ZooKeeper below.
+      logging.warning("Unable to watch the blacklist of {0}: {1}".format(
+        app_id, kazoo_exception))
+
+    with self.__blacklist_lock:
+      blacklist = self.__blacklist_cache.get(app_id)
+    if blacklist is not None:
+      return str(txid) in blacklist
 
     try:
       blacklist = self.run_with_retry(self.handle.get_children, blacklist_root)
@@ -993,6 +1595,79 @@ class ZKTransaction:
         "app {0}, target txid {1}, entity key {2}".format(app_id, target_txid,
         entity_key))
 
+  def get_valid_version(self, app_id, entity_key):
+    """ Gets the valid version a failed transaction registered for an
+    entity key, whether or not the current version is blacklisted.
+
+    Args:
+      app_id: A str representing the application ID.
+      entity_key: The key of the entity.
+    Returns:
+      A long, the valid version, or None if none is registered.
+    Raises:
+      ZKInternalException: If the valid version could not be read.
+    """
+    if self.needs_connection:
+      self.reestablish_connection()
+
+    vtxpath = self.get_valid_transaction_path(app_id, entity_key)
+    try:
+      return long(self.run_with_retry(self.handle.get, vtxpath)[0])
+    except kazoo.exceptions.NoNodeError:
+      return None
+    except kazoo.exceptions.KazooException as kazoo_exception:
+      logging.exception(kazoo_exception)
+      self.reestablish_connection()
+      raise ZKInternalException("Couldn't get the valid version of entity " \
+        "key {0} for app {1}".format(entity_key, app_id))
+
+  def get_valid_transaction_ids(self, app_id, entity_versions):
+    """ Returns the valid transaction ids for many entity keys at once.
+
+    Each distinct transaction is checked against the blacklist only once,
+    and the valid ids of the entities written by blacklisted transactions
+    are read with one round of concurrent requests.
+
+    Args:
+      app_id: A str representing the application ID.
+      entity_versions: A dict mapping entity keys to the transaction ids of
+        their current versions.
+    Returns:
+      A dict mapping each entity key to a long containing its latest valid
+      transaction id, or zero if there is none.
+    Raises:
+      ZKInternalException: If we couldn't get the valid transaction IDs.
+    """
+    if self.needs_connection:
+      self.reestablish_connection()
+
+    blacklisted = set(txid for txid in set(entity_versions.values())
+                      if self.is_blacklisted(app_id, txid))
+
+    valid_ids = {}
+    requests = []
+    try:
+      for entity_key, txid in entity_versions.iteritems():
+        if txid in blacklisted:
+          vtxpath = self.get_valid_transaction_path(app_id, entity_key)
+          requests.append((entity_key, self.handle.get_async(vtxpath)))
+        else:
+          valid_ids[entity_key] = txid
+
+      for entity_key, request in requests:
+        try:
+          valid_ids[entity_key] = long(request.get()[0])
+        except kazoo.exceptions.NoNodeError:
+          # The transaction is blacklisted, but there is no valid id.
+          valid_ids[entity_key] = long(0)
+    except kazoo.exceptions.KazooException as kazoo_exception:
+      logging.exception(kazoo_exception)
+      self.reestablish_connection()
+      raise ZKInternalException("Couldn't get valid transaction ids for " \
+        "app {0}, {1} entity keys".format(app_id, len(entity_versions)))
+
+    return valid_ids
+
   def register_updated_key(self, app_id, current_txid, target_txid, entity_key):
     """ Registers a key which is a part of a transaction. This is to know
     what journal version we must rollback to upon failure.
@@ -1015,22 +1690,26 @@ class ZKTransaction:
     vtxpath = self.get_valid_transaction_path(app_id, entity_key)
 
     try:
-      if self.run_with_retry(self.handle.exists, vtxpath):
+      try:
         # Update the transaction ID for entity if there is valid transaction.
-        self.run_with_retry(self.handle.set_async, vtxpath, str(target_txid))
+        self.run_with_retry(self.handle.set, vtxpath, str(target_txid))
+        return True
+      except kazoo.exceptions.NoNodeError:
+        # There is none, or compacting the blacklist just removed it.
+        pass
+
+      # Store the updated key info into the current transaction node.
+      value = PATH_SEPARATOR.join([urllib.quote_plus(entity_key),
+        str(target_txid)])
+      txpath = self.get_transaction_path(app_id, current_txid)
+
+      if self.run_with_retry(self.handle.exists, txpath):
+        self.handle.create_async(PATH_SEPARATOR.join([txpath,
+          TX_UPDATEDKEY_PREFIX]), value=str(value), acl=ZOO_ACL_OPEN,
+          ephemeral=False, sequence=True, makepath=False)
       else:
-        # Store the updated key info into the current transaction node.
-        value = PATH_SEPARATOR.join([urllib.quote_plus(entity_key),
-          str(target_txid)])
-        txpath = self.get_transaction_path(app_id, current_txid)
-
-        if self.run_with_retry(self.handle.exists, txpath):
-          self.handle.create_async(PATH_SEPARATOR.join([txpath,
-            TX_UPDATEDKEY_PREFIX]), value=str(value), acl=ZOO_ACL_OPEN,
-            ephemeral=False, sequence=True, makepath=False)
-        else:
-          raise ZKTransactionException("Transaction {0} is not valid.".format(
-            current_txid))
+        raise ZKTransactionException("Transaction {0} is not valid.".format(
+          current_txid))
     except kazoo.exceptions.KazooException as kazoo_exception:
       logging.exception(kazoo_exception)
       self.reestablish_connection()
@@ -1061,12 +1740,25 @@ class ZKTransaction:
 
     txpath = self.get_transaction_path(app_id, txid)
     try:
-      lockpath = self.run_with_retry(self.handle.get,
-        PATH_SEPARATOR.join([txpath, TX_LOCK_PATH]))[0]
-      lock_list = lockpath.split(LOCK_LIST_SEPARATOR)
-    except kazoo.exceptions.NoNodeError:
-      # There is no need to rollback because there is no lock.
-      pass
+      # The lock list, the start time and the nodes of the transaction are
+      # read together.
+      lock_request = self.handle.get_async(PATH_SEPARATOR.join([txpath,
+        TX_LOCK_PATH]))
+      txn_request = self.handle.get_async(txpath)
+      children_request = self.handle.get_children_async(txpath)
+      try:
+        lockpath = lock_request.get()[0]
+        lock_list = lockpath.split(LOCK_LIST_SEPARATOR)
+      except kazoo.exceptions.NoNodeError:
+        # There is no need to rollback because there is no lock.
+        pass
+      try:
+        index_path = self.get_expiry_index_path(app_id, txid,
+          txn_request.get()[0])
+        children = children_request.get()
+      except kazoo.exceptions.NoNodeError:
+        # The transaction has already finished.
+        return False
     except kazoo.exceptions.ZookeeperError as zoo_exception:
       logging.exception(zoo_exception)
       return False
@@ -1077,70 +1769,43 @@ class ZKTransaction:
 
     try:
       if lock_list:
-        # Add the transaction ID to the blacklist.
+        # Add the transaction ID to the blacklist, and copy the valid
+        # transaction ID of each updated key into the valid list, with all
+        # of the requests sent at once. They must be in place before the
+        # locks are released.
         now = str(time.time())
         blacklist_root = self.get_blacklist_root_path(app_id)
-
-        if not self.run_with_retry(self.handle.exists, blacklist_root):
-          self.handle.create(blacklist_root, value=DEFAULT_VAL,
-            acl=ZOO_ACL_OPEN, ephemeral=False, sequence=False, makepath=True)
-
-        self.handle.create_async(PATH_SEPARATOR.join([blacklist_root, 
-          str(txid)]), value=now, acl=ZOO_ACL_OPEN)
-
-        children = []
-        try:
-          children = self.run_with_retry(self.handle.get_children, txpath)
-        except kazoo.exceptions.NoNodeError:
-          pass
-
-        # Copy valid transaction ID for each updated key into valid list.
-        for child in children:
-          if re.match("^" + TX_UPDATEDKEY_PREFIX, child):
-            value = self.run_with_retry(self.handle.get,
-              PATH_SEPARATOR.join([txpath, child]))[0]
-            valuelist = value.split(PATH_SEPARATOR)
-            key = urllib.unquote_plus(valuelist[0])
-            vid = valuelist[1]
-            vtxroot = self.get_valid_transaction_root_path(app_id)
-
-            if not self.run_with_retry(self.handle.exists, vtxroot):
-              self.run_with_retry(self.handle.create, vtxroot, DEFAULT_VAL,
-                ZOO_ACL_OPEN, False, False, True)
-            vtxpath = self.get_valid_transaction_path(app_id, key)
-            self.run_with_retry(self.handle.create_async, vtxpath, str(vid),
-              ZOO_ACL_OPEN)
-
-      # Release the locks.
-      for lock in lock_list:
-        try:
-          self.run_with_retry(self.handle.delete, lock)
-        except kazoo.exceptions.NoNodeError:
-          # Try to delete all nodes, so skip any failure to release a lock.
-          pass  
-
-      if self.is_xg(app_id, txid):
-        try:
-          self.run_with_retry(self.handle.delete, self.get_xg_path(app_id,
-            txid))
-        except kazoo.exceptions.NoNodeError:
-          logging.error("No node error when trying to remove {0}".format(txid))
-
-      # Remove the transaction paths.
-      for item in self.run_with_retry(self.handle.get_children, txpath):
-        try:
-          self.run_with_retry(self.handle.delete,
-            PATH_SEPARATOR.join([txpath, item]))
-        except kazoo.exceptions.NoNodeError:
-          logging.error("No node error when trying to remove {0}".format(txid))
-
+        create_requests = [self.handle.create_async(PATH_SEPARATOR.join(
+          [blacklist_root, str(txid)]), value=now, acl=ZOO_ACL_OPEN,
+          makepath=True)]
+        self.add_to_blacklist_cache(app_id, txid)
+
+        value_requests = [self.handle.get_async(PATH_SEPARATOR.join(
+          [txpath, child])) for child in children
+          if re.match("^" + TX_UPDATEDKEY_PREFIX, child)]
+        for request in value_requests:
+          try:
+            value = request.get()[0]
+          except kazoo.exceptions.NoNodeError:
+            continue
+          valuelist = value.split(PATH_SEPARATOR)
+          key = urllib.unquote_plus(valuelist[0])
+          vid = valuelist[1]
+          vtxpath = self.get_valid_transaction_path(app_id, key)
+          create_requests.append(self.handle.create_async(vtxpath,
+            value=str(vid), acl=ZOO_ACL_OPEN, makepath=True))
+
+        for request in create_requests:
+          try:
+            request.get()
+          except kazoo.exceptions.NodeExistsError:
+            pass
+
+      # Release the locks and remove the transaction paths.
       logging.error("Notify failed transaction removing lock: {0}".\
         format(txpath))
-      self.run_with_retry(self.handle.delete, txpath)
+      self.delete_transaction_nodes(txpath, lock_list, children, index_path)
 
-    except ZKInternalException as zk_exception:
-      logging.exception(zk_exception)
-      return False
     except kazoo.exceptions.ZookeeperError as zk_exception:
       logging.exception(zk_exception)
       return False
@@ -1151,6 +1816,98 @@ class ZKTransaction:
       
     return True
 
+  def get_valid_transaction_keys(self, app_id):
+    """ Lists the entity keys that have a valid version registered, which
+    are the keys that failed transactions have written to.
+
+    Args:
+      app_id: A str representing the application ID.
+    Returns:
+      A set of the entity keys.
+    Raises:
+      ZKTransactionException: If the keys could not be listed.
+    """
+    if self.needs_connection:
+      self.reestablish_connection()
+
+    try:
+      children = self.run_with_retry(self.handle.get_children,
+        self.get_valid_transaction_root_path(app_id))
+    except kazoo.exceptions.NoNodeError:
+      return set()
+    except kazoo.exceptions.KazooException as kazoo_exception:
+      logging.exception(kazoo_exception)
+      self.reestablish_connection()
+      raise ZKTransactionException("Couldn't list the valid versions of " \
+        "app {0}".format(app_id))
+    return set(urllib.unquote_plus(child) for child in children)
+
+  def compact_blacklist(self, app_id, cutoff, live_txids, live_keys):
+    """ Removes the blacklisted transaction IDs and valid versions of an
+    application that no entity refers to any more.
+
+    Only entries last written before cutoff are removed, which leaves alone
+    the entities of transactions that failed since. A valid version that is
+    written again while it is being removed is kept.
+
+    Args:
+      app_id: A str representing the application ID.
+      cutoff: A float, the time before which entries can be removed.
+      live_txids: A set of the blacklisted transaction IDs that entities
+        still have as their versions.
+      live_keys: A set of the entity keys whose versions are still
+        blacklisted.
+    Returns:
+      A tuple of two ints, the numbers of blacklisted transaction IDs and
+      valid versions that were removed.
+    Raises:
+      ZKTransactionException: If the entries could not be removed.
+    """
+    if self.needs_connection:
+      self.reestablish_connection()
+
+    live_txids = set(str(txid) for txid in live_txids)
+    blacklist_root = self.get_blacklist_root_path(app_id)
+    valid_root = self.get_valid_transaction_root_path(app_id)
+    try:
+      candidates = []
+      for root, is_live in [
+          (blacklist_root, lambda child: child in live_txids),
+          (valid_root,
+           lambda child: urllib.unquote_plus(child) in live_keys)]:
+        try:
+          children = self.run_with_retry(self.handle.get_children, root)
+        except kazoo.exceptions.NoNodeError:
+          continue
+        candidates.extend((root, PATH_SEPARATOR.join([root, child]))
+          for child in children if not is_live(child))
+
+      stat_requests = [(root, path, self.handle.exists_async(path))
+        for root, path in candidates]
+      delete_requests = []
+      for root, path, request in stat_requests:
+        stat = request.get()
+        if stat is None or stat.mtime / 1000.0 >= cutoff:
+          continue
+        delete_requests.append((root, self.handle.delete_async(path,
+          version=stat.version)))
+
+      removed = {blacklist_root: 0, valid_root: 0}
+      for root, request in delete_requests:
+        try:
+          request.get()
+        except (kazoo.exceptions.NoNodeError,
+                kazoo.exceptions.BadVersionError):
+          continue
+        removed[root] += 1
+    except kazoo.exceptions.KazooException as kazoo_exception:
+      logging.exception(kazoo_exception)
+      self.reestablish_connection()
+      raise ZKTransactionException("Couldn't compact the blacklist of app " \
+        "{0}".format(app_id))
+
+    return removed[blacklist_root], removed[valid_root]
+
   def reestablish_connection(self):
     """ Checks the connection and resets it as needed. """
     logging.warning("Re-establishing ZooKeeper connection.")
@@ -1167,6 +1924,9 @@ class ZKTransaction:
       reconnect_error = True
       logging.exception(exception)
 
+    # Watches set on the old connection are gone.
+    self.drop_blacklist_cache()
+
     self.handle = kazoo.client.KazooClient(hosts=self.host,
       max_retries=self.DEFAULT_NUM_RETRIES, timeout=self.DEFAULT_ZK_TIMEOUT)
 
@@ -1365,13 +2125,173 @@ class ZKTransaction:
       return False
     return True
 
+  def get_index_build_lock_path(self, app_id, index_id):
+    """ Gets the path of the lock held while a composite index is built or
+    deleted.
+
+    Args:
+      app_id: The application ID.
+      index_id: The composite index ID.
+    Returns:
+      A str, the ZooKeeper path of the lock.
+    """
+    return PATH_SEPARATOR.join([INDEX_BUILD_LOCK_PATH,
+      urllib.quote_plus(app_id), str(index_id)])
+
+  def get_index_build_lock(self, app_id, index_id):
+    """ Tries to get the lock for building or deleting a composite index, so
+    that only one datastore server works on each index at a time.
+
+    Args:
+      app_id: The application ID.
+      index_id: The composite index ID.
+    Returns:
+      True if the lock was obtained, False otherwise.
+    """
+    lock_path = self.get_index_build_lock_path(app_id, index_id)
+    try:
+      now = str(time.time())
+      self.run_with_retry(self.handle.create, lock_path, value=now,
+        acl=ZOO_ACL_OPEN, ephemeral=True, makepath=True)
+    except kazoo.exceptions.NodeExistsError:
+      return False
+    except kazoo.exceptions.KazooException as kazoo_exception:
+      logging.exception(kazoo_exception)
+      self.reestablish_connection()
+      return False
+    except Exception as exception:
+      logging.exception(exception)
+      self.reestablish_connection()
+      return False
+    return True
+
+  def release_index_build_lock(self, app_id, index_id):
+    """ Releases the lock for building or deleting a composite index.
+
+    Args:
+      app_id: The application ID.
+      index_id: The composite index ID.
+    Returns:
+      True on success, False on system failures.
+    """
+    lock_path = self.get_index_build_lock_path(app_id, index_id)
+    try:
+      self.run_with_retry(self.handle.delete, lock_path)
+    except kazoo.exceptions.NoNodeError:
+      logging.warning("Index build lock {0} was already gone.".
+        format(lock_path))
+    except kazoo.exceptions.KazooException as kazoo_exception:
+      logging.exception(kazoo_exception)
+      self.reestablish_connection()
+      return False
+    except Exception as exception:
+      logging.exception(exception)
+      self.reestablish_connection()
+      return False
+    return True
+
   def execute_garbage_collection(self, app_id, app_path):
     """ Execute garbage collection for an application.
-    
+
+    Only the buckets of the expiry index whose transactions have all timed
+    out are visited. Every transaction is also checked by a full scan once
+    each GC_FULL_SCAN_INTERVAL, for any that never made it into the index.
+
     Args:
       app_id: The application ID.
       app_path: The application path. 
     """
+    self.collect_expired_transactions(app_id, app_path)
+
+    last_time = 0
+    full_scan_time_path = PATH_SEPARATOR.join([app_path,
+      GC_FULL_SCAN_TIME_PATH])
+    try:
+      last_time = float(self.run_with_retry(self.handle.get,
+        full_scan_time_path)[0])
+    except kazoo.exceptions.NoNodeError:
+      last_time = 0
+
+    if last_time + GC_FULL_SCAN_INTERVAL < time.time():
+      self.collect_all_transactions(app_id, app_path)
+      self.update_node(full_scan_time_path, str(time.time()))
+
+  def collect_expired_transactions(self, app_id, app_path):
+    """ Fails the timed out transactions in the buckets of the expiry index
+    that have expired, and removes those buckets.
+
+    Buckets are visited oldest first, so this stops at the first one that
+    has not expired. Transactions that finished are only in the index until
+    their bucket expires. How far behind the collector is and how much work
+    is left are kept in gc_stats.
+
+    Args:
+      app_id: The application ID.
+      app_path: The application path.
+    Raises:
+      KazooException: If the index could not be read or updated.
+    """
+    now = time.time()
+    stats = {'lag': 0, 'expired_buckets': 0, 'pending_buckets': 0,
+      'examined': 0, 'collected': 0}
+    self.gc_stats[app_id] = stats
+
+    expiry_root = PATH_SEPARATOR.join([app_path, APP_TX_EXPIRY_PATH])
+    txrootpath = PATH_SEPARATOR.join([app_path, APP_TX_PATH])
+    try:
+      buckets = sorted(self.run_with_retry(self.handle.get_children,
+        expiry_root))
+    except kazoo.exceptions.NoNodeError:
+      # There is no transaction yet.
+      return
+
+    for index, bucket in enumerate(buckets):
+      expires = long(bucket) + GC_BUCKET_SECONDS + TX_TIMEOUT
+      if expires >= now:
+        stats['pending_buckets'] = len(buckets) - index
+        break
+      stats['lag'] = max(stats['lag'], now - expires)
+      stats['expired_buckets'] += 1
+
+      bucket_path = PATH_SEPARATOR.join([expiry_root, bucket])
+      entries = self.run_with_retry(self.handle.get_children, bucket_path)
+      stats['examined'] += len(entries)
+      requests = [(entry, self.handle.get_async(PATH_SEPARATOR.join(
+        [txrootpath, entry]))) for entry in entries]
+      for entry, request in requests:
+        try:
+          txtime = float(request.get()[0])
+        except kazoo.exceptions.NoNodeError:
+          # The transaction has finished.
+          continue
+        # A transaction that started again after it was collected is also
+        # in a later bucket.
+        if txtime + TX_TIMEOUT < now:
+          self.notify_failed_transaction(app_id, long(entry.lstrip(
+            APP_TX_PREFIX)))
+          stats['collected'] += 1
+
+      self.__wait_for_deletes([self.handle.delete_async(PATH_SEPARATOR.join(
+        [bucket_path, entry])) for entry in entries])
+      try:
+        self.run_with_retry(self.handle.delete, bucket_path)
+      except kazoo.exceptions.NoNodeError:
+        pass
+      except kazoo.exceptions.NotEmptyError:
+        # A server with a slow clock added to it. It is visited again on the
+        # next run.
+        pass
+
+    logging.info("GC of app {0}: {1}".format(app_id, stats))
+
+  def collect_all_transactions(self, app_id, app_path):
+    """ Fails the timed out transactions of an application by reading the
+    start time of every one of them.
+
+    Args:
+      app_id: The application ID.
+      app_path: The application path.
+    """
     start = time.time()
     # Get the transaction ID list.
     txrootpath = PATH_SEPARATOR.join([app_path, APP_TX_PATH])
@@ -128,6 +128,20 @@ class ZKTransaction:
     """
     return long(target_txid)
 
+  def get_valid_version(self, app_id, entity_key):
+    """ Stub for getting the valid version registered for an entity.
+
+    Returns:
+      Always returns None, since nothing is ever blacklisted.
+    """
+    return None
+
+  def get_valid_transaction_ids(self, app_id, entity_versions):
+    """ This returns valid transaction ids for many entity keys at once.
+    """
+    return dict((entity_key, long(txid))
+                for entity_key, txid in entity_versions.iteritems())
+
   def register_updated_key(self, app_id, current_txid, target_txid, entity_key):
     """ Regist valid transaction id for entity.
 
@@ -143,6 +157,22 @@ class ZKTransaction:
     """
     return 
 
+  def get_valid_transaction_keys(self, app_id):
+    """ Stub for listing the entity keys that have a valid version.
+
+    Returns:
+      Always returns an empty set, since nothing is ever blacklisted.
+    """
+    return set()
+
+  def compact_blacklist(self, app_id, cutoff, live_txids, live_keys):
+    """ Stub for removing blacklist entries no entity refers to.
+
+    Returns:
+      Always returns (0, 0), since nothing is ever blacklisted.
+    """
+    return 0, 0
+
   def close(self):
     """ Stub function for closing all ZooKeeper connections. """
     return
@@ -175,3 +205,38 @@ class ZKTransaction:
       Always returns True.
     """
     return True
+
+  def get_index_build_lock(self, app_id, index_id):
+    """ Stub implementation for getting the lock for building a composite
+    index.
+
+    Returns:
+      Always returns True.
+    """
+    return True
+
+  def release_index_build_lock(self, app_id, index_id):
+    """ Stub for releasing the lock for building a composite index.
+
+    Returns:
+      Always returns True.
+    """
+    return True
+
+  def get_index_version(self, app_id):
+    """ Stub implementation for getting the version of the composite index
+    definitions of an application.
+
+    Returns:
+      Always returns None, so that the definitions are never cached.
+    """
+    return None
+
+  def update_index_version(self, app_id):
+    """ Stub for changing the version of the composite index definitions of
+    an application.
+
+    Returns:
+      Always returns True.
+    """
+    return True
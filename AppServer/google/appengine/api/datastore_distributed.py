@@ -145,10 +145,12 @@ class DatastoreDistributed(apiproxy_stub.APIProxyStub):
     """
     super(DatastoreDistributed, self).__init__(service_name)
 
-    # TODO lock any use of these global variables
     assert isinstance(app_id, basestring) and app_id != ''
     self.__app_id = app_id
     self.__datastore_location = datastore_location
+    # Guards the index cache, the cursor map and the transactional task
+    # actions, since API calls from request threads run concurrently.
+    self.__lock = threading.Lock()
     self.__index_cache = {}
     self.__is_encrypted = True
     res = self.__datastore_location.split(':')
@@ -162,8 +164,8 @@ class DatastoreDistributed(apiproxy_stub.APIProxyStub):
 
     self.__schema_cache = {}
 
-    self.__tx_actions_dict = {}
-    self.__tx_actions = set()
+    # Maps a transaction handle to the tasks to add when it commits.
+    self.__tx_actions = {}
 
     self.__queries = {}
 
@@ -176,9 +178,10 @@ class DatastoreDistributed(apiproxy_stub.APIProxyStub):
   def Clear(self):
     """ Clears the datastore by deleting all currently stored entities and
     queries. """
-    self.__entities = {}
-    self.__queries = {}
-    self.__schema_cache = {}
+    with self.__lock:
+      self.__entities = {}
+      self.__queries = {}
+      self.__schema_cache = {}
 
   def SetTrusted(self, trusted):
     """Set/clear the trusted bit in the stub.
@@ -308,7 +311,8 @@ class DatastoreDistributed(apiproxy_stub.APIProxyStub):
       1,
       self.__is_encrypted, 
       KEY_LOCATION,
-      CERT_LOCATION)
+      CERT_LOCATION,
+      keep_alive=True)
 
     if not api_response or not api_response.has_response():
       raise datastore_errors.InternalError(
@@ -328,20 +332,7 @@ class DatastoreDistributed(apiproxy_stub.APIProxyStub):
   def _Dynamic_Put(self, put_request, put_response):
     """Send a put request to the datastore server. """
     put_request.set_trusted(self.__trusted)
-    
-    ent_kinds = []
-    for ent in put_request.entity_list():
-      last_path = ent.key().path().element_list()[-1]
-      if last_path.type() not in ent_kinds:
-        ent_kinds.append(last_path.type())
-
-    for kind in ent_kinds:
-      indexes = self.__index_cache.get(kind)
-      if indexes:
-        for index in indexes:
-          new_composite = put_request.add_composite_index()
-          new_composite.CopyFrom(index)
-
+    # The datastore server looks up the composite indexes to write itself.
     self._RemoteSend(put_request, put_response, "Put")
     return put_response 
 
@@ -360,33 +351,39 @@ class DatastoreDistributed(apiproxy_stub.APIProxyStub):
     Returns:
       A datastore_pb.DeleteResponse from the AppScale datastore server.
     """
-    # Determine if there are composite indexes that need to be deleted.
-    # The datastore service will look up meta data to figure out which
-    # composite indexes apply.
-    ent_kinds = []
-    for key in delete_request.key_list():
-      last_path = key.path().element_list()[-1]
-      if last_path.type() not in ent_kinds:
-        ent_kinds.append(last_path.type())
- 
-    has_composites = False
-    for kind in ent_kinds:
-      indexes = self.__index_cache.get(kind)
-      if indexes:
-        has_composites = True
-        break
-
-    if has_composites:
-      delete_request.set_mark_changes(True)
-
+    # The datastore server looks up the composite indexes to delete itself.
     delete_request.set_trusted(self.__trusted)
     self._RemoteSend(delete_request, delete_response, "Delete")
     return delete_response
 
+  def __GetIndexes(self, kind):
+    """ Returns a snapshot of the composite indexes cached for a kind.
+
+    Args:
+      kind: A str, the entity kind.
+    Returns:
+      A list of entity_pb.CompositeIndex.
+    """
+    with self.__lock:
+      return list(self.__index_cache.get(kind, []))
+
+  def __AddToIndexCache(self, index):
+    """ Adds a composite index to the index cache.
+
+    Args:
+      index: An entity_pb.CompositeIndex.
+    """
+    ent_kind = index.definition().entity_type()
+    with self.__lock:
+      self.__index_cache.setdefault(ent_kind, []).append(index)
+
   def __cleanup_old_cursors(self):
-    """ Remove any cursors which are no longer being used. """
+    """ Remove any cursors which are no longer being used. 
+
+    The caller must hold self.__lock.
+    """
     for key in self.__queries.keys():
-      _, time_stamp = self.__queries[key]
+      _, time_stamp, _ = self.__queries[key]
       # This calculates the time in the future when this cursor is no longer 
       # valid.
       timeout_time = time_stamp + datetime.timedelta(seconds=CURSOR_TIMEOUT)
@@ -413,21 +410,13 @@ class DatastoreDistributed(apiproxy_stub.APIProxyStub):
     # Set the composite index if it applies.
     indexes = []
     if query.has_kind():
-      kind_indexes = self.__index_cache.get(query.kind())
-      if kind_indexes:
-        indexes.extend(kind_indexes)
+      indexes.extend(self.__GetIndexes(query.kind()))
    
     index_to_use = _FindIndexToUse(query, indexes)
     if index_to_use != None:
       new_index = query.add_composite_index()
       new_index.MergeFrom(index_to_use)
 
-    self._RemoteSend(query, query_response, "RunQuery")
-
-    skipped_results = 0
-    if query_response.has_skipped_results():
-      skipped_results = query_response.skipped_results()
-
     def order_compare_entities(a, b):
       """ Return a negative, zero or positive number depending on whether
       entity a is considered smaller than, equal to, or larger than b,
@@ -488,17 +477,26 @@ class DatastoreDistributed(apiproxy_stub.APIProxyStub):
       else:
         return cmp(x_type, y_type)
 
-    results = query_response.result_list()
-    for result in results:
-      old_datastore_stub_util.PrepareSpecialPropertiesForLoad(result)
-
     old_datastore_stub_util.ValidateQuery(query, filters, orders,
           _MAX_QUERY_COMPONENTS)
 
-    cursor = old_datastore_stub_util.ListCursor(query, results,
-                                            order_compare_entities_pb)
-    self.__cleanup_old_cursors() 
-    self.__queries[cursor.cursor] = cursor, datetime.datetime.now()
+    if _CanStreamQuery(query):
+      cursor = StreamingCursor(query, self.__RunQueryBatch)
+      offset = query.offset()
+    else:
+      self._RemoteSend(query, query_response, "RunQuery")
+      results = query_response.result_list()
+      for result in results:
+        old_datastore_stub_util.PrepareSpecialPropertiesForLoad(result)
+      cursor = old_datastore_stub_util.ListCursor(query, results,
+                                              order_compare_entities_pb)
+      # The datastore server has already applied the offset.
+      offset = 0
+
+    with self.__lock:
+      self.__cleanup_old_cursors()
+      self.__queries[cursor.cursor] = (cursor, datetime.datetime.now(),
+                                       threading.Lock())
 
     if query.has_count():
       count = query.count()
@@ -507,9 +505,10 @@ class DatastoreDistributed(apiproxy_stub.APIProxyStub):
     else:
       count = _BATCH_SIZE
 
-    cursor.PopulateQueryResult(query_result, count,
-                               query.offset(), compile=query.compile())
-    query_result.set_skipped_results(skipped_results)
+    cursor.PopulateQueryResult(query_result, count, offset,
+                               compile=query.compile())
+    if query_response.has_skipped_results():
+      query_result.set_skipped_results(query_response.skipped_results())
     if query.compile():
       compiled_query = query_result.mutable_compiled_query()
       compiled_query.set_keys_only(query.keys_only())
@@ -520,29 +519,59 @@ class DatastoreDistributed(apiproxy_stub.APIProxyStub):
     self.__ValidateAppId(next_request.cursor().app())
 
     cursor_handle = next_request.cursor().cursor()
-    if cursor_handle not in self.__queries:
-      raise apiproxy_errors.ApplicationError(
-            datastore_pb.Error.BAD_REQUEST, 
-            'Cursor %d not found' % cursor_handle)
- 
-    cursor, _ = self.__queries[cursor_handle]
-    if cursor.cursor != cursor_handle:
-      raise apiproxy_errors.ApplicationError(
-            datastore_pb.Error.BAD_REQUEST, 
-            'Cursor %d not found' % cursor_handle)
-
-    assert cursor.app == next_request.cursor().app()
     count = _BATCH_SIZE
     if next_request.has_count():
       count = next_request.count()
-    cursor.PopulateQueryResult(query_result, count,
-                               next_request.offset(),
-                               next_request.compile())
+
+    with self.__lock:
+      if cursor_handle not in self.__queries:
+        raise apiproxy_errors.ApplicationError(
+              datastore_pb.Error.BAD_REQUEST, 
+              'Cursor %d not found' % cursor_handle)
+   
+      cursor, _, cursor_lock = self.__queries[cursor_handle]
+      if cursor.cursor != cursor_handle:
+        raise apiproxy_errors.ApplicationError(
+              datastore_pb.Error.BAD_REQUEST, 
+              'Cursor %d not found' % cursor_handle)
+
+      assert cursor.app == next_request.cursor().app()
+      # A cursor that is still being read has not been abandoned.
+      self.__queries[cursor_handle] = (cursor, datetime.datetime.now(),
+                                       cursor_lock)
+
+    # Cursors advance as they are read, so reads of one cursor from
+    # different threads are serialized. Batches may be fetched remotely, so
+    # this happens outside of the stub lock.
+    with cursor_lock:
+      cursor.PopulateQueryResult(query_result, count,
+                                 next_request.offset(),
+                                 next_request.compile())
+
+  def __RunQueryBatch(self, query):
+    """ Fetches one batch of results for a streaming cursor.
+
+    Args:
+      query: A datastore_pb.Query with the limit and offset of the batch.
+    Returns:
+      A datastore_pb.QueryResult from the datastore server.
+    """
+    query_response = datastore_pb.QueryResult()
+    self._RemoteSend(query, query_response, "RunQuery")
+    for result in query_response.result_list():
+      old_datastore_stub_util.PrepareSpecialPropertiesForLoad(result)
+    return query_response
 
   def _Dynamic_Count(self, query, integer64proto):
     """Get the number of entities for a query. """
+    # Counting needs no entities, so the datastore server can answer from
+    # its indexes.
+    count_query = datastore_pb.Query()
+    count_query.CopyFrom(query)
+    count_query.set_keys_only(True)
+    count_query.clear_property_name()
     query_result = datastore_pb.QueryResult()
-    self._Dynamic_RunQuery(query, query_result)
+    self._Dynamic_RunQuery(count_query, query_result)
     count = query_result.result_size()
     integer64proto.set_value(count)
 
@@ -550,7 +579,8 @@ class DatastoreDistributed(apiproxy_stub.APIProxyStub):
     """Send a begin transaction request from the datastore server. """
     request.set_app(self.__app_id)
     self._RemoteSend(request, transaction, "BeginTransaction")
-    self.__tx_actions = []
+    with self.__lock:
+      self.__tx_actions[transaction.handle()] = []
     return transaction
 
   def _Dynamic_AddActions(self, request, _):
@@ -560,12 +590,10 @@ class DatastoreDistributed(apiproxy_stub.APIProxyStub):
       request: A taskqueue_service_pb.TaskQueueBulkAddRequest containing the
           tasks that should be created when the transaction is comitted.
     """
-    if ((len(self.__tx_actions) + request.add_request_size()) >
-        _MAX_ACTIONS_PER_TXN):
-      raise apiproxy_errors.ApplicationError(
-          datastore_pb.Error.BAD_REQUEST,
-          'Too many messages, maximum allowed %s' % _MAX_ACTIONS_PER_TXN)
+    if request.add_request_size() == 0:
+      return
 
+    handle = request.add_request(0).transaction().handle()
     new_actions = []
     for add_request in request.add_request_list():
       clone = taskqueue_service_pb.TaskQueueAddRequest()
@@ -573,7 +601,13 @@ class DatastoreDistributed(apiproxy_stub.APIProxyStub):
       clone.clear_transaction()
       new_actions.append(clone)
 
-    self.__tx_actions.extend(new_actions)
+    with self.__lock:
+      tx_actions = self.__tx_actions.setdefault(handle, [])
+      if len(tx_actions) + len(new_actions) > _MAX_ACTIONS_PER_TXN:
+        raise apiproxy_errors.ApplicationError(
+            datastore_pb.Error.BAD_REQUEST,
+            'Too many messages, maximum allowed %s' % _MAX_ACTIONS_PER_TXN)
+      tx_actions.extend(new_actions)
 
 
   def _Dynamic_Commit(self, transaction, transaction_response):
@@ -581,26 +615,27 @@ class DatastoreDistributed(apiproxy_stub.APIProxyStub):
         datastore server. """
     transaction.set_app(self.__app_id)
 
-    self._RemoteSend(transaction, transaction_response, "Commit")
-
-    response = taskqueue_service_pb.TaskQueueAddResponse()
     try:
-      for action in self.__tx_actions:
-        try:
-          apiproxy_stub_map.MakeSyncCall(
-              'taskqueue', 'Add', action, response)
-        except apiproxy_errors.ApplicationError, e:
-          logging.warning('Transactional task %s has been dropped, %s',
-                          action, e)
-
+      self._RemoteSend(transaction, transaction_response, "Commit")
     finally:
-      self.__tx_actions = []
+      with self.__lock:
+        tx_actions = self.__tx_actions.pop(transaction.handle(), [])
+
+    response = taskqueue_service_pb.TaskQueueAddResponse()
+    for action in tx_actions:
+      try:
+        apiproxy_stub_map.MakeSyncCall(
+            'taskqueue', 'Add', action, response)
+      except apiproxy_errors.ApplicationError, e:
+        logging.warning('Transactional task %s has been dropped, %s',
+                        action, e)
    
   def _Dynamic_Rollback(self, transaction, transaction_response):
     """ Send a rollback request to the datastore server. """
     transaction.set_app(self.__app_id)
  
-    self.__tx_actions = []
+    with self.__lock:
+      self.__tx_actions.pop(transaction.handle(), None)
     self._RemoteSend(transaction, transaction_response, "Rollback")
  
     return transaction_response
@@ -785,17 +820,14 @@ class DatastoreDistributed(apiproxy_stub.APIProxyStub):
         self._Dynamic_DeleteIndex(index, api_base_pb.VoidProto())
         deleted += 1
 
-    # Add existing indexes in the index cache.
+    # Add existing indexes in the index cache, leaving out the ones that
+    # were just deleted so that no more rows are written for them.
     for key, index in existing.iteritems():
+      if key not in requested:
+        continue
       new_index = entity_pb.CompositeIndex()
       new_index.CopyFrom(index)
-      ent_kind = new_index.definition().entity_type()
-      if ent_kind in self.__index_cache:
-        new_indexes = self.__index_cache[ent_kind]
-        new_indexes.append(new_index)
-        self.__index_cache[ent_kind] = new_indexes
-      else:
-        self.__index_cache[ent_kind] = [new_index]
+      self.__AddToIndexCache(new_index)
   
     # Compared the existing indexes to the requested ones and create any
     # new indexes requested.
@@ -809,20 +841,136 @@ class DatastoreDistributed(apiproxy_stub.APIProxyStub):
         new_index.set_state(entity_pb.CompositeIndex.READ_WRITE)
         self._Dynamic_UpdateIndex(new_index, api_base_pb.VoidProto())
         created += 1
-  
-        ent_kind = new_index.definition().entity_type()
-        if ent_kind in self.__index_cache:
-          new_indexes = self.__index_cache[ent_kind]
-     
-          new_indexes.append(new_index)
-          self.__index_cache[ent_kind] = new_indexes
-        else:
-          self.__index_cache[ent_kind] = [new_index]
+        self.__AddToIndexCache(new_index)
 
     if created or deleted:
       logging.info('Created %d and deleted %d index(es); total %d',
                     created, deleted, len(requested))
 
+class StreamingCursor(old_datastore_stub_util.BaseCursor):
+  """ A query cursor that fetches results from the datastore server as they
+  are read.
+
+  Each batch is a new query that resumes from the compiled cursor the
+  datastore server returned for the previous batch. No results are held
+  between reads, and any datastore server can serve the next batch.
+
+  Public properties:
+    keys_only: whether the query is keys_only
+  """
+
+  def __init__(self, query, run_query):
+    """Constructor.
+
+    Args:
+      query: The datastore_pb.Query to fetch results for.
+      run_query: A function that takes a datastore_pb.Query and returns the
+        datastore_pb.QueryResult from the datastore server.
+    """
+    super(StreamingCursor, self).__init__(query.app())
+    self.__query = datastore_pb.Query()
+    self.__query.CopyFrom(query)
+    self.__query.clear_offset()
+    self.__query.clear_limit()
+    self.__query.clear_count()
+    self.__run_query = run_query
+
+    # The number of results left to return, or None if there is no limit.
+    # Results skipped by an offset do not count towards the limit.
+    self.__remaining = None
+    if query.has_limit():
+      self.__remaining = query.limit()
+    self.__more_results = True
+
+    self.keys_only = query.keys_only()
+
+  def __FetchBatch(self, result, count, offset):
+    """Fetches the next batch of results into a QueryResult.
+
+    Args:
+      result: datastore_pb.QueryResult
+      count: integer of how many results to return
+      offset: integer of how many results to skip
+    """
+    batch = datastore_pb.Query()
+    batch.CopyFrom(self.__query)
+    if count:
+      batch.set_offset(offset)
+      batch.set_limit(count)
+    else:
+      # The datastore server reads a limit of zero as no limit, so skipped
+      # results are fetched as results and dropped here. Only their keys are
+      # needed for that.
+      batch.set_limit(offset)
+      batch.set_keys_only(True)
+      batch.clear_property_name()
+    response = self.__run_query(batch)
+
+    if response.has_compiled_cursor():
+      self.__query.mutable_compiled_cursor().CopyFrom(
+        response.compiled_cursor())
+
+    results = response.result_list()
+    skipped = response.skipped_results()
+    if not count:
+      skipped = len(results)
+      results = []
+    if skipped:
+      result.set_skipped_results(skipped)
+    result.result_list().extend(results)
+
+    self.__more_results = response.more_results()
+    if self.__remaining is not None and count:
+      self.__remaining -= len(results)
+      if self.__remaining <= 0:
+        self.__more_results = False
+
+  def PopulateQueryResult(self, result, count, offset, compile=False):
+    """Populates a QueryResult with this cursor and the given number of results.
+
+    Args:
+      result: datastore_pb.QueryResult
+      count: integer of how many results to return
+      offset: integer of how many results to skip
+      compile: boolean, whether we are compiling this query
+    """
+    limited_offset = min(offset, old_datastore_stub_util._MAX_QUERY_OFFSET)
+    if offset != limited_offset:
+      count = 0
+    count = min(count, old_datastore_stub_util._MAXIMUM_RESULTS)
+    if self.__remaining is not None:
+      count = min(count, self.__remaining)
+
+    if self.__more_results and (count or limited_offset):
+      self.__FetchBatch(result, count, limited_offset)
+    elif self.__remaining == 0:
+      # Only skipping was left, and there is nothing more to skip.
+      self.__more_results = False
+
+    result.set_keys_only(self.keys_only)
+    result.set_more_results(self.__more_results)
+    self.PopulateCursor(result)
+    if compile and self.__query.has_compiled_cursor():
+      result.mutable_compiled_cursor().CopyFrom(self.__query.compiled_cursor())
+
+def _CanStreamQuery(query):
+  """ Checks if a query's results can be fetched a batch at a time.
+
+  Transactional reads are fetched at once. Ancestor queries with sort orders
+  are sorted in memory by the datastore server and cannot be resumed from a
+  cursor, and end cursors are only applied by the stub.
+
+  Args:
+    query: A datastore_pb.Query.
+  Returns:
+    True if the query can be streamed, False otherwise.
+  """
+  if query.has_transaction() or query.has_end_compiled_cursor():
+    return False
+  if query.has_ancestor() and query.order_size() > 0:
+    return False
+  return True
+
 def _FindIndexToUse(query, indexes):
   """ Matches the query with one of the composite indexes. 
 
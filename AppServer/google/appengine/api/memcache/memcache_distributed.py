@@ -19,10 +19,14 @@
 Uses the python-memcached library to interface with memcached.
 """
 import base64
-import cPickle
+import bisect
+import hashlib
 import logging
 import memcache
 import os
+import socket
+import struct
+import threading
 import time
 
 from google.appengine.api import apiproxy_stub
@@ -36,7 +40,287 @@ MemcacheIncrementResponse = memcache_service_pb.MemcacheIncrementResponse
 MemcacheDeleteResponse = memcache_service_pb.MemcacheDeleteResponse
 
 from google.appengine.api.memcache import TYPE_INT
-from google.appengine.api.memcache import TYPE_LONG
+
+# Increments wrap around at this value, as they do in memcached.
+MAX_INCREMENT_VALUE = 2 ** 64
+
+# Maps set policies to the memcached storage command which implements them.
+SET_POLICY_COMMANDS = {
+  MemcacheSetRequest.SET: 'set',
+  MemcacheSetRequest.ADD: 'add',
+  MemcacheSetRequest.REPLACE: 'replace',
+  MemcacheSetRequest.CAS: 'cas',
+}
+
+# Maps memcached storage replies to set statuses.
+SET_STATUSES = {
+  'STORED': MemcacheSetResponse.STORED,
+  'NOT_STORED': MemcacheSetResponse.NOT_STORED,
+  'EXISTS': MemcacheSetResponse.EXISTS,
+  'NOT_FOUND': MemcacheSetResponse.NOT_STORED,
+}
+
+# The number of points each memcached server gets on the hash ring. More
+# points spread keys more evenly across servers.
+VIRTUAL_NODES = 160
+
+
+class HashRing(object):
+  """ A ketama-style consistent hash ring.
+
+  Every node is hashed onto a ring of 32-bit points several times, and a key
+  belongs to the first node found walking clockwise from the key's own
+  point. Adding or removing one of N nodes only moves about 1/N of the keys.
+  """
+
+  def __init__(self, nodes, virtual_nodes=VIRTUAL_NODES):
+    """ Constructor.
+
+    Args:
+      nodes: A list of strs, the names of the nodes on the ring.
+      virtual_nodes: The number of points each node gets on the ring.
+    """
+    self.nodes = list(nodes)
+    points = []
+    for node in self.nodes:
+      # Each MD5 digest provides four points.
+      for replica in range(virtual_nodes / 4):
+        digest = hashlib.md5('{0}-{1}'.format(node, replica)).digest()
+        for offset in range(0, 16, 4):
+          point = struct.unpack('<I', digest[offset:offset + 4])[0]
+          points.append((point, node))
+    points.sort()
+    self.__points = [point for point, _ in points]
+    self.__owners = [node for _, node in points]
+
+  @staticmethod
+  def hash_key(key):
+    """ Maps a key onto the ring.
+
+    Args:
+      key: A str.
+    Returns:
+      An int, the key's point on the ring.
+    """
+    return struct.unpack('<I', hashlib.md5(key).digest()[:4])[0]
+
+  def get_nodes(self, key):
+    """ Yields the nodes responsible for a key, in failover order.
+
+    Args:
+      key: A str.
+    Yields:
+      Each distinct node once, starting with the key's owner.
+    """
+    if not self.__points:
+      return
+    start = bisect.bisect(self.__points, self.hash_key(key))
+    seen = set()
+    for index in xrange(start, start + len(self.__points)):
+      node = self.__owners[index % len(self.__points)]
+      if node not in seen:
+        seen.add(node)
+        yield node
+        if len(seen) == len(self.nodes):
+          return
+
+  def get_node(self, key):
+    """ Returns the node which owns a key, or None if the ring is empty.
+
+    Args:
+      key: A str.
+    """
+    for node in self.get_nodes(key):
+      return node
+    return None
+
+
+class MemcacheClient(memcache.Client):
+  """ A memcache client that pipelines multi-key operations.
+
+  Values are stored as raw strings with the application's flags kept in the
+  memcached flags field, so CAS ids and increments are handled natively by
+  memcached. Each multi-key call sends all of its commands to a server in one
+  write and then reads the replies back in order. Keys are placed on servers
+  with a consistent hash ring rather than modulo hashing.
+  """
+
+  def set_servers(self, servers, version=0):
+    """ Sets the servers this client uses.
+
+    Args:
+      servers: A list of strs, the "host:port" of each memcached server.
+      version: An int identifying this list of servers.
+    """
+    memcache.Client.set_servers(self, servers)
+    self.servers_version = version
+    self.__hosts = dict(zip(servers, self.servers))
+    self.__ring = HashRing(servers)
+
+  def _get_server(self, key):
+    """ Finds the live server which should hold a key.
+
+    If the key's server is down, the next server on the ring is used.
+
+    Args:
+      key: A str, or a (hash, key) tuple whose hash is ignored.
+    Returns:
+      A (server, key) tuple, or (None, None) if no server is available.
+    """
+    if isinstance(key, tuple):
+      _, key = key
+    for name in self.__ring.get_nodes(key):
+      server = self.__hosts[name]
+      if server.connect():
+        return server, key
+    return None, None
+
+  def _group_by_server(self, keys):
+    """ Groups keys by the server that holds them.
+
+    Args:
+      keys: A list of memcache keys.
+    Returns:
+      A list of (server, [(index, key)]) tuples, where index is the position
+      of the key in the given list. Keys without a live server are left out.
+    """
+    servers = {}
+    order = []
+    for index, key in enumerate(keys):
+      server, key = self._get_server(key)
+      if server is None:
+        continue
+      if len(key) > memcache.SERVER_MAX_KEY_LENGTH:
+        # memcached would reject the whole command.
+        logging.warning('Skipping key longer than {0} bytes: {1}'.format(
+          memcache.SERVER_MAX_KEY_LENGTH, key))
+        continue
+      if server not in servers:
+        servers[server] = []
+        order.append(server)
+      servers[server].append((index, key))
+    return [(server, servers[server]) for server in order]
+
+  def gets_multi(self, keys):
+    """ Fetches several keys along with their flags and CAS ids.
+
+    Args:
+      keys: A list of memcache keys.
+    Returns:
+      A dict mapping each key found to a (flags, value, cas_id) tuple.
+    """
+    results = {}
+    for server, indexed_keys in self._group_by_server(keys):
+      try:
+        server.send_cmd('gets ' + ' '.join(key for _, key in indexed_keys))
+        line = server.readline()
+        while line and line != 'END':
+          if not line.startswith('VALUE '):
+            # An error ends the reply. The connection is closed in case
+            # anything was left unread on it.
+            logging.warning('Unable to get keys: {0}'.format(line))
+            server.close_socket()
+            break
+          _, key, flags, length, cas_id = line.split()
+          value = server.recv(int(length) + 2)[:-2]
+          results[key] = (int(flags), value, long(cas_id))
+          line = server.readline()
+      except (socket.error, memcache._Error), error:
+        server.mark_dead(str(error))
+    return results
+
+  def store_multi(self, items):
+    """ Runs several storage commands.
+
+    Args:
+      items: A list of (command, key, flags, value, expiration, cas_id)
+        tuples, where command is one of 'set', 'add', 'replace' or 'cas'.
+        cas_id is only used by 'cas'.
+    Returns:
+      A list with one reply per item, such as 'STORED' or 'EXISTS', or None
+      if the server could not be reached.
+    """
+    replies = [None] * len(items)
+    keys = [item[1] for item in items]
+    for server, indexed_keys in self._group_by_server(keys):
+      commands = []
+      for index, key in indexed_keys:
+        command, _, flags, value, expiration, cas_id = items[index]
+        header = '%s %s %d %d %d' % (command, key, flags, expiration,
+                                     len(value))
+        if command == 'cas':
+          header += ' %d' % cas_id
+        commands.append('%s\r\n%s\r\n' % (header, value))
+      try:
+        server.send_cmds(''.join(commands))
+        for index, _ in indexed_keys:
+          reply = server.readline()
+          if reply == 'ERROR' or reply.startswith('CLIENT_ERROR'):
+            # memcached may read the value of a rejected command as another
+            # command, so later replies cannot be matched to their items.
+            logging.warning('Unable to store {0}: {1}'.format(keys[index],
+              reply))
+            server.close_socket()
+            break
+          replies[index] = reply or None
+      except (socket.error, memcache._Error), error:
+        server.mark_dead(str(error))
+    return replies
+
+  def delete_each(self, keys):
+    """ Deletes several keys.
+
+    Unlike delete_multi, this reports the outcome for every key.
+
+    Args:
+      keys: A list of memcache keys.
+    Returns:
+      A list with one reply per key, 'DELETED' or 'NOT_FOUND', or None if the
+      server could not be reached.
+    """
+    replies = [None] * len(keys)
+    for server, indexed_keys in self._group_by_server(keys):
+      try:
+        server.send_cmds(''.join('delete %s\r\n' % key
+                                 for _, key in indexed_keys))
+        for index, _ in indexed_keys:
+          replies[index] = server.readline() or None
+      except (socket.error, memcache._Error), error:
+        server.mark_dead(str(error))
+    return replies
+
+  def incr_multi(self, items):
+    """ Runs several increment and decrement commands.
+
+    Args:
+      items: A list of (command, key, delta) tuples, where command is 'incr'
+        or 'decr'.
+    Returns:
+      A list with one reply per item: the new value as a long, 'NOT_FOUND',
+      or None if the item could not be changed.
+    """
+    replies = [None] * len(items)
+    keys = [item[1] for item in items]
+    for server, indexed_keys in self._group_by_server(keys):
+      commands = []
+      for index, key in indexed_keys:
+        command, _, delta = items[index]
+        commands.append('%s %s %d\r\n' % (command, key, delta))
+      try:
+        server.send_cmds(''.join(commands))
+        for index, _ in indexed_keys:
+          line = server.readline()
+          if line.isdigit():
+            replies[index] = long(line)
+          elif line == 'NOT_FOUND':
+            replies[index] = line
+          elif line:
+            logging.warning('Unable to change {0}: {1}'.format(
+              keys[index], line))
+      except (socket.error, memcache._Error), error:
+        server.mark_dead(str(error))
+    return replies
+
 
 class MemcacheService(apiproxy_stub.APIProxyStub):
   """Python only memcache service.
@@ -64,20 +348,70 @@ class MemcacheService(apiproxy_stub.APIProxyStub):
     super(MemcacheService, self).__init__(service_name)
     self._gettime = gettime
     self._memcache = None
+    self._servers = []
+    self._servers_version = 0
+    self._servers_lock = threading.Lock()
+    self._last_update = 0
+    self._memcache_file_mtime = None
     self.setupMemcacheClient()
 
   def setupMemcacheClient(self):
     """ Sets up the memcache client. """
+    self._servers = self._ReadServers()
+    self._last_update = self._gettime()
+    self._memcache = MemcacheClient(self._servers, debug=0)
+
+  def _ReadServers(self):
+    """ Reads the list of memcached servers from the AppScale memcache file.
+
+    Returns:
+      A sorted list of strs, the "host:port" of each server.
+    """
     if os.path.exists(self.APPSCALE_MEMCACHE_FILE):
+      self._memcache_file_mtime = os.path.getmtime(self.APPSCALE_MEMCACHE_FILE)
       memcache_file = open(self.APPSCALE_MEMCACHE_FILE, "r")
       all_ips = memcache_file.read().split("\n")
       memcache_file.close()
     else:
+      self._memcache_file_mtime = None
       all_ips = ['localhost']
 
     memcaches = [ip + ":" + self.MEMCACHE_PORT for ip in all_ips if ip != '']
     memcaches.sort()    
-    self._memcache = memcache.Client(memcaches, debug=0)
+    return memcaches
+
+  def _MaybeUpdateServers(self):
+    """ Picks up memcached servers that were added or removed.
+
+    The memcache file is checked at most once per UPDATE_WINDOW. Since the
+    client keeps separate state for each thread, each thread's client
+    switches to the new servers on its next call.
+    """
+    now = self._gettime()
+    with self._servers_lock:
+      if now - self._last_update >= self.UPDATE_WINDOW:
+        self._last_update = now
+        mtime = None
+        if os.path.exists(self.APPSCALE_MEMCACHE_FILE):
+          mtime = os.path.getmtime(self.APPSCALE_MEMCACHE_FILE)
+        if mtime != self._memcache_file_mtime:
+          servers = self._ReadServers()
+          if servers != self._servers:
+            logging.info('Memcache servers changed from {0} to {1}'.format(
+              self._servers, servers))
+            self._servers = servers
+            self._servers_version += 1
+      servers, version = self._servers, self._servers_version
+
+    if self._memcache.servers_version != version:
+      self._memcache.set_servers(servers, version)
+
+  def MakeSyncCall(self, service, call, request, response, request_id=None):
+    """ The main RPC entry point. Updates the memcached servers if needed.
+    """
+    self._MaybeUpdateServers()
+    super(MemcacheService, self).MakeSyncCall(service, call, request,
+                                              response, request_id)
 
   def _Dynamic_Get(self, request, response):
     """Implementation of gets for memcache.
@@ -86,17 +420,16 @@ class MemcacheService(apiproxy_stub.APIProxyStub):
       request: A MemcacheGetRequest protocol buffer.
       response: A MemcacheGetResponse protocol buffer.
     """
-    for key in set(request.key_list()):
-      internal_key = self._GetKey(request.name_space(), key)
-      value = self._memcache.get(internal_key)
-      if value is None:
+    keys = list(set(request.key_list()))
+    internal_keys = [self._GetKey(request.name_space(), key) for key in keys]
+    results = self._memcache.gets_multi(internal_keys)
+    for key, internal_key in zip(keys, internal_keys):
+      if internal_key not in results:
         continue
-      flags = 0
-      stored_flags, cas_id, stored_value = cPickle.loads(value)
-      flags |= stored_flags
+      flags, value, cas_id = results[internal_key]
       item = response.add_item()
       item.set_key(key)
-      item.set_value(stored_value)
+      item.set_value(value)
       item.set_flags(flags)
       if request.for_cas():
         item.set_cas_id(cas_id)
@@ -108,42 +441,26 @@ class MemcacheService(apiproxy_stub.APIProxyStub):
       request: A MemcacheSetRequest.
       response: A MemcacheSetResponse.
     """
+    items = []
+    positions = []
+    statuses = []
     for item in request.item_list():
-      key = self._GetKey(request.name_space(), item.key())
       set_policy = item.set_policy()
-      old_entry = self._memcache.get(key)
-      cas_id = 0
-      if old_entry:
-        _, cas_id, _ = cPickle.loads(old_entry)
-      set_status = MemcacheSetResponse.NOT_STORED
-
-      if ((set_policy == MemcacheSetRequest.SET) or
-        (set_policy == MemcacheSetRequest.ADD and old_entry is None) or
-        (set_policy == MemcacheSetRequest.REPLACE and
-        old_entry is not None)):
-
-        if (old_entry is None or set_policy == MemcacheSetRequest.SET):
-          set_status = MemcacheSetResponse.STORED
-
-      elif (set_policy == MemcacheSetRequest.CAS and item.for_cas() and
-        item.has_cas_id()):
-        if old_entry is None:
-          set_status = MemcacheSetResponse.NOT_STORED
-        elif cas_id != item.cas_id():
-          set_status = MemcacheSetResponse.EXISTS
-        else:
-          set_status = MemcacheSetResponse.STORED
-
-      if (set_status == MemcacheSetResponse.STORED
-        or set_policy == MemcacheSetRequest.REPLACE):
-
-        set_value = cPickle.dumps(
-          [item.flags(), cas_id + 1, item.value()])
-        if set_policy == MemcacheSetRequest.REPLACE:
-          self._memcache.replace(key, set_value)
-        else:
-          self._memcache.set(key, set_value, item.expiration_time())
+      statuses.append(MemcacheSetResponse.NOT_STORED)
+      # A compare-and-set needs the CAS id the caller read the item with.
+      if (set_policy == MemcacheSetRequest.CAS and
+          not (item.for_cas() and item.has_cas_id())):
+        continue
+      key = self._GetKey(request.name_space(), item.key())
+      items.append((SET_POLICY_COMMANDS[set_policy], key, item.flags(),
+                    item.value(), item.expiration_time(), item.cas_id()))
+      positions.append(len(statuses) - 1)
+
+    replies = self._memcache.store_multi(items)
+    for position, reply in zip(positions, replies):
+      statuses[position] = SET_STATUSES.get(reply, MemcacheSetResponse.ERROR)
 
+    for set_status in statuses:
       response.add_set_status(set_status)
 
   def _Dynamic_Delete(self, request, response):
@@ -153,62 +470,95 @@ class MemcacheService(apiproxy_stub.APIProxyStub):
       request: A MemcacheDeleteRequest protocol buffer.
       response: A MemcacheDeleteResponse protocol buffer.
     """
-    for item in request.item_list():
-      key = self._GetKey(request.name_space(), item.key())
-      entry = self._memcache.get(key)
-      delete_status = MemcacheDeleteResponse.DELETED
-
-      if entry is None:
-        delete_status = MemcacheDeleteResponse.NOT_FOUND
+    keys = [self._GetKey(request.name_space(), item.key())
+            for item in request.item_list()]
+    for reply in self._memcache.delete_each(keys):
+      if reply == 'DELETED':
+        response.add_delete_status(MemcacheDeleteResponse.DELETED)
       else:
-        self._memcache.delete(key)
-
-      response.add_delete_status(delete_status)
+        response.add_delete_status(MemcacheDeleteResponse.NOT_FOUND)
 
-  def _Increment(self, namespace, request):
-    """Internal function for incrementing from a MemcacheIncrementRequest.
+  def _Increment(self, namespace, requests):
+    """Internal function for incrementing from MemcacheIncrementRequests.
 
     Args:
       namespace: A string containing the namespace for the request,
         if any. Pass an empty string if there is no namespace.
-      request: A MemcacheIncrementRequest instance.
+      requests: A list of MemcacheIncrementRequest instances.
 
     Returns:
-      An integer or long if the offset was successful, None on error.
+      A list with an integer or long for each successful offset, and None
+      for each one which failed.
     """
-    if not request.delta():
-      return None
-
-    cas_id = 0
-
-    key = self._GetKey(namespace, request.key())
-    value = self._memcache.get(key)
-    if value is None:
-      if not request.has_initial_value():
-        return None
-      flags, cas_id, stored_value = (
-        TYPE_INT, cas_id, str(request.initial_value()))
-    else:
-      flags, cas_id, stored_value = cPickle.loads(value)
+    keys = [self._GetKey(namespace, request.key()) for request in requests]
+    commands = []
+    for key, request in zip(keys, requests):
+      if request.direction() == MemcacheIncrementRequest.DECREMENT:
+        commands.append(('decr', key, request.delta()))
+      else:
+        commands.append(('incr', key, request.delta()))
+
+    new_values = self._memcache.incr_multi(commands)
+
+    # Missing keys which have an initial value are created with it.
+    missing = [index for index, new_value in enumerate(new_values)
+               if new_value == 'NOT_FOUND' and
+               requests[index].has_initial_value()]
+    initial_items = []
+    for index in missing:
+      request = requests[index]
+      initial_value = self._ApplyDelta(request.initial_value(), request)
+      flags = TYPE_INT
+      if request.has_initial_flags():
+        flags = request.initial_flags()
+      initial_items.append(('add', keys[index], flags, str(initial_value),
+                            0, 0))
+      new_values[index] = initial_value
+
+    replies = self._memcache.store_multi(initial_items)
+    created = {}
+    retries = []
+    for index, reply in zip(missing, replies):
+      if reply == 'STORED':
+        created.setdefault(keys[index], index)
+      elif reply == 'NOT_STORED':
+        # Something else created the key first, so apply the delta to it.
+        retries.append(index)
+      else:
+        new_values[index] = None
 
-    if flags == TYPE_INT:
-      new_value = int(stored_value)
-    elif flags == TYPE_LONG:
-      new_value = long(stored_value)
+    # Changes that ran before an earlier item in this batch created their
+    # key are applied again, in order, now that the key exists.
+    for index, new_value in enumerate(new_values):
+      if (new_value == 'NOT_FOUND' and
+          created.get(keys[index], index) < index):
+        retries.append(index)
 
-    if request.direction() == MemcacheIncrementRequest.INCREMENT:
-      new_value += request.delta()
-    elif request.direction() == MemcacheIncrementRequest.DECREMENT:
-      new_value -= request.delta()
+    if retries:
+      retries.sort()
+      retry_values = self._memcache.incr_multi(
+        [commands[index] for index in retries])
+      for index, new_value in zip(retries, retry_values):
+        new_values[index] = new_value
 
-    new_stored_value = cPickle.dumps([flags, cas_id + 1, str(new_value)])
-    try:
-      self._memcache.cas(key, new_stored_value)
-    except Exception, e:
-      logging.error(str(e))
-      return None
+    return [new_value if isinstance(new_value, (int, long)) else None
+            for new_value in new_values]
 
-    return new_value
+  def _ApplyDelta(self, value, request):
+    """ Applies an increment request's delta to a value.
+
+    Decrements stop at zero and increments wrap around at 64 bits, matching
+    memcached.
+
+    Args:
+      value: An integer or long, the starting value.
+      request: A MemcacheIncrementRequest.
+    Returns:
+      The new value.
+    """
+    if request.direction() == MemcacheIncrementRequest.DECREMENT:
+      return max(value - request.delta(), 0)
+    return (value + request.delta()) % MAX_INCREMENT_VALUE
 
   def _Dynamic_Increment(self, request, response):
     """Implementation of increment for memcache.
@@ -217,7 +567,7 @@ class MemcacheService(apiproxy_stub.APIProxyStub):
       request: A MemcacheIncrementRequest protocol buffer.
       response: A MemcacheIncrementResponse protocol buffer.
     """
-    new_value = self._Increment(request.name_space(), request)
+    new_value = self._Increment(request.name_space(), [request])[0]
     if new_value is None:
       raise apiproxy_errors.ApplicationError(
         memcache_service_pb.MemcacheServiceError.UNSPECIFIED_ERROR)
@@ -231,9 +581,8 @@ class MemcacheService(apiproxy_stub.APIProxyStub):
       request: A MemcacheBatchIncrementRequest protocol buffer.
       response: A MemcacheBatchIncrementResponse protocol buffer.
     """
-    namespace = request.name_space()
-    for request_item in request.item_list():
-      new_value = self._Increment(namespace, request_item)
+    new_values = self._Increment(request.name_space(), request.item_list())
+    for new_value in new_values:
       item = response.add_item()
       if new_value is None:
         item.set_increment_status(MemcacheIncrementResponse.NOT_CHANGED)
@@ -301,8 +650,14 @@ class MemcacheService(apiproxy_stub.APIProxyStub):
       namespace: The namespace as provided by the application.
       key: The key as provided by the application.
     Returns:
-      A base64 string __{appname}__{namespace}__{key}
+      A base64 string __{appname}__{namespace}__{key}, or a hash of it if
+      that would be too long for memcached.
     """
     appname = os.environ['APPNAME']
     internal_key = appname + "__" + namespace + "__" + key
-    return base64.b64encode(internal_key) 
+    encoded_key = base64.b64encode(internal_key)
+    if len(encoded_key) > memcache.SERVER_MAX_KEY_LENGTH:
+      # Long keys are hashed to fit in memcached. Base64 never contains the
+      # prefix, so hashed keys cannot collide with encoded ones.
+      return '_' + hashlib.sha256(internal_key).hexdigest()
+    return encoded_key 
@@ -0,0 +1,102 @@
+""" Simulates resizing the memcache tier to compare key placement schemes.
+
+For each resize, a cache is warmed with every key on the old set of servers
+and then read on the new set. A read hits only if the key still maps to the
+server that holds it, so the hit rate right after a resize is the fraction
+of keys that did not move. Modulo hashing (what memcache.Client uses) is
+compared with the consistent hash ring used by memcache_distributed.
+
+Usage: python benchmark_hash_ring.py [num_keys]
+"""
+import binascii
+import os
+import sys
+import time
+
+appserver = "{0}/../../../../..".format(os.path.dirname(__file__))
+sys.path.append(appserver)
+from google.appengine.api.memcache import memcache_distributed
+
+# The number of distinct keys stored in the simulated cache.
+DEFAULT_NUM_KEYS = 100000
+
+# The (servers before, servers after) resizes to simulate.
+RESIZES = [(1, 2), (2, 3), (3, 4), (4, 5), (8, 9), (9, 8), (5, 4), (4, 3)]
+
+
+class ModuloPlacement(object):
+  """ Places keys the way memcache.Client does: crc32 modulo servers. """
+
+  def __init__(self, nodes):
+    self.nodes = nodes
+
+  def get_node(self, key):
+    serverhash = ((binascii.crc32(key) & 0xffffffff) >> 16) & 0x7fff
+    return self.nodes[(serverhash or 1) % len(self.nodes)]
+
+
+def server_names(count):
+  """ Returns the names of the first count servers. """
+  return ['10.0.0.{0}:11211'.format(index) for index in range(count)]
+
+
+def simulate(placement_class, keys, before, after):
+  """ Warms a cache on one set of servers and reads it from another.
+
+  Args:
+    placement_class: A class whose instances map keys to servers.
+    keys: A list of strs, the keys to store.
+    before: An int, the number of servers the cache was warmed with.
+    after: An int, the number of servers the cache is read with.
+  Returns:
+    A tuple of (hit rate, load on the busiest server after the resize
+    relative to an even split).
+  """
+  old_placement = placement_class(server_names(before))
+  new_placement = placement_class(server_names(after))
+
+  cache = {}
+  for key in keys:
+    cache.setdefault(old_placement.get_node(key), set()).add(key)
+
+  hits = 0
+  load = {}
+  for key in keys:
+    node = new_placement.get_node(key)
+    load[node] = load.get(node, 0) + 1
+    if key in cache.get(node, ()):
+      hits += 1
+
+  imbalance = max(load.values()) / (float(len(keys)) / after)
+  return float(hits) / len(keys), imbalance
+
+
+def main():
+  num_keys = DEFAULT_NUM_KEYS
+  if len(sys.argv) > 1:
+    num_keys = int(sys.argv[1])
+  keys = ['app__ns__key{0}'.format(index) for index in range(num_keys)]
+
+  print 'Keys: {0}'.format(num_keys)
+  print '{0:>8} {1:>8} {2:>10} {3:>10} {4:>10} {5:>10} {6:>10}'.format(
+    'before', 'after', 'ideal hit', 'mod hit', 'ring hit', 'mod skew',
+    'ring skew')
+  for before, after in RESIZES:
+    # At best, only the keys that must change owner miss.
+    ideal = float(min(before, after)) / max(before, after)
+    mod_hits, mod_skew = simulate(ModuloPlacement, keys, before, after)
+    ring_hits, ring_skew = simulate(memcache_distributed.HashRing, keys,
+                                       before, after)
+    print ('{0:>8} {1:>8} {2:>10.3f} {3:>10.3f} {4:>10.3f} {5:>10.3f} '
+           '{6:>10.3f}').format(before, after, ideal, mod_hits, ring_hits,
+                                mod_skew, ring_skew)
+
+  ring = memcache_distributed.HashRing(server_names(8))
+  start = time.time()
+  for key in keys:
+    ring.get_node(key)
+  print 'Ring lookups: {0:.0f}/s'.format(num_keys / (time.time() - start))
+
+
+if __name__ == "__main__":
+  main()
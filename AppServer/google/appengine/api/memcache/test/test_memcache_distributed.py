@@ -0,0 +1,208 @@
+import os
+import sys
+import unittest
+from flexmock import flexmock
+
+appserver = "{0}/../../../../..".format(os.path.dirname(__file__))
+sys.path.append(appserver)
+from google.appengine.api.memcache import memcache_distributed
+from google.appengine.api.memcache import memcache_service_pb
+
+HashRing = memcache_distributed.HashRing
+MemcacheService = memcache_distributed.MemcacheService
+MemcacheSetRequest = memcache_service_pb.MemcacheSetRequest
+MemcacheSetResponse = memcache_service_pb.MemcacheSetResponse
+
+
+class TestMemcacheDistributed(unittest.TestCase):
+  def setUp(self):
+    os.environ['APPNAME'] = 'app'
+    flexmock(MemcacheService).should_receive('setupMemcacheClient')
+    self.service = MemcacheService()
+    self.client = flexmock(name='client')
+    self.service._memcache = self.client
+
+  def test_get_fetches_all_keys_at_once(self):
+    key1 = self.service._GetKey('', 'a')
+    key2 = self.service._GetKey('', 'b')
+    self.client.should_receive('gets_multi').once().\
+      and_return({key1: (3, '1', 7L)})
+
+    request = memcache_service_pb.MemcacheGetRequest()
+    request.add_key('a')
+    request.add_key('b')
+    request.set_for_cas(True)
+    response = memcache_service_pb.MemcacheGetResponse()
+    self.service._Dynamic_Get(request, response)
+
+    self.assertEquals(1, response.item_size())
+    item = response.item(0)
+    self.assertEquals(('a', '1', 3, 7L),
+                      (item.key(), item.value(), item.flags(), item.cas_id()))
+
+  def test_set_uses_one_batch(self):
+    key = self.service._GetKey('', 'a')
+    self.client.should_receive('store_multi').once().\
+      with_args([('set', key, 0, 'x', 0, 0), ('cas', key, 0, 'y', 0, 5)]).\
+      and_return(['STORED', 'EXISTS'])
+
+    request = MemcacheSetRequest()
+    item = request.add_item()
+    item.set_key('a')
+    item.set_value('x')
+    item.set_flags(0)
+    item = request.add_item()
+    item.set_key('a')
+    item.set_value('y')
+    item.set_flags(0)
+    item.set_set_policy(MemcacheSetRequest.CAS)
+    item.set_for_cas(True)
+    item.set_cas_id(5)
+    # A CAS without an id is never sent.
+    item = request.add_item()
+    item.set_key('a')
+    item.set_value('z')
+    item.set_flags(0)
+    item.set_set_policy(MemcacheSetRequest.CAS)
+    response = MemcacheSetResponse()
+    self.service._Dynamic_Set(request, response)
+
+    self.assertEquals([MemcacheSetResponse.STORED, MemcacheSetResponse.EXISTS,
+                       MemcacheSetResponse.NOT_STORED],
+                      response.set_status_list())
+
+  def test_delete(self):
+    self.client.should_receive('delete_each').once().\
+      and_return(['DELETED', 'NOT_FOUND'])
+
+    request = memcache_service_pb.MemcacheDeleteRequest()
+    request.add_item().set_key('a')
+    request.add_item().set_key('b')
+    response = memcache_service_pb.MemcacheDeleteResponse()
+    self.service._Dynamic_Delete(request, response)
+
+    self.assertEquals([memcache_service_pb.MemcacheDeleteResponse.DELETED,
+                       memcache_service_pb.MemcacheDeleteResponse.NOT_FOUND],
+                      response.delete_status_list())
+
+  def test_batch_increment(self):
+    key = self.service._GetKey('', 'a')
+    self.client.should_receive('incr_multi').\
+      with_args([('incr', key, 5), ('decr', key, 2), ('incr', key, 1)]).\
+      and_return(['NOT_FOUND', 'NOT_FOUND', 'NOT_FOUND'])
+    self.client.should_receive('store_multi').\
+      with_args([('add', key, memcache_distributed.TYPE_INT, '15', 0, 0)]).\
+      and_return(['STORED'])
+    # Items after the one that created the key are applied again.
+    self.client.should_receive('incr_multi').\
+      with_args([('decr', key, 2), ('incr', key, 1)]).and_return([13L, 14L])
+
+    request = memcache_service_pb.MemcacheBatchIncrementRequest()
+    for delta, direction in [(5, 1), (2, 2), (1, 1)]:
+      item = request.add_item()
+      item.set_key('a')
+      item.set_delta(delta)
+      item.set_direction(direction)
+    request.item(0).set_initial_value(10)
+    response = memcache_service_pb.MemcacheBatchIncrementResponse()
+    self.service._Dynamic_BatchIncrement(request, response)
+
+    self.assertEquals([15, 13, 14],
+                      [item.new_value() for item in response.item_list()])
+
+  def test_long_keys_are_hashed(self):
+    key = self.service._GetKey('', 'a' * 300)
+    self.assertTrue(len(key) <= memcache_distributed.memcache.\
+      SERVER_MAX_KEY_LENGTH)
+    self.assertNotEquals(key, self.service._GetKey('', 'b' * 300))
+    self.assertEquals(self.service._GetKey('', 'a'),
+                      memcache_distributed.base64.b64encode('app____a'))
+
+  def test_servers_are_reloaded_when_file_changes(self):
+    flexmock(os.path).should_receive('exists').and_return(True)
+    flexmock(os.path).should_receive('getmtime').and_return(2)
+    self.service._memcache_file_mtime = 1
+    self.service._servers = ['1.1.1.1:11211']
+    self.service._last_update = 0
+    self.service._gettime = lambda: MemcacheService.UPDATE_WINDOW
+    self.client.servers_version = 0
+    flexmock(self.service).should_receive('_ReadServers').once().\
+      and_return(['1.1.1.1:11211', '2.2.2.2:11211'])
+    self.client.should_receive('set_servers').once().\
+      with_args(['1.1.1.1:11211', '2.2.2.2:11211'], 1)
+
+    self.service._MaybeUpdateServers()
+    self.assertEquals(1, self.service._servers_version)
+
+  def test_servers_are_not_checked_within_update_window(self):
+    self.service._last_update = 0
+    self.service._gettime = lambda: MemcacheService.UPDATE_WINDOW - 1
+    self.client.servers_version = 0
+    flexmock(os.path).should_receive('getmtime').never()
+    self.client.should_receive('set_servers').never()
+
+    self.service._MaybeUpdateServers()
+
+
+class TestMemcacheClient(unittest.TestCase):
+  def setUp(self):
+    self.client = memcache_distributed.MemcacheClient(['localhost:11211'])
+    self.server = flexmock(name='server')
+    self.server.should_receive('send_cmd')
+    self.server.should_receive('send_cmds')
+
+  def set_replies(self, lines):
+    replies = iter(lines)
+    self.server.should_receive('readline').replace_with(lambda: next(replies))
+
+  def test_gets_stops_at_an_error(self):
+    flexmock(self.client).should_receive('_group_by_server').\
+      and_return([(self.server, [(0, 'a'), (1, 'b')])])
+    self.set_replies(['CLIENT_ERROR bad command line format'])
+    self.server.should_receive('close_socket').once()
+    self.assertEquals({}, self.client.gets_multi(['a', 'b']))
+
+  def test_store_stops_when_replies_are_out_of_step(self):
+    flexmock(self.client).should_receive('_group_by_server').\
+      and_return([(self.server, [(0, 'a'), (1, 'b'), (2, 'c')])])
+    self.set_replies(['SERVER_ERROR out of memory storing object',
+                      'CLIENT_ERROR bad data chunk', 'ERROR'])
+    self.server.should_receive('close_socket').once()
+    items = [('set', key, 0, 'x', 0, 0) for key in ['a', 'b', 'c']]
+    self.assertEquals(['SERVER_ERROR out of memory storing object', None,
+                       None], self.client.store_multi(items))
+
+  def test_long_keys_are_not_sent(self):
+    flexmock(self.client).should_receive('_get_server').\
+      replace_with(lambda key: (self.server, key))
+    long_key = 'a' * (memcache_distributed.memcache.SERVER_MAX_KEY_LENGTH + 1)
+    self.assertEquals([(self.server, [(1, 'b')])],
+                      self.client._group_by_server([long_key, 'b']))
+
+
+class TestHashRing(unittest.TestCase):
+  def test_adding_a_node_moves_few_keys(self):
+    nodes = ['10.0.0.{0}:11211'.format(index) for index in range(4)]
+    before = HashRing(nodes)
+    after = HashRing(nodes + ['10.0.0.4:11211'])
+    keys = ['key{0}'.format(index) for index in range(5000)]
+
+    moved = [key for key in keys if before.get_node(key) != after.get_node(key)]
+    # Only keys taken over by the new node should move.
+    self.assertTrue(all(after.get_node(key) == '10.0.0.4:11211'
+                        for key in moved))
+    self.assertTrue(len(moved) < len(keys) * 0.3)
+
+  def test_failover_order_covers_every_node(self):
+    nodes = ['a', 'b', 'c']
+    ring = HashRing(nodes)
+    failover = list(ring.get_nodes('key'))
+    self.assertEquals(sorted(nodes), sorted(failover))
+    self.assertEquals(ring.get_node('key'), failover[0])
+
+  def test_empty_ring(self):
+    self.assertEquals(None, HashRing([]).get_node('key'))
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -429,7 +429,8 @@ class TaskQueueServiceStub(apiproxy_stub.APIProxyStub):
       1,
       False,
       KEY_LOCATION,
-      CERT_LOCATION)
+      CERT_LOCATION,
+      keep_alive=True)
 
     if not api_response or not api_response.has_response():
       raise apiproxy_errors.ApplicationError(
@@ -0,0 +1,234 @@
+import os
+import sys
+import threading
+import time
+import unittest
+from flexmock import flexmock
+
+appserver = "{0}/../../../..".format(os.path.dirname(__file__))
+sys.path.append(appserver)
+from google.appengine.api import apiproxy_stub_map
+from google.appengine.api import datastore_distributed
+from google.appengine.api.taskqueue import taskqueue_service_pb
+from google.appengine.datastore import datastore_pb
+from google.appengine.datastore import entity_pb
+
+# The number of request threads to run against the stub at once.
+NUM_THREADS = 20
+
+# How long each fake datastore RPC takes, in seconds.
+RPC_LATENCY = 0.05
+
+
+class TestDatastoreDistributed(unittest.TestCase):
+  def setUp(self):
+    self.stub = datastore_distributed.DatastoreDistributed('app_id',
+      'localhost:8888')
+
+  def run_threads(self, target):
+    threads = [threading.Thread(target=target, args=(index,))
+               for index in range(NUM_THREADS)]
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join()
+
+  def test_concurrent_rpcs_overlap(self):
+    state = {'in_flight': 0, 'max_in_flight': 0}
+    state_lock = threading.Lock()
+
+    def fake_remote_send(request, response, method):
+      with state_lock:
+        state['in_flight'] += 1
+        state['max_in_flight'] = max(state['max_in_flight'],
+                                     state['in_flight'])
+      time.sleep(RPC_LATENCY)
+      with state_lock:
+        state['in_flight'] -= 1
+
+    flexmock(self.stub).should_receive('_RemoteSend').\
+      replace_with(fake_remote_send)
+
+    def get(index):
+      self.stub._Dynamic_Get(datastore_pb.GetRequest(),
+                             datastore_pb.GetResponse())
+
+    start = time.time()
+    self.run_threads(get)
+    elapsed = time.time() - start
+
+    self.assertTrue(state['max_in_flight'] > 1)
+    self.assertTrue(elapsed < NUM_THREADS * RPC_LATENCY)
+
+  def test_concurrent_transactions_keep_their_own_actions(self):
+    def fake_remote_send(request, response, method):
+      if method == 'BeginTransaction':
+        response.set_handle(int(threading.current_thread().name))
+        response.set_app('app_id')
+      time.sleep(RPC_LATENCY)
+
+    flexmock(self.stub).should_receive('_RemoteSend').\
+      replace_with(fake_remote_send)
+
+    added = []
+    added_lock = threading.Lock()
+    def fake_make_sync_call(service, call, request, response):
+      with added_lock:
+        added.append(request.url())
+
+    flexmock(apiproxy_stub_map).should_receive('MakeSyncCall').\
+      replace_with(fake_make_sync_call)
+
+    def run_transaction(index):
+      threading.current_thread().name = str(index)
+      transaction = datastore_pb.Transaction()
+      self.stub._Dynamic_BeginTransaction(
+        datastore_pb.BeginTransactionRequest(), transaction)
+
+      bulk_request = taskqueue_service_pb.TaskQueueBulkAddRequest()
+      add_request = bulk_request.add_add_request()
+      add_request.set_queue_name('default')
+      add_request.set_task_name('task{0}'.format(index))
+      add_request.set_eta_usec(0)
+      add_request.set_url('/task/{0}'.format(index))
+      add_request.mutable_transaction().CopyFrom(transaction)
+      self.stub._Dynamic_AddActions(bulk_request, None)
+
+      self.stub._Dynamic_Commit(transaction, datastore_pb.CommitResponse())
+
+    self.run_threads(run_transaction)
+
+    self.assertEquals(sorted('/task/{0}'.format(index)
+                             for index in range(NUM_THREADS)),
+                      sorted(added))
+
+  def test_rollback_drops_actions(self):
+    flexmock(self.stub).should_receive('_RemoteSend').and_return()
+    flexmock(apiproxy_stub_map).should_receive('MakeSyncCall').never()
+
+    transaction = datastore_pb.Transaction()
+    transaction.set_handle(1)
+    transaction.set_app('app_id')
+    self.stub._Dynamic_BeginTransaction(
+      datastore_pb.BeginTransactionRequest(), transaction)
+
+    bulk_request = taskqueue_service_pb.TaskQueueBulkAddRequest()
+    add_request = bulk_request.add_add_request()
+    add_request.set_queue_name('default')
+    add_request.set_task_name('task')
+    add_request.set_eta_usec(0)
+    add_request.set_url('/task')
+    add_request.mutable_transaction().CopyFrom(transaction)
+    self.stub._Dynamic_AddActions(bulk_request, None)
+
+    self.stub._Dynamic_Rollback(transaction, None)
+    self.stub._Dynamic_Commit(transaction, datastore_pb.CommitResponse())
+
+  def serve_entities(self, num_entities):
+    """ Makes the stub answer queries from a list of entities, resuming from
+    compiled cursors like the datastore server.
+
+    Returns:
+      A tuple of the entities and a list that records the (cursor position,
+      offset, limit) of each query sent.
+    """
+    entities = []
+    for index in range(num_entities):
+      entity = entity_pb.EntityProto()
+      element = entity.mutable_key().mutable_path().add_element()
+      element.set_type('kind')
+      element.set_id(index + 1)
+      entities.append(entity)
+
+    batches = []
+    def fake_remote_send(request, response, method):
+      start = 0
+      if request.has_compiled_cursor():
+        start = int(request.compiled_cursor().position(0).start_key())
+      batches.append((start, request.offset(), request.limit()))
+      fetched = entities[start:start + request.offset() + request.limit()]
+      response.set_skipped_results(min(request.offset(), len(fetched)))
+      for entity in fetched[request.offset():]:
+        response.add_result().CopyFrom(entity)
+      response.set_more_results(
+        len(fetched) == request.offset() + request.limit())
+      if fetched:
+        response.mutable_compiled_cursor().add_position().set_start_key(
+          str(start + len(fetched)))
+
+    flexmock(self.stub).should_receive('_RemoteSend').\
+      replace_with(fake_remote_send)
+    return entities, batches
+
+  def test_query_results_are_fetched_in_batches(self):
+    entities, batches = self.serve_entities(5)
+
+    query = datastore_pb.Query()
+    query.set_app('app_id')
+    query.set_kind('kind')
+    query.set_offset(1)
+    query.set_limit(3)
+    query.set_count(2)
+    query_result = datastore_pb.QueryResult()
+    self.stub._Dynamic_RunQuery(query, query_result)
+    self.assertEquals(1, query_result.skipped_results())
+    self.assertEquals(entities[1:3], query_result.result_list())
+    self.assertTrue(query_result.more_results())
+
+    next_request = datastore_pb.NextRequest()
+    next_request.mutable_cursor().CopyFrom(query_result.cursor())
+    next_request.set_count(2)
+    next_result = datastore_pb.QueryResult()
+    self.stub._Dynamic_Next(next_request, next_result)
+    # The query limit leaves room for only one more result.
+    self.assertEquals(entities[3:4], next_result.result_list())
+    self.assertFalse(next_result.more_results())
+    self.assertEquals([(0, 1, 2), (3, 0, 1)], batches)
+
+  def test_count_skips_without_returning_results(self):
+    _, batches = self.serve_entities(5)
+
+    query = datastore_pb.Query()
+    query.set_app('app_id')
+    query.set_kind('kind')
+    query.set_offset(4)
+    query.set_limit(0)
+    query_result = datastore_pb.QueryResult()
+    self.stub._Dynamic_RunQuery(query, query_result)
+    self.assertEquals(4, query_result.skipped_results())
+    self.assertEquals(0, query_result.result_size())
+    self.assertEquals([(0, 0, 4)], batches)
+
+    # Once nothing is left to skip, the cursor is done.
+    next_request = datastore_pb.NextRequest()
+    next_request.mutable_cursor().CopyFrom(query_result.cursor())
+    next_result = datastore_pb.QueryResult()
+    self.stub._Dynamic_Next(next_request, next_result)
+    self.assertFalse(next_result.more_results())
+    self.assertEquals(1, len(batches))
+
+  def test_ordered_ancestor_query_is_fetched_at_once(self):
+    sent = []
+    def fake_remote_send(request, response, method):
+      sent.append(request.limit())
+
+    flexmock(self.stub).should_receive('_RemoteSend').\
+      replace_with(fake_remote_send)
+
+    query = datastore_pb.Query()
+    query.set_app('app_id')
+    query.set_kind('kind')
+    query.mutable_ancestor().set_app('app_id')
+    element = query.mutable_ancestor().mutable_path().add_element()
+    element.set_type('kind')
+    element.set_id(1)
+    order = query.add_order()
+    order.set_property('__key__')
+    order.set_direction(datastore_pb.Query_Order.ASCENDING)
+    self.stub._Dynamic_RunQuery(query, datastore_pb.QueryResult())
+    # The query is sent as is, without a batch limit.
+    self.assertEquals([0], sent)
+
+
+if __name__ == "__main__":
+  unittest.main()
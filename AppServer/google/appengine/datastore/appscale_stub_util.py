@@ -609,9 +609,8 @@ class QueryCursor(object):
 
     Args:
       query: A Query PB.
-      db_cursor: An MySQL cursor returning n+2 columns. The first 2 columns
-        must be the path of the entity and the entity itself, while the
-        remaining columns must be the sort columns for the query.
+      results: A list of EntityProtos fetched for the query, including the
+        ones skipped by its offset.
     """
     self.__results = results
     self.__query = query
@@ -697,22 +696,22 @@ class QueryCursor(object):
     position.set_start_key(str(start_key))
     position.set_start_inclusive(False)
 
-  def PopulateQueryResult(self, count, offset, result):
+  def PopulateQueryResult(self, offset, more_results, result):
     """Populates a QueryResult PB with results from the cursor.
 
+    The compiled cursor points at the last fetched result, even when every
+    result was skipped, so that the next batch can resume from it.
+
     Args:
-      count: The number of results to retrieve.
       offset: The number of results to skip.
+      more_results: A bool, whether results beyond these may exist.
       result: out: A query_result PB.
     """
-    result.set_skipped_results(min(count, offset))
-    result_list = result.result_list()
-    if self.__results:
-      result_list.extend(self.__results)
-    else:
-      result_list = []
+    skipped = min(offset, len(self.__results))
+    result.set_skipped_results(skipped)
+    result.result_list().extend(self.__results[skipped:])
     result.set_keys_only(self.__query.keys_only())
-    result.set_more_results(offset < count)
+    result.set_more_results(more_results)
     if self.__results:
       self._EncodeCompiledCursor(result.mutable_compiled_cursor())
 
@@ -81,6 +81,7 @@ THREAD_SAFE_SERVICES = frozenset((
     'app_identity_service',
     'capability_service',
     'channel',
+    'datastore_v3',
     'logservice',
     'mail',
     'memcache',
@@ -21,7 +21,10 @@
 import array
 import httplib
 import re
+import socket
 import struct
+import threading
+import time
 
 __all__ = ['ProtocolMessage', 'Encoder', 'Decoder',
            'ExtendableProtocolMessage',
@@ -32,6 +35,153 @@ __all__ = ['ProtocolMessage', 'Encoder', 'Decoder',
 
 URL_RE = re.compile('^(https?)://([^/]+)(/.*)$')
 
+# AppScale: The number of seconds an idle keep-alive connection stays in the
+# pool before it is closed instead of being reused.
+CONNECTION_IDLE_TIMEOUT = 30
+
+# AppScale: The maximum number of idle connections kept per destination.
+MAX_IDLE_CONNECTIONS = 16
+
+# AppScale: Errors raised when a pooled connection was closed by the remote
+# side while it sat idle. The request is retried once on a new connection,
+# but only if the error came before the server could have handled it.
+STALE_CONNECTION_ERRORS = (socket.error, httplib.CannotSendRequest)
+
+
+def _IsStaleConnectionError(error, written):
+  """ Tells whether a request failed because the server had closed the idle
+  connection it was sent on, so that it can safely be sent again.
+
+  A request that has been written may have been handled, so it is only
+  retried if the server closed the connection without any reply. Timeouts
+  are never retried, since the server may still be handling the request.
+
+  Args:
+    error: The exception the request raised.
+    written: True if the whole request had been written.
+  Returns:
+    True if the request can be sent again on a new connection.
+  """
+  if isinstance(error, socket.timeout):
+    return False
+  if written:
+    return isinstance(error, httplib.BadStatusLine)
+  return isinstance(error, STALE_CONNECTION_ERRORS)
+
+
+class ConnectionPool(object):
+  """ A thread-safe pool of keep-alive HTTP(S) connections.
+
+  Connections are keyed by (server, secure, keyfile, certfile) so that a
+  connection set up with one client certificate is never handed out for
+  another destination.
+  """
+
+  def __init__(self, idle_timeout=CONNECTION_IDLE_TIMEOUT,
+               max_idle=MAX_IDLE_CONNECTIONS):
+    """ Constructor.
+
+    Args:
+      idle_timeout: The number of seconds a connection can sit unused before
+        it is evicted.
+      max_idle: The maximum number of idle connections kept per key.
+    """
+    self.idle_timeout = idle_timeout
+    self.max_idle = max_idle
+    self.__lock = threading.Lock()
+    # Maps a connection key to a list of (connection, last used time) tuples,
+    # most recently used last.
+    self.__idle = {}
+
+  def acquire(self, server, secure=0, keyfile=None, certfile=None):
+    """ Takes an idle connection from the pool, or opens a new one.
+
+    Args:
+      server: A str, the host:port to connect to.
+      secure: Whether to use HTTPS.
+      keyfile: The client key file for HTTPS, or None.
+      certfile: The client certificate file for HTTPS, or None.
+    Returns:
+      A tuple of (connection, reused), where reused is True if the
+      connection came from the pool.
+    """
+    key = (server, bool(secure), keyfile, certfile)
+    now = time.time()
+    expired = []
+    conn = None
+    with self.__lock:
+      idle = self.__idle.get(key, [])
+      while idle:
+        candidate, last_used = idle.pop()
+        if now - last_used > self.idle_timeout:
+          expired.append(candidate)
+        else:
+          conn = candidate
+          break
+      # Anything older than an expired connection is expired as well.
+      if conn is not None:
+        while idle and now - idle[0][1] > self.idle_timeout:
+          expired.append(idle.pop(0)[0])
+
+    for stale in expired:
+      stale.close()
+
+    if conn is not None:
+      return conn, True
+    return self.connect(server, secure, keyfile, certfile), False
+
+  def release(self, conn, server, secure=0, keyfile=None, certfile=None):
+    """ Returns a connection whose response has been fully read.
+
+    Args:
+      conn: The httplib connection to return.
+      server: A str, the host:port the connection is to.
+      secure: Whether the connection uses HTTPS.
+      keyfile: The client key file for HTTPS, or None.
+      certfile: The client certificate file for HTTPS, or None.
+    """
+    key = (server, bool(secure), keyfile, certfile)
+    evicted = None
+    with self.__lock:
+      idle = self.__idle.setdefault(key, [])
+      idle.append((conn, time.time()))
+      if len(idle) > self.max_idle:
+        evicted = idle.pop(0)[0]
+
+    if evicted is not None:
+      evicted.close()
+
+  def clear(self):
+    """ Closes every idle connection in the pool. """
+    with self.__lock:
+      idle, self.__idle = self.__idle, {}
+
+    for connections in idle.values():
+      for conn, _ in connections:
+        conn.close()
+
+  def connect(self, server, secure, keyfile, certfile):
+    """ Opens a new connection.
+
+    Args:
+      server: A str, the host:port to connect to.
+      secure: Whether to use HTTPS.
+      keyfile: The client key file for HTTPS, or None.
+      certfile: The client certificate file for HTTPS, or None.
+    Returns:
+      An httplib.HTTPConnection or httplib.HTTPSConnection.
+    """
+    if secure:
+      if keyfile and certfile:
+        return httplib.HTTPSConnection(server, key_file=keyfile,
+                                       cert_file=certfile)
+      return httplib.HTTPSConnection(server)
+    return httplib.HTTPConnection(server)
+
+
+# AppScale: The process-wide pool used by sendCommand when keep_alive is set.
+connection_pool = ConnectionPool()
+
 class ProtocolMessage:
 
 
@@ -107,28 +257,48 @@ class ProtocolMessage:
     self.__init__(contents=contents_)
 
   def sendCommand(self, server, url, response, follow_redirects=1,
-                  secure=0, keyfile=None, certfile=None):
+                  secure=0, keyfile=None, certfile=None, keep_alive=False):
     data = self.Encode()
-    if secure:
-      if keyfile and certfile:
-        conn = httplib.HTTPSConnection(server, key_file=keyfile,
-                                       cert_file=certfile)
-      else:
-        conn = httplib.HTTPSConnection(server)
-    else:
-      conn = httplib.HTTPConnection(server)
-    conn.putrequest("POST", '/')
-    conn.putheader("Content-Length", "%d" %len(data))
     # AppScale:
-    # We add additional headers for the datastore server to reason 
-    # about what request it is getting.
-    pb_type = str(self.__class__).split('.')[-1]
-    conn.putheader("ProtocolBufferType" , pb_type)
-    conn.putheader("AppData", url) # app id, user email, nick name, auth domain
+    # With keep_alive set, connections are taken from and returned to the
+    # shared connection pool instead of being opened for every call.
+    if keep_alive:
+      conn, reused = connection_pool.acquire(server, secure, keyfile,
+                                             certfile)
+    else:
+      conn = connection_pool.connect(server, secure, keyfile, certfile)
+      reused = False
+
+    written = False
+    try:
+      self._sendRequest(conn, url, data)
+      written = True
+      resp = conn.getresponse()
+    except Exception, error:
+      conn.close()
+      if not reused or not _IsStaleConnectionError(error, written):
+        raise
+      # The server closed the idle connection; retry once on a new one.
+      conn = connection_pool.connect(server, secure, keyfile, certfile)
+      try:
+        self._sendRequest(conn, url, data)
+        resp = conn.getresponse()
+      except Exception:
+        conn.close()
+        raise
+
+    # The body must be consumed before the connection can be reused.
+    try:
+      body = resp.read()
+    except Exception:
+      conn.close()
+      raise
+
+    if keep_alive and not resp.will_close:
+      connection_pool.release(conn, server, secure, keyfile, certfile)
+    else:
+      conn.close()
 
-    conn.endheaders()
-    conn.send(data)
-    resp = conn.getresponse()
     if follow_redirects > 0 and resp.status == 302:
       m = URL_RE.match(resp.getheader('Location'))
       if m:
@@ -137,13 +307,27 @@ class ProtocolMessage:
                                 follow_redirects=follow_redirects - 1,
                                 secure=(protocol == 'https'),
                                 keyfile=keyfile,
-                                certfile=certfile)
+                                certfile=certfile,
+                                keep_alive=keep_alive)
     if resp.status != 200:
       raise ProtocolBufferReturnError(resp.status)
     if response is not None:
-      response.ParseFromString(resp.read())
+      response.ParseFromString(body)
     return response
 
+  def _sendRequest(self, conn, url, data):
+    conn.putrequest("POST", '/')
+    conn.putheader("Content-Length", "%d" %len(data))
+    # AppScale:
+    # We add additional headers for the datastore server to reason 
+    # about what request it is getting.
+    pb_type = str(self.__class__).split('.')[-1]
+    conn.putheader("ProtocolBufferType" , pb_type)
+    conn.putheader("AppData", url) # app id, user email, nick name, auth domain
+
+    conn.endheaders()
+    conn.send(data)
+
   def sendSecureCommand(self, server, keyfile, certfile, url, response,
                         follow_redirects=1):
     return self.sendCommand(server, url, response,
@@ -0,0 +1,209 @@
+import httplib
+import os
+import socket
+import sys
+import time
+import unittest
+from flexmock import flexmock
+
+appserver = "{0}/../../../..".format(os.path.dirname(__file__))
+sys.path.append(appserver)
+from google.net.proto import ProtocolBuffer
+
+ConnectionPool = ProtocolBuffer.ConnectionPool
+
+
+class FakeResponse():
+  def __init__(self, body='', error=None):
+    self.status = 200
+    self.will_close = False
+    self.body = body
+    self.error = error
+
+  def read(self):
+    if self.error is not None:
+      raise self.error
+    return self.body
+
+
+class FakeConnection():
+  """ Records what is sent on it, and fails where it is told to. """
+
+  def __init__(self, send_error=None, response_error=None, response=None):
+    self.send_error = send_error
+    self.response_error = response_error
+    self.response = response or FakeResponse('body')
+    self.sent = []
+    self.closed = False
+
+  def putrequest(self, method, url):
+    pass
+
+  def putheader(self, header, value):
+    pass
+
+  def endheaders(self):
+    pass
+
+  def send(self, data):
+    if self.send_error is not None:
+      raise self.send_error
+    self.sent.append(data)
+
+  def getresponse(self):
+    if self.response_error is not None:
+      raise self.response_error
+    return self.response
+
+  def close(self):
+    self.closed = True
+
+
+class FakeMessage(ProtocolBuffer.ProtocolMessage):
+  def __init__(self):
+    self.parsed = None
+
+  def Encode(self):
+    return 'request'
+
+  def ParseFromString(self, s):
+    self.parsed = s
+
+
+class TestConnectionPool(unittest.TestCase):
+  def setUp(self):
+    self.now = [1000.0]
+    flexmock(time).should_receive('time').replace_with(lambda: self.now[0])
+    self.pool = ConnectionPool(idle_timeout=30, max_idle=2)
+    self.opened = []
+    def connect(server, secure, keyfile, certfile):
+      conn = FakeConnection()
+      self.opened.append(conn)
+      return conn
+    flexmock(self.pool).should_receive('connect').replace_with(connect)
+
+  def test_acquire_reuses_released_connections(self):
+    conn, reused = self.pool.acquire('host:8888')
+    self.assertFalse(reused)
+    self.pool.release(conn, 'host:8888')
+    self.assertEquals((conn, True), self.pool.acquire('host:8888'))
+
+    # Connections are not shared between destinations.
+    self.pool.release(conn, 'host:8888')
+    other, reused = self.pool.acquire('host:8888', secure=1)
+    self.assertFalse(reused)
+    self.assertNotEquals(conn, other)
+
+  def test_acquire_evicts_idle_connections(self):
+    old, _ = self.pool.acquire('host:8888')
+    self.pool.release(old, 'host:8888')
+    self.now[0] += 20
+    recent, _ = self.pool.acquire('host:8888')
+    self.assertEquals(old, recent)
+    other, _ = self.pool.acquire('host:8888')
+    self.pool.release(other, 'host:8888')
+    self.now[0] += 20
+    self.pool.release(recent, 'host:8888')
+
+    # The connection that sat idle too long is closed, not handed out.
+    self.now[0] += 15
+    self.assertEquals((recent, True), self.pool.acquire('host:8888'))
+    self.assertTrue(other.closed)
+    conn, reused = self.pool.acquire('host:8888')
+    self.assertFalse(reused)
+    self.assertFalse(recent.closed)
+
+  def test_release_keeps_at_most_max_idle(self):
+    connections = [self.pool.acquire('host:8888')[0] for _ in range(3)]
+    for conn in connections:
+      self.pool.release(conn, 'host:8888')
+    self.assertTrue(connections[0].closed)
+    self.assertFalse(connections[1].closed)
+    self.assertFalse(connections[2].closed)
+
+  def test_clear_closes_idle_connections(self):
+    first = self.pool.acquire('host:8888')[0]
+    second = self.pool.acquire('other:8888')[0]
+    self.pool.release(first, 'host:8888')
+    self.pool.release(second, 'other:8888')
+    self.pool.clear()
+    self.assertTrue(first.closed)
+    self.assertTrue(second.closed)
+    self.assertFalse(self.pool.acquire('host:8888')[1])
+
+
+class TestSendCommand(unittest.TestCase):
+  def setUp(self):
+    self.pool = ConnectionPool()
+    self.saved_pool = ProtocolBuffer.connection_pool
+    ProtocolBuffer.connection_pool = self.pool
+    self.fresh = FakeConnection()
+    self.request = FakeMessage()
+    self.response = FakeMessage()
+
+  def tearDown(self):
+    ProtocolBuffer.connection_pool = self.saved_pool
+
+  def send_on(self, pooled):
+    flexmock(self.pool).should_receive('acquire').and_return((pooled, True))
+    return self.request.sendCommand('host:8888', 'app', self.response,
+                                    keep_alive=True)
+
+  def test_retries_once_on_a_closed_idle_connection(self):
+    flexmock(self.pool).should_receive('connect').and_return(self.fresh).\
+      once()
+    flexmock(self.pool).should_receive('release').with_args(self.fresh,
+      'host:8888', 0, None, None).once()
+    stale = FakeConnection(send_error=socket.error(32, 'Broken pipe'))
+    self.assertTrue(self.send_on(stale) is self.response)
+    self.assertTrue(stale.closed)
+    self.assertEquals(['request'], self.fresh.sent)
+    self.assertEquals('body', self.response.parsed)
+
+  def test_retries_when_closed_without_a_reply(self):
+    flexmock(self.pool).should_receive('connect').and_return(self.fresh).\
+      once()
+    stale = FakeConnection(response_error=httplib.BadStatusLine(''))
+    self.assertTrue(self.send_on(stale) is self.response)
+    self.assertEquals(['request'], self.fresh.sent)
+
+  def test_only_retries_once(self):
+    broken = FakeConnection(send_error=socket.error(32, 'Broken pipe'))
+    flexmock(self.pool).should_receive('connect').and_return(broken).once()
+    stale = FakeConnection(send_error=socket.error(32, 'Broken pipe'))
+    self.assertRaises(socket.error, self.send_on, stale)
+    self.assertTrue(broken.closed)
+
+  def test_does_not_retry_new_connections(self):
+    broken = FakeConnection(send_error=socket.error(32, 'Broken pipe'))
+    flexmock(self.pool).should_receive('connect').and_return(broken).once()
+    self.assertRaises(socket.error, self.request.sendCommand, 'host:8888',
+                      'app', self.response, keep_alive=True)
+
+  def test_does_not_retry_after_a_timeout(self):
+    flexmock(self.pool).should_receive('connect').never()
+    pooled = FakeConnection(response_error=socket.timeout('timed out'))
+    self.assertRaises(socket.timeout, self.send_on, pooled)
+    self.assertTrue(pooled.closed)
+
+    # Not even one that happens while the request is being written.
+    pooled = FakeConnection(send_error=socket.timeout('timed out'))
+    self.assertRaises(socket.timeout, self.send_on, pooled)
+
+  def test_does_not_retry_after_the_request_was_written(self):
+    flexmock(self.pool).should_receive('connect').never()
+    pooled = FakeConnection(response_error=socket.error(104, 'Reset'))
+    self.assertRaises(socket.error, self.send_on, pooled)
+
+  def test_does_not_retry_a_partial_response(self):
+    flexmock(self.pool).should_receive('connect').never()
+    flexmock(self.pool).should_receive('release').never()
+    pooled = FakeConnection(response=FakeResponse(
+      error=httplib.IncompleteRead('par')))
+    self.assertRaises(httplib.IncompleteRead, self.send_on, pooled)
+    self.assertTrue(pooled.closed)
+    self.assertEquals(None, self.response.parsed)
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -371,6 +371,7 @@ installcassandra()
     cd cassandra
     chmod -v +x bin/cassandra
     cp -v ${APPSCALE_HOME}/AppDB/cassandra/templates/cassandra.in.sh ${APPSCALE_HOME}/AppDB/cassandra/cassandra/bin
+    cp -v ${APPSCALE_HOME}/AppDB/cassandra/templates/datastore_consistency.json /etc/appscale
     mkdir -p /var/lib/cassandra
     # TODO only grant the cassandra user access
     chmod 777 /var/lib/cassandra